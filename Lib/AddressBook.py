@@ -0,0 +1,408 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the classes AddressEntry and AddressBook and the functions which parse addr and addrv2 messages
+#   Peers tell each other about other nodes with addr messages (see https://en.bitcoin.it/wiki/Protocol_documentation#addr) and addrv2 messages (BIP155, see https://github.com/bitcoin/bips/blob/master/bip-0155.mediawiki).
+#   AddressBook keeps the addresses learnt this way along with how each has worked for us, so after a restart the best known peers are connected to without a DNS lookup:
+#       1. Each address has the time it was last announced, its services, the number of successful and failed connections, the last attempt and the connect latency
+#       2. The number of addresses is capped at maxEntries, when full a few entries are sampled at random and the worst is evicted, so one flood of addr messages can not push out the peers which work
+#       3. best ranks the addresses, ones which have connected recently and quickly first, ones which keep failing last
+#       4. The book is saved as fixed size binary records, RECORD below, so loading tens of thousands of addresses is one read and one struct.iter_unpack
+#   Only IPv4 and IPv6 addresses are kept as those are the networks we can connect to, Tor, I2P and CJDNS addresses in addrv2 messages are counted and skipped.
+
+
+## Imports ##
+# os          - https://docs.python.org/3/library/os.html
+# time        - https://docs.python.org/3/library/time.html
+# random      - https://docs.python.org/3/library/random.html
+# struct      - https://docs.python.org/3/library/struct.html
+# ipaddress   - https://docs.python.org/3/library/ipaddress.html
+# Transaction - readVarInt and createVarInt are used for the counts in the messages, see Lib/Transaction.py
+# CaptureLog  - packIP and unpackIP convert between address strings and the 16 byte form, see Lib/CaptureLog.py
+import os
+import time
+import random
+import struct
+import ipaddress
+from Lib.Transaction import readVarInt,createVarInt
+from Lib.CaptureLog import packIP,unpackIP,IPV4_PREFIX
+
+# ADDR_ENTRY - One address in an addr message, time (4), services (8), IPv6 or IPv4 mapped address (16), port (2, big endian)
+ADDR_ENTRY = struct.Struct('<IQ16s')
+# MAX_ADDRESSES - The most addresses allowed in one addr or addrv2 message
+MAX_ADDRESSES = 1000
+# NETWORK_IPV4/NETWORK_IPV6 - The BIP155 network IDs of the networks which are kept, with the address length of each
+NETWORK_IPV4 = 1
+NETWORK_IPV6 = 2
+NETWORK_LENGTHS = {1:4,2:16,3:10,4:32,5:32,6:16}
+# RECORD - An address saved to disk, 48 bytes, little endian
+#   ip (16s)          - IPv6 address, IPv4 addresses are IPv4 mapped
+#   port (H)          - The port
+#   services (Q)      - The services the node announced
+#   lastSeen (I)      - The newest time the address was announced to us
+#   lastSuccess (I)   - When we last connected successfully, 0 for never
+#   lastAttempt (I)   - When we last tried to connect, 0 for never
+#   successes (H)     - Successful connections, capped at 65535
+#   failures (H)      - Failed connections since the last success, capped at 65535
+#   latency (f)       - Average connect latency in seconds, 0 if never connected
+RECORD = struct.Struct('<16sHQIIIHHf2x')
+# FILE_MAGIC - The first bytes of a saved address book, followed by the record count
+FILE_MAGIC = b'ADDRBK01'
+
+def isRoutable(packed):
+    '''
+    Description:
+        Checks an address is one which could be a node on the internet, not private, loopback or reserved.
+    Inputs:
+        packed - 16 byte address
+    Returns:
+        routable - Boolean
+    '''
+    if packed[0:12] == IPV4_PREFIX:
+        return ipaddress.IPv4Address(packed[12:16]).is_global
+    return ipaddress.IPv6Address(packed).is_global
+
+def createAddrPayload(addresses):
+    '''
+    Description:
+        Creates an addr message payload, the reverse of parseAddrPayload.
+    Inputs:
+        addresses - List of (timestamp, services, address, port), the address either 16 bytes or a string
+    Returns:
+        payload - Byte string of the addr payload
+    Raises:
+        ValueError - If there are more than MAX_ADDRESSES addresses
+    '''
+    if len(addresses) > MAX_ADDRESSES:
+        raise ValueError(f'{len(addresses)} addresses do not fit in one addr message, the limit is {MAX_ADDRESSES}')
+    return createVarInt(len(addresses)) + b''.join(ADDR_ENTRY.pack(timestamp,services,ip if isinstance(ip,bytes) else packIP(ip)) + port.to_bytes(2,'big')
+                                                   for timestamp,services,ip,port in addresses)
+
+def parseAddrPayload(payload):
+    '''
+    Description:
+        Parses an addr message payload.
+    Inputs:
+        payload - Byte string or memoryview of the payload
+    Returns:
+        addresses - List of (timestamp, services, 16 byte address, port)
+    Raises:
+        ValueError - If the payload is truncated or has more than MAX_ADDRESSES addresses
+    '''
+    try:
+        count,position = readVarInt(payload,0)
+    except IndexError:
+        raise ValueError('addr payload is empty')
+    if count > MAX_ADDRESSES:
+        raise ValueError(f'addr message has {count} addresses, the limit is {MAX_ADDRESSES}')
+    if len(payload) - position < 30*count:
+        raise ValueError(f'addr message of {len(payload)} Bytes is too short for {count} addresses')
+    addresses = []
+    for i in range(count):
+        timestamp,services,packed = ADDR_ENTRY.unpack_from(payload,position)
+        port = int.from_bytes(payload[position+28:position+30],'big')
+        addresses.append((timestamp,services,packed,port))
+        position += 30
+    return addresses
+
+def parseAddrV2Payload(payload):
+    '''
+    Description:
+        Parses an addrv2 message payload (BIP155). Each address is time (4), services (varint), network ID (1), address length (varint), address, port (2, big endian).
+    Inputs:
+        payload - Byte string or memoryview of the payload
+    Returns:
+        addresses - List of (timestamp, services, 16 byte address, port) of the IPv4 and IPv6 addresses
+        skipped   - The number of addresses on other networks (Tor, I2P, CJDNS) which were skipped
+    Raises:
+        ValueError - If the payload is truncated, has more than MAX_ADDRESSES addresses or an address has the wrong length for its network
+    '''
+    addresses = []
+    skipped   = 0
+    try:
+        count,position = readVarInt(payload,0)
+        if count > MAX_ADDRESSES:
+            raise ValueError(f'addrv2 message has {count} addresses, the limit is {MAX_ADDRESSES}')
+        for i in range(count):
+            timestamp = struct.unpack_from('<I',payload,position)[0]
+            services,position = readVarInt(payload,position+4)
+            network = payload[position]
+            length,position = readVarInt(payload,position+1)
+            if length > 512 or (network in NETWORK_LENGTHS and length != NETWORK_LENGTHS[network]):
+                raise ValueError(f'address of {length} Bytes is not valid for network {network}')
+            address = bytes(payload[position:position+length])
+            position += length
+            if position + 2 > len(payload):
+                raise IndexError
+            port = int.from_bytes(payload[position:position+2],'big')
+            position += 2
+            if network == NETWORK_IPV4:
+                addresses.append((timestamp,services,IPV4_PREFIX + address,port))
+            elif network == NETWORK_IPV6:
+                addresses.append((timestamp,services,address,port))
+            else:
+                skipped += 1
+    except (IndexError,struct.error):
+        raise ValueError('addrv2 payload is truncated')
+    return addresses,skipped
+
+class AddressEntry:
+    # __slots__ - No per object dictionary, there can be tens of thousands of entries
+    __slots__ = ('services','lastSeen','lastSuccess','lastAttempt','successes','failures','latency')
+
+    def __init__(self,services=0,lastSeen=0,lastSuccess=0,lastAttempt=0,successes=0,failures=0,latency=0.0):
+        '''
+        Description:
+            initiliaser method for the class, what is known about one address, see RECORD for the fields
+        '''
+        self.services    = services
+        self.lastSeen    = lastSeen
+        self.lastSuccess = lastSuccess
+        self.lastAttempt = lastAttempt
+        self.successes   = successes
+        self.failures    = failures
+        self.latency     = latency
+
+    def score(self,now):
+        '''
+        Description:
+            How good the address is to connect to, higher is better.
+            An address which has worked recently scores highest, lower latency scores higher, each failure since the last success halves the score.
+            An address never tried scores on how recently it was announced.
+        Inputs:
+            now - The current time.time()
+        Returns:
+            score - Float
+        '''
+        if self.successes:
+            # Between 1 and 2 for a success in the last day, falling with age, divided by the latency
+            recency = 1 + 1/(1 + max(0,now-self.lastSuccess)/86400)
+            score   = recency/(0.05 + self.latency)
+        else:
+            # Never connected, below any address which has worked
+            score = 1/(1 + max(0,now-self.lastSeen)/3600)
+        return score/(2**min(self.failures,30))
+
+class AddressBook:
+    def __init__(self,maxEntries=20000,allowPrivate=False,evictionSample=8):
+        '''
+        Description:
+            initiliaser method for the class
+        Inputs:
+            maxEntries     - The most addresses kept, each takes roughly 250 bytes of memory
+            allowPrivate   - Boolean, set true to keep private and loopback addresses, e.g. to test against Lib/MockPeer.py
+            evictionSample - The number of random entries compared when one has to be evicted
+        '''
+        self.maxEntries     = maxEntries
+        self.allowPrivate   = allowPrivate
+        self.evictionSample = evictionSample
+        # entries - Dictionary of (16 byte address, port) -> AddressEntry
+        # keys    - List of the keys in entries so random ones can be sampled, keyIndex gives the position of each key in it
+        self.entries  = {}
+        self.keys     = []
+        self.keyIndex = {}
+        self.counters = {'received':0,'added':0,'updated':0,'rejected':0,'evicted':0,'skippedNetworks':0}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def key(self,ip,port):
+        # Addresses are kept in the 16 byte form, a string address is packed
+        return (ip if isinstance(ip,bytes) else packIP(ip),port)
+
+    def add(self,packed,port,services=0,timestamp=None):
+        '''
+        Description:
+            Adds an address, or updates lastSeen and services if it is already known.
+        Inputs:
+            packed    - 16 byte address, or an address string
+            port      - The port
+            services  - The services the node announced
+            timestamp - When the node was last seen according to the announcement, defaults to now
+        Returns:
+            added - Boolean, True if the address is new
+        '''
+        now = int(time.time())
+        key = self.key(packed,port)
+        self.counters['received'] += 1
+        if port == 0 or key[0] == bytes(16) or (not self.allowPrivate and not isRoutable(key[0])):
+            self.counters['rejected'] += 1
+            return False
+        # A time in the future is not believed, treat it as 5 days ago like Bitcoin Core
+        if timestamp is None:
+            timestamp = now
+        elif timestamp > now + 600:
+            timestamp = now - 5*86400
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry.lastSeen = max(entry.lastSeen,timestamp)
+            entry.services = services or entry.services
+            self.counters['updated'] += 1
+            return False
+        if len(self.entries) >= self.maxEntries:
+            self.evict(now)
+        self.insert(key,AddressEntry(services,timestamp))
+        self.counters['added'] += 1
+        return True
+
+    def addMany(self,addresses):
+        '''
+        Description:
+            Adds the addresses from parseAddrPayload or parseAddrV2Payload.
+        Inputs:
+            addresses - List of (timestamp, services, 16 byte address, port)
+        Returns:
+            added - The number of new addresses
+        '''
+        return sum(self.add(packed,port,services,timestamp) for timestamp,services,packed,port in addresses)
+
+    def insert(self,key,entry):
+        self.entries[key]  = entry
+        self.keyIndex[key] = len(self.keys)
+        self.keys.append(key)
+
+    def remove(self,key):
+        '''
+        Description:
+            Removes an address, the last key is moved into its place in self.keys so the removal does not shift the list.
+        Inputs:
+            key - (16 byte address, port)
+        '''
+        del self.entries[key]
+        index = self.keyIndex.pop(key)
+        last  = self.keys.pop()
+        if last != key:
+            self.keys[index]    = last
+            self.keyIndex[last] = index
+
+    def evict(self,now):
+        '''
+        Description:
+            Removes the lowest scoring of evictionSample random entries.
+        Inputs:
+            now - The current time.time()
+        '''
+        sample = random.sample(self.keys,min(self.evictionSample,len(self.keys)))
+        worst  = min(sample,key=lambda key: self.entries[key].score(now))
+        self.remove(worst)
+        self.counters['evicted'] += 1
+
+    def recordAttempt(self,ip,port):
+        '''
+        Description:
+            Records that a connection to an address is being tried, the address is added if it is not known.
+        Inputs:
+            ip   - Address string or 16 byte address
+            port - The port
+        Returns:
+            entry - The AddressEntry, None if the address is not kept (e.g. a private address)
+        '''
+        key   = self.key(ip,port)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.add(key[0],port)
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+        entry.lastAttempt = int(time.time())
+        return entry
+
+    def recordSuccess(self,ip,port,latency):
+        '''
+        Description:
+            Records a successful connection, clears the failures and updates the average latency.
+        Inputs:
+            ip      - Address string or 16 byte address
+            port    - The port
+            latency - Seconds the connection (and handshake if measured) took
+        '''
+        entry = self.recordAttempt(ip,port)
+        if entry is None:
+            return
+        entry.latency     = latency if not entry.successes else entry.latency + 0.3*(latency - entry.latency)
+        entry.successes   = min(entry.successes+1,0xffff)
+        entry.failures    = 0
+        entry.lastSuccess = entry.lastAttempt
+
+    def recordFailure(self,ip,port):
+        '''
+        Description:
+            Records a failed connection.
+        Inputs:
+            ip   - Address string or 16 byte address
+            port - The port
+        '''
+        entry = self.recordAttempt(ip,port)
+        if entry is not None:
+            entry.failures = min(entry.failures+1,0xffff)
+
+    def best(self,count,exclude=()):
+        '''
+        Description:
+            The best addresses to connect to, highest score first.
+        Inputs:
+            count   - The number of addresses wanted
+            exclude - Collection of (ip,port) to leave out, e.g. the peers already connected
+        Returns:
+            addresses - List of (ip,port) with ip as a string
+        '''
+        now = time.time()
+        exclude = {self.key(ip,port) for ip,port in exclude}
+        ranked  = sorted((key for key in self.entries if key not in exclude),key=lambda key: self.entries[key].score(now),reverse=True)
+        return [(unpackIP(packed),port) for packed,port in ranked[:count]]
+
+    def stats(self):
+        '''
+        Description:
+            Counts of the addresses held and of what has happened to the addresses received.
+        Returns:
+            stats - Dictionary
+        '''
+        ipv4 = sum(1 for packed,port in self.entries if packed[0:12] == IPV4_PREFIX)
+        stats = {'addresses':len(self.entries),'ipv4':ipv4,'ipv6':len(self.entries)-ipv4,
+                 'connected':sum(1 for entry in self.entries.values() if entry.successes),
+                 'failing':sum(1 for entry in self.entries.values() if entry.failures)}
+        stats.update(self.counters)
+        return stats
+
+    def save(self,path):
+        '''
+        Description:
+            Saves the address book as fixed size records, written to a temporary file and renamed so a crash never leaves half a file.
+        Inputs:
+            path - The file to write
+        '''
+        temporary = path + '.tmp'
+        with open(temporary,'wb') as bookFile:
+            bookFile.write(FILE_MAGIC + struct.pack('<I',len(self.entries)))
+            bookFile.write(b''.join(RECORD.pack(packed,port,entry.services,entry.lastSeen,entry.lastSuccess,entry.lastAttempt,entry.successes,entry.failures,entry.latency)
+                                    for (packed,port),entry in self.entries.items()))
+        os.replace(temporary,path)
+
+    @classmethod
+    def load(cls,path,**bookArgs):
+        '''
+        Description:
+            Loads an address book saved with save.
+        Inputs:
+            path     - The file written by save
+            bookArgs - Passed on to AddressBook, e.g. maxEntries
+        Returns:
+            book - AddressBook instance
+        Raises:
+            ValueError - If the file is not a saved address book
+        '''
+        book = cls(**bookArgs)
+        with open(path,'rb') as bookFile:
+            data = bookFile.read()
+        if data[0:8] != FILE_MAGIC:
+            raise ValueError(f'{path} is not a saved address book')
+        count = struct.unpack_from('<I',data,8)[0]
+        if len(data) != 12 + RECORD.size*count:
+            raise ValueError(f'{path} is truncated')
+        for packed,port,*fields in RECORD.iter_unpack(memoryview(data)[12:]):
+            if len(book.entries) >= book.maxEntries:
+                break
+            book.insert((packed,port),AddressEntry(*fields))
+        return book
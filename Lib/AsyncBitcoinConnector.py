@@ -0,0 +1,407 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the classes AsyncPeer and AsyncBitcoinConnector
+#   BitcoinConnector holds one blocking socket to one peer, to track the network properly we want to be connected to many peers at once from one process.
+#   AsyncBitcoinConnector uses asyncio so that hundreds of peers can share a single event loop (and a single core), each peer is an AsyncPeer.
+#   Each AsyncPeer performs the version/verack handshake without blocking, splits its stream into messages with a MessageFramer and dispatches them.
+#   The handshake is run by the same Handshake state machine as BitcoinConnector.connectToPeer, see Lib/Handshake.py
+#   The message creating and parsing is not duplicated, each peer holds a BitcoinConnector (created with connect=False) and calls its createMessage, createVersionCommand and parse functions.
+
+
+## Imports ##
+# asyncio          - https://docs.python.org/3/library/asyncio.html
+# socket           - https://docs.python.org/3/library/socket.html
+# BitcoinConnector - Class developed for this project, used here for creating and parsing messages
+# MessageFramer    - Class developed for this project which splits the stream of bytes from a peer into complete messages
+# MessageHeader    - Class developed for this project which packs and checks message headers, shared by every peer
+# InventoryCache   - Class developed for this project which remembers the inventory hashes already requested
+# GetDataScheduler - Class developed for this project which decides which peer each announced item is requested from
+# Dispatcher       - Class developed for this project which passes messages to subscribed consumers, shared by every peer
+# Handshake        - Class developed for this project which runs the version/verack handshake and parses the version of the peer
+import asyncio
+import socket
+from Lib.BitcoinConnector import BitcoinConnector
+from Lib.MessageFramer import MessageFramer
+from Lib.MessageHeader import MessageHeaderCodec,FramingError
+from Lib.InventoryCache import InventoryCache
+from Lib.GetDataScheduler import GetDataScheduler
+from Lib.Dispatcher import Dispatcher,NOT_PARSED
+from Lib.Handshake import Handshake,HANDSHAKE_COMMANDS
+
+class AsyncPeer(asyncio.BufferedProtocol):
+    def __init__(self,manager,ip,port):
+        '''
+        Description:
+            initiliaser method for the class, one instance is created per peer connection by AsyncBitcoinConnector.connectPeer
+        Inputs:
+            manager - The AsyncBitcoinConnector instance which owns this peer, messages are dispatched to its messageHandler
+            ip      - The ip address of the peer node
+            port    - The port of the peer node
+        '''
+        self.manager   = manager
+        self.peerIP    = ip
+        self.peerPort  = port
+        # connector - Used for creating and parsing messages only, it does not open a socket as the asyncio transport owns the connection
+        self.connector = BitcoinConnector(protocolVersion=manager.protocolVersion,magic=manager.magic,peerPort=port,ip=ip,connect=False)
+        # The manager scheduler decides what is requested from which peer using the shared cache, so the connector does not filter the inv itself
+        self.connector.inventoryCache = None
+        self.connector.codec = manager.codec
+        self.connector.mempool = manager.mempool
+        self.connector.metrics = manager.metrics
+        self.connector.output  = manager.output
+        self.connector.watcher = manager.watcher
+        self.connector.filterIndex = manager.filterIndex
+        self.connector.exporter    = manager.exporter
+        self.connector.dispatcher = manager.dispatcher
+        # label - The peer label used in the metrics
+        self.label = f'{ip}:{port}'
+        # framer - Holds the receive buffer for this peer, asyncio reads straight into it through get_buffer
+        self.framer    = MessageFramer(magic=manager.magic,bufferSize=manager.bufferSize,codec=manager.codec)
+        self.transport = None
+        # The handshake progress, the parsed version of the peer and the features it sent are kept in self.connector.handshake
+        self.connector.handshake = Handshake(self.connector.createVersionCommand(),manager.protocolVersion,feeRate=manager.feeRate)
+        # handshake - Future which is set once the handshake completes, or set with an exception if the connection is lost first
+        self.handshake = asyncio.get_running_loop().create_future()
+        # closed - Future which is set when the connection is lost
+        self.closed    = asyncio.get_running_loop().create_future()
+
+    def connection_made(self,transport):
+        '''
+        Description:
+            Called by asyncio once the TCP connection is open. Starts the handshake by sending the version message.
+        Inputs:
+            transport - The asyncio transport for this connection
+        '''
+        self.transport = transport
+        for command,payload in self.connector.handshake.start():
+            self.sendMessage(command,payload)
+
+    def get_buffer(self,sizehint):
+        '''
+        Description:
+            Called by asyncio when data is ready to be read, returns the free space in the framer buffer so the data is written straight into it.
+        Inputs:
+            sizehint - Hint from asyncio on how many bytes are available, not needed as the framer sizes the buffer from the message header
+        Returns:
+            freeSpace - Writable memoryview of the free space in the framer buffer
+        '''
+        return self.framer.getBuffer()
+
+    def buffer_updated(self,nbytes):
+        '''
+        Description:
+            Called by asyncio after nbytes have been written into the buffer from get_buffer. Every complete message now in the buffer is handled.
+        Inputs:
+            nbytes - The number of bytes written into the buffer
+        '''
+        self.framer.bufferUpdated(nbytes)
+        captureLog = self.manager.captureLog
+        metrics    = self.connector.metrics
+        try:
+            for command,payload in self.framer.frames():
+                if captureLog is not None:
+                    captureLog.append(command,payload,(self.peerIP,self.peerPort))
+                if metrics is not None:
+                    metrics.received(command,self.label,len(payload))
+                self.handleMessage(command,payload)
+        except FramingError as e:
+            # The stream can not be split into messages any more, drop the peer
+            print(f'Warning: Closing peer {self.peerIP}:{self.peerPort}, {e}')
+            self.close()
+
+    def connection_lost(self,exc):
+        '''
+        Description:
+            Called by asyncio when the connection is closed, either by us, by the peer or because of an error.
+        Inputs:
+            exc - The exception which caused the connection to close, None if it was closed normally
+        '''
+        if not self.handshake.done():
+            self.handshake.set_exception(ConnectionError(f'Connection to {self.peerIP}:{self.peerPort} lost during handshake'))
+            # Stop asyncio logging an unretrieved exception if nobody is waiting on the handshake any more
+            self.handshake.exception()
+        if not self.closed.done():
+            self.closed.set_result(exc)
+        self.manager.peerClosed(self)
+
+    def handleMessage(self,command,payload):
+        '''
+        Description:
+            Handles a single complete message received from the peer.
+            The handshake messages (version, verack and the feature messages, see Lib/Handshake.py) and ping are handled here, every other message is passed to the manager message handler.
+            A peer which sends a bad version is closed.
+        Inputs:
+            command - String, the command name of the message e.g. "inv"
+            payload - memoryview of the message payload, only valid until this function returns
+        '''
+        handshake = self.connector.handshake
+        if command in HANDSHAKE_COMMANDS:
+            # The version of the peer is answered with our verack, the feature messages are recorded
+            try:
+                replies = handshake.receive(command,payload)
+            except ValueError as e:
+                print(f'Warning: Closing peer {self.peerIP}:{self.peerPort}, bad {command} message, {e}')
+                self.close()
+                return
+            for reply,replyPayload in replies:
+                self.sendMessage(reply,replyPayload)
+        elif command == 'ping':
+            # A pong must echo the 8 byte nonce from the ping or the peer will eventually disconnect us
+            self.sendMessage('pong',bytes(payload))
+        else:
+            self.manager.messageHandler(self,command,payload)
+        # The handshake is complete once we have both the version and verack from the peer
+        if handshake.complete and not self.handshake.done():
+            self.handshake.set_result(True)
+
+    def sendMessage(self,commandName,payload):
+        '''
+        Description:
+            Creates a message with createMessage and queues it on the transport, this never blocks.
+        Inputs:
+            commandName (string)  - The name of the command, for example "getdata".
+            payload (byte string) - The payload in bytes to send.
+        '''
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(self.connector.createMessage(commandName,payload))
+            if self.connector.metrics is not None:
+                self.connector.metrics.sent(commandName,self.label,payload)
+
+    def close(self):
+        '''
+        Description:
+            Closes the connection to the peer.
+        '''
+        if self.transport is not None:
+            self.transport.close()
+
+class AsyncBitcoinConnector:
+    def __init__(self,protocolVersion=70016,magic=b'\xf9\xbe\xb4\xd9',lookUpDomain='seed.bitcoin.sipa.be',peerPort=8333,handshakeTimeout=10,maxConcurrentConnects=100,bufferSize=1<<16,messageHandler=None,displayInv=False,displayTx=False,displayBlock=False,maxInFlightPerPeer=5000,requestTimeout=60,checksumMode='always',mempool=None,captureLog=None,metrics=None,output=None,watcher=None,filterIndex=None,exporter=None,feeRate=None):
+        '''
+        Description:
+            initiliaser method for the class
+        Inputs:
+            protocolVersion       - The version of bitcoin the nodes you are connecting to are using, 70016 is needed to negotiate wtxidrelay and sendaddrv2
+            magic                 - The magic value for given network, default to mainnet
+            lookUpDomain          - Domain used to get peer IP addresses when none are passed to run
+            peerPort              - Default port for the peer nodes
+            handshakeTimeout      - Seconds to wait for the version/verack handshake with a peer before giving up on it
+            maxConcurrentConnects - The maximum number of connections which are opened at the same time, stops hundreds of connects being started at once
+            bufferSize            - The starting size of the receive buffer for each peer, kept small as there are many peers and it grows when needed
+            messageHandler        - Function called as messageHandler(peer,command,payload) for every message after the handshake, defaults to defaultHandler
+            displayInv            - When True the defaultHandler will display inv messages
+            displayTx             - When True the defaultHandler will display tx messages
+            displayBlock          - When True the defaultHandler will display block messages
+            maxInFlightPerPeer    - The maximum number of getdata items requested from one peer and not yet received
+            requestTimeout        - Seconds to wait for a requested item before it is requested from another peer which announced it
+            checksumMode          - 'always', 'sample' or 'lazy', how received payload checksums are checked, see Lib/MessageHeader.py
+            mempool               - Optional Mempool (see Lib/Mempool.py) shared by every peer, received transactions are added and block transactions removed
+            captureLog            - Optional CaptureLog (see Lib/CaptureLog.py), every message received from every peer is written to it
+            metrics               - Optional ConnectorMetrics (see Lib/Metrics.py) shared by every peer, or use metrics.attach(connector) before connecting
+            output                - Optional OutputSink (see Lib/OutputSink.py) shared by every peer, the displayed messages are written to it instead of printed
+            watcher               - Optional ScriptWatcher (see Lib/ScriptClassifier.py) shared by every peer, the outputs of parsed transactions and blocks are checked against its watch-list
+            filterIndex           - Optional FilterIndex (see Lib/BlockFilter.py) shared by every peer, the BIP158 filter of every parsed block is stored in it
+            exporter              - Optional ColumnarExporter (see Lib/ColumnarExport.py) shared by every peer, parsed transactions and blocks are added to its columns
+            feeRate               - Optional satoshis per 1000 virtual bytes sent to every peer in a feefilter, transactions paying less are not announced
+        '''
+        self.protocolVersion       = protocolVersion
+        self.magic                 = magic
+        self.lookUpDomain          = lookUpDomain
+        self.peerPort              = peerPort
+        self.handshakeTimeout      = handshakeTimeout
+        self.maxConcurrentConnects = maxConcurrentConnects
+        self.bufferSize            = bufferSize
+        self.messageHandler        = messageHandler if messageHandler else self.defaultHandler
+        self.displayInv            = displayInv
+        self.displayTx             = displayTx
+        self.displayBlock          = displayBlock
+        # codec - One header codec shared by every peer so the command caches are only built once
+        self.codec = MessageHeaderCodec(magic=magic,checksumMode=checksumMode)
+        self.mempool    = mempool
+        self.captureLog = captureLog
+        self.output     = output
+        self.watcher    = watcher
+        self.filterIndex = filterIndex
+        self.exporter    = exporter
+        self.feeRate     = feeRate
+        # dispatcher - Every peer shares it, after the defaultHandler has handled a message it is passed to the consumers subscribed with subscribe
+        self.dispatcher = Dispatcher()
+        self.metrics    = None
+        if metrics is not None:
+            metrics.attach(self)
+        # peers - Dictionary of the connected peers where the key is (ip,port) and the value is the AsyncPeer
+        self.peers = {}
+        # inventoryCache - Shared by every peer so a tx or block announced by several peers is only downloaded once
+        self.inventoryCache = InventoryCache()
+        # scheduler - Assigns announced items to peers, limits the requests in flight per peer and re-sends requests which time out, see Lib/GetDataScheduler.py
+        self.scheduler = GetDataScheduler(maxInFlightPerPeer=maxInFlightPerPeer,timeout=requestTimeout,inventoryCache=self.inventoryCache)
+
+    async def getIPAddresses(self):
+        '''
+        Description:
+            Performs a non blocking lookup of the lookUpDomain and returns every IPv4 and IPv6 address it resolves to, not only the first one.
+        Returns:
+            ips - List of the ip addresses
+        '''
+        try:
+            records = await asyncio.get_running_loop().getaddrinfo(self.lookUpDomain,self.peerPort,family=socket.AF_UNSPEC,type=socket.SOCK_STREAM)
+        except socket.gaierror:
+            print(f'Could not obtain node IP addresses from the look up domain {self.lookUpDomain}')
+            return []
+        # Remove duplicates but keep the order from the DNS response
+        return list(dict.fromkeys(record[4][0] for record in records))
+
+    async def connectPeer(self,ip,port=None):
+        '''
+        Description:
+            Opens a connection to a peer and waits for the handshake to complete.
+        Inputs:
+            ip   - The ip address of the peer node
+            port - The port of the peer node, defaults to self.peerPort
+        Returns:
+            peer - The AsyncPeer once the handshake is complete, None if the connection or handshake failed
+        '''
+        port = port if port else self.peerPort
+        loop = asyncio.get_running_loop()
+        peer = None
+        try:
+            # Both the TCP connect and the handshake must finish inside handshakeTimeout
+            async with asyncio.timeout(self.handshakeTimeout):
+                transport,peer = await loop.create_connection(lambda: AsyncPeer(self,ip,port),ip,port)
+                await peer.handshake
+        except (OSError,asyncio.TimeoutError) as e:
+            print(f'Could not connect to peer at IP {ip} on port {port}: {e!r}')
+            if peer:
+                peer.close()
+            return None
+        self.peers[(ip,port)] = peer
+        print(f'Handshake complete with node {ip} on port {port}, {peer.connector.handshake!r}, {len(self.peers)} peers connected')
+        return peer
+
+    async def connectPeers(self,ips):
+        '''
+        Description:
+            Connects to many peers at once, at most maxConcurrentConnects connections are being opened at any one time.
+        Inputs:
+            ips - List of ip addresses, or (ip,port) tuples, of the peer nodes
+        Returns:
+            peers - List of the AsyncPeers which completed the handshake
+        '''
+        semaphore = asyncio.Semaphore(self.maxConcurrentConnects)
+        async def connectLimited(address):
+            ip,port = address if isinstance(address,tuple) else (address,None)
+            async with semaphore:
+                return await self.connectPeer(ip,port)
+        results = await asyncio.gather(*(connectLimited(address) for address in ips))
+        return [peer for peer in results if peer]
+
+    def peerClosed(self,peer):
+        '''
+        Description:
+            Called by an AsyncPeer when its connection is lost, removes it from the connected peers.
+        Inputs:
+            peer - The AsyncPeer which was closed
+        '''
+        # Anything requested from the peer is requested from another peer which announced it
+        self.scheduler.peerDisconnected(peer)
+        self.sendRequests()
+        if self.peers.get((peer.peerIP,peer.peerPort)) is peer:
+            del self.peers[(peer.peerIP,peer.peerPort)]
+            print(f'Connection closed by peer {peer.peerIP}:{peer.peerPort}, {len(self.peers)} peers connected')
+
+    def defaultHandler(self,peer,command,payload):
+        '''
+        Description:
+            The default message handler, does the same as the loop in main.py for every peer.
+            inv messages are parsed and the vectors are passed to the scheduler which decides which peer to request each from, tx and block messages are parsed.
+            Received txs and blocks, and notfound messages, are reported to the scheduler to free the request slot on the peer.
+            Every message is then passed to the consumers subscribed with subscribe, already parsed messages are not parsed again.
+        Inputs:
+            peer    - The AsyncPeer the message came from
+            command - String, the command name of the message
+            payload - memoryview of the message payload
+        '''
+        result = NOT_PARSED
+        if command == 'inv':
+            inventoryVecs = result = peer.connector.parseInvPayload(payload,display=self.displayInv)
+            if inventoryVecs:
+                self.scheduler.announce(peer,peer.connector.getInventoryVectors(inventoryVecs))
+                self.sendRequests()
+        elif command == 'tx':
+            transaction = result = peer.connector.parseTXPayload(payload,display=self.displayTx)
+            if transaction:
+                self.scheduler.received(peer,transaction.txid)
+                self.sendRequests()
+        elif command == 'block':
+            # A block which fails to parse or verify is not marked received, the request times out and is sent to another peer
+            block = result = peer.connector.parseBlockPayload(payload,display=self.displayBlock)
+            if block:
+                self.scheduler.received(peer,block.header.hash)
+                self.sendRequests()
+        elif command == 'notfound':
+            # notfound has the same format as inv, a count and inventory vectors
+            result = peer.connector.parseMessage(command,payload)
+            self.scheduler.notFound(peer,peer.connector.getInventoryVectors(result))
+            self.sendRequests()
+        self.dispatcher.dispatch(peer.connector,command,payload,result)
+
+    def subscribe(self,command,handler,parse=True,peer=None,invTypes=None,predicate=None):
+        '''
+        Description:
+            Subscribes a consumer to the messages of every peer, see BitcoinConnector.subscribe and Lib/Dispatcher.py. handler is passed the BitcoinConnector of the peer.
+        Returns:
+            subscription - Pass to self.dispatcher.unsubscribe to remove it
+        '''
+        return self.dispatcher.subscribe(command,handler,parse,peer,invTypes,predicate)
+
+    def sendRequests(self):
+        '''
+        Description:
+            Sends the getdata messages for everything the scheduler can assign to a peer right now.
+        '''
+        for peer,payloads in self.scheduler.schedule().items():
+            for payload in payloads:
+                peer.sendMessage('getdata',payload)
+
+    async def checkRequests(self,interval=1):
+        '''
+        Description:
+            Runs for as long as the connector runs, every interval seconds requests which have timed out are sent to another peer.
+        Inputs:
+            interval - Seconds between checks
+        '''
+        while True:
+            await asyncio.sleep(interval)
+            if self.scheduler.checkTimeouts():
+                self.sendRequests()
+
+    async def run(self,ips=None):
+        '''
+        Description:
+            Connects to the peers and then keeps running until every peer has disconnected.
+            All the peers share the one event loop this is run on e.g. asyncio.run(connector.run(ips))
+        Inputs:
+            ips - List of ip addresses, or (ip,port) tuples, to connect to. If not passed a lookup of lookUpDomain is performed
+        '''
+        if not ips:
+            ips = await self.getIPAddresses()
+        await self.connectPeers(ips)
+        timeoutTask = asyncio.create_task(self.checkRequests())
+        # Wait for every peer connection to close
+        try:
+            while self.peers:
+                await asyncio.wait([peer.closed for peer in self.peers.values()],return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            timeoutTask.cancel()
+
+    def close(self):
+        '''
+        Description:
+            Closes the connection to every peer.
+        '''
+        for peer in list(self.peers.values()):
+            peer.close()
+        if self.captureLog is not None:
+            self.captureLog.flush()
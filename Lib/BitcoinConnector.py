@@ -5,6 +5,7 @@
 #   This file holds the class BitcoinConnector
 #   The class provides the functionality to connect to a bitcoin node either at a specified IP address or using the lookup domain seed.bitcoin.sipa.be
 #   It performs the handshake with the node to initiate the connection of sending the version meessage, recieving the version and verack, then sending the verack back.
+#   The handshake is run by the state machine in Lib/Handshake.py under a deadline, the version of the peer is parsed and the feature messages are negotiated.
 #   It also provides functionality for parsing messages for displaying information on inv, transaction and block meesages.
 
 
@@ -12,55 +13,148 @@
 # time    - https://docs.python.org/3/library/time.html
 # socket  - https://docs.python.org/3/library/socket.html
 # struct  - https://docs.python.org/3/library/struct.html
-# os      - https://docs.python.org/3/library/os.html
-# hashlib - https://docs.python.org/3/library/hashlib.html
 # datetime - https://docs.python.org/3/library/datetime.html
+# collections - https://docs.python.org/3/library/collections.html
+# MessageFramer - Class developed for this project which splits the stream of bytes from a peer into complete messages
+# MessageHeader - Class developed for this project which packs and checks the 24 byte message headers, see Lib/MessageHeader.py
+# Transaction   - Class developed for this project which parses a transaction into offsets over the payload, see Lib/Transaction.py
+# Block         - Class developed for this project which parses a block header and streams its transactions, see Lib/Block.py
+# Merkle        - Functions developed for this project which rebuild the Merkle tree of a block, see Lib/Merkle.py
+# InventoryCache - Class developed for this project which remembers the inventory hashes already requested, see Lib/InventoryCache.py
+# HeaderChain    - Class developed for this project which indexes and checks block headers, see Lib/HeaderChain.py
+# CompactBlocks  - Class and functions developed for this project which parse and rebuild BIP152 compact blocks, see Lib/CompactBlocks.py
+# AddressBook    - Class and functions developed for this project which parse addr and addrv2 messages and keep the addresses with connection stats, see Lib/AddressBook.py
+# Metrics        - timedParse times the parse functions when self.metrics is set, see Lib/Metrics.py
+# OutputSink     - Formatters developed for this project which turn parsed messages into text, JSON Lines or binary records, see Lib/OutputSink.py
+# Dispatcher     - Class developed for this project which passes each message to the consumers subscribed to it, see Lib/Dispatcher.py
+# Handshake      - Class and functions developed for this project which run the version/verack handshake and parse the version of the peer, see Lib/Handshake.py
 import time
 import socket
 import struct
-import os
-import hashlib
 from datetime import datetime
+from collections import OrderedDict
+from Lib.MessageFramer import MessageFramer
+from Lib.MessageHeader import MessageHeaderCodec,FramingError
+from Lib.Transaction import Transaction,readVarInt,createVarInt
+from Lib.Block import Block
+from Lib.Merkle import verifyMerkleRoot
+from Lib.InventoryCache import InventoryCache
+from Lib.HeaderChain import HeaderChain,MAX_HEADERS
+from Lib.CompactBlocks import CompactBlock,ShortIDCollision,MSG_CMPCT_BLOCK,COMPACT_VERSION,createSendCmpctPayload,parseSendCmpctPayload,createGetBlockTxnPayload,parseBlockTxnPayload
+from Lib.AddressBook import parseAddrPayload,parseAddrV2Payload
+from Lib.Metrics import timedParse
+from Lib.OutputSink import HumanFormatter,createRecord
+from Lib.Dispatcher import Dispatcher
+from Lib.Handshake import Handshake,createVersionPayload,HANDSHAKE_COMMANDS,NEGOTIATION_COMMANDS
+
+# HUMAN_FORMATTER - Formats the messages displayed when no output sink is set
+HUMAN_FORMATTER = HumanFormatter()
 
 class BitcoinConnector:
-    def __init__(self,protocolVersion=70015,magic=b'\xf9\xbe\xb4\xd9',lookUpDomain='seed.bitcoin.sipa.be',peerPort=8333,ip=None):
+    # MAX_INV_ENTRIES - The protocol limit on the number of inventory vectors in one inv or getdata message
+    MAX_INV_ENTRIES = 50000
+    # MSG_TX           - Inventory type of a transaction
+    # MSG_BLOCK        - Inventory type of a block
+    # MSG_WITNESS_FLAG - Bit set in the inventory type of a getdata to ask for the witness serialization of a tx or block
+    MSG_TX           = 1
+    MSG_BLOCK        = 2
+    MSG_WITNESS_FLAG = 1 << 30
+    # BOOK_ATTEMPTS        - The number of the best address book entries tried before falling back on the DNS lookup
+    # BOOK_CONNECT_TIMEOUT - Seconds each address book entry gets to connect, a saved address may no longer answer at all
+    BOOK_ATTEMPTS        = 8
+    BOOK_CONNECT_TIMEOUT = 5
+
+    def __init__(self,protocolVersion=70016,magic=b'\xf9\xbe\xb4\xd9',lookUpDomain='seed.bitcoin.sipa.be',peerPort=8333,ip=None,connect=True,addressBook=None):
         '''
         Description:
             initiliaser method for the class 
         Inputs:
             protocolVersion - The version of bitcoin the node you are connecting to is using see https://developer.bitcoin.org/reference/p2p_networking.html#protocol-versions
+                              70016 is needed to negotiate wtxidrelay and sendaddrv2, see FEATURE_VERSIONS in Lib/Handshake.py
             magic           - The magic value for given network, default to mainent 
             lookUpDomain    - This is where to get the actual IP address of the node to connect to, need to obtain an IP address from active node 
             port            - Port for the connecting peer node 
             ip              - Can set this if you want to use a specific IP instead of performing a lookup, was added because IP address you got at seed.bitcoin.sipa.be was sometimes slow to send updates, if got a good one wanted to keep the IP 
+            connect         - Boolean, if set false no socket is created or connected. Used when something else owns the connection (e.g. Lib/AsyncBitcoinConnector.py) and only the message creating and parsing functions are needed
+            addressBook     - Optional AddressBook, see Lib/AddressBook.py. When ip is not passed the best addresses in it are tried in turn instead of the DNS lookup,
+                              which is only done if none of them connect. Connection results are recorded in it and addresses from addr and addrv2 messages are added to it
         '''
         # Set the class variables 
         self.protocolVersion = protocolVersion
         self.magic           = magic
         self.lookUpDomain    = lookUpDomain
         self.peerPort        = peerPort
-        # Create a socket instance, will allow us to send messages to the node and recieve messages through a socket 
-        self.socket= self.getSocket()
+        self.addressBook     = addressBook
         # Set the IP address of the peer node we are going to connect to from the lookUpDomain 
         # If ip is passed use the ip passed 
+        bookAddresses = []
         if ip:
             self.peerIP = ip
+        elif addressBook is not None and len(addressBook):
+            # Addresses saved from an earlier run, no DNS lookup needed unless none of the best few connect
+            bookAddresses = addressBook.best(self.BOOK_ATTEMPTS)
+            self.peerIP,self.peerPort = bookAddresses[0]
         else:
             # If a specific ip is not passed then do a DNS lookup
             self.peerIP = self.getIPAddress()
-        # Connect the socket to the peer node 
-        self.connectSocket()
+        # Create a socket instance, will allow us to send messages to the node and recieve messages through a socket, and connect it to the peer node
+        self.socket = None
+        if connect and bookAddresses:
+            self.connectFromAddressBook(bookAddresses,peerPort)
+        elif connect:
+            self.openSocket()
+        # codec - Packs the headers of sent messages and checks the headers and checksums of received messages, see Lib/MessageHeader.py
+        self.codec  = MessageHeaderCodec(magic=self.magic)
+        # Create the framer which will hold the receive buffer and split the stream into complete messages, see Lib/MessageFramer.py
+        self.framer = MessageFramer(magic=self.magic,codec=self.codec)
+        # merkleExecutor - Optional concurrent.futures executor used to spread the Merkle root verification of large blocks across cores
+        self.merkleExecutor = None
+        # inventoryCache - Remembers the tx and block hashes already requested so they are not requested again, set to None to request everything
+        #   When connected to several peers they should all share the one cache so a transaction is only downloaded once
+        self.inventoryCache = InventoryCache()
+        # mempool - Optional Mempool, when set parsed transactions are stored in it and the transactions of parsed blocks are removed from it
+        self.mempool = None
+        # captureLog - Optional CaptureLog, when set readFrames writes every message received to it
+        self.captureLog = None
+        # headerChain - Optional HeaderChain, when set the headers of headers and block messages are checked and added to it, syncHeaders creates one if needed
+        self.headerChain = None
+        # compactBlockVersion - The compact block version agreed with the peer once its sendcmpct arrives, when set blocks are requested as cmpctblock
+        # partialBlocks       - OrderedDict of block hash -> CompactBlock waiting for a blocktxn reply, only the most recent few are kept
+        self.compactBlockVersion = None
+        self.partialBlocks       = OrderedDict()
+        # metrics - Optional ConnectorMetrics, when set the messages and bytes sent and received, parse times and getdata round trip times are recorded
+        #   Set it with ConnectorMetrics.attach(connector) so the queue depths of the connection are reported too, see Lib/Metrics.py
+        self.metrics = None
+        # output - Optional OutputSink, when set the messages parsed with display set true are written to it instead of printed, see Lib/OutputSink.py
+        self.output = None
+        # watcher - Optional ScriptWatcher, when set the outputs of parsed transactions and blocks are checked against its watch-list, see Lib/ScriptClassifier.py
+        self.watcher = None
+        # filterIndex - Optional FilterIndex, when set the BIP158 filter of every parsed block is built and stored in it, see Lib/BlockFilter.py
+        self.filterIndex = None
+        # exporter - Optional ColumnarExporter, when set parsed transactions and blocks are added to its columns for analysis, see Lib/ColumnarExport.py
+        self.exporter = None
+        # dispatcher - Passes each message from dispatchFrames to the subscribed consumers, see subscribe. Several connectors can share one
+        self.dispatcher = Dispatcher()
+        # handshake - The Handshake of the connection once connectToPeer has started it, holds the parsed version of the peer, the features it sent and the handshake time
+        self.handshake = None
+        # scheduler - Optional GetDataScheduler, when set requestInventory queues the inv vectors in it instead of requesting them all at once, so the requests in flight are capped,
+        #   requests which time out or get notfound are sent again and getdata messages are split at 50,000 vectors, see Lib/GetDataScheduler.py
+        #   It should share self.inventoryCache, parseInvPayload then leaves the filtering to it. nextTimeoutCheck - time.monotonic() the timeouts are next checked
+        self.scheduler        = None
+        self.nextTimeoutCheck = 0.0
 
-    def getSocket(self):
+    def getSocket(self,family=socket.AF_INET):
         '''
         Description:
             Gets a socket object which can be used to open a connection to a bitcon node
+        Inputs:
+            family - socket.AF_INET for an IPv4 peer or socket.AF_INET6 for an IPv6 peer
         Returns:
             s - An instance of the class socket https://docs.python.org/3/library/socket.html
         '''
         try:
             # Create the socket instance and return it 
-            s= socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+            s= socket.socket(family,socket.SOCK_STREAM)
             return s 
         except socket.error as err:
             print("Error in creating the socket")
@@ -69,12 +163,14 @@ class BitcoinConnector:
         '''
         Description:
             Performs a lookup to get a Bitcoin nodes IP address using the lookUpDomain instance variable and socket class 
+            Both IPv4 (A) and IPv6 (AAAA) records are looked up, to pick the fastest of all the addresses use Lib/PeerSelector.py
         Returns:
             ip - The ip address of the given bitcoin node 
         '''
         try:
-            # Use the socket function gethostbyname to perform a DNS lookup to get an IP address for a bitcoin node 
-            ip = socket.gethostbyname(self.lookUpDomain)
+            # Use the socket function getaddrinfo to perform a DNS lookup to get an IP address for a bitcoin node, the first record is used
+            records = socket.getaddrinfo(self.lookUpDomain,self.peerPort,family=socket.AF_UNSPEC,type=socket.SOCK_STREAM)
+            ip = records[0][4][0]
             return ip
         except socket.gaierror:
             print(f'Could not obtain a node IP address from the look up domain {self.lookUpDomain}')
@@ -84,12 +180,57 @@ class BitcoinConnector:
         Description:
             Connects the socket class instance stored in self.socket to a given IP address at the location
             stored in the variable self.peerIP and at the port stored in the variable self.peerPort
+        Returns:
+            connected - Boolean, True if the socket connected
         '''
         try:
+            start = time.perf_counter()
             self.socket.connect((self.peerIP,self.peerPort))
             print(f'Socket connected successfully to node {self.peerIP} on port {self.peerPort}')
+            if self.addressBook is not None:
+                self.addressBook.recordSuccess(self.peerIP,self.peerPort,time.perf_counter()-start)
+            return True
         except:
             print(f'Could not connect to peer at IP {self.peerIP} on port {self.peerPort}')
+            if self.addressBook is not None and self.peerIP:
+                self.addressBook.recordFailure(self.peerIP,self.peerPort)
+            return False
+
+    def openSocket(self,timeout=None):
+        '''
+        Description:
+            Creates self.socket for the address family of self.peerIP and connects it, an IPv6 peer needs an IPv6 socket.
+        Inputs:
+            timeout - Optional seconds the connect may take, the socket is blocking again once connected
+        Returns:
+            connected - Boolean, True if the socket connected
+        '''
+        self.socket = self.getSocket(socket.AF_INET6 if self.peerIP and ':' in self.peerIP else socket.AF_INET)
+        self.socket.settimeout(timeout)
+        connected = self.connectSocket()
+        if connected:
+            self.socket.settimeout(None)
+        return connected
+
+    def connectFromAddressBook(self,addresses,lookUpPort):
+        '''
+        Description:
+            Tries the addresses from the address book in turn until one connects, each failure is recorded in the book so it ranks lower next time.
+            If none of them connect the DNS lookup of lookUpDomain is done like when there is no address book.
+        Inputs:
+            addresses  - List of (ip,port) from AddressBook.best, best first
+            lookUpPort - The port to use for the address from the DNS lookup
+        Returns:
+            connected - Boolean, True if the socket connected
+        '''
+        for ip,port in addresses:
+            self.peerIP,self.peerPort = ip,port
+            if self.openSocket(self.BOOK_CONNECT_TIMEOUT):
+                return True
+            self.socket.close()
+        print(f'None of the {len(addresses)} best addresses in the address book connected, looking up {self.lookUpDomain}')
+        self.peerIP,self.peerPort = self.getIPAddress(),lookUpPort
+        return self.openSocket()
 
     def createMessage(self,commandName,payload):
         '''
@@ -109,23 +250,15 @@ class BitcoinConnector:
         '''
         # magic - 4 bytes 
         #   The magic value for the origin netowrk, we are using the mainnet 0xD9B4BEF9 sent little endian 
-        #   This is held in the self.magic class variable
         # command - 12 bytes, char type 
-        #   This is the command name as an ascii charathers
-        #   Needs to be padded out to 12 bytes for example if commandName=version then 
-        #   command=version\0\0\0\0\0
-        #   Encode the commandName as a bytes and add the padding based on lenght 
-        command = f'{commandName}'.encode() + ((12-len(commandName)) * b'\x00')
+        #   This is the command name as an ascii charathers padded out to 12 bytes, for example version\0\0\0\0\0
+        #   The padded command is cached by the codec so it is only built once per command name
         # lenght - 4 bytes 
         #   This is the lenght of the payload 
-        length = struct.pack('I',len(payload))
         # checksum - 4 bytes 
-        #   This is the first 4 bytes of the hash of a hash
-        #   First take the SHA256 of payload and then the SHA256 of result SHA256(SHA256(payload))
-        checksum = hashlib.sha256(payload)
-        checksum = hashlib.sha256(checksum.digest()).digest()[0:4]
-        # Create the message by adding the individual components and the payload
-        message = self.magic + command + length + checksum + payload 
+        #   This is the first 4 bytes of SHA256(SHA256(payload))
+        # The header is packed with one precompiled struct, see Lib/MessageHeader.py
+        message = self.codec.createMessage(commandName,payload)
         return message 
 
     def sendMessage(self,message,msgName=None):
@@ -139,6 +272,8 @@ class BitcoinConnector:
         try:
             # Send the message using the socket object 
             self.socket.send(message)
+            if self.metrics is not None:
+                self.metrics.sent(bytes(message[4:16]).rstrip(b'\x00').decode('ascii','replace'),f'{self.peerIP}:{self.peerPort}',message[24:])
             # Print a message if the msgName has been set 
             print(f'{msgName} sent at {datetime.now()}') if msgName else ''
         except Exception as e:
@@ -148,7 +283,7 @@ class BitcoinConnector:
             else:
                 print(f'Error sending message shown below to peer {self.peerIP}:{self.peerPort}\n{message}')
 
-    def connectToPeer(self):
+    def connectToPeer(self,timeout=10,wtxidRelay=False,addrV2=True,sendHeaders=False,feeRate=None):
         '''
         Description:
             This function performs the connection to the given node to start receiving messages. 
@@ -156,42 +291,230 @@ class BitcoinConnector:
                 1. Send version message - The machine wishing to connect sends a version message to the node to connect to. 
                 2. Receieve resposne - The response will be a version message and a ver ack message acknowlwdging the initial version message.
                 3. Send verack - A version acknowledgment is then sent to the node to acknowledge the version message received. 
+            The steps are run by a Handshake (see Lib/Handshake.py) fed with the messages from readFrames, so it does not matter how the messages are split across reads.
+            The version of the peer is parsed, and wtxidrelay, sendaddrv2, sendheaders and feefilter are negotiated. Everything must finish within timeout seconds.
+            Messages which arrive in the same read after the handshake are left in the framer for readFrames.
+        Inputs:
+            timeout     - Seconds the whole handshake may take
+            wtxidRelay  - Boolean, ask for transactions to be announced by wtxid. Off as parseInvPayload only requests MSG_TX and MSG_BLOCK vectors
+            addrV2      - Boolean, ask for addresses in addrv2 messages
+            sendHeaders - Boolean, ask for new blocks to be announced with headers instead of inv, only useful with self.headerChain set
+            feeRate     - Optional satoshis per 1000 virtual bytes, transactions paying less are not announced to us
+        Returns:
+            handshake - The completed Handshake, also kept in self.handshake. None if the handshake failed or timed out
         '''
         # Step 1. Send Version message
         #   To initiate the flow we first have to send a version message to the node we want to connect to 
-        #   The payload can be created using the createVersionCommand funtion 
-        #   The full message including the payload is created using the createMessage function 
-        #   The message is then sent using the sendMessage function 
-        version_message = self.createMessage('version',self.createVersionCommand())
-        self.sendMessage(version_message,'Initial version payload message')
+        #   The payload is created using the createVersionCommand funtion, the Handshake returns it from start to be sent
+        handshake = self.handshake = Handshake(self.createVersionCommand(),self.protocolVersion,wtxidRelay=wtxidRelay,addrV2=addrV2,sendHeaders=sendHeaders,feeRate=feeRate)
+        for command,payload in handshake.start():
+            self.sendMessage(self.createMessage(command,payload),f'{command} message')
         # Step 2. Receieve the response
-        #   The node we are trying to connect to will responed with a version message and then 
-        #   a verack message. These can be recieved using the recv function. The first version reponse seems to cutoff so  
-        #   so call recv twice and join them to get the two messages in versionRes
-        msgVersionResponse = self.socket.recv(1024)
-        msgVerackResponse  = self.socket.recv(1024)
-        versionRes = msgVersionResponse + msgVerackResponse
-        print(f'\nResponse from initial version message, contains version and verack \n{versionRes}\n')
-        # Step 3. Send verack
-        #   The final step is to acknowledge the version response sent by sending a version acknowledgment 
-        #   (verack) payload. The verack payload is created using the createVerackCommand function, it is just an empty payload
-        #   The message is then created with createMessage and send with sendMessage 
-        verack_message = self.createMessage('verack',self.createVerackCommand())
-        self.sendMessage(verack_message,'Verack response to version')
+        #   The node we are trying to connect to will respond with a version message, maybe wtxidrelay and sendaddrv2, and then a verack message.
+        #   Each is passed to the Handshake which returns what to send back, our verack in reply to the version (Step 3) and the feature messages
+        frames = self.readFrames(deadline=time.monotonic()+timeout)
+        try:
+            for command,payload in frames:
+                if command in HANDSHAKE_COMMANDS:
+                    for reply,replyPayload in handshake.receive(command,payload):
+                        self.sendMessage(self.createMessage(reply,replyPayload),f'{reply} message')
+                elif command == 'ping':
+                    self.sendMessage(self.createMessage('pong',bytes(payload)))
+                else:
+                    self.dispatcher.dispatch(self,command,payload)
+                if handshake.complete:
+                    break
+        except TimeoutError:
+            print(f'Warning: Handshake with peer {self.peerIP}:{self.peerPort} did not complete within {timeout} s')
+        except OSError as e:
+            print(f'Warning: Handshake with peer {self.peerIP}:{self.peerPort} failed, {e}')
+        except ValueError as e:
+            print(f'Warning: Closing peer {self.peerIP}:{self.peerPort}, bad handshake, {e}')
+            self.socket.close()
+        finally:
+            # Puts the socket back to blocking reads
+            frames.close()
+        if not handshake.complete:
+            if self.addressBook is not None and self.peerIP:
+                self.addressBook.recordFailure(self.peerIP,self.peerPort)
+            return None
+        print(f'Handshake complete with node {self.peerIP} on port {self.peerPort}, {handshake!r}')
+        return handshake
+
+    def readFrames(self,deadline=None):
+        '''
+        Description:
+            Generator which reads from the socket and yields every complete message received from the peer.
+            The socket writes directly into the reusable buffer held by self.framer using recv_into, so there is no new buffer per read.
+            Messages which are split across reads are held until complete and reads which contain several messages yield all of them.
+            The payload is a memoryview into the buffer and is only valid until the next message is requested, use bytes(payload) to keep it.
+            If the peer sends a header with the wrong magic or an oversized length the stream can not be framed any more and the generator stops.
+            If self.captureLog is set every message is written to it before it is yielded, see Lib/CaptureLog.py.
+            If self.metrics is set every message is counted, see Lib/Metrics.py.
+        Inputs:
+            deadline - Optional time.monotonic() by which every read must finish, TimeoutError is raised once it passes. Used for the handshake
+        Returns:
+            command - String, the command name of the message e.g. "inv"
+            payload - memoryview of the payload of the message, the 24 byte header is not included
+        '''
+        try:
+            while True:
+                # Hand out every complete message currently in the buffer
+                if self.captureLog is None and self.metrics is None:
+                    yield from self.framer.frames()
+                else:
+                    peer  = (self.peerIP,self.peerPort)
+                    label = f'{self.peerIP}:{self.peerPort}'
+                    for command,payload in self.framer.frames():
+                        if self.captureLog is not None:
+                            self.captureLog.append(command,payload,peer)
+                        if self.metrics is not None:
+                            self.metrics.received(command,label,len(payload))
+                        yield command,payload
+                # Each read may only wait for what is left of the deadline
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError('deadline passed')
+                    self.socket.settimeout(remaining)
+                # Read the next chunk of data straight into the framer buffer
+                if self.framer.recvFrom(self.socket) == 0:
+                    # recv_into returning 0 bytes means the peer closed the connection
+                    print(f'Connection closed by peer {self.peerIP}:{self.peerPort}')
+                    return
+        except FramingError as e:
+            print(f'Warning: Stopped reading from peer {self.peerIP}:{self.peerPort}, {e}')
+            self.socket.close()
+        finally:
+            if deadline is not None and self.socket.fileno() != -1:
+                self.socket.settimeout(None)
+
+    def subscribe(self,command,handler,parse=True,peer=None,invTypes=None,predicate=None):
+        '''
+        Description:
+            Subscribes a consumer to a command, the messages are passed to it by dispatchFrames. See Lib/Dispatcher.py
+        Inputs:
+            command   - String, the command name e.g. 'tx', None for every command
+            handler   - Function called as handler(connector, command, result), result is the message parsed with parseMessage
+            parse     - Boolean, set false to be passed the raw payload, a command nobody wants parsed is never parsed
+            peer      - Optional (ip,port), only messages from this peer
+            invTypes  - Optional collection of inventory vector types, inv and notfound vectors of other types are filtered out
+            predicate - Optional function called as predicate(result), only messages it returns True for
+        Returns:
+            subscription - Pass to unsubscribe to remove it
+        '''
+        return self.dispatcher.subscribe(command,handler,parse,peer,invTypes,predicate)
+
+    def unsubscribe(self,subscription):
+        '''
+        Description:
+            Removes a consumer added with subscribe.
+        Inputs:
+            subscription - The Subscription returned from subscribe
+        '''
+        self.dispatcher.unsubscribe(subscription)
+
+    def parseMessage(self,command,payload,display=False):
+        '''
+        Description:
+            Parses a message with the parse function for its command, used by the dispatcher.
+        Inputs:
+            command - String, the command name
+            payload - memoryview of the payload
+            display - Boolean, passed to the parse function
+        Returns:
+            result - What the parse function returns e.g. the inventory vectors of an inv, a Transaction for a tx or a (block, request) tuple for a cmpctblock.
+                     notfound gives its inventory vectors, a command without a parse function gives the payload unchanged
+        '''
+        if command == 'inv':
+            return self.parseInvPayload(payload,display=display)
+        if command == 'tx':
+            return self.parseTXPayload(payload,display=display)
+        if command == 'block':
+            return self.parseBlockPayload(payload,display=display)
+        if command == 'headers':
+            return self.parseHeadersPayload(payload,display=display)
+        if command == 'cmpctblock':
+            return self.parseCmpctBlockPayload(payload,display=display)
+        if command == 'blocktxn':
+            return self.parseBlockTxnPayload(payload,display=display)
+        if command == 'sendcmpct':
+            return self.parseSendCmpctPayload(payload,display=display)
+        if command == 'addr':
+            return self.parseAddrPayload(payload,display=display)
+        if command == 'addrv2':
+            return self.parseAddrV2Payload(payload,display=display)
+        if command == 'notfound':
+            try:
+                count,start = readVarInt(payload,0)
+            except IndexError:
+                return b''
+            return bytes(payload[start:start+36*count])
+        return payload
+
+    def dispatchFrames(self):
+        '''
+        Description:
+            Reads messages with readFrames until the connection closes and passes each to the subscribed consumers, see subscribe.
+            ping is always answered with a pong so the peer does not drop the connection, whether or not anybody subscribed to it.
+            The feature messages which follow the handshake (e.g. sendheaders and feefilter) are recorded in self.handshake.
+            If self.scheduler is set it is updated after each message, see updateRequests.
+        '''
+        for command,payload in self.readFrames():
+            if command == 'ping':
+                self.sendMessage(self.createMessage('pong',bytes(payload)))
+            elif command in NEGOTIATION_COMMANDS and self.handshake is not None:
+                self.receiveFeature(command,payload)
+            self.dispatcher.dispatch(self,command,payload)
+            if self.scheduler is not None:
+                self.updateRequests(command,payload)
+
+    def receiveFeature(self,command,payload):
+        '''
+        Description:
+            Records a feature message (wtxidrelay, sendaddrv2, sendheaders or feefilter) received after the handshake in self.handshake.
+        Inputs:
+            command - String, the command name
+            payload - memoryview of the payload
+        '''
+        try:
+            self.handshake.receive(command,payload)
+        except ValueError as e:
+            print(f'Warning: could not parse {command} message, {e}')
+
+    def getPayload(self,msg):
+        '''
+        Description:
+            Gets the payload from a message which includes the 24 byte header. 
+            Sometimes the message will only contain the first 24 bytes (the header), if this is the case call recv again to get the payload. 
+        Inputs:
+            msg - Byte string including the message header and payload
+        Returns:
+            payload - Byte string of the payload of the message
+        '''
+        # Get the length of the payload from bytes 16 to 20
+        lenghtOfPayload = int.from_bytes(msg[16:20],"little")
+        # Sometimes only first 24 bytes is sent first 
+        if (len(msg) == 24):
+            # need to call recover again to get the next part of the message which will be the payload 
+            # only accept the next lenghtOfPayload bytes specifiec in the header 
+            return self.socket.recv(lenghtOfPayload) 
+        # We got more than 24 bytes, but just to be sure we havent got more than we need
+        # only use the lenght of the payload specificied in the header as the source of truth 
+        return msg[24:24+lenghtOfPayload]
 
     def createVerackCommand(self):
         '''
         Description:
             Creates a verack payload command which is used to acknowledge the version command sent from the node. 
-            A verack command is just a message with an empty payload. This function really just creates an empty 8 
-            byte payload. 
+            A verack command is just a message with an empty payload, the length in the header is 0.
         Returns
-            verackCMD - Empty 4 byte payload 
+            verackCMD - Empty payload 
         '''
-        ## The payload for a verack is an empty 4 bytes 
-        return b'\x00\x00\x00\x00'
+        ## The payload for a verack is empty
+        return b''
 
-    def createVersionCommand(self):
+    def createVersionCommand(self,startHeight=None,relay=True):
         '''
         Description:
             Creates the version message for the bitcoin transaction.
@@ -206,59 +529,42 @@ class BitcoinConnector:
                 7. user_agent   - The user agent used, variable string length
                 8. start_height - The last block recieved by the sending node 4 bytes
                 9. relay        - Boolean for the remote peer to announce every transaction or not  
+            The payload is packed by createVersionPayload, see Lib/Handshake.py
+        Inputs:
+            startHeight - The height of our best block, defaults to the height of self.headerChain or 0 without one
+            relay       - Boolean, set true so that the remote peer announces transactions
         Returns:
             versionCMD (Byte String) - The version command which can be sent as a payload for a message 
         '''
-        # Version - 4 Bytes
-        #   The protocol versin being used by node, we are connecting to, this is in the class instance variable self.protocolVersion
-        # Services - 8 bytes
-        #   Refers to capabailities you want to enable on your "node"
-        #   For this assignemnt we are specfying that we are not a full node and we just want transactions 
-        #   If we where to implement a full node this will need to be changed 
-        services = b'\x00'*8
-        # timestamp - 8 bytes 
-        #   Unix timestamp in seconds using the time function, double 8 bytes long 
-        timestamp = struct.pack('d',time.time())
-        # addr_recv - 26 bytes 
-        #   This is composed of 4 smaller components which make a network address (see https://en.bitcoin.it/wiki/Protocol_documentation#Network_address)
-        #       1. time (4 bytes)     - The time -> THIS IS NOT USED IN VERSION MESSAGE HENCE LENGHT 26 BYTES FOR addr_recv 
-        #       2. services (8 bytes) - The same as the services mentioned above 
-        #       3. IPv6/4 (16 Bytes)  - The IP address of the node which will recieve this message, the one we will be getting transaction data from, if 1pv4 12 bytes of 0's and then 4 bytes of ipv4
-        #       4. port (2 bytes)     - The port number for the node message is being sent to 
-        service_addr_recv    = b'\x00'*8
-        ip_address_addr_recv = (b'\x00'*12)+socket.inet_aton(self.peerIP)
-        port_addr_recv       = struct.pack('H',8333) # H is unsigned short which is 2 bytes 
-        addr_recv = service_addr_recv + ip_address_addr_recv + port_addr_recv
-        # addr_from - 26 bytes 
-        #   This is composed of the same 4 smaller components mentioned above for the addr_recv which make a network address
-        #   1. time (4 bytes)     - The time -> THIS IS NOT USED IN VERSION MESSAGE HENCE LENGHT 26 BYTES FOR addr_from
-        #   2. services (8 bytes) - The same as services mentioned above
-        #   3. IPv6/4 (16 Bytes)  - The ip address of the transmitting node, can be set to 127.0.0.1 
-        #   4. Port   (2 bytes)   - The port number, 8333 for bitcoin 
-        service_addr_from    = b'\x00'*8
-        ip_address_addr_from = (b'\x00'*12)+socket.inet_aton('127.0.0.1')
-        port_addr_from       = struct.pack('H',8333) # H is unsigned short which is 2 bytes 
-        addr_from = service_addr_from + ip_address_addr_from + port_addr_from
-        # nonce - 8 Bytes 
-        #   This is just a random 8 bytes sent with the version message 
-        nonce = os.urandom(8)
-        # User Agent - Variable lenght string 
-        #   Not sending user agent filed just set to 0 
-        user_agent = b'\x00'
-        # Start Height - 4 bytes 
-        #   This is the height of the last block the transmitting node recieved, in our case havent recived any yet 
-        start_height = struct.pack('i',0)
-        # Relay - 1 Byte 
-        #   Set true so that the remote peer should announce transactions
-        relay = b'\x01'
-        # Add the individual components 
-        versionCMD = struct.pack("i", self.protocolVersion) + services + timestamp + addr_recv + addr_from + nonce + user_agent + start_height + relay 
+        # Services - 8 bytes, we are not a full node and just want transactions so no services are set
+        # timestamp - 8 bytes, the Unix timestamp in seconds as a signed 64 bit integer
+        # addr_recv/addr_from - 26 bytes each, services (8), IPv6 or IPv4 mapped address (16) and the port (2) which is big endian
+        # nonce - 8 random bytes, a version with our own nonce means we connected to ourselves
+        # user_agent - Variable length string, /BitcoinConnector:0.1/
+        # start_height - 4 bytes, the height of the last block we have
+        if startHeight is None:
+            startHeight = self.headerChain.height if self.headerChain is not None else 0
+        versionCMD = createVersionPayload(self.protocolVersion,self.peerIP,self.peerPort,startHeight=startHeight,relay=relay)
         return versionCMD
 
     def parseInvMsg(self,msg,display=True):
         '''
         Description:
             This function parses the inv messages which a node will send with updates. 
+            The payload is taken from the message and then parsed with the function parseInvPayload.
+        Inputs:
+            msg - This is a inv message recieved to be parsed 
+            display - Boolean, if set true will print out summary on the inventory message parsed
+        Returns:
+            finalVecs = Byte string which contains the MSG_TX and MSG_BLOCK type inventory vectors which can be used in a getdata message to get information on new transactions and blocks
+        '''
+        return self.parseInvPayload(self.getPayload(msg),display=display)
+
+    @timedParse('inv')
+    def parseInvPayload(self,payload,display=True):
+        '''
+        Description:
+            This function parses the payload of inv messages which a node will send with updates. 
             The updates vary and depend upon the type of inventory vector sent. 
             There can be up to 50,000 inevnetory vectors sent in a given inv message. 
             See https://en.bitcoin.it/wiki/Protocol_documentation#inv for detail on inv messages.
@@ -266,66 +572,113 @@ class BitcoinConnector:
                 count     - This is the count of the number of inventory vectors in this message https://en.bitcoin.it/wiki/Protocol_documentation#Variable_length_integer
                 inventory - These are the inventory vectors which contain a code (4 bytes) on the type of event and then a hash (32 bytes) which can be used to request data on this event. 
             The type of inventory events this function parses is specifically MSG_TX and MSG_BLOCK events.
+            If self.inventoryCache is set, vectors whose hash has already been requested are dropped so only new events are returned.
+            If self.scheduler is set it does this check when the vectors are passed to it by requestInventory, so it is not done here.
         Inputs:
-            msg - This is a inv message recieved to be parsed 
+            payload - Byte string or memoryview of the inv payload, the 24 byte header is not included
             display - Boolean, if set true will print out summary on the inventory message parsed
         Returns:
             finalVecs = Byte string which contains the MSG_TX and MSG_BLOCK type inventory vectors which can be used in a getdata message to get information on new transactions and blocks
         '''
-        # Sometimes the message will ony contain the first 24 bytes for some reason
-        # Ensure that we have the full amount first, if we only have 24 bytes
-        # call recv again the reamining message will be there 
-        payload = ''
-        # Get the length of the payload from bytes 16 to 20
-        lenghtOfPayload = int.from_bytes(msg[16:20],"little")
-        # Sometimes only first 24 bytes is sent first 
-        if (len(msg) == 24):
-            # need to call recover again to get the next part of the message which will be the payload 
-            # only accept the next lenghtOfPayload bytes specifiec in the header 
-            payload  = self.socket.recv(lenghtOfPayload) 
-        else:
-            # We got more than 24 bytes, but just to be sure we havent got more than we need
-            # only use the lenght of the payload specificied in the header as the source of truth 
-            payload = msg[24:24+lenghtOfPayload]
-        # invCount        - Number of inventory messages 
+        # invCount        - Number of inventory messages, a variable length integer so it can be more than 255
         # inventoryLenght - This is how many bytes if in the inventory, each inventory vector is 36 bytes in lenght so this value should be 36 x invCount 
-        invCount        = payload[0]
-        inventoryLength = len(payload[1:]) 
+        try:
+            invCount,inventoryStart = readVarInt(payload,0)
+        except (IndexError,struct.error):
+            print(f'Warning: inv message of {len(payload)} Bytes is too short to hold the inventory count')
+            return b''
+        inventoryLength = len(payload) - inventoryStart
+        # An inv message can not hold more than 50,000 inventory vectors
+        if invCount > self.MAX_INV_ENTRIES:
+            print(f'Warning: inv message with {invCount} inventory vectors is over the limit of {self.MAX_INV_ENTRIES}')
+            return b''
         # Ensure that the inventory lenght is equal to 36 x inventory count
         # The inventory count tells you how many inventory items you have
         # Each inventory item is 36 bytes in lenght so for a full correct message 
         # we must have 36 x inventory count to trust it, just a precaution seems to be reliable 
         if((36*invCount) == inventoryLength):
             # inventoryVectors - A list where each eleement is a 36 byte inventory vector
-            inventoryVectors = self.getInventoryVectors(payload[1:])
+            inventoryVectors = self.getInventoryVectors(payload[inventoryStart:])
             # blockVecsCount  - Used to keep track of the number of block vecs
             # transactionVecs - Used to keep track of the number of transaction vectors 
-            # finalVecs       - This is a byte string containg the MSG_TX and MSG_BLOCK vectors
+            # finalVecs       - This is a list of the MSG_TX and MSG_BLOCK vectors, joined into one byte string at the end
+            # knownVecsCount  - Used to keep track of the number of vectors dropped as they were already requested
             blockVecsCount       = 0
             transactionVecsCount = 0
-            finalVecs       = b''
+            knownVecsCount       = 0
+            finalVecs       = []
+            inventoryCache  = self.inventoryCache if self.scheduler is None else None
             # Now iterate through the inventory vectors 
             # Extracting information based upon the docs on inventory vectors https://en.bitcoin.it/wiki/Protocol_documentation#Inventory_Vectors 
             for vec in inventoryVectors:
                 # vecType - This is the first 4 bytes of an inventory vector 
                 vecType = int.from_bytes(vec[0:4],"little")
+                # Skip the vector if its hash (the last 32 bytes) has already been requested, add checks and records the hash in one step
+                if (vecType == 1 or vecType == 2) and inventoryCache is not None and not inventoryCache.add(bytes(vec[4:36])):
+                    knownVecsCount +=1
+                    continue
                 # We only want to parse MSG_TX (vecType = 1) and MSG_BLOCK (vecType=2) data 
                 if (vecType == 1):
                     transactionVecsCount +=1
-                    finalVecs+=vec
+                    finalVecs.append(vec)
                 elif (vecType == 2):
                     blockVecsCount +=1
-                    finalVecs+=vec
-            # Print out a summary of the inventiry vectorys received 
+                    finalVecs.append(vec)
+            # Write out a summary of the inventory vectors received
             if(display):
-                print('*******************INV MESSAGE*******************')
-                print(f'Length of payload = {len(payload)} Bytes')
-                print(f'Inv Count = {invCount}')
-                print(f'Length of inventory vectors = {inventoryLength} Bytes')
-                print(f'\nSummary Inventory Vectors Received\n\tNumber of MSG_TX vectors = {transactionVecsCount}\n\tNumber of MSG_BLOCK vectors = {blockVecsCount}\n****************END OF INV MESSAGE***************')
+                self.writeOutput('inv',{'size':len(payload),'count':invCount,'inventoryLength':inventoryLength,'txVectors':transactionVecsCount,
+                                        'blockVectors':blockVecsCount,'knownVectors':knownVecsCount})
             # Return the inventory vectors which can be used to send a getdata message to get tx and block messages 
-            return finalVecs
+            return b''.join(finalVecs)
+        print(f'Warning: inv message count {invCount} does not match {inventoryLength} Bytes of inventory vectors')
+        return b''
          
+    def requestInventory(self,inventoryVecs):
+        '''
+        Description:
+            Requests the tx and block inventory vectors returned by parseInvPayload with getdata.
+            Without self.scheduler they are all requested in one getdata straight away. With it they are queued in the scheduler, which sends at most
+            maxInFlightPerPeer requests at once, splits getdata messages at 50,000 vectors and sends timed out requests again, see updateRequests.
+        Inputs:
+            inventoryVecs - Byte string of 36 byte inventory vectors
+        '''
+        if not inventoryVecs:
+            return
+        if self.scheduler is None:
+            self.sendMessage(self.createMessage('getdata',self.createGetDataCMD(inventoryVecs)),'getdata message')
+            return
+        self.scheduler.announce(self,self.getInventoryVectors(inventoryVecs))
+        self.sendRequests()
+
+    def sendRequests(self):
+        '''
+        Description:
+            Sends the getdata messages for everything self.scheduler can request right now.
+        '''
+        for peer,payloads in self.scheduler.schedule().items():
+            for payload in payloads:
+                self.sendMessage(self.createMessage('getdata',payload),'getdata message')
+
+    def updateRequests(self,command,payload):
+        '''
+        Description:
+            Keeps self.scheduler up to date after each message, called by dispatchFrames when it is set. The items in a notfound are requested again or dropped,
+            once a second the requests which have timed out are re-queued, then whatever the scheduler can request now is sent.
+            Received tx, block and cmpctblock messages are marked in the scheduler by their parse functions.
+        Inputs:
+            command - String, the command name
+            payload - memoryview of the payload
+        '''
+        scheduler = self.scheduler
+        if command == 'notfound':
+            scheduler.notFound(self,self.getInventoryVectors(self.parseMessage(command,payload)))
+        now = time.monotonic()
+        if now >= self.nextTimeoutCheck:
+            self.nextTimeoutCheck = now + 1
+            scheduler.checkTimeouts(now)
+        if scheduler.pending:
+            self.sendRequests()
+
     def getInventoryVectors(self,inventory):
         '''
         Description:
@@ -343,8 +696,11 @@ class BitcoinConnector:
             Creates the getdata payload for the getdata message https://en.bitcoin.it/wiki/Protocol_documentation#getdata
             This payload is sent in response to a inv message to obtain more information on a given event identified by its 
             hash in the inventory vec associated with this event. 
+            MSG_TX and MSG_BLOCK vectors are sent as MSG_WITNESS_TX and MSG_WITNESS_BLOCK so transactions arrive with their witness, without it the wtxids in
+            the mempool are the txids and the short IDs of SegWit transactions in a compact block never match.
+            Once compact blocks have been agreed with the peer (see parseSendCmpctPayload) MSG_BLOCK vectors are sent as MSG_CMPCT_BLOCK so the block arrives as a cmpctblock.
             The getdata payload has two components:
-                count     - The number of inventory vecs in the payload 
+                count     - The number of inventory vecs in the payload, a variable length integer
                 inventory - These are inventory vectors obtained from an inv message and contain the hashes of the events we want more information on. 
             Inputs:    
                 inventoryVecs - Byte string containg the inventory vectors. These are returned from the function parseInvMsg.
@@ -353,9 +709,13 @@ class BitcoinConnector:
         '''
         # Check if there are vecs availble, it seems sometimes none are sent very rare
         if inventoryVecs:
-            # count - The number of inventoryvecs present in the payload 
-            count = int(len(inventoryVecs)/36)
-            count = bytes([count])
+            # The type is the first 4 bytes of each vector, blocks go as compact blocks once agreed and everything else is asked for with its witness
+            blockType = MSG_CMPCT_BLOCK if self.compactBlockVersion else self.MSG_BLOCK | self.MSG_WITNESS_FLAG
+            requestTypes = {self.MSG_TX:struct.pack('<I',self.MSG_TX | self.MSG_WITNESS_FLAG),self.MSG_BLOCK:struct.pack('<I',blockType)}
+            inventoryVecs = b''.join(requestTypes.get(int.from_bytes(inventoryVecs[i:i+4],'little'),inventoryVecs[i:i+4]) + inventoryVecs[i+4:i+36]
+                                     for i in range(0,len(inventoryVecs),36))
+            # count - The number of inventoryvecs present in the payload as a variable length integer, a single byte only works up to 252
+            count = createVarInt(len(inventoryVecs)//36)
             # payload - the count and the inventory vectors 
             payload = count+inventoryVecs
             return payload
@@ -363,208 +723,185 @@ class BitcoinConnector:
             # Return an emty payload 
             return b'\x00'
 
+    def createGetHeadersCMD(self,stopHash=bytes(32)):
+        '''
+        Description:
+            Creates the getheaders payload https://en.bitcoin.it/wiki/Protocol_documentation#getheaders asking for the headers after the best chain of self.headerChain.
+            The payload has 4 components:
+                1. version              - The protocol version, 4 bytes
+                2. hash count           - The number of locator hashes, a variable length integer
+                3. block locator hashes - Hashes from our tip back to genesis, the peer replies from the first one it knows
+                4. hash_stop            - Hash of the last header wanted, all zeros to get as many as possible (2000)
+        Inputs:
+            stopHash - The 32 byte hash of the last header wanted
+        Returns:
+            payload - The payload for the getheaders message
+        '''
+        if self.headerChain is None:
+            self.headerChain = HeaderChain()
+        return self.headerChain.createGetHeadersPayload(self.protocolVersion,stopHash)
+
+    @timedParse('headers')
+    def parseHeadersPayload(self,payload,display=True):
+        '''
+        Description:
+            Parses the payload of a headers message https://en.bitcoin.it/wiki/Protocol_documentation#headers and adds the headers to self.headerChain.
+            The payload is a count followed by up to 2000 80 byte block headers, each followed by a txn_count which is always 0.
+            The proof of work of the whole message is checked in one batch, then each header is linked to its parent and its difficulty checked, see Lib/HeaderChain.py.
+        Inputs:
+            payload - Byte string or memoryview of the headers payload, the 24 byte header is not included
+            display - Boolean, set true to print a summary of the headers received
+        Returns:
+            count - The number of headers in the message, None if the payload could not be parsed
+            added - The number of new headers added to the chain
+        '''
+        if self.headerChain is None:
+            self.headerChain = HeaderChain()
+        chain = self.headerChain
+        try:
+            headers = chain.parseHeaders(payload)
+        except ValueError as e:
+            print(f'Warning: could not parse headers message of {len(payload)} Bytes, {e}')
+            return None,0
+        added,error = chain.addHeaders(headers)
+        if error:
+            print(f'Warning: headers message from peer {self.peerIP}:{self.peerPort} stopped after {added} new headers, {error}')
+        if display:
+            print(f'headers message {len(headers)} headers, {added} new, best height {chain.height} tip {chain.tipHash[::-1].hex()} {datetime.utcfromtimestamp(chain.header(chain.best).timestamp)}')
+        return len(headers),added
+
+    def syncHeaders(self,display=True):
+        '''
+        Description:
+            Downloads the headers of the peer chain into self.headerChain, headers first sync.
+            A getheaders is sent for the headers after our best chain, each headers reply is checked and added and the next getheaders is sent straight away.
+            A reply of fewer than 2000 headers means the peer has no more and the sync is finished. ping messages are answered while syncing, everything else is ignored.
+            Call after connectToPeer.
+        Inputs:
+            display - Boolean, set true to print the progress of each headers message
+        Returns:
+            added - The number of new headers added to the chain
+        '''
+        start = time.perf_counter()
+        total = 0
+        self.sendMessage(self.createMessage('getheaders',self.createGetHeadersCMD()))
+        for command,payload in self.readFrames():
+            if command == 'headers':
+                count,added = self.parseHeadersPayload(payload,display=display)
+                total += added
+                # Stop on a full message which added nothing as well, the peer is not sending headers which connect to ours
+                if count is None or count < MAX_HEADERS or added == 0:
+                    break
+                self.sendMessage(self.createMessage('getheaders',self.createGetHeadersCMD()))
+            elif command == 'ping':
+                self.sendMessage(self.createMessage('pong',bytes(payload)))
+        elapsed = time.perf_counter() - start
+        print(f'Header sync added {total} headers in {elapsed:.2f} s, best height {self.headerChain.height}')
+        return total
+
     def parseTXMsg(self,msg,display=True):
         '''
         Description:
             This function parses a message of the type tx see https://en.bitcoin.it/wiki/Protocol_documentation#tx
+            The payload is taken from the message and then parsed with the function parseTXPayload.
+        Inputs:
+            msg     - Byte string including the message header and payload
+            display - Boolean, set true if you want parsed message displayed to output 
+        Returns:
+            See parseTXPayload
+        '''
+        return self.parseTXPayload(self.getPayload(msg),display=display)
+
+    @timedParse('tx')
+    def parseTXPayload(self,payload,display=True):
+        '''
+        Description:
+            This function parses the payload of a message of the type tx see https://en.bitcoin.it/wiki/Protocol_documentation#tx
             The payload of the message will vary in length however the main components are:
                 version      - Transaction data format version
-                flag         - Indicates presence of witness data (not parsed in this function)
+                flag         - Indicates presence of witness data (SegWit transactions only)
                 tx_in count  - The number of transaction inputs
                 tx_in        - The transaction inputs
                 tx_out count - The number of transaction outputs
                 tx_out       - The transaction outputs 
-                tx_witness   - List of witness (not parsed in this function)
+                tx_witness   - List of witness (SegWit transactions only)
                 lock_time    - The block number or time at which the block is unlocked 
+            The parsing is done by the Transaction class in Lib/Transaction.py, it does not copy the payload or create a dictionary per input/output.
+            It stores the offsets of the inputs and outputs and the fields are only decoded when they are accessed.
         Inputs:
-            msg     - Byte string including the message header and payload
+            payload - Byte string or memoryview of the tx payload, the 24 byte header is not included
             display - Boolean, set true if you want parsed message displayed to output 
+            If self.mempool is set the transaction is added to it, if self.watcher is set its outputs are checked against the watch-list.
+            If self.exporter is set the transaction is added to its columns. If self.scheduler is set the request for it is marked received.
         Returns:
-            payload         - Byte string, entire payload of message 
-            version         - Byte string, version of payload 
-            txInCount       - Byte string, number of input transactions
-            transactionsIn  - List, each element in the list is a dictionary realting to a tx_in data type in Bitcoin docs
-            txOutCount      - Byte string, number of output transactions 
-            transactionsOut - List, each element in the list is a dictionary realting to a tx_out data type in bitcoin docs 
-            lockTime        - Byte string, relating to the lock time 
-        '''
-        # Sometimes the message will ony contain the first 24 bytes for some reasn 
-        # Ensure that we have the full amount first, if we only have 24 bytes
-        # call recv again the reamining message will be there 
-        payload = ''
-        # Get the length of the payload from bytes 16 to 20
-        lenghtOfPayload = int.from_bytes(msg[16:20],"little")
-        # Sometimes only first 24 bytes is sent first 
-        if (len(msg) == 24):
-            # need to call recover again to get the next part of the message which will be the payload 
-            # only accept the next lenghtOfPayload bytes specifiec in the header 
-            payload  = self.socket.recv(lenghtOfPayload) # CONVER TFROM UNISGEDN INT 
-        else:
-            # We got more than 24 bytes, but just to be sure we havent got more than we need
-            # only use the lenght of the payload specificied in the header as the source of truth 
-            payload = msg[24:24+lenghtOfPayload]
-        # version - First 4 bytes of the payload 
-        version = payload[0:4]
-        # flag    = payload[4:5] ### THIS NEVER SEEMED TO BE PRESENT IN THE MESSAGE SO LEFT OUT 
-        # txInCount - The number of transaction inputs 
-        txInCount = payload[4:5]
-        # tx start is where the transaction data starts from in bytes from start of payload
-        txstart = 5
-        if txInCount == b'\xfd':
-            # 2 byte integer 
-            txInCount = payload[5:7] # 2 byte integer
-            # update tx start 
-            txstart = 7
-        elif txInCount == b'\xfe':
-            # 4 byte integer 
-            txInCount = payload[5:9] # 4 byte integer 
-            # update tx start 
-            txstart = 9
-        elif txInCount == b'\xff':
-            # 8 byte integer 
-            txInCount = payload[5:13] # 8 byte integer
-            # update tx start 
-            txstart = 13
-        # transactionsIn - This will be a list of transactions where each element is a dictionaryrealting to a transaction 
-        transactionsIn = [] 
-        # Iterate through each of the transactions using the transaction count information we have for the number of transactions 
-        for i in range(int.from_bytes(txInCount,"little")):
-            # The previous output is 36 bytes long 
-            previousOutput = payload[txstart:txstart+36]
-            # The script lenght, 1 byte lenght of script 
-            scriptLength  = payload[txstart+36:txstart+37]
-            # The script length is optional so only enter this loop if you need to 
-            if int.from_bytes(scriptLength,"little") > 0:
-                # The script signature is gotten from the scriptLength 
-                scriptSignature = payload[txstart+37:txstart+37+int.from_bytes(scriptLength,"little")]
-                # The next 4 bytes is then the sequence 
-                sequence = payload[txstart+37+int.from_bytes(scriptLength,"little"):txstart+4+37+int.from_bytes(scriptLength,"little")]
-                # Append the traansaction to the list of transactions 
-                transactionsIn.append({'previous_output':previousOutput,'script length':scriptLength,'signature script':scriptSignature,'sequence':sequence})
-                # Need to update tx start -> The start of next tx is the end of the previous tx 
-                txstart = txstart+4+37+int.from_bytes(scriptLength,"little")
-            else:
-                # No script means we only need to take the next 4 bytes which is the sequence 
-                sequence = payload[txstart+37:4+txstart+37]
-                # Append the traansaction to the list of transactions 
-                transactionsIn.append({'previous_output':previousOutput,'script length':scriptLength,'signature script':None,'sequence':sequence})
-                # Need to update the start of transaction data
-                txstart = 4+txstart+37
-        # the tx _out count is the next byte wich is the number of transaction outputs
-        txOutCount = payload[txstart:1+txstart]
-        # The start of the txout mesages i.e 1 byte on from the end of the transactions, 1 byte in middle being the txOutCount
-        txOutStart = 1+txstart
-        if txOutCount == b'\xfd':
-            # 2 byte integer, +1 because the first byte is the var int coding byte 
-            txOutCount = payload[txOutStart+1:3+txOutStart] # 2 byte integer
-            # update tx outstart by 2 bytes  
-            txOutStart = 3+txOutStart
-        elif txOutCount == b'\xfe':
-            # 4 byte integer, +1 because the first byte is the var int coding byte
-            txOutCount = payload[txOutStart+1:5+txOutStart] # 4 byte integer 
-            # update tx start by 4 bytes
-            txOutStart = 5+txOutStart
-        elif txOutCount == b'\xff':
-            # 8 byte integer, +1 because the first byte is the var int coding byte
-            txOutCount = payload[1+txOutStart:9+txOutStart] # 8 byte integer
-            # update tx out start by 8 bytes
-            txOutStart = txOutStart+9
-            # Python runs out of memeory if we where to parse these transactions, it is a really big number so just output how many transaction threre are
-            # happens very rarely but instead of a stack trace print out this  
-            if display:
-                print('*******************TX MESSAGE*******************')
-                print(f'Warning: 8 byte transaction out count, Python will run out of memory if details shown, summary of transaction shown below. {int.from_bytes(txOutCount,"little")} transaction outputs.')
-                print(f'Length of payload  = {len(payload)} Bytes')
-                print(f'version ({len(version)} Bytes)  = {int.from_bytes(version,"little")} or {version}')
-                print(f'tx_in count ({len(txInCount)} Byte)  = {int.from_bytes(txInCount,"little")} or {txInCount}')
-                print(f'tx_out count ({len(txOutCount)} Bytes) = {int.from_bytes(txOutCount,"little")} or {txOutCount}')
-                print('******************* END OF TX MESSAGE *******************')
-            return 
-        # transactionsOut - An array of dictinaries where each dictionary is a transaction output  
-        transactionsOut = [] 
-        # Loop through each of the transactions out, we know how many output transactions are from txOutCount  
-        for i in range(int.from_bytes(txOutCount,"little")):
-            # Value - 8 bytes and is the transaction value 
-            value = payload[txOutStart:8+txOutStart]
-            # pkScriptLenght - The lenght of the pk script 1 Byte  
-            pkScriptLength = payload[8+txOutStart:9+txOutStart]
-            # If the pkScriptLenght is greater than 0 
-            if int.from_bytes(pkScriptLength,"little") > 0:
-                # pk_script - The pk script which contains the pucblic key output, the lenght is obtained from the pkScriptLength 
-                pkScript = payload[9+txOutStart:9+txOutStart+int.from_bytes(pkScriptLength,"little")]
-                # Create the transaction object 
-                transactionsOut.append({'value':value,'pk_script length':pkScriptLength,'pk_script':pkScript})
-                # Update txOutStart for the next loop to parse the next transaction out
-                txOutStart = 9+txOutStart+int.from_bytes(pkScriptLength,"little")
-            else:
-                # Create the transaction object 
-                transactionsOut.append({'value':value,'pk_script length':pkScriptLength,'pk_script':None})
-                # Update txOutStart for the next loop to parse the next transaction out
-                txOutStart = 9+txOutStart
-        # The final four bytes should be the lock_time 
-        lockTime = payload[txOutStart:]
+            transaction - Transaction instance, None if the payload could not be parsed. 
+                          If the payload is a memoryview from readFrames the transaction is only valid until the next message is read.
+        '''
+        try:
+            transaction = Transaction(payload)
+        except ValueError as e:
+            # Print a warning instead of a stack trace, a bad transaction from a peer should not stop the program
+            print(f'Warning: could not parse tx message of {len(payload)} Bytes, {e}')
+            return None
+        if self.mempool is not None:
+            self.mempool.add(transaction)
+        if self.watcher is not None:
+            self.watcher.checkTransaction(transaction)
+        if self.exporter is not None:
+            self.exporter.addTransaction(transaction)
+        if self.scheduler is not None:
+            self.scheduler.received(self,transaction.txid)
+        # The txid is only worked out if there are getdata requests waiting, a pushed transaction is not hashed for the metrics
+        if self.metrics is not None and self.metrics.pending:
+            self.metrics.arrived(transaction.txid)
         # If display is set true in input then display the transaction in nice format 
         if display:
-            self.displayTransaction(payload,version,txInCount,transactionsIn,txOutCount,transactionsOut,lockTime)
-        return payload,version,txInCount,transactionsIn,txOutCount,transactionsOut,lockTime
+            self.displayTransaction(transaction)
+        return transaction
 
-    def displayTransaction(self,payload,version,txInCount,transactionsIn,txOutCount,transactionsOut,lockTime):
+    def displayTransaction(self,transaction):
         '''
         Description:
             Displays the deatails of a tx message. 
             It is called from the parseTXMsg message when the display input is set to true. 
         Inputs:
-            payload         - Byte string, entire payload of message 
-            version         - Byte string, version of payload 
-            txInCount       - Byte string, number of input transactions
-            transactionsIn  - List, each element in the list is a dictionary realting to a tx_in data type in Bitcoin docs
-            txOutCount      - Byte string, number of output transactions 
-            transactionsOut - List, each element in the list is a dictionary realting to a tx_out data type in bitcoin docs 
-            lockTime        - Byte string, relating to the lock time 
-        '''
-        print('*******************TX MESSAGE*******************')
-        print(f'Length of payload  = {len(payload)} Bytes')
-        print(f'version ({len(version)} Bytes)  = {int.from_bytes(version,"little")} or {version}')
-        print(f'tx_in count ({len(txInCount)} Byte)  = {int.from_bytes(txInCount,"little")} or {txInCount}')
-        # Loop through the dictonary of transactions in 
-        for i in range(len(transactionsIn)):
-            print(f'\tTransaction input {i}')
-            previous_output       = transactionsIn[i]['previous_output']
-            scriptLength          = transactionsIn[i]['script length']
-            signatureScript   = transactionsIn[i]['signature script']
-            sequence          =  transactionsIn[i]['sequence']
-            print(f'\t\tprevious_output ({len(previous_output)} Bytes) = {previous_output}')
-            print(f'\t\tscript length ({len(scriptLength)} Bytes) = {int.from_bytes(scriptLength,"little")} or {scriptLength}')
-            if signatureScript:
-                print(f'\t\tscript signature ({len(signatureScript)} Bytes) = {signatureScript}')
-            else:
-                print(f'\t\tscript signature (0 Bytes) = {signatureScript}')
-            print(f'\t\tsequence ({len(sequence)} Bytes) = {sequence}')
-        print(f'tx_out count ({len(txOutCount)} Bytes) = {int.from_bytes(txOutCount,"little")} or {txOutCount}')
-        for i in range(len(transactionsOut)):
-            print(f'\tTransaction Output {i}')
-            value = transactionsOut[i]['value']
-            valueSatoshi = int.from_bytes(value,'little')
-            pkScriptLength = transactionsOut[i]['pk_script length']
-            pkScript       = transactionsOut[i]['pk_script']
-            print(f'\t\tvalue ({len(value)} Bytes) = {valueSatoshi} Satoshis ({valueSatoshi*0.00000001} BTC)')
-            print(f'\t\tpk_script length ({len(pkScriptLength)} Bytes) = {int.from_bytes(pkScriptLength,"little")} or {pkScriptLength}')
-            if pkScript:
-                print(f'\t\tpk_script ({len(pkScript)} Bytes) = {pkScript}')
-            else:
-                print(f'\t\tpk_script (0 Bytes) = {pkScript}')
-        if lockTime ==  b'\x00\x00\x00\x00':
-            print(f'lock_time ({len(lockTime)} Bytes) = {lockTime} transaction not locked')
-        elif int.from_bytes(lockTime,"little") < 500000000:
-            print(f'lock_time ({len(lockTime)} Bytes) = {lockTime}, transaction unlocked at block {int.from_bytes(lockTime,"little")}')
+            transaction - Transaction instance returned from parseTXPayload
+        '''
+        self.writeOutput('tx',transaction)
+
+    def writeOutput(self,kind,item,extra=None):
+        '''
+        Description:
+            Writes a parsed message to self.output, or prints it as text in one print call if no output sink is set.
+        Inputs:
+            kind  - String, the kind of message e.g. 'tx'
+            item  - The parsed message, see Lib/OutputSink.py createRecord
+            extra - Optional dictionary of values which are not part of the item, e.g. the merkleTime of a block
+        '''
+        if self.output is not None:
+            self.output.write(kind,item,extra)
         else:
-            print(f'lock_time ({len(lockTime)} Bytes) = {lockTime}, transaction unlocked at {datetime.utcfromtimestamp(int.from_bytes(lockTime,"little"))}')
-        print('******************* END OF TX MESSAGE *******************')
+            print(HUMAN_FORMATTER.format(createRecord(kind,item,extra)).decode('utf-8'),end='')
 
-    def parseBlockMsg(self,msg,display=True):
+    def parseBlockMsg(self,msg,display=True,verify=True):
         '''
         Description:
             This function parses a block message received after a getdata message. 
+            The payload is taken from the message and then parsed with the function parseBlockPayload.
+        Inputs:
+            msg     - Byte string of the msg of type block        
+            display - Boolean, set true if want block information printed
+            verify  - Boolean, set true to check the merkle_root before the block is returned
+        Returns:
+            See parseBlockPayload
+        '''
+        return self.parseBlockPayload(self.getPayload(msg),display=display,verify=verify)
+
+    @timedParse('block')
+    def parseBlockPayload(self,payload,display=True,verify=True):
+        '''
+        Description:
+            This function parses the payload of a block message received after a getdata message. 
             The message contains information on a new block mined 
             The payload of the message contains 8 components:
                 1. version     - The block version information 
@@ -575,87 +912,265 @@ class BitcoinConnector:
                 6. nonce       - The nonce used to generate this block 
                 7. txn_count   - The number of transactions in this block. 
                 8. txns        - The transactions in the format of tx message payloads 
+            The parsing is done by the Block class in Lib/Block.py. The header and txn_count are parsed here, 
+            the transactions are parsed one at a time by iterating block.transactions() so the whole block is never held as parsed objects.
+            When verify is set the Merkle tree is rebuilt from the txids and checked against merkle_root, a block which does not match is rejected.
+            If self.merkleExecutor is set the hashing for large blocks is spread across it, see Lib/Merkle.py.
+            If self.mempool is set the transactions in the block, and any which conflict with them, are removed from it.
+            If self.headerChain is set the block header is added to it.
+            If self.watcher is set the outputs of every transaction in the block are checked against the watch-list.
+            If self.filterIndex is set the BIP158 filter of the block is built and stored in it.
+            If self.exporter is set the block and its transactions are added to its columns.
+            If self.scheduler is set the request for the block is marked received, a block which fails the check is not so it is requested again.
         Inputs:
-            msg     - Byte string of the msg of type block        
+            payload - Byte string or memoryview of the block payload, the 24 byte header is not included
             display - Boolean, set true if want block information printed
+            verify  - Boolean, set true to check the merkle_root before the block is returned
         Returns:
-            payload     - Byte string of the entire payload 
-            version     - Byte string relating to the version 
-            prevBlock   - Byte string of the previous blocks hash 
-            merkle_root - Byte string of the merkle tree collection 
-            timestamp   - Byte string of the timestamp of when the block was created
-            bits        - Byte string of the difficulity target for the block
-            nonce       - Byte string of the nonce to generate this block 
-            txn_count   - Byte string of the transaction count
-        '''
-        # Sometimes the message will ony contain the first 24 bytes for some reason (the header)
-        # Ensure that we have the full amount first, if we only have 24 bytes
-        # call recv again the reamining message will be there 
-        payload = ''
-        # Get the length of the payload from bytes 16 to 20
-        lenghtOfPayload = int.from_bytes(msg[16:20],"little")
-        # Sometimes only first 24 bytes is sent first 
-        if (len(msg) == 24):
-            # need to call recover again to get the next part of the message which will be the payload 
-            # only accept the next lenghtOfPayload bytes specifiec in the header 
-            payload  = self.socket.recv(lenghtOfPayload)  
-        else:
-            # We got more than 24 bytes, but just to be sure we havent got more than we need
-            # only use the lenght of the payload specificied in the header as the source of truth 
-            payload = msg[24:24+lenghtOfPayload]
-        # version - 4 bytes relating to the block version 
-        version    = payload[0:4]
-        # prev_block - 32 bytes relating to the hash value of the previous block 
-        prevBlock  = payload[4:36]
-        # merkle_root - 32 bytes, reference to merkle tree collection which is hash of all transactions realted to block 
-        merkleRoot = payload[36:68] 
-        # timestamp - 4 bytes, a unix timestamp for when this block was created
-        timestamp = payload[68:72]
-        # bits - 4 bytes the calculated difficulty target 
-        bits = payload[72:76]
-        # nonce - 4 bytes the nonce used to generate this block 
-        nonce = payload[76:80]
-        # txn_count - The number of transactions in the block 
-        txn_count = payload[80:81]
-        # parse variable lenght integer see https://wiki.bitcoinsv.io/index.php/VarInt#:~:text=A%20VarInt%20or%20%22Variable%20Integer,of%20the%20object%20being%20defined.
-        if txn_count == b'\xfd':
-            # 2 byte integer 
-            txn_count = payload[81:83] # 2 byte integer
-        elif txn_count == b'\xfe':
-            # 4 byte integer 
-            txn_count = payload[81:85] # 4 byte integer 
-        elif txn_count == b'\xff':
-            # 8 byte integer 
-            txn_count = payload[81:89] # 8 byte integer
-        # If you want to get the actual tx messages they are wahtever now remains in the payload 
-
+            block - Block instance, None if the payload could not be parsed or the merkle_root does not match.
+                    If the payload is a memoryview from readFrames the block is only valid until the next message is read.
+        '''
+        try:
+            block = Block(payload)
+            # Check the merkle root before anything else uses the block 
+            merkleTime = None
+            if verify:
+                valid,root,merkleTime = verifyMerkleRoot(block,executor=self.merkleExecutor)
+                if not valid:
+                    print(f'Warning: rejected block {block.header.hash[::-1].hex()}, merkle root {root[::-1].hex()} does not match the header, checked in {merkleTime*1000:.2f} ms')
+                    return None
+            if self.mempool is not None:
+                self.mempool.removeForBlock(block)
+            if self.watcher is not None:
+                self.watcher.checkBlock(block)
+            if self.filterIndex is not None:
+                self.filterIndex.addBlock(block)
+            if self.exporter is not None:
+                self.exporter.addBlock(block)
+            if self.headerChain is not None:
+                added,error = self.headerChain.addHeader(block.header)
+                if error:
+                    print(f'Warning: header of block {block.header.hash[::-1].hex()} not added to the header chain, {error}')
+            if self.metrics is not None:
+                self.metrics.arrived(block.header.hash)
+            if self.scheduler is not None:
+                self.scheduler.received(self,block.header.hash)
+        except ValueError as e:
+            # Print a warning instead of a stack trace, a bad block from a peer should not stop the program
+            print(f'Warning: could not parse block message of {len(payload)} Bytes, {e}')
+            return None
         # If display passed then display the block message in nice format 
         if display:
-            self.displayBlock(payload,version,prevBlock,merkleRoot,timestamp,bits,nonce,txn_count)
-        return payload,version,prevBlock,merkleRoot,timestamp,bits,nonce,txn_count
+            self.displayBlock(block,merkleTime)
+        return block
+
+    def createSendCmpctCMD(self,announce=True):
+        '''
+        Description:
+            Creates the sendcmpct payload https://github.com/bitcoin/bips/blob/master/bip-0152.mediawiki telling the peer we support version 2 compact blocks.
+            Send it straight after connectToPeer.
+        Inputs:
+            announce - Boolean, True asks the peer to push new blocks as cmpctblock without an inv first, the lowest latency
+        Returns:
+            payload - The payload for the sendcmpct message
+        '''
+        return createSendCmpctPayload(announce,COMPACT_VERSION)
+
+    @timedParse('sendcmpct')
+    def parseSendCmpctPayload(self,payload,display=True):
+        '''
+        Description:
+            Parses a sendcmpct message from the peer. If the peer supports version 2 compact blocks, blocks are requested from it as cmpctblock from then on.
+        Inputs:
+            payload - Byte string or memoryview of the sendcmpct payload
+            display - Boolean, set true to print the version the peer supports
+        Returns:
+            version - The compact block version agreed, None if the peer does not support version 2
+        '''
+        try:
+            announce,version = parseSendCmpctPayload(payload)
+        except ValueError as e:
+            print(f'Warning: could not parse sendcmpct message, {e}')
+            return self.compactBlockVersion
+        if version == COMPACT_VERSION:
+            self.compactBlockVersion = version
+            if self.scheduler is not None:
+                self.scheduler.blockRequestType = MSG_CMPCT_BLOCK
+        if display:
+            print(f'sendcmpct from peer {self.peerIP}:{self.peerPort} version {version} announce {announce}')
+        return self.compactBlockVersion
+
+    @timedParse('cmpctblock')
+    def parseCmpctBlockPayload(self,payload,display=True):
+        '''
+        Description:
+            Parses a cmpctblock message and rebuilds the block from the transactions in self.mempool.
+            If every transaction is found the block is parsed and verified with parseBlockPayload straight away,
+            otherwise the compact block is kept in self.partialBlocks and a getblocktxn request for the missing transactions is returned.
+            A block which fails the Merkle root check after being rebuilt (a short ID matched the wrong transaction), or where two transactions share a short ID, is requested in full with getdata.
+        Inputs:
+            payload - Byte string or memoryview of the cmpctblock payload, the 24 byte header is not included
+            display - Boolean, set true to print a summary of the compact block and the rebuilt block
+        Returns:
+            block   - Block instance from parseBlockPayload, None if the block is not complete yet or could not be parsed
+            request - Tuple (command, payload) of the message to send the peer next (getblocktxn or getdata), None if nothing needs sending
+        '''
+        start = time.perf_counter()
+        try:
+            compactBlock = CompactBlock(payload)
+        except ShortIDCollision as e:
+            # Nothing is wrong with the block, it just can not be rebuilt from short IDs
+            print(f'Warning: cmpctblock {e.blockHash[::-1].hex()} can not be rebuilt, {e}, requesting the full block')
+            if self.inventoryCache is not None:
+                self.inventoryCache.add(e.blockHash)
+            if self.scheduler is not None:
+                self.scheduler.received(self,e.blockHash)
+            return None,self.createFullBlockRequest(e.blockHash)
+        except ValueError as e:
+            print(f'Warning: could not parse cmpctblock message of {len(payload)} Bytes, {e}')
+            return None,None
+        # The block may be announced again with inv, it does not need requesting
+        if self.inventoryCache is not None:
+            self.inventoryCache.add(compactBlock.hash)
+        # The cmpctblock answers the getdata for the block
+        if self.scheduler is not None:
+            self.scheduler.received(self,compactBlock.hash)
+        found = 0
+        if self.mempool is not None:
+            found = compactBlock.fill((entry.wtxid,entry.raw) for entry in self.mempool.entries.values())
+        missing = compactBlock.missing()
+        if display:
+            print(f'cmpctblock {compactBlock.hash[::-1].hex()} {compactBlock.size} Bytes, {len(compactBlock)} transactions, {found} found in the mempool, '
+                  f'{len(missing)} missing, rebuilt in {(time.perf_counter()-start)*1000:.2f} ms')
+        if missing:
+            self.partialBlocks[compactBlock.hash] = compactBlock
+            while len(self.partialBlocks) > 8:
+                self.partialBlocks.popitem(last=False)
+            return None,('getblocktxn',createGetBlockTxnPayload(compactBlock.hash,missing))
+        return self.completeCompactBlock(compactBlock,display)
+
+    @timedParse('blocktxn')
+    def parseBlockTxnPayload(self,payload,display=True):
+        '''
+        Description:
+            Parses a blocktxn message, the transactions missing from a compact block, and completes the block.
+        Inputs:
+            payload - Byte string or memoryview of the blocktxn payload, the 24 byte header is not included
+            display - Boolean, set true to print the rebuilt block
+        Returns:
+            See parseCmpctBlockPayload
+        '''
+        try:
+            blockHash,transactions = parseBlockTxnPayload(payload)
+            compactBlock = self.partialBlocks.pop(blockHash,None)
+            if compactBlock is None:
+                print(f'Warning: blocktxn for block {blockHash[::-1].hex()} which is not waiting for transactions')
+                return None,None
+            compactBlock.addBlockTxn(transactions)
+        except ValueError as e:
+            print(f'Warning: could not use blocktxn message of {len(payload)} Bytes, {e}')
+            return None,None
+        return self.completeCompactBlock(compactBlock,display)
+
+    def completeCompactBlock(self,compactBlock,display=True):
+        '''
+        Description:
+            Parses the full block rebuilt from a compact block with parseBlockPayload, which checks the Merkle root.
+        Inputs:
+            compactBlock - CompactBlock with every transaction filled in
+            display      - Boolean, set true to print the block
+        Returns:
+            See parseCmpctBlockPayload
+        '''
+        block = self.parseBlockPayload(compactBlock.serialize(),display=display)
+        if block is None:
+            # Fall back to downloading the whole block
+            return None,self.createFullBlockRequest(compactBlock.hash)
+        return block,None
+
+    def createFullBlockRequest(self,blockHash):
+        '''
+        Description:
+            Creates the getdata asking for a whole block with its witness, used when a compact block can not be rebuilt.
+        Inputs:
+            blockHash - The 32 byte hash of the block
+        Returns:
+            request - Tuple ('getdata', payload)
+        '''
+        return ('getdata',createVarInt(1) + struct.pack('<I',self.MSG_BLOCK | self.MSG_WITNESS_FLAG) + blockHash)
+
+    def createGetAddrCMD(self):
+        '''
+        Description:
+            Creates the getaddr payload, which is empty, asking the peer for the addresses of other nodes. It replies with addr or addrv2 messages.
+        Returns:
+            payload - The payload for the getaddr message
+        '''
+        return b''
+
+    @timedParse('addr')
+    def parseAddrPayload(self,payload,display=True):
+        '''
+        Description:
+            Parses an addr message and adds the addresses to self.addressBook if it is set.
+        Inputs:
+            payload - Byte string or memoryview of the payload
+            display - Boolean, set true to print the number of addresses received and added
+        Returns:
+            addresses - List of (timestamp, services, 16 byte address, port), None if the message could not be parsed
+        '''
+        try:
+            addresses = parseAddrPayload(payload)
+        except ValueError as e:
+            print(f'Warning: could not parse addr message of {len(payload)} Bytes, {e}')
+            return None
+        return self.addAddresses(addresses,0,display,'addr')
+
+    @timedParse('addrv2')
+    def parseAddrV2Payload(self,payload,display=True):
+        '''
+        Description:
+            Parses an addrv2 message (BIP155) and adds the IPv4 and IPv6 addresses to self.addressBook if it is set, the other networks are counted and skipped.
+        Inputs:
+            payload - Byte string or memoryview of the payload
+            display - Boolean, set true to print the number of addresses received and added
+        Returns:
+            addresses - List of (timestamp, services, 16 byte address, port), None if the message could not be parsed
+        '''
+        try:
+            addresses,skipped = parseAddrV2Payload(payload)
+        except ValueError as e:
+            print(f'Warning: could not parse addrv2 message of {len(payload)} Bytes, {e}')
+            return None
+        return self.addAddresses(addresses,skipped,display,'addrv2')
+
+    def addAddresses(self,addresses,skipped,display,command):
+        '''
+        Description:
+            Adds the addresses parsed from an addr or addrv2 message to self.addressBook if it is set.
+        Inputs:
+            addresses - List of (timestamp, services, 16 byte address, port)
+            skipped   - The number of addresses on networks which are not kept
+            display   - Boolean, set true to print the number of addresses received and added
+            command   - 'addr' or 'addrv2', for the display
+        Returns:
+            addresses - The addresses passed in
+        '''
+        added = 0
+        if self.addressBook is not None:
+            added = self.addressBook.addMany(addresses)
+            self.addressBook.counters['skippedNetworks'] += skipped
+        if display:
+            print(f'{command} from peer {self.peerIP}:{self.peerPort} with {len(addresses)+skipped} addresses, {added} new')
+        return addresses
 
-    def displayBlock(self,payload,version,prevBlock,merkleRoot,timestamp,bits,nonce,txn_count):
+    def displayBlock(self,block,merkleTime=None):
         '''
         Description:
             Used to print out the information related to a block message.
             It is called from the function parseBlockMsg wen display is set true. 
         Inputs:
-            payload     - Byte string of the entire block message payload
-            version     - Byte string relating to the version 
-            prevBlock   - Byte string of the previous blocks hash 
-            merkle_root - Byte string of the merkle tree collection 
-            timestamp   - Byte string of the timestamp of when the block was created
-            bits        - Byte string of the difficulity target for the block
-            nonce       - Byte string of the nonce to generate this block 
-            txn_count   - Byte string of the transaction count
-        '''
-        print('*******************BLOCK MESSAGE*******************')
-        print(f'Length of payload  = {len(payload)} Bytes')
-        print(f'version ({len(version)} Bytes)  = {version}')
-        print(f'prev_block hash ({len(prevBlock)} Bytes) = {prevBlock}')
-        print(f'merkleRoot ({len(merkleRoot)} Bytes) = {merkleRoot}')
-        print(f'timestamp ({len(timestamp)} Bytes) = {datetime.utcfromtimestamp(int.from_bytes(timestamp,"little"))}')
-        print(f'difficulty target ({len(bits)} Bytes) = {int.from_bytes(bits,"little")} or {bits}')
-        print(f'nonce ({len(nonce)} Bytes) = {int.from_bytes(nonce,"little")} or {nonce}')
-        print(f'txn count ({len(txn_count)} Bytes) = {int.from_bytes(txn_count,"little")} or {txn_count}')
-        print('****************END OF BLOCK MESSAGE***************')
+            block      - Block instance returned from parseBlockPayload
+            merkleTime - Seconds taken to verify the merkle root, None if it was not verified
+        '''
+        self.writeOutput('block',block,{'merkleTime':merkleTime})
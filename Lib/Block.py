@@ -0,0 +1,143 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the classes BlockHeader and Block
+#   A Block parses the payload of a block message, see https://en.bitcoin.it/wiki/Protocol_documentation#block
+#   The 80 byte header and the txn_count are read straight away, the transactions are walked one at a time by the generator Block.transactions.
+#   This means a 2-4 MB block never has thousands of parsed transactions in memory at once and a caller can stop as soon as it has what it needs.
+#   Like Transaction nothing is copied out of the payload, every field is decoded from it when accessed.
+
+
+## Imports ##
+# struct      - https://docs.python.org/3/library/struct.html
+# hashlib     - https://docs.python.org/3/library/hashlib.html
+# array       - https://docs.python.org/3/library/array.html
+# Transaction - Class developed for this project which parses a single transaction, see Lib/Transaction.py
+import struct
+import hashlib
+from array import array
+from Lib.Transaction import Transaction,readVarInt,hashSegments,UINT32,INT32
+
+# HEADER_LENGTH - A block header is always 80 bytes
+HEADER_LENGTH = 80
+
+class BlockHeader:
+    # __slots__ - No per object dictionary, a header is just a reference to the payload and where it starts
+    __slots__ = ('payload','start')
+
+    def __init__(self,payload,offset=0):
+        '''
+        Description:
+            initiliaser method for the class. The header is made up of:
+                1. version     - The block version information, 4 bytes
+                2. prev_block  - The hash value of the previous block, 32 bytes
+                3. merkle_root - The hash of all transactions related to this block, 32 bytes
+                4. timestamp   - The timestamp for when this block was created, 4 bytes
+                5. bits        - The calculated difficulity of the block, 4 bytes
+                6. nonce       - The nonce used to generate this block, 4 bytes
+        Inputs:
+            payload - Byte string or memoryview containing the header
+            offset  - Index in payload where the header starts, used when there are many headers in one message
+        Raises:
+            ValueError - If there is not 80 bytes from offset
+        '''
+        if not isinstance(payload,memoryview):
+            payload = memoryview(payload)
+        if len(payload) - offset < HEADER_LENGTH:
+            raise ValueError('Block header is truncated')
+        self.payload = payload
+        self.start   = offset
+
+    @property
+    def version(self):
+        return INT32.unpack_from(self.payload,self.start)[0]
+
+    @property
+    def prevBlock(self):
+        # Hash of the previous block, internal byte order
+        return bytes(self.payload[self.start+4:self.start+36])
+
+    @property
+    def merkleRoot(self):
+        # Merkle root of the transactions in the block, internal byte order
+        return bytes(self.payload[self.start+36:self.start+68])
+
+    @property
+    def timestamp(self):
+        return UINT32.unpack_from(self.payload,self.start+68)[0]
+
+    @property
+    def bits(self):
+        return UINT32.unpack_from(self.payload,self.start+72)[0]
+
+    @property
+    def nonce(self):
+        return UINT32.unpack_from(self.payload,self.start+76)[0]
+
+    @property
+    def raw(self):
+        # memoryview of the 80 header bytes
+        return self.payload[self.start:self.start+HEADER_LENGTH]
+
+    @property
+    def hash(self):
+        # The block hash is the SHA256(SHA256(header)), internal byte order (reverse it for the usual hex display)
+        return hashlib.sha256(hashlib.sha256(self.raw).digest()).digest()
+
+class Block:
+    # __slots__ - No per object dictionary
+    __slots__ = ('payload','header','txCount','txStart')
+
+    def __init__(self,payload):
+        '''
+        Description:
+            Parses the header and txn_count of a block payload. The transactions are not parsed until Block.transactions is iterated.
+        Inputs:
+            payload - Byte string or memoryview of the block payload, the 24 byte message header is not included
+        Raises:
+            ValueError - If the payload is too short to hold the header and txn_count
+        '''
+        if not isinstance(payload,memoryview):
+            payload = memoryview(payload)
+        self.payload = payload
+        self.header  = BlockHeader(payload,0)
+        try:
+            # txn_count - varint straight after the header, txStart is where the first transaction starts
+            self.txCount,self.txStart = readVarInt(payload,HEADER_LENGTH)
+        except (IndexError,struct.error):
+            raise ValueError('Block txn_count is truncated')
+
+    def transactions(self):
+        '''
+        Description:
+            Generator which parses and yields the transactions in the block one at a time in a single pass.
+            Each transaction starts where the previous one ended. Stopping the generator early means the rest of the block is never parsed.
+        Returns:
+            transaction - Transaction instance, its payload is the block payload and transaction.start/transaction.end give its position
+        Raises:
+            ValueError - If a transaction is truncated or bytes remain after the last transaction
+        '''
+        payload  = self.payload
+        position = self.txStart
+        for i in range(self.txCount):
+            transaction = Transaction(payload,position)
+            position    = transaction.end
+            yield transaction
+        if position != len(payload):
+            raise ValueError(f'{len(payload)-position} Bytes left over after the last of {self.txCount} transactions')
+
+    def txids(self,witness=False):
+        '''
+        Description:
+            Computes the txid (or wtxid) of every transaction in the block through the batched hashing path.
+            The block is walked once to collect the byte ranges and then every transaction is hashed in one call of hashSegments.
+        Inputs:
+            witness - Boolean, if True the wtxids are computed instead of the txids
+        Returns:
+            hashes - List of 32 byte hashes in internal byte order, in block order
+        '''
+        segments = array('Q')
+        for transaction in self.transactions():
+            segments.extend(transaction.wtxidSegments() if witness else transaction.txidSegments())
+        return hashSegments(self.payload,segments)
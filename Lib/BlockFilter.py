@@ -0,0 +1,366 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the classes BlockFilter and FilterIndex and the functions which build and match BIP158 Golomb-coded set filters, see https://github.com/bitcoin/bips/blob/master/bip-0158.mediawiki
+#   A basic block filter is a compact probabilistic set of the scripts a block touches, a wallet can check its scripts against a filter of a few KB
+#   instead of downloading and parsing the whole block. The filter is built as follows:
+#       1. The items are the output scripts of every transaction in the block (excluding OP_RETURN and empty scripts) and the scripts of the outputs the block spends
+#       2. Each item is hashed with SipHash-2-4, keyed with the first 16 bytes of the block hash, and mapped onto the range [0, N*M)
+#       3. The hashes are sorted and the differences between them are Golomb-Rice coded, the top bits in unary and the low P bits as they are
+#   With P = 19 and M = 784931 an item which is not in the block matches with a probability of 1/M and each item costs about 21 bits.
+#   The filter header chains the filters, double SHA256 of the filter hash and the previous filter header, so a peer can not hand out a different filter for one block.
+#   A block message does not hold the scripts of the outputs it spends, they are only added when a prevoutScript lookup (e.g. a UTXO set or RPC) is given.
+#   Without it the filters only cover the outputs, they will still find payments to a wallet but the filter headers do not match the headers of the network.
+#   The FilterIndex keeps the filters on disk in two append-only files, like a CaptureLog segment:
+#       1. filters.dat - The filters written one after the other
+#       2. filters.idx - One fixed size record per block, see RECORD below
+
+
+## Imports ##
+# os          - https://docs.python.org/3/library/os.html
+# struct      - https://docs.python.org/3/library/struct.html
+# hashlib     - https://docs.python.org/3/library/hashlib.html
+# SipHash     - Function developed for this project which computes SipHash-2-4, see Lib/SipHash.py
+# Transaction - readVarInt and createVarInt read and write the item count at the start of a filter, see Lib/Transaction.py
+import os
+import struct
+import hashlib
+from Lib.SipHash import siphash
+from Lib.Transaction import readVarInt,createVarInt
+
+# BASIC_FILTER - The filter type of the BIP158 basic filter
+BASIC_FILTER = 0
+# FILTER_P, FILTER_M - The Golomb-Rice parameter and the inverse false positive rate of the basic filter
+FILTER_P = 19
+FILTER_M = 784931
+# OP_RETURN - Output scripts starting with OP_RETURN can not be spent and are left out of the filter
+OP_RETURN = 0x6a
+# ZERO_HEADER - The previous filter header of the genesis block
+ZERO_HEADER = bytes(32)
+# RECORD - The index record of one filter, 76 bytes, little endian
+#   blockHash (32s)    - The block hash, internal byte order
+#   filterHeader (32s) - The filter header, internal byte order
+#   offset (Q)         - Index of the filter in filters.dat
+#   length (I)         - The filter length
+RECORD = struct.Struct('<32s32sQI')
+
+def doubleSha256(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+def filterKey(blockHash):
+    '''
+    Description:
+        The SipHash key of a block filter, the first 16 bytes of the block hash as two little endian 64 bit words.
+    Inputs:
+        blockHash - 32 byte block hash, internal byte order
+    Returns:
+        k0,k1 - The key as two integers
+    '''
+    return struct.unpack_from('<QQ',blockHash,0)
+
+def hashedItems(blockHash,items,count,M=FILTER_M):
+    '''
+    Description:
+        Hashes items onto the range [0, count*M), the hash_to_range of BIP158.
+        The 64 bit SipHash is multiplied by the range and the top 64 bits kept, a fast way to map it onto the range without a division.
+    Inputs:
+        blockHash - 32 byte block hash, the SipHash key is taken from it
+        items     - Iterable of byte strings
+        count     - The number of items in the filter, N
+        M         - The inverse false positive rate
+    Returns:
+        values - List of the hashed values, in the order of items
+    '''
+    k0,k1 = filterKey(blockHash)
+    scale = count*M
+    return [(siphash(k0,k1,item)*scale) >> 64 for item in items]
+
+def encodeFilter(blockHash,items,P=FILTER_P,M=FILTER_M):
+    '''
+    Description:
+        Builds a Golomb-coded set from a set of items.
+        Each difference is written as a string of bits, '1' * quotient + '0' + the P low bits, the strings are joined and turned into bytes with one int call
+        which is far quicker than setting the bits one at a time.
+    Inputs:
+        blockHash - 32 byte block hash, the SipHash key is taken from it
+        items     - Set of byte strings, duplicates must already be removed
+        P         - The Golomb-Rice parameter
+        M         - The inverse false positive rate
+    Returns:
+        filter - Byte string, the item count as a varint followed by the coded differences padded to a whole byte
+    '''
+    count = len(items)
+    if count == 0:
+        return createVarInt(0)
+    mask,bitFormat = (1 << P) - 1,f'0{P}b'
+    pieces,last = [],0
+    for value in sorted(hashedItems(blockHash,items,count,M)):
+        delta,last = value - last,value
+        pieces.append('1'*(delta >> P) + '0' + format(delta & mask,bitFormat))
+    bits = ''.join(pieces)
+    bits += '0'*(-len(bits) % 8)
+    return createVarInt(count) + int(bits,2).to_bytes(len(bits)//8,'big')
+
+def decodeFilter(data,P=FILTER_P):
+    '''
+    Description:
+        Generator which decodes the sorted hashed values of a Golomb-coded set.
+    Inputs:
+        data - Byte string or memoryview of the filter
+        P    - The Golomb-Rice parameter
+    Returns:
+        value - Each hashed value in ascending order
+    Raises:
+        ValueError - If the filter ends before all of its items are read
+    '''
+    count,start = readVarInt(data,0)
+    # The bits as a string of '0' and '1', the leading 1 keeps the leading zero bits of the first byte
+    bits = bin(int.from_bytes(b'\x01' + bytes(data[start:]),'big'))[3:]
+    position,value = 0,0
+    for i in range(count):
+        stop = bits.find('0',position)
+        if stop < 0 or stop + 1 + P > len(bits):
+            raise ValueError(f'filter of {count} items ends after {i}')
+        value   += ((stop - position) << P) | int(bits[stop+1:stop+1+P],2)
+        position = stop + 1 + P
+        yield value
+
+def filterItems(block,prevoutScript=None):
+    '''
+    Description:
+        Collects the items of the basic filter of a block.
+    Inputs:
+        block         - Block instance
+        prevoutScript - Optional function called as prevoutScript(previousHash, previousIndex) which returns the script of a spent output, or None if not known.
+                        Not called for the coinbase
+    Returns:
+        items   - Set of byte strings
+        missing - The number of spent outputs whose script was not found (all of them when prevoutScript is None)
+    '''
+    items,missing = set(),0
+    for number,transaction in enumerate(block.transactions()):
+        payload = transaction.payload
+        offsets = transaction.outputOffsets
+        for i in range(0,len(offsets),3):
+            start,end = offsets[i+1],offsets[i+2]
+            if end > start and payload[start] != OP_RETURN:
+                items.add(bytes(payload[start:end]))
+        if number == 0:
+            continue
+        if prevoutScript is None:
+            missing += transaction.inputCount
+            continue
+        for txIn in transaction.inputs():
+            script = prevoutScript(bytes(txIn.previousHash),txIn.previousIndex)
+            if script is None:
+                missing += 1
+            elif script:
+                items.add(bytes(script))
+    return items,missing
+
+class BlockFilter:
+    # __slots__ - No per object dictionary, a filter is its block hash and bytes
+    __slots__ = ('blockHash','data')
+
+    def __init__(self,blockHash,data):
+        '''
+        Description:
+            initiliaser method for the class, a basic filter of one block
+        Inputs:
+            blockHash - 32 byte block hash, internal byte order
+            data      - Byte string of the serialized filter
+        '''
+        self.blockHash = blockHash
+        self.data      = data
+
+    @classmethod
+    def fromBlock(cls,block,prevoutScript=None):
+        '''
+        Description:
+            Builds the basic filter of a block.
+        Inputs:
+            block         - Block instance
+            prevoutScript - Optional lookup of the scripts of spent outputs, see filterItems
+        Returns:
+            blockFilter - BlockFilter instance
+            missing     - The number of spent outputs left out as their script was not found
+        '''
+        blockHash = block.header.hash
+        items,missing = filterItems(block,prevoutScript)
+        return cls(blockHash,encodeFilter(blockHash,items)),missing
+
+    def __len__(self):
+        # The number of items in the filter
+        return readVarInt(self.data,0)[0]
+
+    @property
+    def hash(self):
+        return doubleSha256(self.data)
+
+    def header(self,previousHeader=ZERO_HEADER):
+        '''
+        Description:
+            Works out the filter header, double SHA256 of the filter hash and the header of the previous block's filter.
+        Inputs:
+            previousHeader - The filter header of the previous block, 32 zero bytes for the genesis block
+        Returns:
+            header - 32 byte filter header, internal byte order
+        '''
+        return doubleSha256(self.hash + previousHeader)
+
+    def match(self,scripts):
+        '''
+        Description:
+            Finds which scripts may be in the block. The scripts are hashed and sorted then walked alongside the filter, so the filter is decoded once
+            and the walk stops once the largest script hash is passed. A script which is not in the block is matched with a probability of 1/M.
+        Inputs:
+            scripts - Iterable of byte strings, e.g. the output scripts of a wallet
+        Returns:
+            matched - Set of the scripts which match
+        '''
+        count = len(self)
+        scripts = list(scripts)
+        if count == 0 or not scripts:
+            return set()
+        queries = sorted(zip(hashedItems(self.blockHash,scripts,count),scripts))
+        matched,i = set(),0
+        for value in decodeFilter(self.data):
+            while i < len(queries) and queries[i][0] < value:
+                i += 1
+            if i == len(queries):
+                break
+            while i < len(queries) and queries[i][0] == value:
+                matched.add(queries[i][1])
+                i += 1
+        return matched
+
+class FilterIndex:
+    def __init__(self,directory,prevoutScript=None):
+        '''
+        Description:
+            initiliaser method for the class, opens the index in a directory and reads the records of the filters already in it
+        Inputs:
+            directory     - The directory the files are kept in, created if it does not exist
+            prevoutScript - Optional lookup of the scripts of spent outputs used when building filters, see filterItems
+        '''
+        self.directory     = directory
+        self.prevoutScript = prevoutScript
+        os.makedirs(directory,exist_ok=True)
+        dataPath = os.path.join(directory,'filters.dat')
+        idxPath  = os.path.join(directory,'filters.idx')
+        # records - Dictionary of block hash -> (filter header, offset, length), in the order the filters were added
+        self.records = {}
+        if os.path.exists(idxPath):
+            with open(idxPath,'rb') as idxFile:
+                data = idxFile.read()
+            dataSize = os.path.getsize(dataPath) if os.path.exists(dataPath) else 0
+            # A record cut short by a crash, or whose filter did not reach the disk, is dropped and the filter is built again the next time the block is seen
+            for blockHash,header,offset,length in RECORD.iter_unpack(data[:len(data) - len(data) % RECORD.size]):
+                if offset + length <= dataSize:
+                    self.records[blockHash] = (header,offset,length)
+        self.dataFile = open(dataPath,'a+b')
+        self.idxFile  = open(idxPath,'ab')
+        # offset - The size of the data file, where the next filter is written
+        self.offset = self.dataFile.seek(0,os.SEEK_END)
+        # stats - Filters added, the spent output scripts which were not found, and the total filter bytes
+        self.stats = {'filters':0,'missingPrevouts':0,'bytes':0}
+
+    def addBlock(self,block):
+        '''
+        Description:
+            Builds the filter of a block and appends it and its record to the index. A block already in the index is not added again.
+            The filter header chains from the header of the previous block if it is in the index, otherwise it starts from 32 zero bytes
+            as at the genesis block, so the headers of an index started part way up the chain do not match the network's.
+        Inputs:
+            block - Block instance
+        Returns:
+            header - The filter header of the block
+        '''
+        blockHash = block.header.hash
+        record = self.records.get(blockHash)
+        if record is not None:
+            return record[0]
+        blockFilter,missing = BlockFilter.fromBlock(block,self.prevoutScript)
+        previous = self.records.get(bytes(block.header.prevBlock))
+        header   = blockFilter.header(previous[0] if previous is not None else ZERO_HEADER)
+        self.dataFile.write(blockFilter.data)
+        self.idxFile.write(RECORD.pack(blockHash,header,self.offset,len(blockFilter.data)))
+        self.records[blockHash] = (header,self.offset,len(blockFilter.data))
+        self.offset += len(blockFilter.data)
+        self.stats['filters']         += 1
+        self.stats['missingPrevouts'] += missing
+        self.stats['bytes']           += len(blockFilter.data)
+        return header
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self,blockHash):
+        return blockHash in self.records
+
+    def filterHeader(self,blockHash):
+        '''
+        Description:
+            Gets the filter header of a block.
+        Inputs:
+            blockHash - 32 byte block hash, internal byte order
+        Returns:
+            header - 32 byte filter header, None if the block is not in the index
+        '''
+        record = self.records.get(blockHash)
+        return record[0] if record is not None else None
+
+    def getFilter(self,blockHash):
+        '''
+        Description:
+            Reads the filter of a block from disk.
+        Inputs:
+            blockHash - 32 byte block hash, internal byte order
+        Returns:
+            blockFilter - BlockFilter instance, None if the block is not in the index
+        '''
+        record = self.records.get(blockHash)
+        if record is None:
+            return None
+        header,offset,length = record
+        # Buffered writes are flushed first so a filter just added can be read back
+        self.dataFile.flush()
+        self.dataFile.seek(offset)
+        return BlockFilter(blockHash,self.dataFile.read(length))
+
+    def scan(self,scripts,blockHashes=None):
+        '''
+        Description:
+            Generator which checks scripts against many blocks, only the filter of each block is read from disk.
+        Inputs:
+            scripts     - Iterable of byte strings, e.g. the output scripts of a wallet
+            blockHashes - Iterable of the block hashes to check, None for every block in the index in the order they were added
+        Returns:
+            blockHash - The hash of each block which may touch one of the scripts
+            matched   - Set of the scripts which matched in that block
+        '''
+        scripts = [bytes(script) for script in scripts]
+        for blockHash in (blockHashes if blockHashes is not None else list(self.records)):
+            blockFilter = self.getFilter(blockHash)
+            if blockFilter is None:
+                continue
+            matched = blockFilter.match(scripts)
+            if matched:
+                yield blockHash,matched
+
+    def flush(self):
+        self.dataFile.flush()
+        self.idxFile.flush()
+
+    def close(self):
+        '''
+        Description:
+            Flushes and closes both files.
+        '''
+        if self.dataFile is not None:
+            self.dataFile.close()
+            self.dataFile = None
+        if self.idxFile is not None:
+            self.idxFile.close()
+            self.idxFile = None
@@ -0,0 +1,329 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the classes CaptureLog and CaptureReader
+#   CaptureLog records every framed message received so it can be replayed later without connecting to a peer.
+#   The capture is a directory of numbered segments, each segment is two append-only files:
+#       1. capture-NNNNNN.dat - The message payloads written one after the other
+#       2. capture-NNNNNN.idx - One fixed size record per message, see RECORD below
+#   A new segment is started once the data file reaches segmentBytes so no single file grows forever.
+#   CaptureReader memory maps both files of every segment, a payload is a memoryview into the map so replaying days of traffic never loads a whole segment into RAM.
+#   The records are written in time order so a time range is found with a binary search, scanning by command only reads the 12 command bytes of each record.
+
+
+## Imports ##
+# os     - https://docs.python.org/3/library/os.html
+# time   - https://docs.python.org/3/library/time.html
+# mmap   - https://docs.python.org/3/library/mmap.html
+# socket - https://docs.python.org/3/library/socket.html
+# struct - https://docs.python.org/3/library/struct.html
+import os
+import time
+import mmap
+import socket
+import struct
+
+# RECORD - The index record of one message, 52 bytes, little endian
+#   timestamp (d) - time.time() the message was received
+#   offset (Q)    - Index of the payload in the segment data file
+#   length (I)    - The payload length
+#   command (12s) - The command name padded with nulls, as in the message header
+#   ip (16s)      - The peer IP address as an IPv6 address, IPv4 addresses are IPv4 mapped (::ffff:a.b.c.d)
+#   port (H)      - The peer port
+RECORD = struct.Struct('<dQI12s16sH2x')
+# COMMAND_OFFSET - Index of the command in a record, used to scan by command without unpacking the whole record
+COMMAND_OFFSET = 20
+# IPV4_PREFIX - The first 12 bytes of an IPv4 mapped IPv6 address
+IPV4_PREFIX = bytes(10) + b'\xff\xff'
+
+def packIP(ip):
+    '''
+    Description:
+        Converts an IP address string to the 16 byte form stored in the index.
+    Inputs:
+        ip - IPv4 or IPv6 address string, None if not known
+    Returns:
+        packed - 16 byte string, all zero if the address is not known
+    '''
+    if not ip:
+        return bytes(16)
+    try:
+        return IPV4_PREFIX + socket.inet_pton(socket.AF_INET,ip)
+    except OSError:
+        pass
+    try:
+        return socket.inet_pton(socket.AF_INET6,ip)
+    except OSError:
+        return bytes(16)
+
+def unpackIP(packed):
+    '''
+    Description:
+        Converts the 16 byte address from the index back to a string.
+    Inputs:
+        packed - 16 byte string
+    Returns:
+        ip - IP address string, IPv4 mapped addresses are returned in IPv4 form
+    '''
+    if packed[0:12] == IPV4_PREFIX:
+        return socket.inet_ntop(socket.AF_INET,packed[12:16])
+    return socket.inet_ntop(socket.AF_INET6,packed)
+
+def segmentNumbers(directory):
+    '''
+    Description:
+        Finds the segments in a capture directory.
+    Inputs:
+        directory - The capture directory
+    Returns:
+        numbers - Sorted list of the segment numbers
+    '''
+    numbers = []
+    for name in os.listdir(directory):
+        if name.startswith('capture-') and name.endswith('.idx'):
+            numbers.append(int(name[8:-4]))
+    return sorted(numbers)
+
+class CaptureLog:
+    def __init__(self,directory,segmentBytes=1<<30):
+        '''
+        Description:
+            initiliaser method for the class, opens a new segment after any already in the directory
+        Inputs:
+            directory    - The directory the segments are written to, created if it does not exist
+            segmentBytes - A new segment is started once the data file of the current one reaches this size, default 1GB
+        '''
+        self.directory    = directory
+        self.segmentBytes = segmentBytes
+        os.makedirs(directory,exist_ok=True)
+        existing = segmentNumbers(directory)
+        # segment - The number of the segment being written
+        self.segment  = existing[-1]+1 if existing else 0
+        self.dataFile = None
+        self.idxFile  = None
+        # offset - The size of the current data file, the offset the next payload is written at
+        self.offset   = 0
+        # commands - Cache of command name -> 12 byte padded command
+        self.commands = {}
+        self.openSegment()
+
+    def openSegment(self):
+        '''
+        Description:
+            Closes the current segment files, if any, and opens the files for the next segment.
+        '''
+        self.closeFiles()
+        base = os.path.join(self.directory,f'capture-{self.segment:06d}')
+        # Buffered appends, the records are only written to disk in large blocks
+        self.dataFile = open(base+'.dat','ab')
+        self.idxFile  = open(base+'.idx','ab')
+        self.offset   = 0
+
+    def append(self,command,payload,peer=None,timestamp=None):
+        '''
+        Description:
+            Writes one message to the capture.
+        Inputs:
+            command   - String, the command name of the message e.g. "inv"
+            payload   - Byte string or memoryview of the payload
+            peer      - Tuple (ip,port) of the peer the message came from, None if not known
+            timestamp - time.time() the message was received, defaults to now
+        '''
+        if self.offset >= self.segmentBytes:
+            self.segment += 1
+            self.openSegment()
+        paddedCommand = self.commands.get(command)
+        if paddedCommand is None:
+            paddedCommand = command.encode('ascii','replace')[0:12].ljust(12,b'\x00')
+            self.commands[command] = paddedCommand
+        ip,port = peer if peer else (None,0)
+        length  = len(payload)
+        self.dataFile.write(payload)
+        self.idxFile.write(RECORD.pack(time.time() if timestamp is None else timestamp,self.offset,length,paddedCommand,packIP(ip),port))
+        self.offset += length
+
+    def flush(self):
+        '''
+        Description:
+            Writes the buffered data and records to disk so a reader can see them.
+        '''
+        # The data is flushed before the index, the reader also ignores any record pointing past the end of the data file
+        self.dataFile.flush()
+        self.idxFile.flush()
+
+    def closeFiles(self):
+        '''
+        Description:
+            Flushes and closes the files of the current segment.
+        '''
+        if self.dataFile is not None:
+            self.flush()
+            self.dataFile.close()
+            self.idxFile.close()
+            self.dataFile = None
+            self.idxFile  = None
+
+    def close(self):
+        '''
+        Description:
+            Flushes and closes the capture.
+        '''
+        self.closeFiles()
+
+class CaptureReader:
+    def __init__(self,directory):
+        '''
+        Description:
+            initiliaser method for the class, memory maps every segment in the directory
+        Inputs:
+            directory - The capture directory written by CaptureLog
+        '''
+        self.directory = directory
+        # segments - List of (data mmap, index mmap, record count) for each non empty segment, in order
+        self.segments  = []
+        # starts - The overall record number of the first record in each segment, used to find the segment of a record number
+        self.starts    = []
+        self.count     = 0
+        for number in segmentNumbers(directory):
+            base = os.path.join(directory,f'capture-{number:06d}')
+            with open(base+'.idx','rb') as idxFile, open(base+'.dat','rb') as dataFile:
+                # Ignore a partly written record at the end, e.g. the capture is still being written
+                records = os.fstat(idxFile.fileno()).st_size // RECORD.size
+                # mmap can not map an empty file
+                if records == 0:
+                    continue
+                dataSize = os.fstat(dataFile.fileno()).st_size
+                idxMap   = mmap.mmap(idxFile.fileno(),0,access=mmap.ACCESS_READ)
+                dataMap  = mmap.mmap(dataFile.fileno(),0,access=mmap.ACCESS_READ) if dataSize else b''
+            # Also ignore records whose payload has not reached the data file yet
+            while records and sum(struct.unpack_from('<QI',idxMap,(records-1)*RECORD.size+8)) > dataSize:
+                records -= 1
+            if records == 0:
+                idxMap.close()
+                if isinstance(dataMap,mmap.mmap):
+                    dataMap.close()
+                continue
+            self.segments.append((memoryview(dataMap),idxMap,records))
+            self.starts.append(self.count)
+            self.count += records
+
+    def __len__(self):
+        return self.count
+
+    def locate(self,i):
+        '''
+        Description:
+            Finds the segment holding record number i.
+        Inputs:
+            i - Overall record number
+        Returns:
+            segment - (data, index, record count) of the segment
+            local   - The record number within the segment
+        '''
+        if not 0 <= i < self.count:
+            raise IndexError('Capture record out of range')
+        # Binary search over the segment starts, there are few segments
+        low,high = 0,len(self.starts)-1
+        while low < high:
+            mid = (low+high+1)//2
+            if self.starts[mid] <= i:
+                low = mid
+            else:
+                high = mid-1
+        return self.segments[low],i-self.starts[low]
+
+    def timestamp(self,i):
+        '''
+        Description:
+            The timestamp of record i, only the first 8 bytes of the record are read.
+        Inputs:
+            i - Overall record number
+        Returns:
+            timestamp - time.time() the message was received
+        '''
+        (data,index,records),local = self.locate(i)
+        return struct.unpack_from('<d',index,local*RECORD.size)[0]
+
+    def record(self,i):
+        '''
+        Description:
+            Reads one captured message.
+        Inputs:
+            i - Overall record number
+        Returns:
+            timestamp - time.time() the message was received
+            command   - String, the command name
+            peer      - Tuple (ip,port) of the peer
+            payload   - memoryview of the payload in the memory mapped data file
+        '''
+        (data,index,records),local = self.locate(i)
+        timestamp,offset,length,command,ip,port = RECORD.unpack_from(index,local*RECORD.size)
+        return timestamp,command.rstrip(b'\x00').decode('ascii'),(unpackIP(ip),port),data[offset:offset+length]
+
+    def findTime(self,timestamp):
+        '''
+        Description:
+            Binary search for the first record received at or after timestamp.
+        Inputs:
+            timestamp - time.time() value
+        Returns:
+            i - Record number, len(self) if every record is earlier
+        '''
+        low,high = 0,self.count
+        while low < high:
+            mid = (low+high)//2
+            if self.timestamp(mid) < timestamp:
+                low = mid+1
+            else:
+                high = mid
+        return low
+
+    def messages(self,start=None,end=None,commands=None):
+        '''
+        Description:
+            Generator which replays the captured messages in the order they were received.
+            The payloads are memoryviews into the memory mapped files, nothing is copied until the payload is used.
+        Inputs:
+            start    - Only replay messages received at or after this time.time() value, None for the start of the capture
+            end      - Only replay messages received before this time.time() value, None for the end of the capture
+            commands - Optional collection of command names e.g. {'block'}, only these messages are replayed
+        Returns:
+            timestamp - time.time() the message was received
+            command   - String, the command name
+            peer      - Tuple (ip,port) of the peer
+            payload   - memoryview of the payload
+        '''
+        first = self.findTime(start) if start is not None else 0
+        last  = self.findTime(end) if end is not None else self.count
+        wanted = None
+        if commands is not None:
+            wanted = {command.encode('ascii').ljust(12,b'\x00') for command in commands}
+        size = RECORD.size
+        # Walk the segments directly rather than calling record() for every message
+        for segment,segmentStart in zip(self.segments,self.starts):
+            data,index,records = segment
+            low  = max(first-segmentStart,0)
+            high = min(last-segmentStart,records)
+            for local in range(low,high):
+                position = local*size
+                # Compare the command bytes first so skipped messages are never unpacked
+                if wanted is not None and index[position+COMMAND_OFFSET:position+COMMAND_OFFSET+12] not in wanted:
+                    continue
+                timestamp,offset,length,command,ip,port = RECORD.unpack_from(index,position)
+                yield timestamp,command.rstrip(b'\x00').decode('ascii'),(unpackIP(ip),port),data[offset:offset+length]
+
+    def close(self):
+        '''
+        Description:
+            Releases the memory maps, any payload memoryviews must be released first.
+        '''
+        for data,index,records in self.segments:
+            obj = data.obj
+            data.release()
+            if isinstance(obj,mmap.mmap):
+                obj.close()
+            index.close()
+        self.segments = []
+        self.starts   = []
+        self.count    = 0
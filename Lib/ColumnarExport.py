@@ -0,0 +1,367 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the classes ColumnarExporter and ColumnarReader and the functions which write and read the chunk files
+#   The exporter collects parsed transactions and blocks into columns, one typed array per field, instead of an object or dictionary per row.
+#   There are four tables and a blob, the rows of each table refer to the rows of the others by their index in the same chunk:
+#       block  - One row per block, firstTx is the row of its first transaction
+#       tx     - One row per transaction, firstInput and firstOutput are the rows of its first input and output, block is the row of its block or -1 for a tx message
+#       input  - One row per input, tx is the row of its transaction
+#       output - One row per output, value in Satoshis as int64, scriptType (see SCRIPT_TYPES) and scriptOffset/scriptLength into the scripts blob
+#       scripts - The output scripts joined together
+#   The columns are built with array.array, appending to one is a C call and the column is already the packed binary it is written as.
+#   Once rowsPerChunk transactions are collected the columns are written to a chunk file, see the chunk layout below, and a new chunk is started.
+#   The reader memory maps the chunk files and gives each column as a NumPy array when NumPy is installed, or a memoryview cast to the column type if not,
+#   in both cases without copying. Aggregates over millions of rows are then single vectorised calls, e.g. chunk['output.value'].sum()
+#   Chunk file layout, little endian:
+#       magic (8 bytes) 'BTCCOL01', column count (I), 4 bytes padding
+#       one COLUMN entry per column - name (24s), type (4s, an array typecode or e.g. '32s' for fixed size byte strings), offset (Q) and length in bytes (Q)
+#       the column data, each column starting on an 8 byte boundary
+
+
+## Imports ##
+# os               - https://docs.python.org/3/library/os.html
+# sys              - https://docs.python.org/3/library/sys.html
+# time             - https://docs.python.org/3/library/time.html
+# mmap             - https://docs.python.org/3/library/mmap.html
+# struct           - https://docs.python.org/3/library/struct.html
+# array            - https://docs.python.org/3/library/array.html
+# numpy            - https://numpy.org/doc/stable/, optional, the columns are given as memoryviews without it
+# Transaction      - The precompiled structs used to read the fields straight from the payload, see Lib/Transaction.py
+# ScriptClassifier - classifyScript gives the type of each output script, see Lib/ScriptClassifier.py
+import os
+import sys
+import time
+import mmap
+import struct
+from array import array
+from Lib.Transaction import INT64,UINT32
+from Lib.ScriptClassifier import classifyScript,P2PKH,P2SH,P2WPKH,P2WSH,P2TR,P2PK,MULTISIG,OP_RETURN,WITNESS,NONSTANDARD
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# FILE_MAGIC - The first 8 bytes of a chunk file
+FILE_MAGIC = b'BTCCOL01'
+# COLUMN - The directory entry of one column, 48 bytes
+COLUMN = struct.Struct('<24s4sQQ')
+# TABLES - The columns of each table, name and type. Numbers are array typecodes, 'Ns' is a fixed size byte string of N bytes
+#   The hashes are in internal byte order, reverse them for the usual hex display
+TABLES = {
+    'block' :(('hash','32s'),('prevBlock','32s'),('version','i'),('timestamp','I'),('bits','I'),('txCount','I'),('size','I'),('firstTx','Q'),('received','d')),
+    'tx'    :(('txid','32s'),('version','i'),('lockTime','I'),('size','I'),('vsize','I'),('inputCount','I'),('outputCount','I'),
+              ('firstInput','Q'),('firstOutput','Q'),('block','q'),('received','d')),
+    'input' :(('prevHash','32s'),('prevIndex','I'),('sequence','I'),('scriptLength','I'),('tx','Q')),
+    'output':(('value','q'),('scriptType','B'),('scriptLength','I'),('scriptOffset','Q'),('tx','Q')),
+}
+# ROW_COLUMNS - A number column of each table, its length is the number of rows
+ROW_COLUMNS = {'block':'block.version','tx':'tx.version','input':'input.prevIndex','output':'output.value'}
+# SCRIPT_TYPES - The scriptType column holds the index of the type in this tuple
+SCRIPT_TYPES = (NONSTANDARD,P2PKH,P2SH,P2WPKH,P2WSH,P2TR,P2PK,MULTISIG,OP_RETURN,WITNESS)
+SCRIPT_TYPE_CODES = {scriptType:code for code,scriptType in enumerate(SCRIPT_TYPES)}
+# NUMPY_TYPES - The NumPy dtype of each array typecode
+NUMPY_TYPES = {'b':'<i1','B':'<u1','i':'<i4','I':'<u4','q':'<i8','Q':'<u8','d':'<f8'}
+
+def columnNames():
+    '''
+    Description:
+        The names of every column, table.field, then the scripts blob
+    Returns:
+        names - List of (name, type) tuples
+    '''
+    return [(f'{table}.{field}',columnType) for table,fields in TABLES.items() for field,columnType in fields] + [('scripts','B')]
+
+def writeChunk(path,columns):
+    '''
+    Description:
+        Writes columns to a chunk file. The file is written to a temporary name and renamed so a reader never sees half a chunk.
+    Inputs:
+        path    - The file to write
+        columns - Dictionary of name -> (type, array or bytearray)
+    '''
+    names  = list(columns)
+    offset = 16 + COLUMN.size*len(names)
+    entries,datas = [],[]
+    for name in names:
+        columnType,data = columns[name]
+        if isinstance(data,array) and sys.byteorder == 'big' and data.itemsize > 1:
+            # The files are always little endian
+            data = array(data.typecode,data)
+            data.byteswap()
+        data = memoryview(data).cast('B')
+        offset += -offset % 8
+        entries.append(COLUMN.pack(name.encode('ascii'),columnType.encode('ascii'),offset,len(data)))
+        datas.append((offset,data))
+        offset += len(data)
+    temporary = path + '.tmp'
+    with open(temporary,'wb') as chunkFile:
+        chunkFile.write(FILE_MAGIC + struct.pack('<I4x',len(names)) + b''.join(entries))
+        for start,data in datas:
+            chunkFile.write(bytes(start - chunkFile.tell()))
+            chunkFile.write(data)
+    os.replace(temporary,path)
+
+def readChunk(path,useNumpy=True):
+    '''
+    Description:
+        Memory maps a chunk file and gives each column without copying it.
+    Inputs:
+        path     - The chunk file
+        useNumpy - Boolean, False to get memoryviews even if NumPy is installed
+    Returns:
+        columns - Dictionary of name -> column. With NumPy each number column is an array of its type and each byte string column a uint8 array of shape (rows, N).
+                  Without NumPy each number column is a memoryview cast to its array typecode and each byte string column a flat memoryview of the rows joined together.
+    Raises:
+        ValueError - If the file is not a chunk file
+    '''
+    with open(path,'rb') as chunkFile:
+        mapped = mmap.mmap(chunkFile.fileno(),0,access=mmap.ACCESS_READ)
+    if mapped[0:8] != FILE_MAGIC:
+        raise ValueError(f'{path} is not a columnar chunk file')
+    count = struct.unpack_from('<I',mapped,8)[0]
+    view  = memoryview(mapped)
+    columns = {}
+    for i in range(count):
+        name,columnType,offset,length = COLUMN.unpack_from(mapped,16 + COLUMN.size*i)
+        name,columnType = name.rstrip(b'\x00').decode('ascii'),columnType.rstrip(b'\x00').decode('ascii')
+        data = view[offset:offset+length]
+        if columnType.endswith('s'):
+            width = int(columnType[:-1])
+            columns[name] = numpy.frombuffer(data,dtype=numpy.uint8).reshape(-1,width) if numpy is not None and useNumpy else data
+        elif numpy is not None and useNumpy:
+            columns[name] = numpy.frombuffer(data,dtype=NUMPY_TYPES[columnType])
+        elif sys.byteorder == 'big' and columnType not in ('b','B'):
+            # memoryview can only be cast to the native byte order
+            swapped = array(columnType,bytes(data))
+            swapped.byteswap()
+            columns[name] = memoryview(swapped)
+        else:
+            columns[name] = data.cast(columnType)
+    return columns
+
+class ColumnarExporter:
+    def __init__(self,directory,rowsPerChunk=1000000,classify=True):
+        '''
+        Description:
+            initiliaser method for the class, starts a new chunk after any already in the directory
+        Inputs:
+            directory    - The directory the chunk files are written to, created if it does not exist
+            rowsPerChunk - A chunk is written once it holds this many transactions, the block holding the last one is always finished first
+            classify     - Boolean, True to fill the output scriptType column with classifyScript, False to leave it 0 (NONSTANDARD) and save about a microsecond per output
+        '''
+        self.directory    = directory
+        self.rowsPerChunk = rowsPerChunk
+        self.classify     = classify
+        os.makedirs(directory,exist_ok=True)
+        existing = sorted(name for name in os.listdir(directory) if name.startswith('chunk-') and name.endswith('.col'))
+        # chunk - The number of the next chunk file
+        self.chunk = int(existing[-1][6:12]) + 1 if existing else 0
+        # stats - Rows written to chunk files so far and the number of chunk files
+        self.stats = {'blocks':0,'transactions':0,'inputs':0,'outputs':0,'chunks':0}
+        self.newChunk()
+
+    def newChunk(self):
+        '''
+        Description:
+            Starts empty columns, each number column is an array of its typecode and each byte string column a bytearray.
+        '''
+        self.columns = {name:(columnType,bytearray() if columnType.endswith('s') or name == 'scripts' else array(columnType)) for name,columnType in columnNames()}
+        # The columns used for every row are kept as attributes so the add functions do not look them up by name
+        columns = {name:column for name,(columnType,column) in self.columns.items()}
+        self.txColumns     = [columns['tx.' + field] for field,columnType in TABLES['tx']]
+        self.inputColumns  = [columns['input.' + field] for field,columnType in TABLES['input']]
+        self.outputColumns = [columns['output.' + field] for field,columnType in TABLES['output']]
+        self.blockColumns  = [columns['block.' + field] for field,columnType in TABLES['block']]
+        self.scripts       = columns['scripts']
+
+    def rows(self,table):
+        # The number of rows of a table in the current chunk
+        return len(self.columns[ROW_COLUMNS[table]][1])
+
+    def addTransaction(self,transaction,blockRow=-1,received=None):
+        '''
+        Description:
+            Adds a transaction and its inputs and outputs to the columns. The fields are read straight from the payload with the offsets of the transaction,
+            no TxIn or TxOut objects are created. A chunk is written once it is full, unless the transaction is part of a block.
+        Inputs:
+            transaction - Transaction instance
+            blockRow    - The row of the block holding the transaction, -1 for a tx message
+            received    - time.time() the transaction was received, defaults to now
+        '''
+        txid,version,lockTime,size,vsize,inputCount,outputCount,firstInput,firstOutput,block,receivedColumn = self.txColumns
+        prevHash,prevIndex,sequence,inputScriptLength,inputTx = self.inputColumns
+        value,scriptType,scriptLength,scriptOffset,outputTx = self.outputColumns
+        scripts = self.scripts
+        payload = transaction.payload
+        txRow   = len(version)
+        txid += transaction.txid
+        version.append(transaction.version)
+        lockTime.append(transaction.lockTime)
+        size.append(transaction.size)
+        vsize.append(transaction.vsize)
+        firstInput.append(len(prevIndex))
+        firstOutput.append(len(value))
+        block.append(blockRow)
+        receivedColumn.append(received if received is not None else time.time())
+        offsets = transaction.inputOffsets
+        inputCount.append(len(offsets)//3)
+        for i in range(0,len(offsets),3):
+            start,end = offsets[i],offsets[i+2]
+            prevHash += payload[start:start+32]
+            prevIndex.append(UINT32.unpack_from(payload,start+32)[0])
+            sequence.append(UINT32.unpack_from(payload,end)[0])
+            inputScriptLength.append(end - offsets[i+1])
+            inputTx.append(txRow)
+        offsets = transaction.outputOffsets
+        outputCount.append(len(offsets)//3)
+        classify,codes = self.classify,SCRIPT_TYPE_CODES
+        for i in range(0,len(offsets),3):
+            start,end = offsets[i+1],offsets[i+2]
+            value.append(INT64.unpack_from(payload,offsets[i])[0])
+            scriptType.append(codes[classifyScript(payload[start:end])[0]] if classify else 0)
+            scriptLength.append(end - start)
+            scriptOffset.append(len(scripts))
+            scripts += payload[start:end]
+            outputTx.append(txRow)
+        if blockRow < 0 and txRow + 1 >= self.rowsPerChunk:
+            self.flush()
+
+    def addBlock(self,block,received=None):
+        '''
+        Description:
+            Adds a block and all of its transactions, a block is never split across chunks.
+        Inputs:
+            block    - Block instance
+            received - time.time() the block was received, defaults to now
+        '''
+        received = received if received is not None else time.time()
+        blockHash,prevBlock,version,timestamp,bits,txCount,size,firstTx,receivedColumn = self.blockColumns
+        header   = block.header
+        blockRow = len(version)
+        blockHash += header.hash
+        prevBlock += header.prevBlock
+        version.append(header.version)
+        timestamp.append(header.timestamp)
+        bits.append(header.bits)
+        txCount.append(block.txCount)
+        size.append(len(block.payload))
+        firstTx.append(self.rows('tx'))
+        receivedColumn.append(received)
+        for transaction in block.transactions():
+            self.addTransaction(transaction,blockRow,received)
+        if self.rows('tx') >= self.rowsPerChunk:
+            self.flush()
+
+    def flush(self):
+        '''
+        Description:
+            Writes the collected rows to the next chunk file and starts a new chunk, nothing is written if the chunk is empty.
+        Returns:
+            path - The chunk file written, None if the chunk was empty
+        '''
+        if not self.rows('tx') and not self.rows('block'):
+            return None
+        path = os.path.join(self.directory,f'chunk-{self.chunk:06d}.col')
+        writeChunk(path,self.columns)
+        for table in TABLES:
+            self.stats[table + 's' if table != 'tx' else 'transactions'] += self.rows(table)
+        self.stats['chunks'] += 1
+        self.chunk += 1
+        self.newChunk()
+        return path
+
+    def close(self):
+        # Writes the last, part full, chunk
+        self.flush()
+
+class ColumnarReader:
+    def __init__(self,directory,useNumpy=True):
+        '''
+        Description:
+            initiliaser method for the class, finds the chunk files in a directory
+        Inputs:
+            directory - The directory written by a ColumnarExporter
+            useNumpy  - Boolean, False to get memoryviews even if NumPy is installed
+        '''
+        self.directory = directory
+        self.useNumpy  = useNumpy and numpy is not None
+        self.paths     = [os.path.join(directory,name) for name in sorted(os.listdir(directory)) if name.startswith('chunk-') and name.endswith('.col')]
+
+    def chunks(self):
+        '''
+        Description:
+            Generator which memory maps each chunk in turn, see readChunk. The row references (tx, firstOutput, ...) are within a chunk.
+        '''
+        for path in self.paths:
+            yield readChunk(path,self.useNumpy)
+
+    def column(self,name):
+        '''
+        Description:
+            Joins a column of every chunk into one, e.g. 'output.value'. This copies the column, the row reference columns only make sense within a chunk.
+        Inputs:
+            name - The column name, table.field
+        Returns:
+            column - NumPy array, or an array.array without NumPy
+        '''
+        parts = [chunk[name] for chunk in self.chunks()]
+        if self.useNumpy:
+            return numpy.concatenate(parts) if parts else numpy.zeros(0,dtype=NUMPY_TYPES.get(dict(columnNames()).get(name,'B'),'<u1'))
+        columnType = dict(columnNames())[name]
+        if columnType.endswith('s'):
+            return b''.join(bytes(part) for part in parts)
+        joined = array(columnType)
+        for part in parts:
+            joined.frombytes(part.cast('B') if part.format != 'B' else part)
+        return joined
+
+    def summary(self):
+        '''
+        Description:
+            Works out the totals and distributions of every chunk, with one vectorised call per column per chunk when NumPy is installed.
+        Returns:
+            summary - Dictionary of:
+                blocks, transactions, inputs, outputs - The row counts
+                totalValue        - The total value of the outputs in Satoshis
+                valueByScriptType - Dictionary of script type -> total value of the outputs of that type
+                sizeDistribution  - Dictionary of n -> the number of transactions of size [n, 2n) bytes
+                sizePercentiles   - Dictionary of 50, 90 and 99 -> that percentile of the transaction sizes
+        '''
+        summary = {'blocks':0,'transactions':0,'inputs':0,'outputs':0,'totalValue':0,'valueByScriptType':{},'sizeDistribution':{},'sizePercentiles':{}}
+        byType,bySize,sizes = [0]*len(SCRIPT_TYPES),{},[]
+        for chunk in self.chunks():
+            values,types,txSizes = chunk['output.value'],chunk['output.scriptType'],chunk['tx.size']
+            summary['blocks']       += len(chunk['block.version'])
+            summary['transactions'] += len(txSizes)
+            summary['inputs']       += len(chunk['input.prevIndex'])
+            summary['outputs']      += len(values)
+            if self.useNumpy:
+                summary['totalValue'] += int(values.sum())
+                # The value of each script type, the int64 values are summed exactly by splitting them on the type
+                for code in numpy.unique(types):
+                    byType[code] += int(values[types == code].sum())
+                # frexp gives the exponent e with size = m*2**e and 0.5 <= m < 1, so the sizes in [2**(e-1), 2**e)
+                exponents,counts = numpy.unique(numpy.frexp(txSizes.astype(numpy.float64))[1],return_counts=True)
+                for exponent,count in zip(exponents.tolist(),counts.tolist()):
+                    bySize[exponent] = bySize.get(exponent,0) + count
+                sizes.append(txSizes)
+            else:
+                summary['totalValue'] += sum(values)
+                for code,value in zip(types,values):
+                    byType[code] += value
+                for size in txSizes:
+                    exponent = size.bit_length()
+                    bySize[exponent] = bySize.get(exponent,0) + 1
+                sizes.extend(txSizes)
+        summary['valueByScriptType'] = {SCRIPT_TYPES[code]:value for code,value in enumerate(byType) if value}
+        summary['sizeDistribution']  = {1 << (exponent - 1):count for exponent,count in sorted(bySize.items())}
+        if summary['transactions']:
+            if self.useNumpy:
+                allSizes = numpy.concatenate(sizes)
+                summary['sizePercentiles'] = {p:int(value) for p,value in zip((50,90,99),numpy.percentile(allSizes,(50,90,99),method='lower'))}
+            else:
+                sizes.sort()
+                summary['sizePercentiles'] = {p:sizes[min(len(sizes)-1,len(sizes)*p//100)] for p in (50,90,99)}
+        return summary
@@ -0,0 +1,387 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the class CompactBlock and the functions which create and parse the BIP152 compact block messages, see https://github.com/bitcoin/bips/blob/master/bip-0152.mediawiki
+#   Without compact blocks a new block is downloaded in full (1-4 MB) even though most of its transactions have already been received in tx messages.
+#   With compact blocks the peer sends a cmpctblock message holding the header and a 6 byte short ID for each transaction, a few KB for a full block:
+#       1. sendcmpct  - Sent by each side to say compact blocks are supported (version 2, short IDs from wtxids) and whether new blocks should be pushed as cmpctblock straight away
+#       2. cmpctblock - The header, a nonce, the short IDs and a few prefilled transactions (always the coinbase)
+#       3. The block is rebuilt by working out the short ID of every transaction held locally (the mempool) and matching them to the short IDs of the block
+#       4. getblocktxn/blocktxn - Any transactions which are not held locally are requested by their index in the block and sent back in full
+#   The short ID is SipHash-2-4 of the wtxid, keyed with the first 16 bytes of SHA256(header + nonce), and cut to 6 bytes.
+#   If two local transactions match the same short ID neither is used and it is requested, the Merkle root check of the rebuilt block catches any wrong match.
+
+
+## Imports ##
+# os          - https://docs.python.org/3/library/os.html
+# struct      - https://docs.python.org/3/library/struct.html
+# hashlib     - https://docs.python.org/3/library/hashlib.html
+# SipHash     - Functions developed for this project which compute SipHash-2-4, see Lib/SipHash.py
+# Transaction - Used to find where each transaction ends and to work out the wtxids, see Lib/Transaction.py
+# Block       - BlockHeader decodes the compact block header, see Lib/Block.py
+import os
+import struct
+import hashlib
+from Lib.SipHash import siphash256
+from Lib.Transaction import Transaction,readVarInt,createVarInt,UINT64
+from Lib.Block import Block,BlockHeader,HEADER_LENGTH
+
+# MSG_CMPCT_BLOCK - Inventory type used in getdata to ask for a block as a cmpctblock message
+MSG_CMPCT_BLOCK = 4
+# COMPACT_VERSION - Version 2 short IDs are computed from the wtxid and the transactions are sent with their witness
+COMPACT_VERSION = 2
+# SHORT_ID_MASK - The short ID is the low 6 bytes of the SipHash
+SHORT_ID_MASK = 0xffffffffffff
+# MAX_TRANSACTIONS - The most transactions which fit in a 4 MB block, limits the counts read from a peer
+MAX_TRANSACTIONS = 4000000//60
+
+def createSendCmpctPayload(announce=True,version=COMPACT_VERSION):
+    '''
+    Description:
+        Creates the payload of a sendcmpct message.
+    Inputs:
+        announce - Boolean, True asks the peer to send new blocks as cmpctblock straight away (high bandwidth mode), False to announce them with inv or headers first
+        version  - The compact block version, 2 for short IDs from wtxids
+    Returns:
+        payload - The 9 byte payload
+    '''
+    return struct.pack('<?Q',announce,version)
+
+def parseSendCmpctPayload(payload):
+    '''
+    Description:
+        Parses the payload of a sendcmpct message.
+    Inputs:
+        payload - Byte string or memoryview of the payload
+    Returns:
+        announce - Boolean, True if the peer wants new blocks pushed as cmpctblock
+        version  - The compact block version the peer supports
+    Raises:
+        ValueError - If the payload is not 9 bytes
+    '''
+    if len(payload) < 9:
+        raise ValueError(f'sendcmpct payload of {len(payload)} Bytes is too short')
+    announce,version = struct.unpack_from('<?Q',payload,0)
+    return announce,version
+
+def readIndexes(payload,position,count,limit):
+    '''
+    Description:
+        Reads count differentially encoded indexes, each is stored as the gap from the index before it minus one.
+    Inputs:
+        payload  - Byte string or memoryview
+        position - Index in payload of the first varint
+        count    - The number of indexes
+        limit    - Every index must be below this
+    Returns:
+        indexes  - List of absolute indexes in increasing order
+        position - Index in payload after the last varint
+    Raises:
+        ValueError - If an index is not below limit
+    '''
+    indexes  = []
+    previous = -1
+    for i in range(count):
+        gap,position = readVarInt(payload,position)
+        previous += gap + 1
+        if previous >= limit:
+            raise ValueError(f'index {previous} is outside the block of {limit} transactions')
+        indexes.append(previous)
+    return indexes,position
+
+def writeIndexes(indexes):
+    '''
+    Description:
+        Differentially encodes a list of increasing indexes, the reverse of readIndexes.
+    Inputs:
+        indexes - List of indexes in increasing order
+    Returns:
+        encoded - Byte string of the varints
+    '''
+    parts    = []
+    previous = -1
+    for index in indexes:
+        parts.append(createVarInt(index - previous - 1))
+        previous = index
+    return b''.join(parts)
+
+def readTransactions(payload,position,count):
+    '''
+    Description:
+        Reads count serialized transactions which follow one another.
+    Inputs:
+        payload  - Byte string or memoryview
+        position - Index in payload of the first transaction
+        count    - The number of transactions
+    Returns:
+        transactions - List of byte strings, copied out of the payload
+        position     - Index in payload after the last transaction
+    '''
+    transactions = []
+    for i in range(count):
+        transaction = Transaction(payload,position)
+        transactions.append(bytes(transaction.raw))
+        position = transaction.end
+    return transactions,position
+
+def shortIDKeys(header,nonce):
+    '''
+    Description:
+        Works out the SipHash key of a compact block, the first two little endian 64 bit words of SHA256(header + nonce).
+    Inputs:
+        header - The 80 byte block header
+        nonce  - The 64 bit nonce of the compact block
+    Returns:
+        k0,k1 - The key as two integers
+    '''
+    digest = hashlib.sha256(bytes(header) + UINT64.pack(nonce)).digest()
+    return struct.unpack_from('<QQ',digest,0)
+
+def createCmpctBlockPayload(block,nonce=None,prefill=(0,)):
+    '''
+    Description:
+        Creates a cmpctblock payload from a full block, used by Lib/MockPeer.py to serve compact blocks.
+    Inputs:
+        block   - Byte string of the block payload
+        nonce   - The 64 bit nonce, random if not passed
+        prefill - The indexes of the transactions sent in full, the coinbase (0) must always be included as nobody else can hold it
+    Returns:
+        payload - Byte string of the cmpctblock payload
+    '''
+    block  = Block(block)
+    header = bytes(block.header.raw)
+    nonce  = int.from_bytes(os.urandom(8),'little') if nonce is None else nonce
+    k0,k1  = shortIDKeys(header,nonce)
+    prefill = set(prefill)
+    shortIDs  = []
+    prefilled = []
+    previous  = -1
+    for i,transaction in enumerate(block.transactions()):
+        if i in prefill:
+            # Each prefilled transaction follows its differentially encoded index
+            prefilled.append(createVarInt(i - previous - 1) + bytes(transaction.raw))
+            previous = i
+        else:
+            shortIDs.append((siphash256(k0,k1,transaction.wtxid) & SHORT_ID_MASK).to_bytes(6,'little'))
+    return (header + UINT64.pack(nonce) + createVarInt(len(shortIDs)) + b''.join(shortIDs)
+            + createVarInt(len(prefilled)) + b''.join(prefilled))
+
+def createGetBlockTxnPayload(blockHash,indexes):
+    '''
+    Description:
+        Creates a getblocktxn payload asking for the transactions at indexes of a block.
+    Inputs:
+        blockHash - The 32 byte block hash
+        indexes   - List of the transaction indexes wanted, in increasing order
+    Returns:
+        payload - Byte string of the getblocktxn payload
+    '''
+    return blockHash + createVarInt(len(indexes)) + writeIndexes(indexes)
+
+def parseGetBlockTxnPayload(payload):
+    '''
+    Description:
+        Parses a getblocktxn payload.
+    Inputs:
+        payload - Byte string or memoryview of the payload
+    Returns:
+        blockHash - The 32 byte block hash
+        indexes   - List of the transaction indexes wanted
+    Raises:
+        ValueError - If the payload is truncated
+    '''
+    try:
+        count,position = readVarInt(payload,32)
+        if count > MAX_TRANSACTIONS:
+            raise ValueError(f'getblocktxn asks for {count} transactions')
+        indexes,position = readIndexes(payload,position,count,MAX_TRANSACTIONS)
+    except (IndexError,struct.error):
+        raise ValueError('getblocktxn payload is truncated')
+    return bytes(payload[0:32]),indexes
+
+def createBlockTxnPayload(blockHash,transactions):
+    '''
+    Description:
+        Creates a blocktxn payload, the reply to getblocktxn.
+    Inputs:
+        blockHash    - The 32 byte block hash
+        transactions - List of byte strings of the serialized transactions, in the order they were asked for
+    Returns:
+        payload - Byte string of the blocktxn payload
+    '''
+    return blockHash + createVarInt(len(transactions)) + b''.join(transactions)
+
+def parseBlockTxnPayload(payload):
+    '''
+    Description:
+        Parses a blocktxn payload.
+    Inputs:
+        payload - Byte string or memoryview of the payload
+    Returns:
+        blockHash    - The 32 byte block hash
+        transactions - List of byte strings of the serialized transactions
+    Raises:
+        ValueError - If the payload is truncated or has bytes left over
+    '''
+    try:
+        count,position = readVarInt(payload,32)
+        if count > MAX_TRANSACTIONS:
+            raise ValueError(f'blocktxn holds {count} transactions')
+        transactions,position = readTransactions(payload,position,count)
+    except (IndexError,struct.error):
+        raise ValueError('blocktxn payload is truncated')
+    if position != len(payload):
+        raise ValueError(f'{len(payload)-position} Bytes left over after the last of {count} transactions')
+    return bytes(payload[0:32]),transactions
+
+class ShortIDCollision(ValueError):
+    '''
+    Description:
+        Raised when two transactions of a compact block have the same short ID. The block can not be rebuilt and has to be downloaded in full.
+        The header was parsed so the hash of the block to request is in blockHash.
+    '''
+    def __init__(self,message,blockHash):
+        super().__init__(message)
+        self.blockHash = blockHash
+
+class CompactBlock:
+    # __slots__ - No per object dictionary
+    __slots__ = ('header','hash','nonce','k0','k1','shortIDs','transactions','slotOf','collisions','size')
+
+    def __init__(self,payload):
+        '''
+        Description:
+            Parses a cmpctblock payload. The payload is copied from as the compact block is kept until the missing transactions arrive.
+            The payload is made up of:
+                1. header            - The 80 byte block header
+                2. nonce             - 8 bytes, used with the header to key the short IDs
+                3. shortids_length   - Varint, the number of short IDs
+                4. shortids          - 6 bytes each, one per transaction not prefilled, in block order
+                5. prefilledtxn_length - Varint, the number of prefilled transactions
+                6. prefilledtxn      - The differentially encoded index (varint) and the full transaction of each
+        Inputs:
+            payload - Byte string or memoryview of the cmpctblock payload
+        Raises:
+            ValueError       - If the payload is truncated or the counts or indexes are invalid
+            ShortIDCollision - If two transactions have the same short ID, a ValueError carrying the block hash
+        '''
+        try:
+            self.header = BlockHeader(bytes(payload[0:HEADER_LENGTH]))
+            self.hash   = self.header.hash
+            self.nonce  = UINT64.unpack_from(payload,HEADER_LENGTH)[0]
+            shortIDCount,position = readVarInt(payload,HEADER_LENGTH+8)
+            if shortIDCount > MAX_TRANSACTIONS or position + 6*shortIDCount > len(payload):
+                raise ValueError(f'{shortIDCount} short IDs do not fit in the payload')
+            shortIDBytes = payload[position:position+6*shortIDCount]
+            position += 6*shortIDCount
+            prefilledCount,position = readVarInt(payload,position)
+            txCount = shortIDCount + prefilledCount
+            if txCount > MAX_TRANSACTIONS:
+                raise ValueError(f'{prefilledCount} prefilled transactions is too many')
+            # transactions - Byte string of each transaction in block order, None until it is found
+            self.transactions = [None]*txCount
+            previous = -1
+            for i in range(prefilledCount):
+                gap,position = readVarInt(payload,position)
+                previous += gap + 1
+                if previous >= txCount:
+                    raise ValueError(f'prefilled index {previous} is outside the block of {txCount} transactions')
+                transaction = Transaction(payload,position)
+                self.transactions[previous] = bytes(transaction.raw)
+                position = transaction.end
+        except (IndexError,struct.error):
+            raise ValueError('cmpctblock payload is truncated')
+        if position != len(payload):
+            raise ValueError(f'{len(payload)-position} Bytes left over after the prefilled transactions')
+        self.size   = len(payload)
+        self.k0,self.k1 = shortIDKeys(self.header.raw,self.nonce)
+        # The short IDs fill the slots not prefilled, in order
+        # slotOf     - Dictionary of short ID -> index of its transaction in the block
+        # collisions - The indexes where two local transactions matched the short ID, these have to be requested
+        self.shortIDs   = [int.from_bytes(shortIDBytes[6*i:6*i+6],'little') for i in range(shortIDCount)]
+        self.slotOf     = {}
+        self.collisions = set()
+        shortIDs = iter(self.shortIDs)
+        for index,transaction in enumerate(self.transactions):
+            if transaction is None:
+                shortID = next(shortIDs)
+                if shortID in self.slotOf:
+                    raise ShortIDCollision(f'short ID {shortID:012x} appears twice in the block',self.hash)
+                self.slotOf[shortID] = index
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def shortID(self,wtxid):
+        '''
+        Description:
+            Works out the short ID of a transaction for this block.
+        Inputs:
+            wtxid - The 32 byte wtxid
+        Returns:
+            shortID - The 6 byte short ID as an integer
+        '''
+        return siphash256(self.k0,self.k1,wtxid) & SHORT_ID_MASK
+
+    def fill(self,candidates):
+        '''
+        Description:
+            Fills in the transactions of the block from the transactions held locally.
+            The short ID of each candidate is worked out and looked up in the short IDs of the block, this is the cost of a compact block (one SipHash per candidate).
+        Inputs:
+            candidates - Iterable of (wtxid, serialized transaction), e.g. the entries of the mempool
+        Returns:
+            found - The number of transactions filled in
+        '''
+        k0,k1        = self.k0,self.k1
+        slotOf       = self.slotOf
+        transactions = self.transactions
+        collisions   = self.collisions
+        found = 0
+        for wtxid,raw in candidates:
+            index = slotOf.get(siphash256(k0,k1,wtxid) & SHORT_ID_MASK)
+            if index is None or index in collisions:
+                continue
+            if transactions[index] is None:
+                transactions[index] = raw
+                found += 1
+            elif transactions[index] != raw:
+                # Two local transactions have this short ID, there is no way to tell which is right so ask for it
+                transactions[index] = None
+                collisions.add(index)
+                found -= 1
+        return found
+
+    def missing(self):
+        '''
+        Description:
+            The indexes of the transactions not found yet.
+        Returns:
+            indexes - List of indexes in increasing order, empty when the block is complete
+        '''
+        return [index for index,transaction in enumerate(self.transactions) if transaction is None]
+
+    def addBlockTxn(self,transactions):
+        '''
+        Description:
+            Fills in the missing transactions from a blocktxn message, they are in the order of the indexes from missing.
+        Inputs:
+            transactions - List of byte strings from parseBlockTxnPayload
+        Raises:
+            ValueError - If the number of transactions is not the number missing
+        '''
+        missing = self.missing()
+        if len(transactions) != len(missing):
+            raise ValueError(f'blocktxn has {len(transactions)} transactions, {len(missing)} are missing')
+        for index,transaction in zip(missing,transactions):
+            self.transactions[index] = transaction
+
+    def serialize(self):
+        '''
+        Description:
+            Builds the full block payload once every transaction is filled in, it can then be parsed like a block message.
+        Returns:
+            block - Byte string of the block payload
+        '''
+        return bytes(self.header.raw) + createVarInt(len(self.transactions)) + b''.join(self.transactions)
@@ -0,0 +1,399 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the class DecodePipeline and the functions run by its worker processes.
+#   In main.py the socket reads and all the parsing run on one thread, so while a large block is parsed and its Merkle root checked nothing is read from the socket.
+#   DecodePipeline moves the decoding of tx and block messages to a pool of worker processes so it can use every core and the reading loop only frames messages:
+#       1. The reader copies each payload into a ring buffer in shared memory (multiprocessing.shared_memory), the payload itself is never pickled
+#       2. A small task (sequence number, command, offset, length) is put on a queue for the workers
+#       3. A worker decodes the payload straight out of shared memory and puts a small result dictionary on the result queue
+#       4. Results are handed back in the order the messages were submitted, and the space in the ring is freed in that order.
+#          Messages which are not decoded (inv, ping, ...) are kept behind any decode still in progress so every message comes out in the order it arrived
+#   If the ring is full the reader waits for results to free space, a payload bigger than the whole ring is decoded in the reading process.
+#   While waiting for a result the workers are checked every pollInterval seconds. If one has died its result will never come, so the messages still with the
+#   workers are decoded in the reading process straight out of the ring, and so is every later message.
+#   The workers only send back a summary, parseTXPayload and parseBlockPayload are not run, so the connector hooks which they feed (the mempool, watcher,
+#   filter index, exporter and header chain) get nothing. See connectorHooks, main.py refuses to use the pipeline with any of them set.
+
+
+## Imports ##
+# os              - https://docs.python.org/3/library/os.html
+# queue           - https://docs.python.org/3/library/queue.html
+# time            - https://docs.python.org/3/library/time.html
+# collections     - https://docs.python.org/3/library/collections.html
+# multiprocessing - https://docs.python.org/3/library/multiprocessing.html
+# shared_memory   - https://docs.python.org/3/library/multiprocessing.shared_memory.html
+# Transaction     - Class developed for this project which parses a transaction, see Lib/Transaction.py
+# Block           - Class developed for this project which parses a block, see Lib/Block.py
+# Merkle          - merkleRoot is used to check the block merkle_root, see Lib/Merkle.py
+import os
+import time
+import queue
+from collections import deque
+import multiprocessing
+from multiprocessing import shared_memory
+from Lib.Transaction import Transaction
+from Lib.Block import Block
+from Lib.Merkle import merkleRoot
+
+def decodeMessage(command,payload):
+    '''
+    Description:
+        The default decoder run by the workers, it does the work of parseTXPayload and parseBlockPayload and returns a summary which is cheap to send back.
+        The payload is a memoryview into shared memory so nothing returned may reference it.
+    Inputs:
+        command - String, "tx" or "block"
+        payload - memoryview of the payload
+    Returns:
+        result - Dictionary of the decoded fields, {'error': message} if the payload could not be parsed, None for other commands
+    '''
+    try:
+        if command == 'tx':
+            transaction = Transaction(payload)
+            return {'txid':transaction.txid,'wtxid':transaction.wtxid,'size':transaction.size,'vsize':transaction.vsize,
+                    'inputs':transaction.inputCount,'outputs':transaction.outputCount,'value':transaction.totalOutputValue()}
+        if command == 'block':
+            block  = Block(payload)
+            header = block.header
+            txids  = block.txids()
+            root,mutated = merkleRoot(txids) if txids else (b'',False)
+            return {'hash':header.hash,'prevBlock':header.prevBlock,'timestamp':header.timestamp,'txCount':block.txCount,
+                    'merkleValid':root == header.merkleRoot and not mutated,'txids':txids}
+    except ValueError as e:
+        return {'error':str(e)}
+    return None
+
+# CONNECTOR_HOOKS - The optional connector attributes which are only fed by parseTXPayload and parseBlockPayload
+CONNECTOR_HOOKS = ('mempool','watcher','filterIndex','exporter','headerChain')
+
+def connectorHooks(connector):
+    '''
+    Description:
+        Finds the hooks set on a connector which would get nothing if tx and block messages were decoded by a DecodePipeline.
+    Inputs:
+        connector - BitcoinConnector
+    Returns:
+        hooks - List of the attribute names which are set, empty if the pipeline can be used
+    '''
+    return [name for name in CONNECTOR_HOOKS if getattr(connector,name,None) is not None]
+
+def displayDecoded(command,result):
+    '''
+    Description:
+        Prints a one line summary of a result from decodeMessage.
+    Inputs:
+        command - String, "tx" or "block"
+        result  - Dictionary returned from decodeMessage
+    '''
+    if result is None:
+        return
+    if 'error' in result:
+        print(f'Warning: could not parse {command} message, {result["error"]}')
+    elif command == 'tx':
+        print(f'tx {result["txid"][::-1].hex()} size {result["size"]} vsize {result["vsize"]} inputs {result["inputs"]} outputs {result["outputs"]} value {result["value"]}')
+    elif command == 'block':
+        print(f'block {result["hash"][::-1].hex()} transactions {result["txCount"]} merkle root {"valid" if result["merkleValid"] else "INVALID"}')
+
+def runDecoder(decoder,command,payload):
+    '''
+    Description:
+        Runs the decoder on one payload, an exception is turned into an error result so one bad message can not stop the decoding.
+    Inputs:
+        decoder - Function called as decoder(command,payload)
+        command - String, the command name
+        payload - memoryview of the payload
+    Returns:
+        result - The decoder result, {'error': message} if it raised
+    '''
+    try:
+        return decoder(command,payload)
+    except Exception as e:
+        return {'error':f'{type(e).__name__}: {e}'}
+
+def workerMain(ringName,tasks,results,decoder):
+    '''
+    Description:
+        The loop run in each worker process. Attaches to the shared memory ring, decodes each task and puts the result on the result queue.
+    Inputs:
+        ringName - The name of the SharedMemory block holding the ring
+        tasks    - Queue of (sequence, command, offset, length), None tells the worker to exit
+        results  - Queue the (sequence, result) tuples are put on
+        decoder  - Function called as decoder(command,payload)
+    '''
+    ring = shared_memory.SharedMemory(name=ringName)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            sequence,command,offset,length = task
+            payload = ring.buf[offset:offset+length]
+            result  = runDecoder(decoder,command,payload)
+            # The view must be released before the ring can be closed
+            payload.release()
+            results.put((sequence,result))
+    finally:
+        ring.close()
+
+class DecodePipeline:
+    def __init__(self,workers=None,ringBytes=64*1024*1024,decoder=decodeMessage,commands=('tx','block'),pollInterval=1.0):
+        '''
+        Description:
+            initiliaser method for the class, call start to create the shared memory and worker processes
+        Inputs:
+            workers   - The number of worker processes, defaults to the number of cores
+            ringBytes - Size of the shared memory ring, it must hold every payload waiting to be decoded, default 64MB (16 full blocks)
+            decoder   - Function called in the workers as decoder(command,payload), must be a module level function so it can be sent to the workers
+            commands  - The commands decodeFrames sends to the workers, other messages are passed through
+            pollInterval - Seconds between checks that the workers are still alive while waiting for a result
+        '''
+        self.workers   = workers if workers else (os.cpu_count() or 1)
+        self.ringBytes = ringBytes
+        self.decoder   = decoder
+        self.commands  = set(commands)
+        self.pollInterval = pollInterval
+        self.ring      = None
+        self.processes = []
+        # failed - Set once a worker has died, every message is then decoded in this process
+        self.failed    = False
+        # nextSequence - The sequence number of the next message submitted
+        # nextResult   - The sequence number of the next result to hand back
+        self.nextSequence = 0
+        self.nextResult   = 0
+        # regions  - deque of [sequence, start, end, done] for the space in use in the ring, oldest first
+        # regionOf - Dictionary of sequence -> its entry in regions
+        # head     - Index in the ring the next payload is written at
+        self.regions   = deque()
+        self.regionOf  = {}
+        self.head      = 0
+        # ready    - Dictionary of sequence -> (command, result) for results which arrived before earlier ones
+        # inFlight - Dictionary of sequence -> (command, offset, length) for the messages in the workers
+        self.ready     = {}
+        self.inFlight  = {}
+
+    def start(self):
+        '''
+        Description:
+            Creates the shared memory ring and starts the worker processes.
+        '''
+        context = multiprocessing.get_context()
+        self.ring    = shared_memory.SharedMemory(create=True,size=self.ringBytes)
+        self.tasks   = context.Queue()
+        self.results = context.Queue()
+        for i in range(self.workers):
+            process = context.Process(target=workerMain,args=(self.ring.name,self.tasks,self.results,self.decoder),daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def allocate(self,length):
+        '''
+        Description:
+            Finds space for length bytes in the ring. Space is used in order so it is always after head, or at the start of the ring if it does not fit at the end.
+            head and tail alone can not tell a full ring from an empty one (both have head == tail), so whether the space in use has wrapped round is worked out
+            from the regions: it has wrapped if the newest region starts before the oldest one.
+        Inputs:
+            length - The number of bytes needed
+        Returns:
+            offset - Index in the ring to write at, None if there is not enough free space right now
+        '''
+        if not self.regions:
+            self.head = 0
+            return 0 if length <= self.ringBytes else None
+        tail = self.regions[0][1]
+        if self.regions[-1][1] >= tail:
+            # Not wrapped, the space in use is from tail to head. Free space is from head to the end, and from the start to tail
+            if self.head + length <= self.ringBytes:
+                return self.head
+            if length <= tail:
+                return 0
+            return None
+        # head has wrapped round, the only free space is between head and tail, none at all when head == tail
+        return self.head if self.head + length <= tail else None
+
+    def reserve(self,sequence,length):
+        '''
+        Description:
+            Takes length bytes of the ring for a message.
+        Inputs:
+            sequence - The sequence number of the message
+            length   - The number of bytes needed
+        Returns:
+            offset - Index in the ring to write the payload at, None if there is not enough free space right now
+        '''
+        # An empty payload takes no space, it has no region so every region has a length and allocate can tell if the ring has wrapped
+        if length == 0:
+            return 0
+        offset = self.allocate(length)
+        if offset is None:
+            return None
+        self.head = offset + length
+        region = [sequence,offset,offset+length,False]
+        self.regions.append(region)
+        self.regionOf[sequence] = region
+        return offset
+
+    def release(self,sequence):
+        '''
+        Description:
+            Marks the space of a decoded message as done. Space is only freed from the oldest end so the ring stays in order.
+        Inputs:
+            sequence - The sequence number of the message
+        '''
+        region = self.regionOf.pop(sequence,None)
+        if region is None:
+            return
+        region[3] = True
+        while self.regions and self.regions[0][3]:
+            self.regions.popleft()
+
+    def submit(self,command,payload):
+        '''
+        Description:
+            Copies a payload into the ring and queues it for the workers. If the ring is full it waits for results to free up space.
+        Inputs:
+            command - String, the command name
+            payload - Byte string or memoryview of the payload, it is copied so it may be reused as soon as this returns
+        Returns:
+            sequence - The sequence number of the message, results are handed back in this order
+        '''
+        sequence = self.nextSequence
+        self.nextSequence += 1
+        length = len(payload)
+        if length > self.ringBytes or self.failed:
+            # Too big for the ring, or there are no workers left, decode it here rather than fail
+            self.ready[sequence] = (command,runDecoder(self.decoder,command,payload))
+            return sequence
+        offset = self.reserve(sequence,length)
+        while offset is None:
+            self.collect(block=True)
+            if self.failed:
+                # A worker died while waiting, the ring has been emptied
+                self.ready[sequence] = (command,runDecoder(self.decoder,command,payload))
+                return sequence
+            offset = self.reserve(sequence,length)
+        self.ring.buf[offset:offset+length] = payload
+        self.inFlight[sequence] = (command,offset,length)
+        self.tasks.put((sequence,command,offset,length))
+        return sequence
+
+    def collect(self,block=False):
+        '''
+        Description:
+            Takes the results off the result queue and frees the ring space of the oldest finished messages.
+            While waiting the workers are checked every pollInterval seconds, if one has died the messages in flight are decoded here by decodeInProcess.
+        Inputs:
+            block - Boolean, set true to wait for at least one result
+        '''
+        while not self.failed:
+            try:
+                sequence,result = self.results.get(block=block,timeout=self.pollInterval if block else None)
+            except queue.Empty:
+                if not block:
+                    return
+                if not all(process.is_alive() for process in self.processes):
+                    self.decodeInProcess()
+                continue
+            block = False
+            self.ready[sequence] = (self.inFlight.pop(sequence)[0],result)
+            self.release(sequence)
+
+    def decodeInProcess(self):
+        '''
+        Description:
+            Called when a worker process has died, the result of the message it had will never arrive. Every message still in flight is decoded here straight
+            out of the ring and every later message is decoded in this process too, so the reader never waits on the result queue again.
+        '''
+        dead = [f'{process.pid} (exit code {process.exitcode})' for process in self.processes if not process.is_alive()]
+        print(f'Warning: decode worker {", ".join(dead)} died, decoding the {len(self.inFlight)} messages in flight and every later message in this process')
+        self.failed = True
+        for sequence in sorted(self.inFlight):
+            command,offset,length = self.inFlight.pop(sequence)
+            payload = self.ring.buf[offset:offset+length]
+            self.ready[sequence] = (command,runDecoder(self.decoder,command,payload))
+            payload.release()
+            self.release(sequence)
+
+    def pending(self):
+        '''
+        Description:
+            The number of messages submitted whose results have not been handed back yet.
+        '''
+        return self.nextSequence - self.nextResult
+
+    def readyResults(self,wait=False):
+        '''
+        Description:
+            Generator which hands back the results which are ready, in the order the messages were submitted.
+        Inputs:
+            wait - Boolean, set true to wait until every submitted message has been decoded
+        Returns:
+            sequence - The sequence number from submit
+            command  - String, the command name
+            result   - The decoder result
+        '''
+        while True:
+            if self.nextResult not in self.ready:
+                waiting = wait and self.pending() > 0
+                self.collect(block=waiting)
+                if self.nextResult not in self.ready:
+                    if waiting:
+                        continue
+                    return
+            command,result = self.ready.pop(self.nextResult)
+            yield self.nextResult,command,result
+            self.nextResult += 1
+
+    def decodeFrames(self,frames):
+        '''
+        Description:
+            Generator which takes the (command, payload) frames from readFrames, sends the commands in self.commands to the workers and passes the rest through.
+            Everything is handed back in the order it arrived. A passed through message which arrives while earlier messages are still being decoded is copied
+            and held until their results are ready, so e.g. a ping behind a large block is answered once the block is decoded. The reading is never held up.
+            Results are checked for after each frame, as reading the next frame blocks on the socket. While no messages arrive, finished results (and the
+            messages held behind them) wait for the next frame, on a busy peer that is a few milliseconds.
+        Inputs:
+            frames - Iterable of (command, payload), e.g. connector.readFrames()
+        Returns:
+            command - String, the command name
+            payload - The payload memoryview for passed through messages, the decoder result for decoded ones
+        '''
+        for command,payload in frames:
+            if command in self.commands:
+                self.submit(command,payload)
+            elif self.pending():
+                # Earlier messages are still being decoded, keep this one behind them. The payload is only valid until the next frame so it is copied
+                self.ready[self.nextSequence] = (command,bytes(payload))
+                self.nextSequence += 1
+            else:
+                yield command,payload
+            for sequence,decodedCommand,result in self.readyResults():
+                yield decodedCommand,result
+        # The frames have ended, hand back everything still being decoded
+        for sequence,decodedCommand,result in self.readyResults(wait=True):
+            yield decodedCommand,result
+
+    def close(self):
+        '''
+        Description:
+            Stops the workers and frees the shared memory.
+        '''
+        for process in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            # A worker only exits once its results are on the pipe, after a failure nothing reads them so they are drained here
+            deadline = time.monotonic() + 5
+            while process.is_alive() and time.monotonic() < deadline:
+                process.join(timeout=0.05)
+                try:
+                    while True:
+                        self.results.get_nowait()
+                except queue.Empty:
+                    pass
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+        if self.ring is not None:
+            self.ring.close()
+            self.ring.unlink()
+            self.ring = None
@@ -0,0 +1,159 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the classes Subscription and Dispatcher
+#   Instead of one loop with an if for every command, consumers subscribe to the messages they want and the Dispatcher calls them.
+#       1. Subscriptions are held in a dictionary by command name so finding the subscribers of a message is one lookup, subscribers to every command are kept apart
+#       2. Each subscription can filter on the peer the message came from, the inventory vector types of an inv (or notfound) and any other test on the parsed message
+#       3. A message is parsed at most once whatever the number of subscribers, with the parse function of the connector, and only if a subscriber wants it parsed.
+#          A command nobody has subscribed to is not parsed at all, so a consumer of inv messages does not pay for parsing every tx and block
+#   The parsed message is passed to each handler as handler(connector, command, result), the connector is the one the message came from so a handler can reply to that peer.
+
+
+## Imports ##
+# Transaction - readVarInt is used to read the count of a notfound message, see Lib/Transaction.py
+from Lib.Transaction import readVarInt
+
+# INV_COMMANDS - Commands whose result is a byte string of 36 byte inventory vectors, the invTypes filter applies to these
+INV_COMMANDS = frozenset(('inv','notfound'))
+# NOT_PARSED - Passed as the result to dispatch when the message has not been parsed yet
+NOT_PARSED = object()
+
+class Subscription:
+    # __slots__ - No per object dictionary, the filters are checked for every message
+    __slots__ = ('command','handler','parse','peer','invTypes','predicate')
+
+    def __init__(self,command,handler,parse=True,peer=None,invTypes=None,predicate=None):
+        '''
+        Description:
+            initiliaser method for the class, one subscriber and its filters. Created by Dispatcher.subscribe
+        Inputs:
+            command   - String, the command name to receive e.g. 'tx', None to receive every command
+            handler   - Function called as handler(connector, command, result)
+            parse     - Boolean, True for the result to be the parsed message (see BitcoinConnector.parseMessage), False for the raw payload memoryview
+            peer      - Optional (ip,port) tuple, only messages from this peer are received
+            invTypes  - Optional collection of inventory vector types (e.g. {1} for MSG_TX), for inv and notfound only the vectors of these types are passed and
+                        the handler is not called if there are none
+            predicate - Optional function called as predicate(result), the handler is only called if it returns True
+        '''
+        self.command   = command
+        self.handler   = handler
+        self.parse     = parse
+        self.peer      = peer
+        self.invTypes  = frozenset(invTypes) if invTypes is not None else None
+        self.predicate = predicate
+
+class Dispatcher:
+    def __init__(self):
+        '''
+        Description:
+            initiliaser method for the class
+        '''
+        # subscriptions - Dictionary of command name -> list of Subscriptions
+        # everything    - List of the Subscriptions to every command
+        self.subscriptions = {}
+        self.everything    = []
+        # displayCommands - Set of the commands parsed with display set true, e.g. {'tx','block'}
+        self.displayCommands = set()
+        # stats - Messages dispatched, parsed, and skipped as nobody subscribed
+        self.stats = {'dispatched':0,'parsed':0,'skipped':0}
+
+    def subscribe(self,command,handler,parse=True,peer=None,invTypes=None,predicate=None):
+        '''
+        Description:
+            Adds a subscriber, see Subscription for the inputs.
+        Returns:
+            subscription - The Subscription, pass it to unsubscribe to remove it
+        '''
+        subscription = Subscription(command,handler,parse,peer,invTypes,predicate)
+        if command is None:
+            self.everything.append(subscription)
+        else:
+            self.subscriptions.setdefault(command,[]).append(subscription)
+        return subscription
+
+    def unsubscribe(self,subscription):
+        '''
+        Description:
+            Removes a subscriber.
+        Inputs:
+            subscription - The Subscription returned from subscribe
+        '''
+        subscribers = self.everything if subscription.command is None else self.subscriptions.get(subscription.command,[])
+        if subscription in subscribers:
+            subscribers.remove(subscription)
+        if subscription.command is not None and not subscribers:
+            self.subscriptions.pop(subscription.command,None)
+
+    def wants(self,command):
+        '''
+        Description:
+            Checks if anybody has subscribed to a command.
+        Inputs:
+            command - String, the command name
+        Returns:
+            wanted - Boolean
+        '''
+        return command in self.subscriptions or bool(self.everything)
+
+    def dispatch(self,connector,command,payload,result=NOT_PARSED):
+        '''
+        Description:
+            Passes a message to every matching subscriber. The message is parsed with connector.parseMessage the first time a subscriber wants it parsed.
+        Inputs:
+            connector - The BitcoinConnector the message came from, used to parse and passed to the handlers
+            command   - String, the command name
+            payload   - memoryview of the payload
+            result    - The parsed message if it has already been parsed, so it is not parsed again
+        Returns:
+            result - The parsed message, NOT_PARSED if nobody wanted it parsed
+        '''
+        subscribers = self.subscriptions.get(command)
+        if subscribers is None and not self.everything:
+            self.stats['skipped'] += 1
+            return result
+        self.stats['dispatched'] += 1
+        if self.everything:
+            subscribers = (subscribers or []) + self.everything
+        peer = (connector.peerIP,connector.peerPort)
+        for subscription in subscribers:
+            if subscription.peer is not None and subscription.peer != peer:
+                continue
+            if subscription.parse:
+                if result is NOT_PARSED:
+                    result = connector.parseMessage(command,payload,display=command in self.displayCommands)
+                    self.stats['parsed'] += 1
+                value = result
+            else:
+                value = payload
+            if subscription.invTypes is not None and command in INV_COMMANDS:
+                value = self.filterInventory(value,subscription.invTypes,raw=not subscription.parse)
+                if not value:
+                    continue
+            if subscription.predicate is not None and not subscription.predicate(value):
+                continue
+            subscription.handler(connector,command,value)
+        return result
+
+    @staticmethod
+    def filterInventory(vectors,invTypes,raw=False):
+        '''
+        Description:
+            Keeps the inventory vectors of the wanted types.
+        Inputs:
+            vectors  - Byte string of 36 byte inventory vectors, or the raw inv payload (count first) if raw is set
+            invTypes - frozenset of the wanted types
+            raw      - Boolean, True if vectors is the payload with the count at the front
+        Returns:
+            vectors - Byte string of the vectors of the wanted types
+        '''
+        if not vectors:
+            return b''
+        start = 0
+        if raw:
+            try:
+                count,start = readVarInt(vectors,0)
+            except IndexError:
+                return b''
+        return b''.join(bytes(vectors[i:i+36]) for i in range(start,len(vectors)-35,36) if int.from_bytes(vectors[i:i+4],'little') in invTypes)
@@ -0,0 +1,301 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the class GetDataScheduler
+#   The scheduler decides which peer each announced tx or block is requested from with a getdata message.
+#   It keeps track of:
+#       1. pending   - Inventory which has been announced but not requested yet, blocks are put at the front so they are fetched first
+#       2. inFlight  - Inventory which has been requested and not received yet, along with the peer and when it was requested
+#       3. announcers - The other peers which announced each item, these are used if the first request fails
+#   Each peer has at most maxInFlightPerPeer items requested at once so a large inv burst (e.g. after a block) is fetched at a controlled rate.
+#   A request which is not answered within timeout seconds, or is answered with notfound, is re-sent to another peer which announced it.
+#   With no other peer to ask a timed out request is re-sent to the same peer up to maxRetries times, after that it is dropped. Drops are counted in stats.
+#   getdata payloads are split so none holds more than the protocol limit of 50,000 inventory vectors.
+#   The scheduler does no networking itself, schedule returns the getdata payloads for each peer and the caller sends them.
+#   AsyncBitcoinConnector uses one for all of its peers, BitcoinConnector uses one for its single peer when connector.scheduler is set (see main.py).
+
+
+## Imports ##
+# time        - https://docs.python.org/3/library/time.html
+# collections - https://docs.python.org/3/library/collections.html
+# Transaction - createVarInt is used to encode the getdata count, see Lib/Transaction.py
+import time
+from collections import OrderedDict
+from Lib.Transaction import createVarInt
+
+class GetDataScheduler:
+    # MSG_TX           - Inventory type of a transaction
+    # MSG_BLOCK        - Inventory type of a block, these are requested before transactions
+    # MSG_WITNESS_FLAG - Bit set in the inventory type to ask for the witness version of a tx or block
+    MSG_TX           = 1
+    MSG_BLOCK        = 2
+    MSG_WITNESS_FLAG = 1 << 30
+
+    def __init__(self,maxInFlightPerPeer=5000,timeout=60,maxPerMessage=50000,inventoryCache=None,maxRetries=0):
+        '''
+        Description:
+            initiliaser method for the class
+        Inputs:
+            maxInFlightPerPeer - The maximum number of items requested from a single peer and not yet received
+            timeout            - Seconds to wait for a requested item before it is requested from another peer
+            maxPerMessage      - The maximum number of inventory vectors in one getdata payload, the protocol limit is 50,000
+            inventoryCache     - Optional InventoryCache (see Lib/InventoryCache.py), items in it are treated as already fetched and items are added to it when requested
+            maxRetries         - How many times a timed out item is requested again from the same peer when no other peer announced it, 0 drops it straight away.
+                                 A single connection has no other peer to ask
+        '''
+        self.maxInFlightPerPeer = maxInFlightPerPeer
+        self.timeout            = timeout
+        self.maxPerMessage      = maxPerMessage
+        self.inventoryCache     = inventoryCache
+        self.maxRetries         = maxRetries
+        # blockRequestType - The type MSG_BLOCK vectors are requested as, a connector which has agreed compact blocks with its peer sets MSG_CMPCT_BLOCK
+        self.blockRequestType   = self.MSG_BLOCK | self.MSG_WITNESS_FLAG
+        # pending     - OrderedDict of hash -> 36 byte inventory vector, in the order they will be requested
+        # announcers  - Dictionary of hash -> list of the peers which announced it and have not been asked for it yet
+        # inFlight    - OrderedDict of hash -> (peer,time requested,vector), ordered by time requested so the oldest are at the front
+        # peerInFlight - Dictionary of peer -> set of the hashes requested from that peer, also the set of connected peers
+        # retries      - Dictionary of hash -> the number of times it has been requested again from the same peer
+        self.pending      = OrderedDict()
+        self.announcers   = {}
+        self.inFlight     = OrderedDict()
+        self.peerInFlight = {}
+        self.retries      = {}
+        # stats - Items requested and received, requests which timed out or were answered with notfound, and items requested again or dropped with nobody left to ask
+        self.stats = {'requested':0,'received':0,'timedOut':0,'notFound':0,'retried':0,'dropped':0}
+
+    def addPeer(self,peer):
+        '''
+        Description:
+            Registers a peer so it can be sent requests. Called automatically the first time a peer announces something.
+        Inputs:
+            peer - Any hashable object which identifies the peer, e.g. an AsyncPeer
+        '''
+        self.peerInFlight.setdefault(peer,set())
+
+    def announce(self,peer,inventoryVecs):
+        '''
+        Description:
+            Records the inventory vectors announced by a peer in an inv message.
+            Items already pending or in flight just gain the peer as another place they can be requested from.
+        Inputs:
+            peer          - The peer which sent the inv message
+            inventoryVecs - Iterable of 36 byte inventory vectors, type (4 bytes) + hash (32 bytes)
+        '''
+        self.addPeer(peer)
+        inventoryCache = self.inventoryCache
+        for vec in inventoryVecs:
+            vec     = bytes(vec)
+            invHash = vec[4:36]
+            if invHash in self.pending or invHash in self.inFlight:
+                # Already being fetched, remember this peer as a fall back
+                self.announcers[invHash].append(peer)
+                continue
+            # Already fetched (or requested by something not using this scheduler)
+            if inventoryCache is not None and not inventoryCache.add(invHash):
+                continue
+            self.pending[invHash]    = vec
+            self.announcers[invHash] = [peer]
+            # Blocks jump the queue, block latency matters more than transaction latency
+            if int.from_bytes(vec[0:4],'little') & ~self.MSG_WITNESS_FLAG == self.MSG_BLOCK:
+                self.pending.move_to_end(invHash,last=False)
+
+    def received(self,peer,invHash):
+        '''
+        Description:
+            Records that a requested item has arrived, freeing up a request slot on the peer.
+        Inputs:
+            peer    - The peer the item came from
+            invHash - The 32 byte hash of the item (the txid for a tx, the block hash for a block)
+        Returns:
+            requested - Boolean, True if the item was in flight
+        '''
+        entry = self.inFlight.pop(invHash,None)
+        self.announcers.pop(invHash,None)
+        self.retries.pop(invHash,None)
+        # It may have been announced again after it was requested
+        self.pending.pop(invHash,None)
+        if entry is None:
+            return False
+        self.peerInFlight.get(entry[0],set()).discard(invHash)
+        self.stats['received'] += 1
+        return True
+
+    def notFound(self,peer,inventoryVecs):
+        '''
+        Description:
+            Handles a notfound message, each item is requested again from another peer which announced it.
+        Inputs:
+            peer          - The peer which sent the notfound
+            inventoryVecs - Iterable of 36 byte inventory vectors from the notfound message
+        '''
+        for vec in inventoryVecs:
+            invHash = bytes(vec[4:36])
+            entry   = self.inFlight.get(invHash)
+            if entry is not None and entry[0] == peer:
+                self.stats['notFound'] += 1
+                self.retry(invHash)
+
+    def retry(self,invHash,samePeer=False):
+        '''
+        Description:
+            Takes an item out of flight and puts it back at the front of pending so it is requested from the next peer which announced it.
+            If no other peer announced it, it is dropped and removed from the inventory cache so it can be requested if it is announced again.
+        Inputs:
+            invHash  - The 32 byte hash of the item
+            samePeer - Boolean, set true if the peer it was requested from may be asked again (up to maxRetries times) when no other peer announced it
+        Returns:
+            requeued - Boolean, False if the item was dropped
+        '''
+        peer,requestTime,vec = self.inFlight.pop(invHash)
+        self.peerInFlight.get(peer,set()).discard(invHash)
+        announcers = self.announcers.get(invHash)
+        if not announcers and samePeer and self.retries.get(invHash,0) < self.maxRetries:
+            self.retries[invHash] = self.retries.get(invHash,0) + 1
+            announcers = self.announcers[invHash] = [peer]
+        if announcers:
+            self.pending[invHash] = vec
+            self.pending.move_to_end(invHash,last=False)
+            self.stats['retried'] += 1
+            return True
+        self.drop(invHash)
+        return False
+
+    def drop(self,invHash):
+        '''
+        Description:
+            Forgets an item nobody is left to request it from, it is removed from the inventory cache so it can be requested if it is announced again.
+        Inputs:
+            invHash - The 32 byte hash of the item
+        '''
+        self.announcers.pop(invHash,None)
+        self.retries.pop(invHash,None)
+        if self.inventoryCache is not None:
+            self.inventoryCache.discard(invHash)
+        self.stats['dropped'] += 1
+
+    def checkTimeouts(self,now=None):
+        '''
+        Description:
+            Finds the requests which have not been answered within timeout seconds and re-queues them for another peer, or the same peer up to maxRetries times.
+            The requests dropped with nobody left to ask are counted in stats and a warning is printed.
+            inFlight is ordered by request time so only the front needs to be checked.
+        Inputs:
+            now - The current time from time.monotonic, defaults to now
+        Returns:
+            timedOut - The number of requests which timed out
+        '''
+        now      = time.monotonic() if now is None else now
+        cutoff   = now - self.timeout
+        timedOut = []
+        for invHash,(peer,requestTime,vec) in self.inFlight.items():
+            if requestTime > cutoff:
+                break
+            timedOut.append(invHash)
+        dropped = sum(not self.retry(invHash,samePeer=True) for invHash in timedOut)
+        self.stats['timedOut'] += len(timedOut)
+        if dropped:
+            print(f'Warning: {dropped} getdata requests timed out with no peer left to ask, dropped, {self.stats["dropped"]} dropped in total')
+        return len(timedOut)
+
+    def peerDisconnected(self,peer):
+        '''
+        Description:
+            Removes a peer, everything in flight from it is requested from another peer.
+        Inputs:
+            peer - The peer which disconnected
+        '''
+        inFlight = self.peerInFlight.pop(peer,set())
+        for invHash in inFlight:
+            if invHash in self.inFlight:
+                self.retry(invHash)
+
+    def schedule(self,now=None):
+        '''
+        Description:
+            Assigns pending items to peers. Each item goes to the first peer which announced it and has a free request slot.
+            Items with no available peer stay pending, items whose announcers have all disconnected are dropped.
+        Inputs:
+            now - The current time from time.monotonic, defaults to now
+        Returns:
+            requests - Dictionary of peer -> list of getdata payloads to send to that peer
+        '''
+        now          = time.monotonic() if now is None else now
+        peerInFlight = self.peerInFlight
+        maxInFlight  = self.maxInFlightPerPeer
+        assigned     = {}
+        dropped      = []
+        # freeSlots - The total number of requests the peers can still take, once it is 0 there is no point looking further
+        freeSlots    = sum(max(0,maxInFlight-len(hashes)) for hashes in peerInFlight.values())
+        for invHash,vec in self.pending.items():
+            if freeSlots == 0:
+                break
+            peers  = self.announcers[invHash]
+            # Forget peers which have disconnected
+            peers[:] = [peer for peer in peers if peer in peerInFlight]
+            if not peers:
+                dropped.append(invHash)
+                continue
+            for i,peer in enumerate(peers):
+                if len(peerInFlight[peer]) < maxInFlight:
+                    del peers[i]
+                    peerInFlight[peer].add(invHash)
+                    self.inFlight[invHash] = (peer,now,vec)
+                    assigned.setdefault(peer,[]).append(vec)
+                    freeSlots -= 1
+                    break
+        # Remove what was assigned or dropped from pending
+        for peer,vecs in assigned.items():
+            self.stats['requested'] += len(vecs)
+            for vec in vecs:
+                del self.pending[vec[4:36]]
+        for invHash in dropped:
+            del self.pending[invHash]
+            self.drop(invHash)
+        return {peer:self.createGetDataPayloads(vecs) for peer,vecs in assigned.items()}
+
+    def createGetDataPayloads(self,inventoryVecs):
+        '''
+        Description:
+            Creates getdata payloads for a list of inventory vectors, splitting them so no payload holds more than maxPerMessage vectors.
+            MSG_TX vectors have MSG_WITNESS_FLAG set so transactions arrive with their witness, MSG_BLOCK vectors are sent as blockRequestType.
+            The count is a variable length integer so counts over 252 are encoded correctly.
+        Inputs:
+            inventoryVecs - List of 36 byte inventory vectors
+        Returns:
+            payloads - List of getdata payloads
+        '''
+        payloads = []
+        for i in range(0,len(inventoryVecs),self.maxPerMessage):
+            chunk = inventoryVecs[i:i+self.maxPerMessage]
+            payloads.append(createVarInt(len(chunk)) + b''.join(self.witnessVector(vec) for vec in chunk))
+        return payloads
+
+    def witnessVector(self,vec):
+        '''
+        Description:
+            Sets MSG_WITNESS_FLAG in the type of a MSG_TX inventory vector and sets the type of a MSG_BLOCK vector to blockRequestType, other types are left as they are.
+        Inputs:
+            vec - 36 byte inventory vector
+        Returns:
+            vec - 36 byte inventory vector
+        '''
+        invType = int.from_bytes(vec[0:4],'little')
+        if invType == self.MSG_TX:
+            return (invType | self.MSG_WITNESS_FLAG).to_bytes(4,'little') + vec[4:36]
+        if invType == self.MSG_BLOCK:
+            return self.blockRequestType.to_bytes(4,'little') + vec[4:36]
+        return vec
+
+    def inFlightCount(self,peer=None):
+        '''
+        Description:
+            The number of items requested and not yet received.
+        Inputs:
+            peer - If passed only the items requested from this peer are counted
+        Returns:
+            count - Integer
+        '''
+        if peer is None:
+            return len(self.inFlight)
+        return len(self.peerInFlight.get(peer,()))
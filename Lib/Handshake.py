@@ -0,0 +1,273 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the classes PeerVersion and Handshake and the functions which create and parse the version and feefilter messages.
+#   The handshake used to send a version, read the socket twice and hope the version and verack had arrived, the version of the peer was only printed as raw bytes.
+#   Handshake is a state machine which does not touch the socket, the connector feeds it the messages it receives and sends the replies it returns:
+#       1. start         - Our version message
+#       2. version       - The version of the peer is parsed into a PeerVersion (services, start height, user agent, relay), checked, and answered with
+#                          wtxidrelay (BIP339) and sendaddrv2 (BIP155), which must be sent between version and verack, then our verack
+#       3. verack        - Once the peer has sent both its version and verack the handshake is complete, sendheaders (BIP130) and feefilter (BIP133) are sent then
+#       4. wtxidrelay, sendaddrv2, sendheaders and feefilter from the peer are recorded in self.features whenever they arrive
+#   A feature is only sent if the lower of the two protocol versions supports it. The time from our version to the end of the handshake is kept in self.elapsed.
+#   The same state machine is used by BitcoinConnector.connectToPeer, which reads under a deadline, and by AsyncPeer.
+
+
+## Imports ##
+# os          - https://docs.python.org/3/library/os.html
+# time        - https://docs.python.org/3/library/time.html
+# struct      - https://docs.python.org/3/library/struct.html
+# Transaction - readVarInt and createVarInt read and write the user agent length, see Lib/Transaction.py
+# CaptureLog  - packIP and unpackIP convert the addresses in the version message, see Lib/CaptureLog.py
+import os
+import time
+import struct
+from Lib.Transaction import readVarInt,createVarInt
+from Lib.CaptureLog import packIP,unpackIP
+
+# USER_AGENT - Sent in our version message, see BIP14
+USER_AGENT = b'/BitcoinConnector:0.1/'
+# VERSION_HEADER - version (4), services (8), timestamp (8) then addr_recv and addr_from, each services (8), address (16) and port (2, big endian)
+#   The nonce (8) follows, then the user agent as a variable length string, start height (4) and relay (1)
+VERSION_HEADER = struct.Struct('<iQq')
+NET_ADDR       = struct.Struct('<Q16s')
+NONCE_OFFSET   = VERSION_HEADER.size + 2*(NET_ADDR.size+2)
+# MIN_PEER_VERSION - Peers older than this are not connected to, the same limit as Bitcoin Core
+MIN_PEER_VERSION = 31800
+# MAX_USER_AGENT - The longest user agent accepted, the same limit as Bitcoin Core
+MAX_USER_AGENT = 256
+# FEATURE_VERSIONS - The protocol version both sides need for each feature message
+FEATURE_VERSIONS = {'sendheaders':70012,'feefilter':70013,'wtxidrelay':70016,'sendaddrv2':70016}
+# NEGOTIATION_COMMANDS - The feature messages, wtxidrelay and sendaddrv2 are only valid before verack
+NEGOTIATION_COMMANDS = frozenset(FEATURE_VERSIONS)
+PRE_VERACK_COMMANDS  = frozenset(('wtxidrelay','sendaddrv2'))
+# HANDSHAKE_COMMANDS - Every command handled by Handshake.receive
+HANDSHAKE_COMMANDS = NEGOTIATION_COMMANDS | {'version','verack'}
+# SERVICE_NAMES - The service bits of the version and addr messages, see https://developer.bitcoin.org/reference/p2p_networking.html#version
+SERVICE_NAMES = ((1,'NETWORK'),(1<<2,'BLOOM'),(1<<3,'WITNESS'),(1<<6,'COMPACT_FILTERS'),(1<<10,'NETWORK_LIMITED'),(1<<11,'P2P_V2'))
+
+def serviceNames(services):
+    '''
+    Description:
+        Turns the service bits of a peer into a readable string.
+    Inputs:
+        services - Integer of the service bits
+    Returns:
+        names - String e.g. 'NETWORK|WITNESS', 'NONE' if no bits are set
+    '''
+    names = [name for bit,name in SERVICE_NAMES if services & bit]
+    unknown = services & ~sum(bit for bit,name in SERVICE_NAMES)
+    if unknown:
+        names.append(hex(unknown))
+    return '|'.join(names) if names else 'NONE'
+
+def createVersionPayload(protocolVersion,peerIP,peerPort,startHeight=0,relay=True,services=0,userAgent=USER_AGENT,nonce=None):
+    '''
+    Description:
+        Creates the payload of a version message.
+    Inputs:
+        protocolVersion - The protocol version we speak
+        peerIP          - The IP address of the peer, sent in addr_recv
+        peerPort        - The port of the peer, sent in addr_recv
+        startHeight     - The height of our best block
+        relay           - Boolean, True for the peer to announce every transaction
+        services        - Our service bits, 0 as we do not serve blocks
+        userAgent       - Byte string of our user agent
+        nonce           - 8 byte string used to detect connecting to ourselves, random if not passed
+    Returns:
+        payload - The payload for the version message
+    '''
+    nonce = nonce if nonce is not None else os.urandom(8)
+    addrRecv = NET_ADDR.pack(0,packIP(peerIP)) + struct.pack('>H',peerPort)
+    addrFrom = NET_ADDR.pack(services,packIP('127.0.0.1')) + struct.pack('>H',8333)
+    return (VERSION_HEADER.pack(protocolVersion,services,int(time.time())) + addrRecv + addrFrom + nonce
+            + createVarInt(len(userAgent)) + userAgent + struct.pack('<i?',startHeight,relay))
+
+class PeerVersion:
+    # __slots__ - The fields of the version message, see createVersionPayload
+    __slots__ = ('version','services','timestamp','addrRecv','addrFrom','nonce','userAgent','startHeight','relay')
+
+    def __init__(self,payload):
+        '''
+        Description:
+            initiliaser method for the class, parses the payload of a version message.
+            The relay flag was added in protocol version 70001, it is True if the peer does not send it.
+        Inputs:
+            payload - Byte string or memoryview of the version payload
+        Raises:
+            ValueError - If the payload is cut short or the user agent is too long
+        '''
+        try:
+            self.version,self.services,self.timestamp = VERSION_HEADER.unpack_from(payload,0)
+            position = VERSION_HEADER.size
+            addresses = []
+            for i in range(2):
+                services,packed = NET_ADDR.unpack_from(payload,position)
+                port, = struct.unpack_from('>H',payload,position+NET_ADDR.size)
+                addresses.append((unpackIP(packed),port,services))
+                position += NET_ADDR.size + 2
+            self.addrRecv,self.addrFrom = addresses
+            self.nonce = bytes(payload[position:position+8])
+            length,position = readVarInt(payload,position+8)
+            if length > MAX_USER_AGENT:
+                raise ValueError(f'user agent of {length} Bytes is too long')
+            self.userAgent = bytes(payload[position:position+length]).decode('utf-8','replace')
+            self.startHeight, = struct.unpack_from('<i',payload,position+length)
+        except (struct.error,IndexError):
+            raise ValueError(f'version payload of {len(payload)} Bytes is too short')
+        position += length + 4
+        self.relay = bool(payload[position]) if position < len(payload) else True
+
+    def __repr__(self):
+        return (f'version {self.version} {self.userAgent} height {self.startHeight} services {serviceNames(self.services)} relay {self.relay} '
+                f'time offset {self.timestamp-int(time.time())} s')
+
+def createFeeFilterPayload(feeRate):
+    '''
+    Description:
+        Creates the payload of a feefilter message (BIP133), the peer should not announce transactions paying less than feeRate.
+    Inputs:
+        feeRate - Satoshis per 1000 virtual bytes
+    Returns:
+        payload - The payload for the feefilter message
+    '''
+    return struct.pack('<q',feeRate)
+
+def parseFeeFilterPayload(payload):
+    '''
+    Description:
+        Parses the payload of a feefilter message.
+    Inputs:
+        payload - Byte string or memoryview of the payload
+    Returns:
+        feeRate - Satoshis per 1000 virtual bytes
+    Raises:
+        ValueError - If the payload is not 8 bytes
+    '''
+    if len(payload) < 8:
+        raise ValueError(f'feefilter payload of {len(payload)} Bytes is too short')
+    return struct.unpack_from('<q',payload,0)[0]
+
+class Handshake:
+    def __init__(self,versionPayload,protocolVersion,wtxidRelay=False,addrV2=True,sendHeaders=False,feeRate=None):
+        '''
+        Description:
+            initiliaser method for the class, one per connection
+        Inputs:
+            versionPayload  - Our version payload, see createVersionPayload. Its nonce is used to detect connecting to ourselves
+            protocolVersion - The protocol version in our version payload
+            wtxidRelay      - Boolean, send wtxidrelay so transactions are announced by wtxid, the inv handling must then accept MSG_WTX (type 5)
+            addrV2          - Boolean, send sendaddrv2 so addresses are sent as addrv2, which includes Tor v3 and I2P addresses
+            sendHeaders     - Boolean, send sendheaders so new blocks are announced with headers instead of inv, needs a HeaderChain to make use of them
+            feeRate         - Optional satoshis per 1000 virtual bytes sent in a feefilter, transactions paying less are not announced to us
+        '''
+        self.versionPayload  = versionPayload
+        self.protocolVersion = protocolVersion
+        self.nonce           = bytes(versionPayload[NONCE_OFFSET:NONCE_OFFSET+8])
+        self.wtxidRelay      = wtxidRelay
+        self.addrV2          = addrV2
+        self.sendHeaders     = sendHeaders
+        self.feeRate         = feeRate
+        # peer    - PeerVersion of the peer once its version has arrived
+        # verack  - Set once the verack of the peer has arrived
+        # sent    - Set of the feature messages we have sent
+        # features - Dictionary of the feature messages the peer sent -> True, or the fee rate for feefilter
+        self.peer     = None
+        self.verack   = False
+        self.sent     = set()
+        self.features = {}
+        # started/elapsed - time.perf_counter() when our version was sent and the seconds until the handshake completed
+        self.started  = None
+        self.elapsed  = None
+
+    @property
+    def complete(self):
+        # The handshake is complete once the peer has sent both its version and verack
+        return self.peer is not None and self.verack
+
+    @property
+    def commonVersion(self):
+        # The lower of the two protocol versions decides which features can be used
+        return min(self.protocolVersion,self.peer.version) if self.peer is not None else self.protocolVersion
+
+    def negotiated(self,feature):
+        '''
+        Description:
+            Checks if a feature is in use, both sides sent the message for wtxidrelay and sendaddrv2, the peer sent it for sendheaders and feefilter.
+        Inputs:
+            feature - The command name of the feature e.g. 'wtxidrelay'
+        Returns:
+            negotiated - Boolean
+        '''
+        if feature in PRE_VERACK_COMMANDS:
+            return feature in self.sent and feature in self.features
+        return feature in self.features
+
+    def start(self):
+        '''
+        Description:
+            Starts the handshake.
+        Returns:
+            messages - List of (command, payload) to send, our version
+        '''
+        self.started = time.perf_counter()
+        return [('version',self.versionPayload)]
+
+    def offer(self,feature,payload=b''):
+        # Adds a feature message to send if it is supported by both sides, returns a list to add to the replies
+        if self.commonVersion < FEATURE_VERSIONS[feature]:
+            return []
+        self.sent.add(feature)
+        return [(feature,payload)]
+
+    def receive(self,command,payload):
+        '''
+        Description:
+            Handles a handshake message from the peer, see HANDSHAKE_COMMANDS.
+        Inputs:
+            command - String, the command name
+            payload - Byte string or memoryview of the payload
+        Returns:
+            messages - List of (command, payload) to send in reply, in order
+        Raises:
+            ValueError - If the version can not be parsed, is too old, is a second version or is our own (we connected to ourselves), the connection should be closed.
+                         Also if a feefilter is cut short
+        '''
+        replies = []
+        if command == 'version':
+            if self.peer is not None:
+                raise ValueError('second version message')
+            peer = PeerVersion(payload)
+            if peer.version < MIN_PEER_VERSION:
+                raise ValueError(f'protocol version {peer.version} is too old')
+            if peer.nonce == self.nonce:
+                raise ValueError('connected to ourselves')
+            self.peer = peer
+            # wtxidrelay and sendaddrv2 must be sent before our verack
+            if self.wtxidRelay:
+                replies += self.offer('wtxidrelay')
+            if self.addrV2:
+                replies += self.offer('sendaddrv2')
+            replies.append(('verack',b''))
+        elif command == 'verack':
+            self.verack = True
+        elif command in PRE_VERACK_COMMANDS:
+            # Too late after verack, the feature is not used
+            if not self.verack:
+                self.features[command] = True
+        elif command == 'feefilter':
+            self.features[command] = parseFeeFilterPayload(payload)
+        elif command in NEGOTIATION_COMMANDS:
+            self.features[command] = True
+        if command in ('version','verack') and self.complete and self.elapsed is None:
+            self.elapsed = time.perf_counter() - self.started if self.started is not None else 0.0
+            if self.sendHeaders:
+                replies += self.offer('sendheaders')
+            if self.feeRate is not None:
+                replies += self.offer('feefilter',createFeeFilterPayload(self.feeRate))
+        return replies
+
+    def __repr__(self):
+        features = ','.join(f'{feature}={value}' if feature == 'feefilter' else feature for feature,value in self.features.items()) or 'none'
+        return f'{self.peer!r}, peer features {features}, handshake {self.elapsed*1000:.1f} ms' if self.complete else 'handshake not complete'
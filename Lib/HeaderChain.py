@@ -0,0 +1,472 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the class HeaderChain and the functions for converting between the compact bits form of a proof of work target and the target.
+#   HeaderChain is an in memory index of block headers received in headers messages (see https://en.bitcoin.it/wiki/Protocol_documentation#headers) and block messages.
+#   Every header is checked before it is added:
+#       1. It must connect to a header already in the chain
+#       2. Its hash must meet the target in its bits (proof of work)
+#       3. Its bits must be the difficulty required at its height, the target is retargeted every 2016 blocks from the time the last 2016 took
+#   A headers message holds up to 2000 headers, the hashing and proof of work checks are done for the whole message in one batch before the headers are linked.
+#   Headers which do not build on the best chain are kept as forks, the best chain is the one with the most total work and is switched to if a fork overtakes it.
+#   To keep memory small with 800,000+ headers, the headers are stored back to back in one bytearray and the height, parent and work of each are in arrays by index.
+#   The chain can be saved to a file holding the raw headers, their hashes and the parent and height of each so a restart loads it without hashing or checking anything again.
+#   Only the mainnet difficulty rules are implemented, testnet minimum difficulty blocks are not.
+
+
+## Imports ##
+# os          - https://docs.python.org/3/library/os.html
+# struct      - https://docs.python.org/3/library/struct.html
+# hashlib     - https://docs.python.org/3/library/hashlib.html
+# array       - https://docs.python.org/3/library/array.html
+# Transaction - readVarInt and createVarInt are used for the headers and getheaders counts, see Lib/Transaction.py
+# Block       - BlockHeader decodes the header fields, the same class parseBlockPayload uses, see Lib/Block.py
+import os
+import struct
+import hashlib
+from array import array
+from Lib.Transaction import readVarInt,createVarInt,UINT32
+from Lib.Block import BlockHeader,HEADER_LENGTH
+
+# GENESIS_HEADER - The 80 byte header of the mainnet genesis block
+GENESIS_HEADER = bytes.fromhex('0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c')
+# POW_LIMIT_BITS - The easiest target allowed on mainnet, in compact form
+POW_LIMIT_BITS = 0x1d00ffff
+# RETARGET_INTERVAL/TARGET_TIMESPAN - The target is recalculated every 2016 blocks so they take two weeks
+RETARGET_INTERVAL = 2016
+TARGET_TIMESPAN   = 14*24*60*60
+# MAX_HEADERS - The most headers a peer sends in one headers message
+MAX_HEADERS = 2000
+# FILE_MAGIC - The first bytes of a saved chain file, followed by the header count
+FILE_MAGIC = b'HDRCHN01'
+
+def bitsToTarget(bits):
+    '''
+    Description:
+        Expands the compact bits form of a target, the top byte is the size in bytes and the low 3 bytes are the most significant bytes of the target.
+    Inputs:
+        bits - The 4 byte bits field of a header as an integer
+    Returns:
+        target - The target as an integer, 0 if the bits are negative (invalid)
+    '''
+    size     = bits >> 24
+    mantissa = bits & 0x007fffff
+    if bits & 0x00800000:
+        return 0
+    if size <= 3:
+        return mantissa >> 8*(3-size)
+    return mantissa << 8*(size-3)
+
+def targetToBits(target):
+    '''
+    Description:
+        Converts a target to the compact bits form, the reverse of bitsToTarget (the low bits of the target are lost).
+    Inputs:
+        target - The target as an integer
+    Returns:
+        bits - The compact form as an integer
+    '''
+    size = (target.bit_length()+7)//8
+    if size <= 3:
+        compact = target << 8*(3-size)
+    else:
+        compact = target >> 8*(size-3)
+    # The mantissa is signed, if its top bit would be set shift it down a byte
+    if compact & 0x00800000:
+        compact >>= 8
+        size += 1
+    return compact | (size << 24)
+
+class HeaderChain:
+    def __init__(self,genesis=GENESIS_HEADER,powLimitBits=POW_LIMIT_BITS,retargeting=True):
+        '''
+        Description:
+            initiliaser method for the class, the chain starts with just the genesis header
+        Inputs:
+            genesis      - The 80 byte header of the first block, defaults to the mainnet genesis block
+            powLimitBits - The easiest target allowed, in compact form
+            retargeting  - Boolean, set false for a network where the difficulty never changes (e.g. regtest or Lib/MockPeer.py)
+        '''
+        self.powLimit    = bitsToTarget(powLimitBits)
+        self.retargeting = retargeting
+        # raw      - Every header back to back, header i is raw[80*i:80*i+80], always in an order where a parent comes before its children
+        # hashes   - Dictionary of block hash -> index
+        # hashList - The block hash of each index
+        # heights/parents - The height and parent index of each index, the genesis parent is -1
+        # chainWork - The total work of the chain ending at each index
+        self.raw       = bytearray()
+        self.hashes    = {}
+        self.hashList  = []
+        self.heights   = array('I')
+        self.parents   = array('i')
+        self.chainWork = []
+        # best      - The index of the tip of the chain with the most work
+        # mainChain - Index of the header at each height of the best chain
+        # tips      - The set of indexes with no children, the best tip and the tips of every fork
+        self.best      = 0
+        self.mainChain = array('I')
+        self.tips      = set()
+        # targets/works - Caches of bits -> target and bits -> work, there are few distinct bits values
+        self.targets   = {}
+        self.works     = {}
+        genesisHash = self.hashHeader(genesis)
+        self.insert(bytes(genesis),genesisHash,-1)
+
+    def __len__(self):
+        return len(self.hashList)
+
+    def __contains__(self,blockHash):
+        return blockHash in self.hashes
+
+    @staticmethod
+    def hashHeader(raw):
+        # SHA256(SHA256(header)), internal byte order
+        return hashlib.sha256(hashlib.sha256(raw).digest()).digest()
+
+    def target(self,bits):
+        target = self.targets.get(bits)
+        if target is None:
+            target = self.targets[bits] = bitsToTarget(bits)
+        return target
+
+    def work(self,bits):
+        # The expected number of hashes needed to meet the target, 2**256 / (target+1)
+        work = self.works.get(bits)
+        if work is None:
+            work = self.works[bits] = (1 << 256)//(self.target(bits)+1)
+        return work
+
+    def header(self,index):
+        '''
+        Description:
+            The header at an index.
+        Inputs:
+            index - Index of the header in the chain
+        Returns:
+            header - BlockHeader instance over the stored bytes
+        '''
+        # Copied out so no memoryview holds self.raw, a bytearray can not grow while one exists
+        return BlockHeader(bytes(self.raw[HEADER_LENGTH*index:HEADER_LENGTH*(index+1)]))
+
+    def bitsAt(self,index):
+        return UINT32.unpack_from(self.raw,HEADER_LENGTH*index+72)[0]
+
+    def timestampAt(self,index):
+        return UINT32.unpack_from(self.raw,HEADER_LENGTH*index+68)[0]
+
+    @property
+    def height(self):
+        # The height of the best chain tip
+        return self.heights[self.best]
+
+    @property
+    def tipHash(self):
+        return self.hashList[self.best]
+
+    def getByHash(self,blockHash):
+        '''
+        Description:
+            Looks up a header by its hash.
+        Inputs:
+            blockHash - The 32 byte block hash, internal byte order
+        Returns:
+            header - BlockHeader instance, None if it is not in the chain
+            height - The height of the header, None if it is not in the chain
+        '''
+        index = self.hashes.get(blockHash)
+        if index is None:
+            return None,None
+        return self.header(index),self.heights[index]
+
+    def getByHeight(self,height):
+        '''
+        Description:
+            Looks up the header at a height of the best chain.
+        Inputs:
+            height - The block height
+        Returns:
+            header - BlockHeader instance, None if the best chain is not that long
+        '''
+        if not 0 <= height < len(self.mainChain):
+            return None
+        return self.header(self.mainChain[height])
+
+    def ancestor(self,index,height):
+        '''
+        Description:
+            Finds the header at a lower height on the chain ending at index.
+            If index is on the best chain this is a lookup, otherwise the parents are walked back until the best chain is reached.
+        Inputs:
+            index  - Index of a header
+            height - The height of the ancestor wanted
+        Returns:
+            index - Index of the ancestor
+        '''
+        heights   = self.heights
+        mainChain = self.mainChain
+        while heights[index] > height:
+            if heights[index] < len(mainChain) and mainChain[heights[index]] == index:
+                return mainChain[height]
+            index = self.parents[index]
+        return index
+
+    def expectedBits(self,parent):
+        '''
+        Description:
+            Works out the bits a header building on parent must have.
+            The difficulty only changes every 2016 blocks, then the new target is the old one scaled by how long the last 2016 blocks took compared to two weeks,
+            limited to a change of 4 times either way and never easier than the proof of work limit.
+        Inputs:
+            parent - Index of the parent header
+        Returns:
+            bits - The required bits
+        '''
+        parentBits = self.bitsAt(parent)
+        height     = self.heights[parent] + 1
+        if not self.retargeting or height % RETARGET_INTERVAL != 0:
+            return parentBits
+        first    = self.ancestor(parent,height-RETARGET_INTERVAL)
+        timespan = self.timestampAt(parent) - self.timestampAt(first)
+        timespan = min(max(timespan,TARGET_TIMESPAN//4),TARGET_TIMESPAN*4)
+        target   = min(bitsToTarget(parentBits)*timespan//TARGET_TIMESPAN,self.powLimit)
+        return targetToBits(target)
+
+    def insert(self,raw,blockHash,parent):
+        '''
+        Description:
+            Adds a checked header to the index and moves the best chain to it if it now has the most work.
+        Inputs:
+            raw       - The 80 header bytes
+            blockHash - The block hash
+            parent    - Index of the parent header, -1 for the genesis header
+        Returns:
+            index - Index of the new header
+        '''
+        index = len(self.hashList)
+        bits  = UINT32.unpack_from(raw,72)[0]
+        self.raw       += raw
+        self.hashes[blockHash] = index
+        self.hashList.append(blockHash)
+        self.heights.append(self.heights[parent]+1 if parent >= 0 else 0)
+        self.parents.append(parent)
+        self.chainWork.append((self.chainWork[parent] if parent >= 0 else 0) + self.work(bits))
+        self.tips.discard(parent)
+        self.tips.add(index)
+        if parent < 0 or self.chainWork[index] > self.chainWork[self.best]:
+            self.setBest(index)
+        return index
+
+    def setBest(self,index):
+        '''
+        Description:
+            Makes index the tip of the best chain. Only the part of mainChain above the fork point is rewritten.
+        Inputs:
+            index - Index of the new best tip
+        '''
+        mainChain = self.mainChain
+        height    = self.heights[index]
+        # Walk back from the new tip until the walk meets the current best chain
+        branch = []
+        while index >= 0 and not (self.heights[index] < len(mainChain) and mainChain[self.heights[index]] == index):
+            branch.append(index)
+            index = self.parents[index]
+        forkHeight = self.heights[index]+1 if index >= 0 else 0
+        del mainChain[forkHeight:]
+        mainChain.extend(reversed(branch))
+        self.best = mainChain[height]
+
+    def parseHeaders(self,payload):
+        '''
+        Description:
+            Splits a headers message payload into the raw headers, each header is followed by a txn_count which is always 0.
+        Inputs:
+            payload - Byte string or memoryview of the headers payload
+        Returns:
+            headers - List of 80 byte strings
+        Raises:
+            ValueError - If the payload is truncated or holds more than MAX_HEADERS headers
+        '''
+        try:
+            count,position = readVarInt(payload,0)
+        except (IndexError,struct.error):
+            raise ValueError('headers count is truncated')
+        if count > MAX_HEADERS:
+            raise ValueError(f'headers message has {count} headers, the limit is {MAX_HEADERS}')
+        headers = []
+        for i in range(count):
+            if position + HEADER_LENGTH >= len(payload):
+                raise ValueError(f'headers message is truncated at header {i} of {count}')
+            headers.append(bytes(payload[position:position+HEADER_LENGTH]))
+            try:
+                txCount,position = readVarInt(payload,position+HEADER_LENGTH)
+            except (IndexError,struct.error):
+                raise ValueError(f'headers message is truncated at header {i} of {count}')
+        return headers
+
+    def addHeaders(self,headers):
+        '''
+        Description:
+            Checks and adds a batch of headers, e.g. from one headers message, in order.
+            The hashes and proof of work of the whole batch are checked first, then each header is linked to its parent and its difficulty checked.
+            Headers already in the chain are skipped. Adding stops at the first invalid header, the headers before it are kept.
+        Inputs:
+            headers - List of 80 byte header strings, each must follow one already in the chain or earlier in the list
+        Returns:
+            added - The number of new headers added
+            error - String describing the first invalid header, None if every header was valid
+        '''
+        sha256 = hashlib.sha256
+        hashes = [sha256(sha256(raw).digest()).digest() for raw in headers]
+        # Batch proof of work check, the header hash read as a little endian number must not be above the target
+        target = self.target
+        for i,(raw,blockHash) in enumerate(zip(headers,hashes)):
+            bits = UINT32.unpack_from(raw,72)[0]
+            limit = target(bits)
+            if limit == 0 or limit > self.powLimit or int.from_bytes(blockHash,'little') > limit:
+                headers = headers[:i]
+                error   = f'header {blockHash[::-1].hex()} does not meet its proof of work target'
+                break
+        else:
+            error = None
+        added = 0
+        for raw,blockHash in zip(headers,hashes):
+            if blockHash in self.hashes:
+                continue
+            parent = self.hashes.get(raw[4:36])
+            if parent is None:
+                return added,f'header {blockHash[::-1].hex()} does not connect to the chain'
+            bits = UINT32.unpack_from(raw,72)[0]
+            if bits != self.expectedBits(parent):
+                return added,f'header {blockHash[::-1].hex()} has bits {bits:08x}, expected {self.expectedBits(parent):08x}'
+            self.insert(raw,blockHash,parent)
+            added += 1
+        return added,error
+
+    def addHeader(self,header):
+        '''
+        Description:
+            Checks and adds a single header, e.g. the header of a block message.
+        Inputs:
+            header - BlockHeader instance or 80 byte string
+        Returns:
+            added - The number of new headers added, 0 or 1
+            error - String describing why the header is invalid, None if it is valid
+        '''
+        raw = bytes(header.raw) if isinstance(header,BlockHeader) else bytes(header)
+        return self.addHeaders([raw])
+
+    def locator(self):
+        '''
+        Description:
+            The block locator sent in getheaders, hashes of the best chain from the tip back to genesis.
+            The first 10 are the last 10 blocks then the step back doubles each time, so the peer can find where our chain leaves theirs with few hashes.
+        Returns:
+            hashes - List of 32 byte block hashes, newest first
+        '''
+        hashes = []
+        height = self.height
+        step   = 1
+        while height > 0:
+            hashes.append(self.hashList[self.mainChain[height]])
+            if len(hashes) >= 10:
+                step *= 2
+            height -= step
+        hashes.append(self.hashList[self.mainChain[0]])
+        return hashes
+
+    def createGetHeadersPayload(self,protocolVersion=70016,stopHash=bytes(32)):
+        '''
+        Description:
+            Creates the payload of a getheaders message asking for the headers after our best chain.
+        Inputs:
+            protocolVersion - The protocol version
+            stopHash        - Hash of the last header wanted, all zeros for as many as the peer will send (2000)
+        Returns:
+            payload - Byte string of the getheaders payload
+        '''
+        locator = self.locator()
+        return struct.pack('<I',protocolVersion) + createVarInt(len(locator)) + b''.join(locator) + stopHash
+
+    def forks(self):
+        '''
+        Description:
+            The tips of the chains which are not the best chain.
+        Returns:
+            forks - List of (tip hash, tip height, fork height) where fork height is the first height which differs from the best chain
+        '''
+        forks = []
+        for tip in self.tips:
+            if tip == self.best:
+                continue
+            forkPoint = tip
+            while not (self.heights[forkPoint] < len(self.mainChain) and self.mainChain[self.heights[forkPoint]] == forkPoint):
+                forkPoint = self.parents[forkPoint]
+            forks.append((self.hashList[tip],self.heights[tip],self.heights[forkPoint]+1))
+        return forks
+
+    def save(self,path):
+        '''
+        Description:
+            Saves the chain to a file, the header count followed by the raw headers, their hashes and the parent and height of each.
+            The file is written to a temporary name first and renamed so a crash never leaves a half written chain.
+        Inputs:
+            path - The file to write
+        '''
+        temporary = path + '.tmp'
+        with open(temporary,'wb') as chainFile:
+            chainFile.write(FILE_MAGIC + struct.pack('<I',len(self.hashList)))
+            chainFile.write(self.raw)
+            chainFile.write(b''.join(self.hashList))
+            chainFile.write(self.parents.tobytes())
+            chainFile.write(self.heights.tobytes())
+        os.replace(temporary,path)
+
+    @classmethod
+    def load(cls,path,powLimitBits=POW_LIMIT_BITS,retargeting=True):
+        '''
+        Description:
+            Loads a chain saved with save. The headers were checked before they were saved so they are not hashed or checked again,
+            the index is rebuilt from the saved hashes, parents and heights and only the chain work is added up.
+        Inputs:
+            path         - The file written by save
+            powLimitBits - The easiest target allowed, in compact form
+            retargeting  - Boolean, set false for a network where the difficulty never changes
+        Returns:
+            chain - HeaderChain instance
+        Raises:
+            ValueError - If the file is not a saved chain
+        '''
+        with open(path,'rb') as chainFile:
+            data = chainFile.read()
+        if data[0:8] != FILE_MAGIC:
+            raise ValueError(f'{path} is not a saved header chain')
+        count = struct.unpack_from('<I',data,8)[0]
+        rawEnd     = 12 + HEADER_LENGTH*count
+        hashEnd    = rawEnd + 32*count
+        parentsEnd = hashEnd + 4*count
+        if count == 0 or len(data) != parentsEnd + 4*count:
+            raise ValueError(f'{path} is truncated')
+        chain = cls(data[12:12+HEADER_LENGTH],powLimitBits,retargeting)
+        chain.raw      = bytearray(data[12:rawEnd])
+        chain.hashList = [data[i:i+32] for i in range(rawEnd,hashEnd,32)]
+        chain.hashes   = dict(zip(chain.hashList,range(count)))
+        chain.parents  = array('i',data[hashEnd:parentsEnd])
+        chain.heights  = array('I',data[parentsEnd:])
+        # Parents always come before their children so the work adds up in one pass
+        work      = chain.work
+        parents   = chain.parents
+        chainWork = []
+        for parent,(bits,) in zip(parents,struct.iter_unpack('<72xI4x',chain.raw)):
+            chainWork.append((chainWork[parent] if parent >= 0 else 0) + work(bits))
+        chain.chainWork = chainWork
+        # The best tip is the first header with the most work, the same one insert would have picked
+        chain.best = max(range(count),key=chainWork.__getitem__)
+        chain.tips = set(range(count)).difference(parents)
+        mainChain = array('I',bytes(4*(chain.heights[chain.best]+1)))
+        index = chain.best
+        while index >= 0:
+            mainChain[chain.heights[index]] = index
+            index = parents[index]
+        chain.mainChain = mainChain
+        return chain
@@ -0,0 +1,90 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the class InventoryCache
+#   Every inv message is turned into a getdata, without remembering what has already been requested the same transaction is downloaded from every peer which announces it.
+#   InventoryCache is a bounded LRU (least recently used) cache of the inventory hashes which have been requested or received.
+#   It holds at most maxEntries hashes, when full the least recently seen hash is dropped, and a hash is forgotten expiry seconds after it was last seen.
+
+
+## Imports ##
+# time        - https://docs.python.org/3/library/time.html
+# collections - https://docs.python.org/3/library/collections.html
+import time
+from collections import OrderedDict
+
+class InventoryCache:
+    # ENTRY_BYTES - Rough memory used by one entry, the 32 byte hash as a bytes object, the float timestamp and the OrderedDict node
+    ENTRY_BYTES = 200
+
+    def __init__(self,maxEntries=None,maxBytes=32*1024*1024,expiry=20*60):
+        '''
+        Description:
+            initiliaser method for the class
+        Inputs:
+            maxEntries - The maximum number of hashes held, if None it is worked out from maxBytes
+            maxBytes   - Memory cap in bytes used to work out maxEntries when it is not passed, default 32MB (about 160,000 hashes)
+            expiry     - Seconds after which a hash is forgotten and will be requested again if announced, None to never expire
+        '''
+        self.maxEntries = maxEntries if maxEntries else max(1,maxBytes//self.ENTRY_BYTES)
+        self.expiry     = expiry
+        # entries - Ordered from least to most recently seen, the key is the 32 byte hash and the value is the time it was last seen
+        self.entries    = OrderedDict()
+
+    def expire(self,now):
+        '''
+        Description:
+            Removes the hashes which have not been seen for expiry seconds.
+            The entries are ordered by when they were last seen so only the front of the cache needs to be checked.
+        Inputs:
+            now - The current time from time.monotonic
+        '''
+        if self.expiry is None:
+            return
+        entries = self.entries
+        cutoff  = now - self.expiry
+        while entries:
+            oldestHash,seen = next(iter(entries.items()))
+            if seen > cutoff:
+                break
+            del entries[oldestHash]
+
+    def add(self,invHash):
+        '''
+        Description:
+            Records that invHash has been requested or received.
+        Inputs:
+            invHash - The 32 byte hash from an inventory vector
+        Returns:
+            new - Boolean, True if the hash was not already in the cache (it should be requested), False if it is already known
+        '''
+        now = time.monotonic()
+        self.expire(now)
+        entries = self.entries
+        if invHash in entries:
+            # Known, refresh it so a hash which keeps being announced stays in the cache
+            entries.move_to_end(invHash)
+            entries[invHash] = now
+            return False
+        entries[invHash] = now
+        # Drop the least recently seen hash when over the limit
+        if len(entries) > self.maxEntries:
+            entries.popitem(last=False)
+        return True
+
+    def discard(self,invHash):
+        '''
+        Description:
+            Forgets a hash, e.g. when a request for it failed and it should be requested again the next time it is announced.
+        Inputs:
+            invHash - The 32 byte hash to forget
+        '''
+        self.entries.pop(invHash,None)
+
+    def __contains__(self,invHash):
+        seen = self.entries.get(invHash)
+        return seen is not None and (self.expiry is None or time.monotonic()-seen < self.expiry)
+
+    def __len__(self):
+        return len(self.entries)
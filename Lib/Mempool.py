@@ -0,0 +1,296 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the classes MempoolEntry and Mempool
+#   The mempool keeps the transactions received in tx messages which have not been confirmed in a block yet, keyed by txid.
+#   Each entry holds a copy of the serialized transaction (the payload from readFrames is only valid until the next read) and a few numbers, nothing is kept parsed.
+#   The fee of a transaction is the value of the outputs it spends minus the value of its outputs. A tx message does not carry the value of the outputs spent so the fee is worked out:
+#       1. From the fee passed to add, or
+#       2. From the outputs of parent transactions already in the mempool, falling back on the prevoutLookup function (e.g. a UTXO set or RPC) for the others
+#   If the fee can not be worked out the transaction is still stored but is not in the fee-rate index, until a parent it was waiting on is added.
+#   The fee-rate index is a sorted list of (fee rate, txid) kept with bisect, so top-N and percentile queries are a slice or a single index.
+#   The memory used is capped at maxBytes, when full the transactions without a known fee are evicted oldest first, then the lowest fee rate first (along with anything spending them).
+#   When a block is parsed its transactions are removed, along with any mempool transactions which spend the same outputs (they can never confirm now).
+
+
+## Imports ##
+# time        - https://docs.python.org/3/library/time.html
+# bisect      - https://docs.python.org/3/library/bisect.html
+# collections - https://docs.python.org/3/library/collections.html
+# Transaction - Class developed for this project which parses a transaction into offsets over the payload, see Lib/Transaction.py
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from Lib.Transaction import Transaction, UINT32
+
+class MempoolEntry:
+    # __slots__ - No per object dictionary, there can be hundreds of thousands of entries
+    __slots__ = ('raw','fee','vsize','feeRate','time','usage','wtxid')
+
+    def __init__(self,raw,fee,vsize,entryTime,usage,wtxid):
+        '''
+        Description:
+            initiliaser method for the class, created by Mempool.add
+        Inputs:
+            raw       - Byte string of the serialized transaction
+            fee       - The fee in Satoshis, None if it is not known
+            vsize     - The virtual size of the transaction in vbytes
+            entryTime - The time.time() the transaction was added
+            usage     - The bytes of memory counted against the mempool for this entry
+            wtxid     - The 32 byte wtxid, kept for the short IDs of compact blocks (see Lib/CompactBlocks.py)
+        '''
+        self.raw     = raw
+        self.fee     = fee
+        self.vsize   = vsize
+        # feeRate - Satoshis per vbyte, None if the fee is not known
+        self.feeRate = fee/vsize if fee is not None else None
+        self.time    = entryTime
+        self.usage   = usage
+        self.wtxid   = wtxid
+
+class Mempool:
+    # ENTRY_BYTES - Rough memory used per entry on top of the serialized transaction, the entry, the dictionary slot and the index tuple
+    # INPUT_BYTES - Rough memory used per input for the outpoint -> spender dictionary
+    ENTRY_BYTES = 300
+    INPUT_BYTES = 150
+
+    def __init__(self,maxBytes=300*1024*1024,prevoutLookup=None):
+        '''
+        Description:
+            initiliaser method for the class
+        Inputs:
+            maxBytes      - Memory budget in bytes, default 300MB the same as Bitcoin Core
+            prevoutLookup - Optional function called as prevoutLookup(previousHash,previousIndex) returning the value in Satoshis of an output
+                            which is not in the mempool, or None if it is not known. Without it only fees of transactions spending mempool outputs are known.
+        '''
+        self.maxBytes      = maxBytes
+        self.prevoutLookup = prevoutLookup
+        # entries    - Dictionary of txid -> MempoolEntry
+        # spenders   - Dictionary of outpoint (previous hash + index, 36 bytes) -> txid of the mempool transaction spending it
+        # feeIndex   - List of (fee rate, txid) sorted from lowest to highest fee rate, only the entries with a known fee
+        # unknownFee - OrderedDict of the txids with no known fee, oldest first, these are evicted first
+        self.entries    = {}
+        self.spenders   = {}
+        self.feeIndex   = []
+        self.unknownFee = OrderedDict()
+        # usage - Bytes of memory counted against maxBytes
+        self.usage      = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self,txid):
+        return txid in self.entries
+
+    def get(self,txid):
+        '''
+        Description:
+            Parses a stored transaction.
+        Inputs:
+            txid - The 32 byte txid, internal byte order
+        Returns:
+            transaction - Transaction instance, None if the txid is not in the mempool
+        '''
+        entry = self.entries.get(txid)
+        return Transaction(entry.raw) if entry is not None else None
+
+    def outputValue(self,previousHash,previousIndex):
+        '''
+        Description:
+            Looks up the value of an output, first in the mempool then with prevoutLookup.
+        Inputs:
+            previousHash  - The 32 byte txid of the transaction holding the output
+            previousIndex - The index of the output
+        Returns:
+            value - The value in Satoshis, None if it is not known
+        '''
+        entry = self.entries.get(previousHash)
+        if entry is not None:
+            parent = Transaction(entry.raw)
+            return parent.output(previousIndex).value if previousIndex < parent.outputCount else None
+        if self.prevoutLookup is not None:
+            return self.prevoutLookup(previousHash,previousIndex)
+        return None
+
+    def computeFee(self,transaction):
+        '''
+        Description:
+            Works out the fee of a transaction from the value of the outputs it spends.
+        Inputs:
+            transaction - Transaction instance
+        Returns:
+            fee - The fee in Satoshis, None if the value of any spent output is not known
+        '''
+        spent = 0
+        for txIn in transaction.inputs():
+            value = self.outputValue(txIn.previousHash,txIn.previousIndex)
+            if value is None:
+                return None
+            spent += value
+        return spent - transaction.totalOutputValue()
+
+    def add(self,transaction,fee=None):
+        '''
+        Description:
+            Adds a transaction to the mempool, evicting the lowest value transactions if it goes over maxBytes.
+        Inputs:
+            transaction - Transaction instance, e.g. returned from parseTXPayload
+            fee         - The fee in Satoshis if the caller knows it, otherwise it is worked out with computeFee
+        Returns:
+            added - Boolean, False if the transaction was already in the mempool or was evicted straight away
+        '''
+        txid = transaction.txid
+        if txid in self.entries:
+            return False
+        if fee is None:
+            fee = self.computeFee(transaction)
+        # Copy the transaction out of the receive buffer
+        raw   = bytes(transaction.raw)
+        usage = len(raw) + self.ENTRY_BYTES + self.INPUT_BYTES*transaction.inputCount
+        # Only a SegWit transaction needs a second hash for the wtxid
+        wtxid = transaction.wtxid if transaction.hasWitness else txid
+        entry = MempoolEntry(raw,fee,transaction.vsize,time.time(),usage,wtxid)
+        self.entries[txid] = entry
+        for txIn in transaction.inputs():
+            self.spenders[bytes(txIn.previousOutput)] = txid
+        if entry.feeRate is None:
+            self.unknownFee[txid] = None
+        else:
+            insort(self.feeIndex,(entry.feeRate,txid))
+        self.usage += usage
+        if self.unknownFee:
+            self.updateChildFees(transaction)
+        if self.usage > self.maxBytes:
+            self.trim()
+        return txid in self.entries
+
+    def updateChildFees(self,transaction):
+        '''
+        Description:
+            Works out the fee of the mempool transactions with no known fee which spend the outputs of a transaction just added.
+            A child can arrive before its parent, its fee is only known once the parent's outputs are in the mempool.
+        Inputs:
+            transaction - Transaction instance of the parent
+        Returns:
+            updated - The number of children moved into the fee-rate index
+        '''
+        updated = 0
+        txid    = transaction.txid
+        for index in range(transaction.outputCount):
+            child = self.spenders.get(txid + UINT32.pack(index))
+            if child is None or child not in self.unknownFee:
+                continue
+            entry = self.entries[child]
+            fee   = self.computeFee(Transaction(entry.raw))
+            if fee is None:
+                # Still waiting on another parent
+                continue
+            del self.unknownFee[child]
+            entry.fee     = fee
+            entry.feeRate = fee/entry.vsize
+            insort(self.feeIndex,(entry.feeRate,child))
+            updated += 1
+        return updated
+
+    def remove(self,txid,descendants=False):
+        '''
+        Description:
+            Removes a transaction from the mempool.
+        Inputs:
+            txid        - The 32 byte txid
+            descendants - Boolean, set true to also remove the mempool transactions spending its outputs, and theirs
+        Returns:
+            removed - The number of transactions removed
+        '''
+        entry = self.entries.pop(txid,None)
+        if entry is None:
+            return 0
+        transaction = Transaction(entry.raw)
+        for txIn in transaction.inputs():
+            outpoint = bytes(txIn.previousOutput)
+            if self.spenders.get(outpoint) == txid:
+                del self.spenders[outpoint]
+        if entry.feeRate is None:
+            del self.unknownFee[txid]
+        else:
+            i = bisect_left(self.feeIndex,(entry.feeRate,txid))
+            del self.feeIndex[i]
+        self.usage -= entry.usage
+        removed = 1
+        if descendants:
+            for index in range(transaction.outputCount):
+                child = self.spenders.get(txid + UINT32.pack(index))
+                if child is not None:
+                    removed += self.remove(child,descendants=True)
+        return removed
+
+    def trim(self):
+        '''
+        Description:
+            Evicts transactions until the memory used is under maxBytes.
+            Transactions without a known fee go first, oldest first, then the lowest fee rate. Descendants are evicted with their parent as they can not confirm without it.
+        Returns:
+            evicted - The number of transactions evicted
+        '''
+        evicted = 0
+        while self.usage > self.maxBytes and self.entries:
+            if self.unknownFee:
+                txid = next(iter(self.unknownFee))
+            else:
+                txid = self.feeIndex[0][1]
+            evicted += self.remove(txid,descendants=True)
+        return evicted
+
+    def removeForBlock(self,block):
+        '''
+        Description:
+            Removes the transactions confirmed in a block, and the mempool transactions which conflict with them (spend the same outputs).
+        Inputs:
+            block - Block instance, e.g. returned from parseBlockPayload
+        Returns:
+            confirmed - The number of block transactions which were in the mempool
+            conflicts - The number of mempool transactions removed because they conflict with the block
+        '''
+        confirmed = 0
+        conflicts = 0
+        entries   = self.entries
+        spenders  = self.spenders
+        for transaction in block.transactions():
+            txid = transaction.txid
+            if txid in entries:
+                confirmed += self.remove(txid)
+            if not spenders:
+                continue
+            for txIn in transaction.inputs():
+                spender = spenders.get(bytes(txIn.previousOutput))
+                if spender is not None and spender != txid:
+                    conflicts += self.remove(spender,descendants=True)
+        return confirmed,conflicts
+
+    def topN(self,n):
+        '''
+        Description:
+            The highest fee rate transactions.
+        Inputs:
+            n - The number of transactions
+        Returns:
+            top - List of (fee rate in sat/vB, txid) from the highest fee rate down
+        '''
+        if n <= 0:
+            return []
+        return self.feeIndex[:-n-1:-1]
+
+    def feeRatePercentile(self,percentile):
+        '''
+        Description:
+            The fee rate at a percentile of the transactions with a known fee, e.g. 50 is the median and 90 is higher than 90% of transactions.
+        Inputs:
+            percentile - Number from 0 to 100
+        Returns:
+            feeRate - Satoshis per vbyte, None if no transaction has a known fee
+        '''
+        if not self.feeIndex:
+            return None
+        percentile = min(100,max(0,percentile))
+        return self.feeIndex[round(percentile/100*(len(self.feeIndex)-1))][0]
@@ -0,0 +1,147 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the functions for rebuilding the Merkle tree of a block and checking it against the merkle_root in the block header.
+#   See https://en.bitcoin.it/wiki/Protocol_documentation#Merkle_Trees
+#   The leaves of the tree are the txids of the transactions in the block, each level hashes pairs of the level below with SHA256(SHA256(left+right)).
+#   If a level has an odd number of hashes the last one is paired with itself.
+#   For large blocks the hashing can be spread across a concurrent.futures executor (a ProcessPoolExecutor or ThreadPoolExecutor):
+#       1. The txids are computed in chunks of transactions, each worker is only sent the bytes of the block its chunk covers.
+#       2. The bottom levels of the tree are built in aligned subtrees, each worker returns the root of its subtree and the top of the tree is built from these.
+
+
+## Imports ##
+# time        - https://docs.python.org/3/library/time.html
+# hashlib     - https://docs.python.org/3/library/hashlib.html
+# array       - https://docs.python.org/3/library/array.html
+# Transaction - hashSegments is the batched txid hashing function developed for this project, see Lib/Transaction.py
+import time
+import hashlib
+from array import array
+from Lib.Transaction import hashSegments
+
+def merkleLevels(hashes,levels=None):
+    '''
+    Description:
+        Builds levels of the Merkle tree upwards from hashes.
+        Each pair of 32 byte hashes is hashed with SHA256(SHA256(left+right)), the last hash is paired with itself if there is an odd number.
+        It also checks for the duplicate transaction mutation (CVE-2012-2459), where a pair of identical hashes gives the same root as a different list of transactions.
+    Inputs:
+        hashes - List of 32 byte hashes, internal byte order
+        levels - The number of levels to build, if None the levels are built until there is only one hash left (the root)
+    Returns:
+        hashes  - List of the hashes at the top level built
+        mutated - Boolean, True if a pair of identical hashes was found
+    '''
+    sha256  = hashlib.sha256
+    mutated = False
+    level   = 0
+    while (levels is None and len(hashes) > 1) or (levels is not None and level < levels):
+        # Check for identical pairs before the last hash is duplicated
+        for i in range(0,len(hashes)-1,2):
+            if hashes[i] == hashes[i+1]:
+                mutated = True
+        if len(hashes) % 2:
+            hashes = hashes + [hashes[-1]]
+        # Join the level into one bytes object so each pair is a 64 byte slice and not a new concatenation
+        view   = memoryview(b''.join(hashes))
+        hashes = [sha256(sha256(view[i:i+64]).digest()).digest() for i in range(0,len(view),64)]
+        level += 1
+    return hashes,mutated
+
+def merkleRoot(hashes):
+    '''
+    Description:
+        Computes the Merkle root of a list of txids.
+    Inputs:
+        hashes - List of 32 byte txids in block order, internal byte order
+    Returns:
+        root    - The 32 byte Merkle root, internal byte order
+        mutated - Boolean, True if the tree contains a pair of identical hashes (the block must be rejected)
+    '''
+    if not hashes:
+        raise ValueError('Can not compute the Merkle root of an empty list')
+    roots,mutated = merkleLevels(list(hashes))
+    return roots[0],mutated
+
+def rebaseSegments(segments,first,last):
+    '''
+    Description:
+        Takes the txid segments of transactions first to last and moves them so they index into only the bytes those transactions cover.
+        This means a worker process is sent a slice of the block and not the whole block.
+    Inputs:
+        segments - Flat array with 6 offsets per transaction, see Transaction.txidSegments
+        first    - Index of the first transaction in the chunk
+        last     - Index one past the last transaction in the chunk
+    Returns:
+        start    - The offset in the block payload the chunk starts at
+        end      - The offset in the block payload the chunk ends at
+        segments - array of the segments of the chunk, relative to start
+    '''
+    start = segments[6*first]
+    # The last transaction ends at the end of its first range (no witness) or of its third range (SegWit)
+    end   = max(segments[6*last-5],segments[6*last-1])
+    chunk = array('Q')
+    for i in range(6*first,6*last,2):
+        # Unused ranges are (0,0) and are left as they are
+        if segments[i+1] > segments[i]:
+            chunk.append(segments[i]-start)
+            chunk.append(segments[i+1]-start)
+        else:
+            chunk.append(0)
+            chunk.append(0)
+    return start,end,chunk
+
+def verifyMerkleRoot(block,executor=None,workers=4,minParallelTransactions=2048):
+    '''
+    Description:
+        Rebuilds the Merkle tree of a block from its transactions and compares the root with the merkle_root in the block header.
+        If an executor is passed and the block has at least minParallelTransactions transactions the hashing is split into workers chunks and spread across the executor.
+    Inputs:
+        block                   - Block instance, see Lib/Block.py
+        executor                - Optional concurrent.futures executor, ProcessPoolExecutor spreads the hashing across cores
+        workers                 - The number of chunks to split the work into when an executor is used
+        minParallelTransactions - Blocks with fewer transactions are verified serially as the cost of the executor is more than the saving
+    Returns:
+        valid   - Boolean, True if the computed root matches the header and the tree is not mutated
+        root    - The computed 32 byte Merkle root, internal byte order
+        elapsed - Seconds taken to verify the block
+    Raises:
+        ValueError - If the block transactions could not be parsed
+    '''
+    startTime = time.perf_counter()
+    # Walk the block once to collect the txid byte ranges of every transaction
+    segments = array('Q')
+    for transaction in block.transactions():
+        segments.extend(transaction.txidSegments())
+    txCount = len(segments)//6
+    if executor is None or txCount < minParallelTransactions or txCount == 0:
+        txids = hashSegments(block.payload,segments) if txCount else []
+        root,mutated = merkleRoot(txids) if txids else (b'',False)
+    else:
+        # Step 1 - txids in chunks, each chunk is sent only the bytes it covers
+        chunkSize = -(-txCount//workers)
+        futures   = []
+        for first in range(0,txCount,chunkSize):
+            last = min(first+chunkSize,txCount)
+            start,end,chunk = rebaseSegments(segments,first,last)
+            futures.append(executor.submit(hashSegments,bytes(block.payload[start:end]),chunk))
+        txids = []
+        for future in futures:
+            txids.extend(future.result())
+        # Step 2 - aligned subtrees, the subtree size is a power of 2 so no pair crosses from one subtree into the next
+        levels = max(0,(txCount//workers).bit_length()-1)
+        subtreeSize = 1 << levels
+        futures = [executor.submit(merkleLevels,txids[i:i+subtreeSize],levels) for i in range(0,txCount,subtreeSize)]
+        subtreeRoots = []
+        mutated = False
+        for future in futures:
+            roots,subtreeMutated = future.result()
+            subtreeRoots.extend(roots)
+            mutated = mutated or subtreeMutated
+        # Step 3 - the top of the tree from the subtree roots
+        root,topMutated = merkleRoot(subtreeRoots)
+        mutated = mutated or topMutated
+    valid = (root == block.header.merkleRoot) and not mutated
+    return valid,root,time.perf_counter()-startTime
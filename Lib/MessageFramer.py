@@ -0,0 +1,181 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the class MessageFramer
+#   The class takes the raw stream of bytes coming from a peer node and splits it up into complete bitcoin messages (frames).
+#   A TCP socket does not know anything about bitcoin messages, a single recv can contain half a message or several messages joined together.
+#   The framer keeps one reusable bytearray which the socket writes directly into using recv_into, so no new buffers are created per read.
+#   Each complete message is handed back as the command name and a memoryview of the payload which points into the buffer, so the payload is not copied either.
+#   Headers are unpacked and checked by a MessageHeaderCodec as soon as they arrive, a wrong magic or oversized length raises FramingError before the buffer is grown for the payload.
+#   Payloads whose checksum does not match are dropped (depending on the codec checksumMode).
+
+
+## Imports ##
+# MessageHeader - Class developed for this project which packs and checks message headers, see Lib/MessageHeader.py
+from Lib.MessageHeader import MessageHeaderCodec
+
+class MessageFramer:
+    # HEADER_LENGTH - Every bitcoin message starts with a 24 byte header, magic (4) + command (12) + length (4) + checksum (4)
+    HEADER_LENGTH = 24
+
+    def __init__(self,magic=b'\xf9\xbe\xb4\xd9',bufferSize=1<<20,checksumMode='always',codec=None):
+        '''
+        Description:
+            initiliaser method for the class
+        Inputs:
+            magic        - The magic value for given network, default to mainnet
+            bufferSize   - The starting size in bytes of the receive buffer, it will grow if a single message is bigger than this (e.g. a large block)
+            checksumMode - 'always', 'sample' or 'lazy', how payload checksums are checked, see Lib/MessageHeader.py. Ignored if codec is passed
+            codec        - Optional MessageHeaderCodec to share with the sending side, one is created if not passed
+        '''
+        self.magic  = magic
+        self.codec  = codec if codec is not None else MessageHeaderCodec(magic=magic,checksumMode=checksumMode)
+        # header - (command, length, checksum) of the message at self.start once its header has arrived, None until then
+        self.header = None
+        # lastChecksum - The header checksum of the last frame yielded, with checksumMode 'lazy' the caller can check it with codec.verifyChecksum
+        self.lastChecksum = None
+        # checksumFailures - The number of frames dropped because the checksum did not match
+        self.checksumFailures = 0
+        # buffer - The reusable bytearray the socket writes into
+        # view   - A memoryview over the buffer, slicing a memoryview does not copy the data
+        self.buffer = bytearray(bufferSize)
+        self.view   = memoryview(self.buffer)
+        # start - Index of the first byte in the buffer which has not been handed out as part of a frame yet
+        # end   - Index one past the last byte written into the buffer
+        self.start = 0
+        self.end   = 0
+
+    def pendingHeader(self):
+        '''
+        Description:
+            Unpacks and checks the header of the message at the front of the buffer, the result is kept until that message is consumed.
+        Returns:
+            header - (command, length, checksum), or None if the 24 header bytes have not all arrived
+        Raises:
+            FramingError - If the header has the wrong magic or a payload length over the limit
+        '''
+        if self.header is None and self.end - self.start >= self.HEADER_LENGTH:
+            self.header = self.codec.unpackHeader(self.buffer,self.start)
+        return self.header
+
+    def pendingFrameLength(self):
+        '''
+        Description:
+            Works out how many bytes the message currently at the front of the buffer needs in total.
+            If the header has not fully arrived yet we only know that we need the 24 header bytes.
+        Returns:
+            frameLength - The number of bytes (header + payload) needed to complete the message at self.start
+        Raises:
+            FramingError - If the header is invalid, so a bad length is never used to grow the buffer
+        '''
+        header = self.pendingHeader()
+        if header is None:
+            return self.HEADER_LENGTH
+        return self.HEADER_LENGTH + header[1]
+
+    def compact(self):
+        '''
+        Description:
+            Moves the bytes which have not been consumed yet to the start of the buffer so there is free space at the end to read into.
+            Any payload memoryviews handed out before this call may now point at different data, this is why frames are only valid until the next read.
+        '''
+        pending = self.end - self.start
+        if pending and self.start:
+            # memoryview slice assignment does a memmove in place, no temporary copy is created
+            self.view[0:pending] = self.view[self.start:self.end]
+        self.start = 0
+        self.end   = pending
+
+    def grow(self,size):
+        '''
+        Description:
+            Replaces the buffer with a larger one when a single message will not fit in the current buffer.
+            The bytes which have not been consumed yet are copied to the start of the new buffer.
+        Inputs:
+            size - The minimum size in bytes of the new buffer
+        '''
+        # Double the buffer until it is big enough so a run of growing blocks does not cause a grow on every message
+        newSize = len(self.buffer)
+        while newSize < size:
+            newSize *= 2
+        newBuffer = bytearray(newSize)
+        pending   = self.end - self.start
+        newBuffer[0:pending] = self.view[self.start:self.end]
+        self.buffer = newBuffer
+        self.view   = memoryview(newBuffer)
+        self.start  = 0
+        self.end    = pending
+
+    def getBuffer(self):
+        '''
+        Description:
+            Returns a writable memoryview over the free space at the end of the buffer, this can be passed directly to socket.recv_into.
+            Before returning it makes sure the message at the front of the buffer will fit, compacting or growing the buffer if needed.
+        Returns:
+            freeSpace - Writable memoryview of the free space in the buffer
+        '''
+        frameLength = self.pendingFrameLength()
+        # If the current message would run off the end of the buffer, or there is no free space left at all, move the pending bytes to the front
+        if self.start + frameLength > len(self.buffer) or self.end == len(self.buffer):
+            self.compact()
+            # If it still does not fit then the message is bigger than the buffer
+            if frameLength > len(self.buffer):
+                self.grow(frameLength)
+        return self.view[self.end:]
+
+    def bufferUpdated(self,nbytes):
+        '''
+        Description:
+            Records that nbytes have been written into the memoryview returned by getBuffer.
+        Inputs:
+            nbytes - The number of bytes written, this is the value returned from socket.recv_into
+        '''
+        self.end += nbytes
+
+    def recvFrom(self,sock):
+        '''
+        Description:
+            Performs a single recv_into on the socket passed straight into the framer buffer.
+        Inputs:
+            sock - A connected socket instance
+        Returns:
+            nbytes - The number of bytes received, 0 means the peer closed the connection
+        '''
+        nbytes = sock.recv_into(self.getBuffer())
+        self.bufferUpdated(nbytes)
+        return nbytes
+
+    def frames(self):
+        '''
+        Description:
+            Generator which yields every complete message currently held in the buffer.
+            Incomplete messages are left in the buffer until the rest of the bytes arrive.
+            Messages which fail the checksum check are dropped with a warning.
+            The payload memoryview is only valid until the next call to getBuffer/recvFrom, call bytes(payload) if it needs to be kept.
+        Returns:
+            command - String, the command name of the message e.g. "inv"
+            payload - memoryview of the message payload
+        Raises:
+            FramingError - If a header has the wrong magic or a payload length over the limit, the connection should be closed
+        '''
+        codec = self.codec
+        while self.end - self.start >= self.HEADER_LENGTH:
+            command,length,checksum = self.pendingHeader()
+            frameEnd = self.start + self.HEADER_LENGTH + length
+            # Wait for the rest of the payload to arrive
+            if frameEnd > self.end:
+                return
+            payload     = self.view[self.start+self.HEADER_LENGTH:frameEnd]
+            self.start  = frameEnd
+            self.header = None
+            if not codec.checkReceived(checksum,payload):
+                self.checksumFailures += 1
+                print(f'Warning: Dropped {command} message with a bad checksum')
+                continue
+            self.lastChecksum = checksum
+            yield command,payload
+        # Everything has been consumed, reset to the start of the buffer so it does not need to be compacted later
+        if self.start == self.end:
+            self.start = 0
+            self.end   = 0
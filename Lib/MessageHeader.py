@@ -0,0 +1,175 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the class MessageHeaderCodec and the exception FramingError
+#   Every message sent and received has a 24 byte header, see https://en.bitcoin.it/wiki/Protocol_documentation#Message_structure
+#       magic (4 bytes) + command (12 bytes) + length (4 bytes) + checksum (4 bytes)
+#   This is the hottest code on both the send and receive side so the codec keeps everything it can work out once:
+#       1. The header is packed and unpacked with a single precompiled struct.Struct
+#       2. The padded 12 byte command names, and the decoded names of received commands, are cached
+#       3. The checksum of an empty payload is precomputed
+#   On the receive side a header with the wrong magic or a payload length over the limit is rejected before any of the payload is buffered.
+#   The checksum of received payloads can be verified on every message, on a sample of messages (for trusted peers) or lazily by the caller.
+
+
+## Imports ##
+# struct  - https://docs.python.org/3/library/struct.html
+# hashlib - https://docs.python.org/3/library/hashlib.html
+import struct
+import hashlib
+
+# HEADER - magic (4s), command (12s), length (I), checksum (4s), little endian, 24 bytes
+HEADER = struct.Struct('<4s12sI4s')
+# MAX_PAYLOAD_LENGTH - The largest payload accepted, the same limit Bitcoin Core uses (MAX_PROTOCOL_MESSAGE_LENGTH)
+MAX_PAYLOAD_LENGTH = 4*1000*1000
+
+class FramingError(ValueError):
+    '''
+    Description:
+        Raised when a received header can not be trusted (wrong magic or a payload length over the limit).
+        The stream can not be split into messages after this so the connection should be closed.
+    '''
+
+class MessageHeaderCodec:
+    # CHECKSUM_MODES - always: verify every payload, sample: verify one in every sampleInterval payloads, lazy: never verify, the caller can use verifyChecksum
+    CHECKSUM_MODES = ('always','sample','lazy')
+    # MAX_CACHED_COMMANDS - Limit on the decoded command names cached, stops a peer filling memory with random command names
+    MAX_CACHED_COMMANDS = 256
+
+    def __init__(self,magic=b'\xf9\xbe\xb4\xd9',checksumMode='always',sampleInterval=100,maxPayloadLength=MAX_PAYLOAD_LENGTH):
+        '''
+        Description:
+            initiliaser method for the class
+        Inputs:
+            magic            - The magic value for given network, default to mainnet
+            checksumMode     - 'always', 'sample' or 'lazy', how received payload checksums are verified
+            sampleInterval   - When checksumMode is 'sample', one in every sampleInterval payloads is verified
+            maxPayloadLength - Headers with a payload length over this are rejected
+        '''
+        if checksumMode not in self.CHECKSUM_MODES:
+            raise ValueError(f'checksumMode must be one of {self.CHECKSUM_MODES}')
+        self.magic            = magic
+        self.checksumMode     = checksumMode
+        self.sampleInterval   = sampleInterval
+        self.maxPayloadLength = maxPayloadLength
+        # sampleCounter - Counts the received payloads so every sampleInterval-th one is verified
+        self.sampleCounter    = 0
+        # paddedCommands - Cache of command name -> 12 byte null padded command
+        # commandNames   - Cache of 12 byte command from a header -> command name string
+        self.paddedCommands   = {}
+        self.commandNames     = {}
+        # emptyChecksum - The checksum of an empty payload e.g. verack, worked out once
+        self.emptyChecksum    = hashlib.sha256(hashlib.sha256(b'').digest()).digest()[0:4]
+
+    def checksum(self,payload):
+        '''
+        Description:
+            The checksum is the first 4 bytes of SHA256(SHA256(payload))
+        Inputs:
+            payload - Byte string or memoryview
+        Returns:
+            checksum - 4 byte string
+        '''
+        if not payload:
+            return self.emptyChecksum
+        return hashlib.sha256(hashlib.sha256(payload).digest()).digest()[0:4]
+
+    def paddedCommand(self,commandName):
+        '''
+        Description:
+            The command name encoded as ascii and padded with null bytes to 12 bytes, cached after the first call for each command.
+        Inputs:
+            commandName - String, for example "version"
+        Returns:
+            command - 12 byte string
+        '''
+        command = self.paddedCommands.get(commandName)
+        if command is None:
+            command = commandName.encode('ascii')
+            if len(command) > 12:
+                raise ValueError(f'Command name {commandName} is longer than 12 bytes')
+            command = command + (12-len(command))*b'\x00'
+            self.paddedCommands[commandName] = command
+        return command
+
+    def commandName(self,command):
+        '''
+        Description:
+            Decodes the 12 byte command from a received header to a string, known commands are looked up in a cache.
+        Inputs:
+            command - 12 byte string from the header
+        Returns:
+            commandName - String, for example "inv"
+        '''
+        commandName = self.commandNames.get(command)
+        if commandName is None:
+            commandName = command.rstrip(b'\x00').decode('ascii','replace')
+            if len(self.commandNames) < self.MAX_CACHED_COMMANDS:
+                self.commandNames[command] = commandName
+        return commandName
+
+    def createMessage(self,commandName,payload):
+        '''
+        Description:
+            Creates a full message, the 24 byte header followed by the payload.
+        Inputs:
+            commandName (string)  - The name of the command, for example "version".
+            payload (byte string) - The payload in bytes to send.
+        Returns:
+            message (byte string) - The header and payload
+        '''
+        return HEADER.pack(self.magic,self.paddedCommand(commandName),len(payload),self.checksum(payload)) + payload
+
+    def unpackHeader(self,buffer,offset=0):
+        '''
+        Description:
+            Unpacks and checks a received header. This is called as soon as the 24 header bytes have arrived, before the payload is buffered.
+        Inputs:
+            buffer - Byte string, bytearray or memoryview holding the header
+            offset - Index of the header in buffer
+        Returns:
+            commandName - String, the command name
+            length      - The payload length
+            checksum    - The 4 byte checksum from the header
+        Raises:
+            FramingError - If the magic is wrong or the payload length is over maxPayloadLength
+        '''
+        magic,command,length,checksum = HEADER.unpack_from(buffer,offset)
+        if magic != self.magic:
+            raise FramingError(f'Bad magic {magic.hex()} expected {self.magic.hex()}')
+        if length > self.maxPayloadLength:
+            raise FramingError(f'Payload length {length} is over the limit of {self.maxPayloadLength}')
+        return self.commandName(command),length,checksum
+
+    def verifyChecksum(self,checksum,payload):
+        '''
+        Description:
+            Checks the checksum from a header against the payload.
+        Inputs:
+            checksum - The 4 byte checksum from the header
+            payload  - Byte string or memoryview of the payload
+        Returns:
+            valid - Boolean
+        '''
+        return self.checksum(payload) == checksum
+
+    def checkReceived(self,checksum,payload):
+        '''
+        Description:
+            Checks a received payload following checksumMode. In 'lazy' mode nothing is checked, in 'sample' mode only every sampleInterval-th payload is.
+        Inputs:
+            checksum - The 4 byte checksum from the header
+            payload  - Byte string or memoryview of the payload
+        Returns:
+            valid - Boolean, True if the checksum matches or was not checked
+        '''
+        mode = self.checksumMode
+        if mode == 'always':
+            return self.checksum(payload) == checksum
+        if mode == 'sample':
+            self.sampleCounter += 1
+            if self.sampleCounter >= self.sampleInterval:
+                self.sampleCounter = 0
+                return self.checksum(payload) == checksum
+        return True
@@ -0,0 +1,470 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the classes Counter, Gauge, Histogram, MetricsRegistry, ConnectorMetrics and MetricsServer and the decorator timedParse
+#   They give a view of how the connectors behave under load, exposed in the Prometheus text format (see https://prometheus.io/docs/instrumenting/exposition_formats/)
+#   on a local HTTP endpoint so Prometheus, or just curl, can read them.
+#   ConnectorMetrics holds the metrics of BitcoinConnector and AsyncBitcoinConnector:
+#       1. Messages and bytes received and sent, per command and per peer
+#       2. A histogram of the time taken by each parse function, per command
+#       3. A histogram of the getdata round trip time, from the getdata being sent to the tx or block being parsed
+#       4. The receive and send queue depths of every connection, bytes received but not parsed yet and bytes written but not sent yet
+#   The overhead is kept low, when metrics are off each hook is one attribute check. When on, a message costs two dictionary updates and a parse costs two perf_counter calls
+#   and a bisect. Nothing is formatted until the endpoint is scraped, and the queue depths are only read then.
+#   The metrics are updated from the thread which reads the messages and read from the server thread, copying a dictionary with list() holds the GIL so it never sees one half updated.
+
+
+## Imports ##
+# time        - https://docs.python.org/3/library/time.html
+# bisect      - https://docs.python.org/3/library/bisect.html
+# struct      - https://docs.python.org/3/library/struct.html
+# weakref     - https://docs.python.org/3/library/weakref.html
+# functools   - https://docs.python.org/3/library/functools.html
+# threading   - https://docs.python.org/3/library/threading.html
+# collections - https://docs.python.org/3/library/collections.html
+# http.server - https://docs.python.org/3/library/http.server.html
+# fcntl/termios - https://docs.python.org/3/library/fcntl.html, used to read the kernel socket queues, only available on Unix
+# Transaction - readVarInt is used to read the count of a getdata message, see Lib/Transaction.py
+import time
+import bisect
+import struct
+import weakref
+import functools
+import threading
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+from Lib.Transaction import readVarInt
+try:
+    import fcntl
+    import termios
+    # SIOCINQ and SIOCOUTQ - The bytes waiting in the kernel receive queue and not yet acknowledged in the send queue of a socket
+    SIOCINQ  = termios.FIONREAD
+    SIOCOUTQ = termios.TIOCOUTQ
+except (ImportError,AttributeError):
+    fcntl = None
+
+# PARSE_BUCKETS - Upper bounds in seconds of the parse time histogram, from a small inv to a 4MB block
+PARSE_BUCKETS = (0.00001,0.000025,0.00005,0.0001,0.00025,0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0)
+# ROUND_TRIP_BUCKETS - Upper bounds in seconds of the getdata round trip histogram
+ROUND_TRIP_BUCKETS = (0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0,30.0,60.0)
+# INV_KINDS - The label used for each inventory vector type requested with getdata, witness types have bit 30 set
+INV_KINDS = {1:'tx',2:'block',4:'cmpctblock',0x40000001:'tx',0x40000002:'block'}
+
+def escapeLabel(value):
+    # Label values are quoted, so backslash, quote and newline are escaped
+    return str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+def formatLabels(labelNames,labels,extra=''):
+    '''
+    Description:
+        Formats the labels of a sample e.g. {command="inv",peer="1.2.3.4:8333"}
+    Inputs:
+        labelNames - Tuple of the label names
+        labels     - Tuple of the label values, in the same order
+        extra      - Already formatted label to add at the end, used for the le label of histogram buckets
+    Returns:
+        text - The formatted labels, an empty string if there are none
+    '''
+    parts = [f'{name}="{escapeLabel(value)}"' for name,value in zip(labelNames,labels)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+def formatValue(value):
+    # Whole numbers are written without a decimal point, infinity as +Inf
+    if value == float('inf'):
+        return '+Inf'
+    return str(value) if isinstance(value,int) else repr(float(value))
+
+class Counter:
+    def __init__(self,name,help,labelNames=()):
+        '''
+        Description:
+            initiliaser method for the class, a value which only goes up, one per combination of label values
+        Inputs:
+            name       - The metric name, ending in _total by convention
+            help       - One line description shown in the HELP line
+            labelNames - Tuple of the label names
+        '''
+        self.name       = name
+        self.help       = help
+        self.labelNames = labelNames
+        # values - Dictionary of label values tuple -> count
+        self.values     = {}
+
+    def inc(self,labels=(),amount=1):
+        '''
+        Description:
+            Adds amount to the counter for the label values.
+        Inputs:
+            labels - Tuple of the label values
+            amount - The amount to add
+        '''
+        values = self.values
+        values[labels] = values.get(labels,0) + amount
+
+    def render(self):
+        '''
+        Description:
+            Formats the counter in the Prometheus text format.
+        Returns:
+            lines - List of the lines
+        '''
+        lines = [f'# HELP {self.name} {self.help}',f'# TYPE {self.name} counter']
+        lines.extend(f'{self.name}{formatLabels(self.labelNames,labels)} {formatValue(value)}' for labels,value in list(self.values.items()))
+        return lines
+
+class Gauge:
+    def __init__(self,name,help,labelNames=(),function=None):
+        '''
+        Description:
+            initiliaser method for the class, a value which goes up and down
+        Inputs:
+            name       - The metric name
+            help       - One line description shown in the HELP line
+            labelNames - Tuple of the label names
+            function   - Optional function returning a dictionary of label values tuple -> value, called when the metrics are scraped instead of set being used
+        '''
+        self.name       = name
+        self.help       = help
+        self.labelNames = labelNames
+        self.function   = function
+        self.values     = {}
+
+    def set(self,labels,value):
+        '''
+        Description:
+            Sets the gauge for the label values.
+        Inputs:
+            labels - Tuple of the label values
+            value  - The value
+        '''
+        self.values[labels] = value
+
+    def render(self):
+        '''
+        Description:
+            Formats the gauge in the Prometheus text format.
+        Returns:
+            lines - List of the lines
+        '''
+        values = self.function() if self.function is not None else dict(self.values)
+        lines  = [f'# HELP {self.name} {self.help}',f'# TYPE {self.name} gauge']
+        lines.extend(f'{self.name}{formatLabels(self.labelNames,labels)} {formatValue(value)}' for labels,value in values.items())
+        return lines
+
+class Histogram:
+    def __init__(self,name,help,labelNames=(),buckets=PARSE_BUCKETS):
+        '''
+        Description:
+            initiliaser method for the class, counts observations into buckets by value
+        Inputs:
+            name       - The metric name, ending in the unit e.g. _seconds
+            help       - One line description shown in the HELP line
+            labelNames - Tuple of the label names
+            buckets    - Sorted tuple of the bucket upper bounds, a +Inf bucket is added
+        '''
+        self.name       = name
+        self.help       = help
+        self.labelNames = labelNames
+        self.buckets    = tuple(buckets)
+        # values - Dictionary of label values tuple -> [count in each bucket (not cumulative, the last is +Inf), sum, count]
+        self.values     = {}
+
+    def observe(self,labels,value):
+        '''
+        Description:
+            Records one observation.
+        Inputs:
+            labels - Tuple of the label values
+            value  - The observed value e.g. seconds
+        '''
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0]*(len(self.buckets)+1),0.0,0]
+        # bisect_left puts a value equal to a bound in that bucket, buckets are "less than or equal"
+        entry[0][bisect.bisect_left(self.buckets,value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self):
+        '''
+        Description:
+            Formats the histogram in the Prometheus text format, the buckets are cumulative.
+        Returns:
+            lines - List of the lines
+        '''
+        lines = [f'# HELP {self.name} {self.help}',f'# TYPE {self.name} histogram']
+        for labels,(counts,total,count) in list(self.values.items()):
+            cumulative = 0
+            for bound,bucketCount in zip(self.buckets + (float('inf'),),list(counts)):
+                cumulative += bucketCount
+                bucketLabel = 'le="' + formatValue(bound) + '"'
+                lines.append(f'{self.name}_bucket{formatLabels(self.labelNames,labels,bucketLabel)} {cumulative}')
+            lines.append(f'{self.name}_sum{formatLabels(self.labelNames,labels)} {formatValue(total)}')
+            lines.append(f'{self.name}_count{formatLabels(self.labelNames,labels)} {count}')
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        '''
+        Description:
+            initiliaser method for the class, holds the metrics rendered together on one endpoint
+        '''
+        self.metrics = []
+
+    def counter(self,name,help,labelNames=()):
+        # Creates and registers a Counter
+        metric = Counter(name,help,labelNames)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self,name,help,labelNames=(),function=None):
+        # Creates and registers a Gauge
+        metric = Gauge(name,help,labelNames,function)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self,name,help,labelNames=(),buckets=PARSE_BUCKETS):
+        # Creates and registers a Histogram
+        metric = Histogram(name,help,labelNames,buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        '''
+        Description:
+            Formats every metric in the Prometheus text format.
+        Returns:
+            text - String of the metrics, ending in a new line
+        '''
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+class ConnectorMetrics(MetricsRegistry):
+    def __init__(self,maxPending=100000):
+        '''
+        Description:
+            initiliaser method for the class, the metrics of the connectors. One instance can be shared by many connectors, each peer is a label.
+        Inputs:
+            maxPending - The most getdata requests whose send time is kept for the round trip time, the oldest are dropped first
+        '''
+        super().__init__()
+        self.maxPending = maxPending
+        self.messagesReceived = self.counter('bitcoin_messages_received_total','Messages received',('command','peer'))
+        self.bytesReceived    = self.counter('bitcoin_bytes_received_total','Bytes received including the 24 byte header',('command','peer'))
+        self.messagesSent     = self.counter('bitcoin_messages_sent_total','Messages sent',('command','peer'))
+        self.bytesSent        = self.counter('bitcoin_bytes_sent_total','Bytes sent including the 24 byte header',('command','peer'))
+        self.parseSeconds     = self.histogram('bitcoin_parse_seconds','Time taken by each parse function, including displaying the message',('command',),PARSE_BUCKETS)
+        self.roundTripSeconds = self.histogram('bitcoin_getdata_round_trip_seconds','Time from sending a getdata to parsing the tx or block',('kind',),ROUND_TRIP_BUCKETS)
+        self.receiveQueue     = self.gauge('bitcoin_receive_queue_bytes','Bytes received but not parsed yet, in the kernel and in the framer buffer',('peer',),self.receiveQueues)
+        self.sendQueue        = self.gauge('bitcoin_send_queue_bytes','Bytes written but not sent yet, in the kernel or the asyncio transport',('peer',),self.sendQueues)
+        self.pendingRequests  = self.gauge('bitcoin_getdata_pending','getdata items sent and not received yet',(),lambda: {():len(self.pending)})
+        # pending - OrderedDict of requested hash -> (time.perf_counter() the getdata was sent, kind), oldest first
+        self.pending = OrderedDict()
+        # sources - The connectors attached, weak so a closed connector is forgotten
+        self.sources = weakref.WeakSet()
+
+    def attach(self,connector):
+        '''
+        Description:
+            Turns the metrics on for a BitcoinConnector or an AsyncBitcoinConnector (and every peer it connects to afterwards).
+        Inputs:
+            connector - BitcoinConnector or AsyncBitcoinConnector instance
+        '''
+        connector.metrics = self
+        self.sources.add(connector)
+
+    def received(self,command,peer,nbytes):
+        '''
+        Description:
+            Counts a message received.
+        Inputs:
+            command - String, the command name
+            peer    - String, the peer label ip:port
+            nbytes  - The length of the payload, the 24 byte header is added
+        '''
+        key = (command,peer)
+        messages = self.messagesReceived.values
+        messages[key] = messages.get(key,0) + 1
+        received = self.bytesReceived.values
+        received[key] = received.get(key,0) + nbytes + 24
+
+    def sent(self,command,peer,payload):
+        '''
+        Description:
+            Counts a message sent. For getdata the send time of each requested hash is kept for the round trip time.
+        Inputs:
+            command - String, the command name
+            peer    - String, the peer label ip:port
+            payload - Byte string of the payload
+        '''
+        key = (command,peer)
+        messages = self.messagesSent.values
+        messages[key] = messages.get(key,0) + 1
+        sent = self.bytesSent.values
+        sent[key] = sent.get(key,0) + len(payload) + 24
+        if command == 'getdata':
+            self.requested(payload)
+
+    def requested(self,payload):
+        '''
+        Description:
+            Records the send time of every inventory vector in a getdata payload.
+        Inputs:
+            payload - Byte string of the getdata payload
+        '''
+        try:
+            count,position = readVarInt(payload,0)
+        except IndexError:
+            return
+        now     = time.perf_counter()
+        pending = self.pending
+        for start in range(position,min(len(payload),position+36*count),36):
+            invType = struct.unpack_from('<I',payload,start)[0]
+            pending[bytes(payload[start+4:start+36])] = (now,INV_KINDS.get(invType,'other'))
+        while len(pending) > self.maxPending:
+            pending.popitem(last=False)
+
+    def arrived(self,itemHash):
+        '''
+        Description:
+            Records the round trip time of a requested tx or block which has been parsed, anything not requested (e.g. pushed to us) is ignored.
+        Inputs:
+            itemHash - The 32 byte txid or block hash
+        '''
+        request = self.pending.pop(itemHash,None)
+        if request is not None:
+            self.roundTripSeconds.observe((request[1],),time.perf_counter()-request[0])
+
+    def connections(self):
+        '''
+        Description:
+            Every connection of the attached connectors.
+        Returns:
+            connections - List of (peer label, framer, socket or None, asyncio transport or None)
+        '''
+        connections = []
+        for source in list(self.sources):
+            if hasattr(source,'peers'):
+                # AsyncBitcoinConnector
+                connections.extend((f'{ip}:{port}',peer.framer,None,peer.transport) for (ip,port),peer in list(source.peers.items()))
+            elif source.socket is not None:
+                connections.append((f'{source.peerIP}:{source.peerPort}',source.framer,source.socket,None))
+        return connections
+
+    def receiveQueues(self):
+        # Gauge function, the framer holds the bytes received but not handed out as messages yet, the kernel the bytes not read yet
+        queues = {}
+        for peer,framer,sock,transport in self.connections():
+            queues[(peer,)] = framer.end - framer.start + socketQueue(sock,SIOCINQ if fcntl else None)
+        return queues
+
+    def sendQueues(self):
+        # Gauge function, an asyncio transport buffers writes itself, a blocking socket leaves them in the kernel
+        queues = {}
+        for peer,framer,sock,transport in self.connections():
+            if transport is not None:
+                queues[(peer,)] = transport.get_write_buffer_size() if not transport.is_closing() else 0
+            elif fcntl is not None:
+                queues[(peer,)] = socketQueue(sock,SIOCOUTQ)
+        return queues
+
+def socketQueue(sock,request):
+    '''
+    Description:
+        Reads the number of bytes in a kernel socket queue with ioctl.
+    Inputs:
+        sock    - The socket, None for no socket
+        request - SIOCINQ or SIOCOUTQ, None if ioctl is not available
+    Returns:
+        nbytes - The bytes in the queue, 0 if it can not be read
+    '''
+    if sock is None or request is None:
+        return 0
+    try:
+        return struct.unpack('i',fcntl.ioctl(sock.fileno(),request,b'\x00'*4))[0]
+    except (OSError,ValueError):
+        # The socket has been closed
+        return 0
+
+def timedParse(command):
+    '''
+    Description:
+        Decorator for the parse functions of BitcoinConnector, when self.metrics is set the time taken is added to the parse time histogram.
+    Inputs:
+        command - The command label e.g. 'tx'
+    Returns:
+        decorator - Function which wraps the parse function
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def timed(self,*args,**kwargs):
+            metrics = self.metrics
+            if metrics is None:
+                return function(self,*args,**kwargs)
+            start = time.perf_counter()
+            try:
+                return function(self,*args,**kwargs)
+            finally:
+                metrics.parseSeconds.observe((command,),time.perf_counter()-start)
+        return timed
+    return decorator
+
+class MetricsServer:
+    def __init__(self,registry,host='127.0.0.1',port=9100):
+        '''
+        Description:
+            initiliaser method for the class, serves registry.render() at http://host:port/metrics from a background thread
+        Inputs:
+            registry - MetricsRegistry (e.g. ConnectorMetrics) to serve
+            host     - The address to listen on, local only by default
+            port     - The port to listen on, 0 picks a free port (see self.port after start)
+        '''
+        self.registry = registry
+        self.host     = host
+        self.port     = port
+        self.server   = None
+        self.thread   = None
+
+    def start(self):
+        '''
+        Description:
+            Starts listening in a daemon thread.
+        Returns:
+            address - (host, port) being listened on
+        '''
+        registry = self.registry
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/metrics','/'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type','text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length',str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self,format,*args):
+                # Scrapes are not printed, they would fill the terminal
+                pass
+        self.server = ThreadingHTTPServer((self.host,self.port),Handler)
+        self.server.daemon_threads = True
+        self.port   = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever,daemon=True)
+        self.thread.start()
+        return self.host,self.port
+
+    def stop(self):
+        '''
+        Description:
+            Stops the server.
+        '''
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,676 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the classes MockPeer and MockConnection and the functions used to create synthetic transactions and blocks.
+#   MockPeer is a local stand in for a bitcoin node so BitcoinConnector and AsyncBitcoinConnector can be run, load tested and timed without a real mainnet node.
+#   It listens on a local port and for each connection:
+#       1. Completes the version/verack handshake, the version, wtxidrelay and sendaddrv2 are sent handshakeGap before the verack (0 joins them into one write).
+#          The version of the client is parsed and the feature messages it sends are recorded, sendheaders and feefilter are sent after its verack like a real node
+#       2. Once our verack arrives it streams transactions at txRate per second and a block every blockInterval seconds, of roughly txSize and blockSize bytes.
+#          The stream is created once by a single thread and sent to every connection past its verack, so every client sees the same transactions and one chain of blocks
+#       3. Items are announced with inv and sent when requested with getdata (anything no longer held gets a notfound), or pushed directly with announce=False.
+#          witnessShare of the transactions are SegWit, they are sent with their witness only when requested as MSG_WITNESS_TX or MSG_WITNESS_BLOCK like a real node
+#       4. Supports BIP152 compact blocks, after a sendcmpct blocks are pushed as cmpctblock (or sent as one when asked for with MSG_CMPCT_BLOCK) and getblocktxn is answered.
+#          Blocks are filled with the transactions already streamed first so a client holding them in its mempool can rebuild the block
+#       5. Answers ping with pong and getheaders with headers from its chain, which can be pre-mined to chainLength blocks to test a header sync
+#       6. Answers getaddr with an addr message of the addresses in self.addresses, to test Lib/AddressBook.py
+#   To test the framing the outgoing stream can be split into TCP segments of segmentSize bytes, or mergeCount messages can be joined into one write.
+#   The transactions and blocks are valid to parse, the blocks have the correct Merkle root and meet the regtest proof of work target.
+#   The time each item was first sent is kept in sentTimes so the latency of the connector can be measured when it runs in the same process.
+#   It can be run on its own with: python -m Lib.MockPeer --port 18444 --tx-rate 100 --block-interval 30
+
+
+## Imports ##
+# os          - https://docs.python.org/3/library/os.html
+# random      - https://docs.python.org/3/library/random.html
+# time        - https://docs.python.org/3/library/time.html
+# socket      - https://docs.python.org/3/library/socket.html
+# struct      - https://docs.python.org/3/library/struct.html
+# argparse    - https://docs.python.org/3/library/argparse.html
+# threading   - https://docs.python.org/3/library/threading.html
+# collections - https://docs.python.org/3/library/collections.html
+# BitcoinConnector - Class developed for this project, used here to create the version message
+# MessageHeader    - Class developed for this project which packs message headers, see Lib/MessageHeader.py
+# MessageFramer    - Class developed for this project which splits the received stream into messages, see Lib/MessageFramer.py
+# Transaction      - Used to work out the txids and read the getdata count, see Lib/Transaction.py
+# Block            - Used to work out the block hash, see Lib/Block.py
+# Merkle           - merkleRoot is used to build the block header, see Lib/Merkle.py
+# CompactBlocks    - Functions developed for this project which create and parse the compact block messages, see Lib/CompactBlocks.py
+# AddressBook      - createAddrPayload creates the reply to getaddr, see Lib/AddressBook.py
+# Handshake        - Functions developed for this project which parse the version of the client and create the feature messages, see Lib/Handshake.py
+import os
+import random
+import time
+import socket
+import struct
+import argparse
+import threading
+from collections import OrderedDict
+from Lib.BitcoinConnector import BitcoinConnector
+from Lib.MessageHeader import MessageHeaderCodec
+from Lib.MessageFramer import MessageFramer
+from Lib.Transaction import Transaction,readVarInt,createVarInt
+from Lib.Block import Block,BlockHeader
+from Lib.Merkle import merkleRoot
+from Lib.CompactBlocks import MSG_CMPCT_BLOCK,COMPACT_VERSION,createSendCmpctPayload,createCmpctBlockPayload,parseSendCmpctPayload,parseGetBlockTxnPayload,createBlockTxnPayload
+from Lib.AddressBook import createAddrPayload,MAX_ADDRESSES
+from Lib.Handshake import PeerVersion,FEATURE_VERSIONS,NEGOTIATION_COMMANDS,createFeeFilterPayload,parseFeeFilterPayload
+
+# MSG_TX/MSG_BLOCK - Inventory types, see https://en.bitcoin.it/wiki/Protocol_documentation#Inventory_Vectors
+# MSG_WITNESS_FLAG - Bit set in the inventory type to ask for the witness serialization, MSG_WITNESS_TX and MSG_WITNESS_BLOCK
+MSG_TX    = 1
+MSG_BLOCK = 2
+MSG_WITNESS_FLAG = 1 << 30
+# REGTEST_BITS - The easiest proof of work target, about every second nonce meets it
+REGTEST_BITS = 0x207fffff
+# OUTPUT_SCRIPT_LENGTH/INPUT_SCRIPT_LENGTH - A P2WPKH output script and a P2PKH style signature script, used to give the transactions a realistic shape
+OUTPUT_SCRIPT_LENGTH = 22
+INPUT_SCRIPT_LENGTH  = 107
+
+def createTransaction(size=250,inputs=1,witness=False):
+    '''
+    Description:
+        Creates a random transaction of roughly size bytes. The spent outputs are random so every transaction has a different txid.
+        The size is made up with outputs after the inputs, so a large size gives a transaction with many outputs.
+    Inputs:
+        size    - The rough size in bytes of the serialized transaction
+        inputs  - The number of inputs, e.g. a large number for a consolidation transaction
+        witness - Boolean, set true for a SegWit transaction, each input has an empty signature script and a P2WPKH style witness (signature and public key)
+    Returns:
+        transaction - Byte string of the serialized transaction
+    '''
+    scriptLength = 0 if witness else INPUT_SCRIPT_LENGTH
+    # Each input is the outpoint (36), script length (1), script and sequence (4), plus the witness items and their lengths
+    inputBytes = 32 + 4 + 1 + scriptLength + 4 + (1+1+72+1+33 if witness else 0)
+    parts = [struct.pack('<i',2)]
+    if witness:
+        # marker and flag
+        parts.append(b'\x00\x01')
+    parts.append(createVarInt(inputs))
+    for i in range(inputs):
+        parts.append(os.urandom(32) + struct.pack('<I',i) + bytes([scriptLength]) + os.urandom(scriptLength) + b'\xff\xff\xff\xff')
+    outputBytes = 8 + 1 + OUTPUT_SCRIPT_LENGTH
+    outputs = max(1,(size - 12 - inputs*inputBytes)//outputBytes)
+    parts.append(createVarInt(outputs))
+    for i in range(outputs):
+        parts.append(struct.pack('<q',10000+i) + bytes([OUTPUT_SCRIPT_LENGTH]) + b'\x00\x14' + os.urandom(20))
+    if witness:
+        for i in range(inputs):
+            parts.append(b'\x02' + bytes([72]) + os.urandom(72) + bytes([33]) + os.urandom(33))
+    parts.append(b'\x00\x00\x00\x00')
+    return b''.join(parts)
+
+def stripWitness(transaction):
+    '''
+    Description:
+        The serialization of a transaction without its marker, flag and witness, as sent to a peer which did not ask for the witness.
+    Inputs:
+        transaction - Transaction instance, see Lib/Transaction.py
+    Returns:
+        transaction - Byte string of the serialized transaction, the same bytes as the txid is hashed from
+    '''
+    start1,end1,start2,end2,start3,end3 = transaction.txidSegments()
+    payload = transaction.payload
+    return bytes(payload[start1:end1]) + bytes(payload[start2:end2]) + bytes(payload[start3:end3])
+
+def stripBlockWitness(block):
+    '''
+    Description:
+        The serialization of a block with the witness taken out of every transaction, sent for MSG_BLOCK.
+    Inputs:
+        block - Byte string of the serialized block
+    Returns:
+        block - Byte string of the block without witness data
+    '''
+    parsed = Block(block)
+    return bytes(block[:parsed.txStart]) + b''.join(stripWitness(transaction) for transaction in parsed.transactions())
+
+def createCoinbase(height):
+    '''
+    Description:
+        Creates a coinbase transaction for a block, the height is in the signature script (BIP34) so every coinbase has a different txid.
+    Inputs:
+        height - The block height
+    Returns:
+        transaction - Byte string of the serialized transaction
+    '''
+    heightScript = bytes([4]) + struct.pack('<I',height)
+    return (struct.pack('<i',1) + b'\x01' + bytes(32) + b'\xff\xff\xff\xff' + bytes([len(heightScript)]) + heightScript + b'\xff\xff\xff\xff'
+            + b'\x01' + struct.pack('<q',625000000) + bytes([OUTPUT_SCRIPT_LENGTH]) + b'\x00\x14' + os.urandom(20) + b'\x00\x00\x00\x00')
+
+def createBlock(prevBlock,transactions,height=0,timestamp=None,bits=REGTEST_BITS):
+    '''
+    Description:
+        Creates a block from a list of serialized transactions, a coinbase is added at the front.
+        The Merkle root is computed from the txids and the nonce is searched for until the header hash meets the target of bits.
+    Inputs:
+        prevBlock    - The 32 byte hash of the previous block, internal byte order
+        transactions - List of byte strings of serialized transactions
+        height       - The height of the block, used in the coinbase
+        timestamp    - The block timestamp, defaults to now
+        bits         - The compact proof of work target, default the regtest target so the search is quick
+    Returns:
+        block - Byte string of the serialized block
+    '''
+    transactions = [createCoinbase(height)] + list(transactions)
+    root,mutated = merkleRoot([Transaction(tx).txid for tx in transactions])
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    # Expand the compact target, the top byte is the size and the low 3 bytes the mantissa
+    target = (bits & 0xffffff) << (8*((bits >> 24)-3))
+    nonce  = 0
+    while True:
+        header = struct.pack('<i32s32sIII',0x20000000,prevBlock,root,timestamp,bits,nonce)
+        if int.from_bytes(BlockHeader(header).hash,'little') <= target:
+            break
+        nonce += 1
+    return header + createVarInt(len(transactions)) + b''.join(transactions)
+
+class MockConnection:
+    def __init__(self,mockPeer,sock,address):
+        '''
+        Description:
+            initiliaser method for the class, one is created for each connection accepted by MockPeer
+        Inputs:
+            mockPeer - The MockPeer which accepted the connection, holds the settings and the items which can be requested
+            sock     - The connected socket
+            address  - Tuple (ip,port) of the connecting client
+        '''
+        self.mockPeer = mockPeer
+        self.socket   = sock
+        self.address  = address
+        # pending - Messages waiting to be written when mergeCount messages are joined into one write
+        self.pending  = []
+        # sendLock - The reading thread (handshake, getdata, pong) and the streaming thread both write to the socket
+        self.sendLock = threading.Lock()
+        self.open     = True
+        # compactAnnounce - Set when the client sends sendcmpct version 2 asking for blocks to be pushed as cmpctblock
+        self.compactAnnounce = False
+        # clientVersion - PeerVersion of the client once its version has arrived
+        # features      - Dictionary of the feature messages the client sent -> True, or the fee rate for feefilter
+        self.clientVersion = None
+        self.features      = {}
+        # streaming - Set once our verack arrives, from then on MockPeer.stream sends it the transactions and blocks
+        self.streaming     = False
+
+    def send(self,commandName,payload,flush=True,whole=False):
+        '''
+        Description:
+            Queues a message and writes the queue to the socket once it holds mergeCount messages or flush is set.
+        Inputs:
+            commandName - The name of the command, for example "inv"
+            payload     - The payload byte string
+            flush       - Boolean, set true to write straight away, e.g. for replies
+            whole       - Boolean, set true to write the message in one write even if segmentSize is set
+        '''
+        mockPeer = self.mockPeer
+        message  = mockPeer.codec.createMessage(commandName,payload)
+        with self.sendLock:
+            self.pending.append(message)
+            if flush or whole or len(self.pending) >= mockPeer.mergeCount:
+                self.flush(whole)
+
+    def sendAll(self,messages,whole=False):
+        '''
+        Description:
+            Queues several messages and writes them together, like a node answering one message with several.
+        Inputs:
+            messages - List of (commandName, payload)
+            whole    - Boolean, set true to write them in one write even if segmentSize is set
+        '''
+        codec = self.mockPeer.codec
+        with self.sendLock:
+            self.pending.extend(codec.createMessage(commandName,payload) for commandName,payload in messages)
+            self.flush(whole)
+
+    def flush(self,whole=False):
+        '''
+        Description:
+            Writes the queued messages, split into segmentSize writes if it is set. Called with sendLock held.
+        Inputs:
+            whole - Boolean, set true to write everything queued in one write
+        '''
+        if not self.pending or not self.open:
+            return
+        data     = b''.join(self.pending)
+        messages = len(self.pending)
+        self.pending = []
+        segmentSize = None if whole else self.mockPeer.segmentSize
+        try:
+            if segmentSize:
+                view = memoryview(data)
+                for i in range(0,len(data),segmentSize):
+                    self.socket.sendall(view[i:i+segmentSize])
+            else:
+                self.socket.sendall(data)
+        except OSError:
+            self.open = False
+            return
+        self.mockPeer.countSent(messages,len(data))
+
+    def handleMessage(self,command,payload):
+        '''
+        Description:
+            Handles one message from the client.
+        Inputs:
+            command - String, the command name
+            payload - memoryview of the payload
+        '''
+        mockPeer = self.mockPeer
+        if command == 'version':
+            self.clientVersion = PeerVersion(payload)
+            common = min(self.clientVersion.version,mockPeer.protocolVersion)
+            # Like a real node wtxidrelay and sendaddrv2 go between the version and verack, with handshakeGap 0 they all arrive in one read
+            messages = [('version',mockPeer.versionConnector.createVersionCommand(startHeight=mockPeer.height))]
+            messages += [(feature,b'') for feature in ('wtxidrelay','sendaddrv2') if common >= FEATURE_VERSIONS[feature]]
+            if mockPeer.handshakeGap:
+                self.sendAll(messages,whole=True)
+                time.sleep(mockPeer.handshakeGap)
+                self.send('verack',b'',whole=True)
+            else:
+                self.sendAll(messages+[('verack',b'')],whole=True)
+        elif command == 'verack':
+            # Like a real node say compact blocks are supported, then start streaming to the client now the handshake is finished
+            common = min(self.clientVersion.version,mockPeer.protocolVersion) if self.clientVersion is not None else 0
+            messages = [('sendheaders',b'')] if common >= FEATURE_VERSIONS['sendheaders'] else []
+            messages.append(('sendcmpct',createSendCmpctPayload(False,COMPACT_VERSION)))
+            if common >= FEATURE_VERSIONS['feefilter']:
+                messages.append(('feefilter',createFeeFilterPayload(mockPeer.feeRate)))
+            self.sendAll(messages)
+            self.streaming = True
+        elif command in NEGOTIATION_COMMANDS:
+            self.features[command] = parseFeeFilterPayload(payload) if command == 'feefilter' else True
+        elif command == 'ping':
+            self.send('pong',bytes(payload))
+        elif command == 'getdata':
+            self.handleGetData(payload)
+        elif command == 'getheaders':
+            self.handleGetHeaders(payload)
+        elif command == 'sendcmpct':
+            announce,version = parseSendCmpctPayload(payload)
+            self.compactAnnounce = announce and version == COMPACT_VERSION
+        elif command == 'getaddr':
+            now = int(time.time())
+            self.send('addr',createAddrPayload([(now,1,ip,port) for ip,port in mockPeer.addresses[:MAX_ADDRESSES]]))
+        elif command == 'getblocktxn':
+            blockHash,indexes = parseGetBlockTxnPayload(payload)
+            block = mockPeer.items.get(blockHash)
+            if block is not None:
+                transactions = [bytes(transaction.raw) for transaction in Block(block).transactions()]
+                self.send('blocktxn',createBlockTxnPayload(blockHash,[transactions[i] for i in indexes]))
+
+    def handleGetData(self,payload):
+        '''
+        Description:
+            Sends the transactions and blocks requested in a getdata message, a notfound is sent for anything no longer held.
+        Inputs:
+            payload - memoryview of the getdata payload
+        '''
+        mockPeer = self.mockPeer
+        with mockPeer.itemsLock:
+            mockPeer.stats['getdataReceived'] += 1
+        count,position = readVarInt(payload,0)
+        notFound = []
+        for i in range(count):
+            vec = bytes(payload[position:position+36])
+            position += 36
+            # Items are held with their witness, it is taken out unless the witness flag is set
+            invType = int.from_bytes(vec[0:4],'little')
+            witness = invType & MSG_WITNESS_FLAG
+            invType &= ~MSG_WITNESS_FLAG
+            item = mockPeer.items.get(vec[4:36])
+            if item is None:
+                notFound.append(vec)
+            elif invType == MSG_CMPCT_BLOCK:
+                self.send('cmpctblock',createCmpctBlockPayload(item),flush=False)
+            elif invType == MSG_BLOCK:
+                self.send('block',item if witness else stripBlockWitness(item),flush=False)
+            else:
+                self.send('tx',item if witness else stripWitness(Transaction(item)),flush=False)
+        if notFound:
+            self.send('notfound',createVarInt(len(notFound)) + b''.join(notFound),flush=False)
+        with self.sendLock:
+            self.flush()
+
+    def handleGetHeaders(self,payload):
+        '''
+        Description:
+            Replies to a getheaders message with up to 2000 headers following the first locator hash on the chain, or following the genesis block if none are.
+        Inputs:
+            payload - memoryview of the getheaders payload
+        '''
+        mockPeer = self.mockPeer
+        count,position = readVarInt(payload,4)
+        start = 0
+        with mockPeer.itemsLock:
+            for i in range(count):
+                height = mockPeer.heightOf.get(bytes(payload[position+32*i:position+32*i+32]))
+                if height is not None:
+                    start = height
+                    break
+            stopHeight = mockPeer.heightOf.get(bytes(payload[position+32*count:position+32*count+32]),len(mockPeer.headers))
+            headers = mockPeer.headers[start+1:min(start+1+2000,stopHeight+1)]
+        # Each header is followed by a txn_count of 0
+        self.send('headers',createVarInt(len(headers)) + b''.join(header + b'\x00' for header in headers))
+
+    def sendStream(self,transactions,invPayload,block,blockHash,compactPayload):
+        '''
+        Description:
+            Sends one step of the stream created by MockPeer.stream, the payloads are built once and shared by every connection.
+        Inputs:
+            transactions   - List of byte strings of the new transactions, pushed as tx messages when announce is False
+            invPayload     - The inv payload announcing the transactions, None if there are none or announce is False
+            block          - Byte string of the new block, None if there is no block this step
+            blockHash      - The 32 byte hash of the block
+            compactPayload - Function returning the cmpctblock payload of the block, only called for a client which asked for them
+        '''
+        mockPeer = self.mockPeer
+        if invPayload is not None:
+            self.send('inv',invPayload,flush=False)
+        elif not mockPeer.announce:
+            for tx in transactions:
+                self.send('tx',tx,flush=False)
+        if block is not None:
+            if self.compactAnnounce:
+                self.send('cmpctblock',compactPayload(),flush=False)
+            elif mockPeer.announce:
+                self.send('inv',b'\x01' + struct.pack('<I',MSG_BLOCK) + blockHash,flush=False)
+            else:
+                self.send('block',block,flush=False)
+        with mockPeer.itemsLock:
+            mockPeer.stats['txSent'] += len(transactions)
+            if block is not None:
+                mockPeer.stats['blocksSent'] += 1
+
+    def run(self):
+        '''
+        Description:
+            Reads and handles messages from the client until it disconnects.
+        '''
+        framer = MessageFramer(magic=self.mockPeer.magic,bufferSize=1<<16)
+        try:
+            while self.open and framer.recvFrom(self.socket):
+                for command,payload in framer.frames():
+                    self.handleMessage(command,payload)
+        except (OSError,ValueError):
+            pass
+        self.close()
+
+    def close(self):
+        '''
+        Description:
+            Closes the connection, the streaming thread stops at its next check.
+        '''
+        self.open = False
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+
+class MockPeer:
+    def __init__(self,host='127.0.0.1',port=0,magic=b'\xf9\xbe\xb4\xd9',protocolVersion=70016,txRate=10,txSize=250,blockInterval=None,blockSize=1<<20,
+                 invBatch=10,announce=True,segmentSize=None,mergeCount=1,handshakeGap=0.05,maxItems=100000,chainLength=0,feeRate=1000,witnessShare=0.8):
+        '''
+        Description:
+            initiliaser method for the class
+        Inputs:
+            host            - The address to listen on, IPv4 or IPv6 (e.g. '::1')
+            port            - The port to listen on, 0 picks a free port (see self.port after start)
+            magic           - The magic value for given network, default to mainnet so the connector defaults work
+            protocolVersion - The protocol version sent in the version message, wtxidrelay and sendaddrv2 are only sent when both sides are at 70016 or above
+            txRate          - Transactions per second sent to each connection, 0 for none
+            txSize          - The rough size in bytes of each transaction
+            blockInterval   - Seconds between blocks, None for no blocks
+            blockSize       - The rough size in bytes of each block
+            invBatch        - The number of transactions announced in each inv (or pushed together when announce is False)
+            announce        - Boolean, True to announce with inv and wait for getdata, False to push tx and block messages directly
+            segmentSize     - If set every write is split into TCP segments of this many bytes, to test messages split across reads
+            mergeCount      - The number of streamed messages joined into a single write, to test several messages in one read
+            handshakeGap    - Seconds between sending the version and the verack, 0 sends them in one write
+            maxItems        - The number of transactions and blocks held for getdata, the oldest are dropped first
+            chainLength     - The number of blocks mined on top of the genesis block at the start, for getheaders to serve.
+                              A HeaderChain following the mock chain is HeaderChain(mockPeer.headers[0],REGTEST_BITS,retargeting=False)
+            feeRate         - Satoshis per 1000 virtual bytes sent in the feefilter after the handshake
+            witnessShare    - The share of the created transactions which are SegWit, between 0 and 1
+        '''
+        self.host            = host
+        self.port            = port
+        self.magic           = magic
+        self.txRate          = txRate
+        self.txSize          = txSize
+        self.blockInterval   = blockInterval
+        self.blockSize       = blockSize
+        self.invBatch        = invBatch
+        self.announce        = announce
+        self.segmentSize     = segmentSize
+        self.mergeCount      = max(1,mergeCount)
+        self.handshakeGap    = handshakeGap
+        self.feeRate         = feeRate
+        self.witnessShare    = witnessShare
+        self.protocolVersion = protocolVersion
+        self.maxItems        = maxItems
+        self.codec           = MessageHeaderCodec(magic=magic)
+        # versionConnector - Only used for createVersionCommand, it does not open a socket
+        self.versionConnector = BitcoinConnector(protocolVersion=protocolVersion,magic=magic,ip=host if host != '0.0.0.0' else '127.0.0.1',connect=False)
+        # items     - OrderedDict of hash -> serialized tx or block, what can be requested with getdata
+        # sentTimes - OrderedDict of hash -> time.perf_counter() the item was created and first sent, for latency measurements
+        self.items      = OrderedDict()
+        self.sentTimes  = OrderedDict()
+        # unconfirmed - OrderedDict of txid -> serialized tx of the streamed transactions not in a block yet, the next block is filled from these first
+        self.unconfirmed = OrderedDict()
+        self.itemsLock  = threading.Lock()
+        # tip/height - The hash and height of the last block created, each block builds on the last, starting from a genesis block at height 0
+        # headers    - The 80 byte header of every block by height, for getheaders
+        # heightOf   - Dictionary of block hash -> height
+        genesis         = createBlock(bytes(32),[],0,timestamp=1296688602)
+        self.tip        = BlockHeader(genesis).hash
+        self.height     = 0
+        self.headers    = [genesis[:80]]
+        self.heightOf   = {self.tip:0}
+        # The pre-mined blocks only have a coinbase and are a second apart, only their headers are kept
+        for i in range(chainLength):
+            self.addHeader(createBlock(self.tip,[],self.height+1,timestamp=1296688602+self.height+1)[:80])
+        # addresses - List of (ip,port) sent in reply to getaddr
+        self.addresses  = []
+        # stats - Counts updated from every connection thread, only changed with itemsLock held
+        self.stats      = {'connections':0,'messagesSent':0,'bytesSent':0,'txSent':0,'blocksSent':0,'getdataReceived':0}
+        self.running    = threading.Event()
+        self.listener   = None
+        self.connections = []
+
+    def countSent(self,messages,nbytes):
+        '''
+        Description:
+            Adds a write to the stats.
+        Inputs:
+            messages - The number of messages written
+            nbytes   - The number of bytes written
+        '''
+        with self.itemsLock:
+            self.stats['messagesSent'] += messages
+            self.stats['bytesSent']    += nbytes
+
+    def store(self,item,itemHash,unconfirmed=False):
+        '''
+        Description:
+            Holds a transaction or block so it can be requested, and records when it was sent.
+        Inputs:
+            item        - Byte string of the serialized tx or block
+            itemHash    - The 32 byte txid or block hash
+            unconfirmed - Boolean, set true for a streamed transaction so it goes in the next block
+        Returns:
+            itemHash - The hash passed in
+        '''
+        with self.itemsLock:
+            if unconfirmed:
+                self.unconfirmed[itemHash] = item
+                while len(self.unconfirmed) > self.maxItems:
+                    self.unconfirmed.popitem(last=False)
+            self.items[itemHash]     = item
+            self.sentTimes[itemHash] = time.perf_counter()
+            while len(self.items) > self.maxItems:
+                self.items.popitem(last=False)
+            while len(self.sentTimes) > self.maxItems:
+                self.sentTimes.popitem(last=False)
+        return itemHash
+
+    def newTransaction(self):
+        '''
+        Description:
+            Creates a transaction of roughly txSize bytes, SegWit for witnessShare of them.
+        Returns:
+            transaction - Byte string of the serialized transaction with its witness
+        '''
+        return createTransaction(self.txSize,witness=random.random() < self.witnessShare)
+
+    def nextBlock(self):
+        '''
+        Description:
+            Creates the next block on top of the last one, filled up to blockSize with the streamed transactions not in a block yet, oldest first, then new transactions.
+        Returns:
+            block     - Byte string of the serialized block
+            blockHash - The 32 byte block hash
+        '''
+        with self.itemsLock:
+            transactions = []
+            size = 0
+            while self.unconfirmed and size < self.blockSize:
+                tx = self.unconfirmed.popitem(last=False)[1]
+                transactions.append(tx)
+                size += len(tx)
+            while size < self.blockSize:
+                tx = self.newTransaction()
+                transactions.append(tx)
+                size += len(tx)
+            block = createBlock(self.tip,transactions,self.height+1)
+            self.addHeader(block[:80])
+        return block,self.store(block,self.tip)
+
+    def stream(self):
+        '''
+        Description:
+            Creates the transactions and blocks and sends them to every connection past its verack, until stop is called.
+            Transactions are created invBatch at a time, every invBatch/txRate seconds, blocks every blockInterval seconds.
+            Nothing is created while no connection is streaming, like the stream of a client which has not finished its handshake.
+        '''
+        now       = time.monotonic()
+        nextTx    = now if self.txRate else float('inf')
+        nextBlock = now + self.blockInterval if self.blockInterval else float('inf')
+        while self.running.is_set():
+            now = time.monotonic()
+            connections = [connection for connection in self.connections if connection.streaming and connection.open]
+            transactions = []
+            invPayload   = None
+            block = blockHash = None
+            if now >= nextTx:
+                if connections:
+                    transactions = [self.newTransaction() for i in range(self.invBatch)]
+                    txids = [self.store(tx,Transaction(tx).txid,unconfirmed=True) for tx in transactions]
+                    if self.announce:
+                        invPayload = createVarInt(len(txids)) + b''.join(struct.pack('<I',MSG_TX) + txid for txid in txids)
+                nextTx += self.invBatch/self.txRate
+            if now >= nextBlock:
+                if connections:
+                    block,blockHash = self.nextBlock()
+                nextBlock += self.blockInterval
+            if transactions or block is not None:
+                compact = []
+                def compactPayload():
+                    # Only built if a client asked for compact blocks, then shared
+                    if not compact:
+                        compact.append(createCmpctBlockPayload(block))
+                    return compact[0]
+                for connection in connections:
+                    connection.sendStream(transactions,invPayload,block,blockHash,compactPayload)
+            # With mergeCount 1 every message has already been written, otherwise a part filled merge waits for the next batch
+            wait = min(nextTx,nextBlock) - time.monotonic()
+            if wait > 0:
+                time.sleep(min(wait,0.5))
+
+    def addHeader(self,header):
+        '''
+        Description:
+            Adds the header of a new block to the top of the chain. Called with itemsLock held.
+        Inputs:
+            header - The 80 byte block header, it must build on self.tip
+        '''
+        self.tip     = BlockHeader(header).hash
+        self.height += 1
+        self.headers.append(header)
+        self.heightOf[self.tip] = self.height
+
+    def start(self):
+        '''
+        Description:
+            Starts listening and accepting connections on a background thread.
+        Returns:
+            address - Tuple (host,port) the MockPeer is listening on
+        '''
+        self.listener = socket.socket(socket.AF_INET6 if ':' in self.host else socket.AF_INET,socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        self.listener.bind((self.host,self.port))
+        self.listener.listen(128)
+        self.port = self.listener.getsockname()[1]
+        self.running.set()
+        threading.Thread(target=self.acceptLoop,daemon=True).start()
+        if self.txRate or self.blockInterval:
+            threading.Thread(target=self.stream,daemon=True).start()
+        return self.host,self.port
+
+    def acceptLoop(self):
+        '''
+        Description:
+            Accepts connections until stop is called, each connection is read on its own thread.
+        '''
+        while self.running.is_set():
+            try:
+                sock,address = self.listener.accept()
+            except OSError:
+                break
+            # Segments should go out as they are written and not be joined by Nagle's algorithm
+            sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+            connection = MockConnection(self,sock,address)
+            self.connections.append(connection)
+            with self.itemsLock:
+                self.stats['connections'] += 1
+            threading.Thread(target=connection.run,daemon=True).start()
+
+    def stop(self):
+        '''
+        Description:
+            Stops accepting connections and closes every connection.
+        '''
+        self.running.clear()
+        if self.listener is not None:
+            self.listener.close()
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local mock bitcoin peer which streams synthetic inv, tx and block messages')
+    parser.add_argument('--host',default='127.0.0.1')
+    parser.add_argument('--port',type=int,default=18444)
+    parser.add_argument('--tx-rate',type=float,default=10,help='Transactions per second to each connection')
+    parser.add_argument('--tx-size',type=int,default=250,help='Rough size of each transaction in bytes')
+    parser.add_argument('--block-interval',type=float,default=None,help='Seconds between blocks')
+    parser.add_argument('--block-size',type=int,default=1<<20,help='Rough size of each block in bytes')
+    parser.add_argument('--inv-batch',type=int,default=10,help='Transactions per inv message')
+    parser.add_argument('--push',action='store_true',help='Send tx and block messages directly instead of announcing them with inv')
+    parser.add_argument('--segment-size',type=int,default=None,help='Split every write into TCP segments of this size')
+    parser.add_argument('--merge',type=int,default=1,help='Join this many messages into one write')
+    parser.add_argument('--chain-length',type=int,default=0,help='Blocks to mine at the start for getheaders to serve')
+    parser.add_argument('--witness-share',type=float,default=0.8,help='Share of the transactions which are SegWit')
+    args = parser.parse_args()
+    mockPeer = MockPeer(host=args.host,port=args.port,txRate=args.tx_rate,txSize=args.tx_size,blockInterval=args.block_interval,blockSize=args.block_size,
+                        invBatch=args.inv_batch,announce=not args.push,segmentSize=args.segment_size,mergeCount=args.merge,
+                        chainLength=args.chain_length,witnessShare=args.witness_share)
+    host,port = mockPeer.start()
+    print(f'Mock peer listening on {host}:{port}')
+    try:
+        while True:
+            time.sleep(5)
+            print(mockPeer.stats)
+    except KeyboardInterrupt:
+        mockPeer.stop()
+        print("Program exited")
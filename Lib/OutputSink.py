@@ -0,0 +1,454 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the classes HumanFormatter, JsonLinesFormatter, BinaryFormatter and OutputSink and the functions which turn parsed messages into records
+#   Printing a parsed message field by field makes dozens of print calls per message, each a write to the terminal, and at relay rates the terminal becomes the bottleneck.
+#   Instead the parsed messages are written through an output layer:
+#       1. A parsed tx, block or inv summary is turned into a record, a dictionary of only the selected fields, so fields nobody wants are never worked out (e.g. the wtxid hash)
+#       2. A formatter turns the record into bytes, the human readable text the connector used to print, one JSON object per line (JSON Lines) or a compact binary record
+#       3. OutputSink queues the bytes and a background thread writes them in batches of batchBytes, or every flushInterval seconds, with one write call per batch
+#   Hashes are written as hex in the usual display order (reversed, like block explorers), scripts and witness items as hex.
+#   The record is built and formatted on the calling thread as the parsed objects point into the receive buffer and are only valid until the next message is read.
+#   If the writer falls behind by more than maxPendingBytes, write waits for it rather than using unbounded memory.
+
+
+## Imports ##
+# sys       - https://docs.python.org/3/library/sys.html
+# json      - https://docs.python.org/3/library/json.html
+# time      - https://docs.python.org/3/library/time.html
+# math      - https://docs.python.org/3/library/math.html
+# struct    - https://docs.python.org/3/library/struct.html
+# threading - https://docs.python.org/3/library/threading.html
+# datetime  - https://docs.python.org/3/library/datetime.html
+import sys
+import json
+import time
+import math
+import struct
+import threading
+from datetime import datetime
+
+# HASH_FIELDS - Fields holding a hash in internal byte order, written reversed so they read like block explorers
+HASH_FIELDS = frozenset(('txid','wtxid','hash','prevBlock','merkleRoot','prevHash'))
+
+def inputRecord(txIn):
+    # One transaction input as a dictionary, the memoryviews are copied as the payload will be reused
+    return {'prevHash':txIn.previousHash,'prevIndex':txIn.previousIndex,'script':bytes(txIn.signatureScript),
+            'sequence':txIn.sequence,'witness':[bytes(item) for item in txIn.witness]}
+
+def outputRecord(txOut):
+    # One transaction output as a dictionary
+    return {'value':txOut.value,'script':bytes(txOut.pkScript)}
+
+# FIELDS - For each kind of record, the field name -> function(item, extra) which works the field out, in the order they are written
+#   tx items are Transaction instances (Lib/Transaction.py), block items Block instances (Lib/Block.py), inv items the summary dictionary from parseInvPayload
+FIELDS = {
+    'tx':{
+        'txid':        lambda transaction,extra: transaction.txid,
+        'wtxid':       lambda transaction,extra: transaction.wtxid,
+        'size':        lambda transaction,extra: transaction.size,
+        'vsize':       lambda transaction,extra: transaction.vsize,
+        'version':     lambda transaction,extra: transaction.version,
+        'inputCount':  lambda transaction,extra: transaction.inputCount,
+        'outputCount': lambda transaction,extra: transaction.outputCount,
+        'value':       lambda transaction,extra: transaction.totalOutputValue(),
+        'lockTime':    lambda transaction,extra: transaction.lockTime,
+        'inputs':      lambda transaction,extra: [inputRecord(txIn) for txIn in transaction.inputs()],
+        'outputs':     lambda transaction,extra: [outputRecord(txOut) for txOut in transaction.outputs()],
+    },
+    'block':{
+        'hash':        lambda block,extra: block.header.hash,
+        'prevBlock':   lambda block,extra: block.header.prevBlock,
+        'merkleRoot':  lambda block,extra: block.header.merkleRoot,
+        'version':     lambda block,extra: block.header.version,
+        'timestamp':   lambda block,extra: block.header.timestamp,
+        'bits':        lambda block,extra: block.header.bits,
+        'nonce':       lambda block,extra: block.header.nonce,
+        'txCount':     lambda block,extra: block.txCount,
+        'size':        lambda block,extra: len(block.payload),
+        'merkleTime':  lambda block,extra: extra.get('merkleTime'),
+    },
+}
+
+def createRecord(kind,item,extra=None,fieldNames=None):
+    '''
+    Description:
+        Turns a parsed message into a record of the selected fields.
+    Inputs:
+        kind       - String, the kind of message e.g. 'tx', 'block' or 'inv'
+        item       - The parsed message, a Transaction or Block instance, or a dictionary for any other kind
+        extra      - Optional dictionary of values which are not part of the item, e.g. the merkleTime of a block
+        fieldNames - Tuple of the fields wanted, None for every field
+    Returns:
+        record - Dictionary starting with 'type' and 'time' (time.time() the record was made) followed by the fields
+    '''
+    extra  = extra or {}
+    record = {'type':kind,'time':time.time()}
+    functions = FIELDS.get(kind)
+    if functions is None:
+        # Already a dictionary, only the selection applies
+        source = dict(item,**extra)
+        record.update((name,source[name]) for name in (fieldNames if fieldNames is not None else source) if name in source)
+    else:
+        record.update((name,functions[name](item,extra)) for name in (fieldNames if fieldNames is not None else functions) if name in functions)
+    return record
+
+def hexEncode(value,key=None):
+    '''
+    Description:
+        Converts the bytes in a record to hex strings so it can be written as JSON, hashes are reversed.
+    Inputs:
+        value - The record, or a value inside it
+        key   - The field name of the value
+    Returns:
+        value - The value with every bytes object replaced by a hex string
+    '''
+    if isinstance(value,(bytes,bytearray,memoryview)):
+        return bytes(value[::-1]).hex() if key in HASH_FIELDS else bytes(value).hex()
+    if isinstance(value,dict):
+        return {name:hexEncode(item,name) for name,item in value.items()}
+    if isinstance(value,list):
+        return [hexEncode(item,key) for item in value]
+    return value
+
+class HumanFormatter:
+    def __init__(self,fields=None):
+        '''
+        Description:
+            initiliaser method for the class, formats records as the multi line text the connector has always displayed
+        Inputs:
+            fields - Optional dictionary of kind -> tuple of field names to show, kinds not in it show every field
+        '''
+        self.fields = fields or {}
+
+    def fieldNames(self,kind):
+        # The fields to put in the record of this kind, None for all
+        return self.fields.get(kind)
+
+    def format(self,record):
+        '''
+        Description:
+            Formats a record as text, only the lines for fields in the record are written.
+        Inputs:
+            record - Dictionary from createRecord
+        Returns:
+            data - Bytes of the text, UTF-8
+        '''
+        kind = record['type']
+        if kind == 'tx':
+            lines = self.formatTransaction(record)
+        elif kind == 'block':
+            lines = self.formatBlock(record)
+        elif kind == 'inv':
+            lines = self.formatInv(record)
+        else:
+            lines = [kind + ' ' + ' '.join(f'{name} = {value}' for name,value in hexEncode(record).items() if name not in ('type','time'))]
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def formatTransaction(self,record):
+        # The text of a tx message, see parseTXPayload
+        lines = ['*******************TX MESSAGE*******************']
+        if 'size' in record:
+            lines.append(f'Length of payload  = {record["size"]} Bytes')
+        if 'txid' in record:
+            lines.append(f'txid  = {record["txid"][::-1].hex()}')
+        if 'wtxid' in record and record['wtxid'] != record.get('txid'):
+            lines.append(f'wtxid = {record["wtxid"][::-1].hex()}')
+        if 'version' in record:
+            lines.append(f'version (4 Bytes)  = {record["version"]}')
+        if 'inputCount' in record:
+            lines.append(f'tx_in count = {record["inputCount"]}')
+        for i,txIn in enumerate(record.get('inputs',())):
+            lines.append(f'\tTransaction input {i}')
+            lines.append(f'\t\tprevious_output (36 Bytes) = {txIn["prevHash"][::-1].hex()}:{txIn["prevIndex"]}')
+            lines.append(f'\t\tscript length = {len(txIn["script"])}')
+            lines.append(f'\t\tscript signature ({len(txIn["script"])} Bytes) = {txIn["script"].hex() if txIn["script"] else None}')
+            lines.append(f'\t\tsequence (4 Bytes) = {txIn["sequence"]}')
+            for j,item in enumerate(txIn['witness']):
+                lines.append(f'\t\twitness item {j} ({len(item)} Bytes) = {item.hex()}')
+        if 'outputCount' in record:
+            lines.append(f'tx_out count = {record["outputCount"]}')
+        for i,txOut in enumerate(record.get('outputs',())):
+            lines.append(f'\tTransaction Output {i}')
+            lines.append(f'\t\tvalue (8 Bytes) = {txOut["value"]} Satoshis ({txOut["value"]*0.00000001} BTC)')
+            lines.append(f'\t\tpk_script length = {len(txOut["script"])}')
+            lines.append(f'\t\tpk_script ({len(txOut["script"])} Bytes) = {txOut["script"].hex() if txOut["script"] else None}')
+        if 'value' in record:
+            lines.append(f'total output value = {record["value"]} Satoshis')
+        if 'lockTime' in record:
+            lockTime = record['lockTime']
+            if lockTime == 0:
+                lines.append(f'lock_time (4 Bytes) = {lockTime} transaction not locked')
+            elif lockTime < 500000000:
+                lines.append(f'lock_time (4 Bytes) = {lockTime}, transaction unlocked at block {lockTime}')
+            else:
+                lines.append(f'lock_time (4 Bytes) = {lockTime}, transaction unlocked at {datetime.utcfromtimestamp(lockTime)}')
+        lines.append('******************* END OF TX MESSAGE *******************')
+        return lines
+
+    def formatBlock(self,record):
+        # The text of a block message, see parseBlockPayload
+        lines = ['*******************BLOCK MESSAGE*******************']
+        if 'size' in record:
+            lines.append(f'Length of payload  = {record["size"]} Bytes')
+        if 'hash' in record:
+            lines.append(f'block hash (32 Bytes) = {record["hash"][::-1].hex()}')
+        if 'version' in record:
+            lines.append(f'version (4 Bytes)  = {record["version"]} or {record["version"]:#010x}')
+        if 'prevBlock' in record:
+            lines.append(f'prev_block hash (32 Bytes) = {record["prevBlock"][::-1].hex()}')
+        if 'merkleRoot' in record:
+            lines.append(f'merkleRoot (32 Bytes) = {record["merkleRoot"][::-1].hex()}')
+        if 'timestamp' in record:
+            lines.append(f'timestamp (4 Bytes) = {datetime.utcfromtimestamp(record["timestamp"])}')
+        if 'bits' in record:
+            lines.append(f'difficulty target (4 Bytes) = {record["bits"]} or {record["bits"]:#010x}')
+        if 'nonce' in record:
+            lines.append(f'nonce (4 Bytes) = {record["nonce"]}')
+        if 'txCount' in record:
+            lines.append(f'txn count = {record["txCount"]}')
+        if record.get('merkleTime') is not None:
+            lines.append(f'merkle root verified in {record["merkleTime"]*1000:.2f} ms')
+        lines.append('****************END OF BLOCK MESSAGE***************')
+        return lines
+
+    def formatInv(self,record):
+        # The summary of an inv message, see parseInvPayload
+        lines = ['*******************INV MESSAGE*******************']
+        if 'size' in record:
+            lines.append(f'Length of payload = {record["size"]} Bytes')
+        if 'count' in record:
+            lines.append(f'Inv Count = {record["count"]}')
+        if 'inventoryLength' in record:
+            lines.append(f'Length of inventory vectors = {record["inventoryLength"]} Bytes')
+        lines.append('\nSummary Inventory Vectors Received')
+        if 'txVectors' in record:
+            lines.append(f'\tNumber of MSG_TX vectors = {record["txVectors"]}')
+        if 'blockVectors' in record:
+            lines.append(f'\tNumber of MSG_BLOCK vectors = {record["blockVectors"]}')
+        if 'knownVectors' in record:
+            lines.append(f'\tNumber of already requested vectors dropped = {record["knownVectors"]}')
+        lines.append('****************END OF INV MESSAGE***************')
+        return lines
+
+class JsonLinesFormatter(HumanFormatter):
+    def __init__(self,fields=None):
+        '''
+        Description:
+            initiliaser method for the class, formats each record as one line of JSON (see https://jsonlines.org/), bytes are written as hex
+        Inputs:
+            fields - Optional dictionary of kind -> tuple of field names to write, kinds not in it write every field
+        '''
+        super().__init__(fields)
+        # encoder - One compact encoder reused for every record
+        self.encoder = json.JSONEncoder(separators=(',',':'))
+
+    def format(self,record):
+        '''
+        Description:
+            Formats a record as a line of JSON.
+        Inputs:
+            record - Dictionary from createRecord
+        Returns:
+            data - Bytes of the line, ending in a new line
+        '''
+        return (self.encoder.encode(hexEncode(record)) + '\n').encode('utf-8')
+
+# RECORD_HEADER - Starts every binary record, kind ID (B), time.time() (d) and the length of the body which follows (I)
+RECORD_HEADER = struct.Struct('<BdI')
+# BINARY_LAYOUTS - kind -> (kind ID, struct of the body, the field names in the order packed), the fields are fixed so field selection does not apply
+#   Any other kind is written with kind ID 0 and the body as the JSON of the record, so nothing is lost
+BINARY_LAYOUTS = {
+    'tx':   (1,struct.Struct('<32s32sIIiIIqI'),('txid','wtxid','size','vsize','version','inputCount','outputCount','value','lockTime')),
+    'block':(2,struct.Struct('<32s32s32siIIIIId'),('hash','prevBlock','merkleRoot','version','timestamp','bits','nonce','txCount','size','merkleTime')),
+    'inv':  (3,struct.Struct('<IIIIII'),('size','count','inventoryLength','txVectors','blockVectors','knownVectors')),
+}
+BINARY_KINDS = {layout[0]:kind for kind,layout in BINARY_LAYOUTS.items()}
+
+class BinaryFormatter:
+    def __init__(self):
+        '''
+        Description:
+            initiliaser method for the class, formats records as compact fixed size binary records, see BINARY_LAYOUTS. Read them back with readBinaryRecords.
+            A tx record is 133 bytes against roughly 300 for JSON Lines, and packing is one struct call.
+        '''
+        self.encoder = json.JSONEncoder(separators=(',',':'))
+
+    def fieldNames(self,kind):
+        # The binary layouts are fixed, only their fields are worked out
+        layout = BINARY_LAYOUTS.get(kind)
+        return layout[2] if layout is not None else None
+
+    def format(self,record):
+        '''
+        Description:
+            Packs a record.
+        Inputs:
+            record - Dictionary from createRecord
+        Returns:
+            data - Bytes of the record header and body
+        '''
+        layout = BINARY_LAYOUTS.get(record['type'])
+        if layout is None:
+            body = self.encoder.encode(hexEncode(record)).encode('utf-8')
+            return RECORD_HEADER.pack(0,record['time'],len(body)) + body
+        kindID,body,names = layout
+        values = [record[name] for name in names]
+        if record['type'] == 'block' and values[-1] is None:
+            # No merkle time, NaN stands for None
+            values[-1] = math.nan
+        return RECORD_HEADER.pack(kindID,record['time'],body.size) + body.pack(*values)
+
+def readBinaryRecords(stream):
+    '''
+    Description:
+        Generator which reads back the records written by BinaryFormatter.
+    Inputs:
+        stream - File opened in binary mode
+    Returns:
+        record - Dictionary like the one created by createRecord, hashes as bytes in internal byte order
+    Raises:
+        ValueError - If the stream ends part way through a record
+    '''
+    while True:
+        header = stream.read(RECORD_HEADER.size)
+        if not header:
+            return
+        if len(header) < RECORD_HEADER.size:
+            raise ValueError('binary record stream ends part way through a record header')
+        kindID,recordTime,length = RECORD_HEADER.unpack(header)
+        body = stream.read(length)
+        if len(body) < length:
+            raise ValueError('binary record stream ends part way through a record')
+        if kindID == 0:
+            yield json.loads(body)
+            continue
+        kind = BINARY_KINDS.get(kindID)
+        if kind is None:
+            raise ValueError(f'unknown binary record kind {kindID}')
+        layout = BINARY_LAYOUTS[kind]
+        record = {'type':kind,'time':recordTime}
+        record.update(zip(layout[2],layout[1].unpack(body)))
+        if kind == 'block' and math.isnan(record['merkleTime']):
+            record['merkleTime'] = None
+        yield record
+
+class OutputSink:
+    def __init__(self,formatter=None,path=None,stream=None,batchBytes=1<<16,flushInterval=0.2,maxPendingBytes=16<<20,background=True):
+        '''
+        Description:
+            initiliaser method for the class
+        Inputs:
+            formatter       - HumanFormatter, JsonLinesFormatter or BinaryFormatter instance, defaults to HumanFormatter
+            path            - File to append the output to, if not passed stream is used
+            stream          - Binary stream to write to when path is not passed, defaults to standard output
+            batchBytes      - The writer thread writes once this many bytes are waiting
+            flushInterval   - Seconds after which whatever is waiting is written even if under batchBytes
+            maxPendingBytes - write waits once this many bytes are waiting, so a slow terminal or disk slows the caller instead of using all the memory
+            background      - Boolean, set false to write on the calling thread in write (still batched, see flush)
+        '''
+        self.formatter       = formatter if formatter is not None else HumanFormatter()
+        self.ownsStream      = path is not None
+        self.stream          = open(path,'ab') if path is not None else (stream if stream is not None else sys.stdout.buffer)
+        self.batchBytes      = batchBytes
+        self.flushInterval   = flushInterval
+        self.maxPendingBytes = maxPendingBytes
+        self.background      = background
+        # pending - List of formatted records waiting to be written, pendingBytes their total size
+        self.pending      = []
+        self.pendingBytes = 0
+        self.condition    = threading.Condition()
+        # writeLock - Held from taking a batch until it is written, so batches reach the stream in order whichever thread writes them
+        self.writeLock    = threading.Lock()
+        self.closing      = False
+        self.stats        = {'records':0,'bytes':0,'batches':0}
+        self.thread = None
+        if background:
+            self.thread = threading.Thread(target=self.writerLoop,daemon=True)
+            self.thread.start()
+
+    def write(self,kind,item,extra=None):
+        '''
+        Description:
+            Formats a parsed message and queues it to be written.
+        Inputs:
+            kind  - String, the kind of message e.g. 'tx'
+            item  - The parsed message, see createRecord
+            extra - Optional dictionary of values which are not part of the item, e.g. the merkleTime of a block
+        '''
+        data = self.formatter.format(createRecord(kind,item,extra,self.formatter.fieldNames(kind)))
+        with self.condition:
+            while self.background and self.pendingBytes > self.maxPendingBytes and not self.closing:
+                self.condition.wait()
+            self.pending.append(data)
+            self.pendingBytes += len(data)
+            self.stats['records'] += 1
+            if self.pendingBytes >= self.batchBytes:
+                if self.background:
+                    self.condition.notify_all()
+                else:
+                    self.writeBatch(self.takePending())
+
+    def takePending(self):
+        # Swaps out the waiting records, called with self.condition held
+        batch = self.pending
+        self.pending      = []
+        self.pendingBytes = 0
+        self.condition.notify_all()
+        return batch
+
+    def writeBatch(self,batch):
+        '''
+        Description:
+            Writes a batch of formatted records with one write call.
+        Inputs:
+            batch - List of bytes
+        '''
+        if not batch:
+            return
+        data = b''.join(batch)
+        self.stream.write(data)
+        self.stream.flush()
+        self.stats['bytes']   += len(data)
+        self.stats['batches'] += 1
+
+    def writerLoop(self):
+        '''
+        Description:
+            Run by the background thread, writes the waiting records whenever batchBytes are waiting or flushInterval has passed, until close is called.
+        '''
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pendingBytes >= self.batchBytes or self.closing,timeout=self.flushInterval)
+                closing = self.closing
+            try:
+                self.flush()
+            except (OSError,ValueError) as e:
+                print(f'Warning: could not write output, {e}',file=sys.stderr)
+            if closing:
+                return
+
+    def flush(self):
+        '''
+        Description:
+            Writes everything waiting now.
+        '''
+        with self.writeLock:
+            with self.condition:
+                batch = self.takePending()
+            self.writeBatch(batch)
+
+    def close(self):
+        '''
+        Description:
+            Writes everything waiting, stops the writer thread and closes the file if the sink opened it.
+        '''
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+        if self.ownsStream:
+            self.stream.close()
@@ -0,0 +1,474 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the classes PeerStats and PeerSelector and the functions resolveSeeds and selectFastestPeers
+#   Some peers pass on new transactions and blocks seconds before others, which peer we listen to decides how early we see things.
+#   Instead of picking a peer by hand PeerSelector measures every peer and keeps the connection set moving towards the fastest:
+#       1. Every DNS seed is resolved for both IPv4 (A) and IPv6 (AAAA) records, giving a pool of candidate addresses
+#       2. Handshakes are raced, raceFactor times as many candidates as are needed are connected at once and the first to finish the handshake are kept
+#       3. Each peer is pinged every pingInterval seconds and the ping/pong round trip time (RTT) is averaged
+#       4. For every tx and block announced in an inv the time it was first announced by any peer is kept, each peer is scored on how far behind the first it announces (its inv lead time)
+#       5. Every rotateInterval seconds the slowest peer is dropped if it is slower than the median and a fresh candidate is raced in its place
+#       6. Whenever fewer candidates are left than one race needs they are refilled, from the addresses the peers send in addr/addrv2 messages (or the best in the address book)
+#          and by resolving the seeds again at most every seedInterval seconds, an address is not raced again for retryInterval seconds
+#   The score of a peer is its average inv delay (seconds behind the first announcer) plus half its RTT, lower is better. Until a peer has announced enough items its handshake time stands in for the inv delay.
+#   The peers are held by an AsyncBitcoinConnector, PeerSelector wraps its message handler to take the measurements and then passes every message on.
+#   With an AddressBook (see Lib/AddressBook.py) the candidates are the best addresses saved from earlier runs and the seeds are only resolved if those run out,
+#   every handshake result is recorded in it and the addresses the peers send in addr and addrv2 messages are added to it, the candidates are then refilled from it.
+
+
+## Imports ##
+# os                    - https://docs.python.org/3/library/os.html
+# time                  - https://docs.python.org/3/library/time.html
+# socket                - https://docs.python.org/3/library/socket.html
+# asyncio               - https://docs.python.org/3/library/asyncio.html
+# collections           - https://docs.python.org/3/library/collections.html
+# AsyncBitcoinConnector - Class developed for this project which holds many peer connections on one event loop, see Lib/AsyncBitcoinConnector.py
+# Transaction           - readVarInt is used to read the inv count, see Lib/Transaction.py
+# AddressBook           - parseAddrPayload and parseAddrV2Payload read the addresses peers send, isRoutable leaves out private addresses, see Lib/AddressBook.py
+# CaptureLog            - unpackIP converts the 16 byte addresses in addr messages to strings, see Lib/CaptureLog.py
+import os
+import time
+import socket
+import asyncio
+from collections import OrderedDict
+from Lib.AsyncBitcoinConnector import AsyncBitcoinConnector
+from Lib.Transaction import readVarInt
+from Lib.AddressBook import parseAddrPayload,parseAddrV2Payload,isRoutable
+from Lib.CaptureLog import unpackIP
+
+# DNS_SEEDS - The mainnet DNS seeds listed in Bitcoin Core, each returns a different set of reachable nodes
+DNS_SEEDS = ('seed.bitcoin.sipa.be','dnsseed.bluematt.me','seed.bitcoinstats.com','seed.bitcoin.jonasschnelli.ch',
+             'seed.btc.petertodd.net','seed.bitcoin.sprovoost.nl','dnsseed.emzy.de','seed.bitcoin.wiz.biz')
+
+async def resolveSeeds(seeds=DNS_SEEDS,port=8333):
+    '''
+    Description:
+        Resolves every DNS seed at once for both IPv4 and IPv6 addresses. A seed which fails to resolve is skipped.
+    Inputs:
+        seeds - Iterable of DNS seed domains
+        port  - The port of the nodes
+    Returns:
+        addresses - List of (ip,port) tuples without duplicates, IPv4 and IPv6 addresses alternate so neither is tried only after the other
+    '''
+    loop    = asyncio.get_running_loop()
+    results = await asyncio.gather(*(loop.getaddrinfo(seed,port,family=socket.AF_UNSPEC,type=socket.SOCK_STREAM) for seed in seeds),return_exceptions=True)
+    byFamily = {socket.AF_INET:[],socket.AF_INET6:[]}
+    seen = set()
+    for seed,records in zip(seeds,results):
+        if isinstance(records,Exception):
+            print(f'Could not obtain node IP addresses from the DNS seed {seed}: {records!r}')
+            continue
+        for family,socketType,proto,name,address in records:
+            if address[0] not in seen and family in byFamily:
+                seen.add(address[0])
+                byFamily[family].append((address[0],address[1]))
+    ipv4,ipv6 = byFamily[socket.AF_INET],byFamily[socket.AF_INET6]
+    print(f'Resolved {len(ipv4)} IPv4 and {len(ipv6)} IPv6 addresses from {len(seeds)} DNS seeds')
+    addresses = []
+    for i in range(max(len(ipv4),len(ipv6))):
+        addresses.extend(ipv4[i:i+1] + ipv6[i:i+1])
+    return addresses
+
+class PeerStats:
+    # __slots__ - No per object dictionary
+    __slots__ = ('handshakeTime','rtt','rttSamples','invDelay','invCount','firstCount','connectedAt')
+
+    def __init__(self,handshakeTime):
+        '''
+        Description:
+            initiliaser method for the class, the measurements of one peer
+        Inputs:
+            handshakeTime - Seconds from starting the connection to the end of the handshake
+        '''
+        self.handshakeTime = handshakeTime
+        # rtt/rttSamples - Average ping/pong round trip time in seconds and the number of pongs it is from
+        self.rtt        = None
+        self.rttSamples = 0
+        # invDelay/invCount - Average seconds the peer announced items after the first peer to announce them, and the number of items
+        # firstCount        - The number of items this peer announced first
+        self.invDelay   = 0.0
+        self.invCount   = 0
+        self.firstCount = 0
+        self.connectedAt = time.monotonic()
+
+    def score(self,minInvSamples):
+        '''
+        Description:
+            The score used to rank peers, lower is better.
+        Inputs:
+            minInvSamples - The number of announced items needed before the inv delay is used
+        Returns:
+            score - Average inv delay (or the handshake time when there are too few items) plus half the RTT, in seconds
+        '''
+        delay = self.invDelay if self.invCount >= minInvSamples else self.handshakeTime
+        rtt   = self.rtt if self.rtt is not None else self.handshakeTime
+        return delay + rtt/2
+
+class PeerSelector:
+    def __init__(self,connector=None,seeds=DNS_SEEDS,targetPeers=8,raceFactor=3,pingInterval=10,rotateInterval=60,minInvSamples=20,averaging=0.2,maxTracked=100000,addressBook=None,
+                 seedInterval=1800,retryInterval=600,maxCandidates=1000,allowPrivate=False):
+        '''
+        Description:
+            initiliaser method for the class
+        Inputs:
+            connector      - The AsyncBitcoinConnector which holds the connections, a default one is created if not passed
+            seeds          - DNS seed domains resolved for candidate addresses
+            targetPeers    - The number of peers to stay connected to
+            raceFactor     - How many candidates are connected for each peer needed, the rest are closed once enough handshakes finish
+            pingInterval   - Seconds between pings to each peer
+            rotateInterval - Seconds between dropping the slowest peer for a fresh candidate
+            minInvSamples  - The number of announced items a peer needs before its inv delay counts in its score
+            averaging      - Weight of each new sample in the moving averages of RTT and inv delay, between 0 and 1
+            maxTracked     - The number of announced hashes whose first announcement time is kept
+            addressBook    - Optional AddressBook, candidates are taken from it before the seeds are resolved and the handshake results are recorded in it
+            seedInterval   - The fewest seconds between resolving the seeds, they are only resolved again when the candidates run low
+            retryInterval  - Seconds before an address which was raced, or a peer which was dropped, can be a candidate again
+            maxCandidates  - The most candidates kept, addresses from addr messages are not added beyond it
+            allowPrivate   - Boolean, set true to race private and loopback addresses from addr messages, e.g. to test against Lib/MockPeer.py
+        '''
+        self.connector      = connector if connector is not None else AsyncBitcoinConnector()
+        self.seeds          = seeds
+        self.targetPeers    = targetPeers
+        self.raceFactor     = max(1,raceFactor)
+        self.pingInterval   = pingInterval
+        self.rotateInterval = rotateInterval
+        self.minInvSamples  = minInvSamples
+        self.averaging      = averaging
+        self.maxTracked     = maxTracked
+        self.addressBook    = addressBook
+        self.seedInterval   = seedInterval
+        self.retryInterval  = retryInterval
+        self.maxCandidates  = maxCandidates
+        self.allowPrivate   = allowPrivate
+        # candidates - OrderedDict of (ip,port) -> None not tried yet, oldest first, used as an ordered set
+        # tried      - OrderedDict of (ip,port) -> time.monotonic() it was last raced, oldest first
+        # stats      - Dictionary of (ip,port) -> PeerStats for the connected peers
+        # firstSeen  - OrderedDict of announced hash -> time.monotonic() of the first announcement, oldest first
+        # pings      - Dictionary of (ip,port) -> (nonce, time.perf_counter() the ping was sent)
+        self.candidates = OrderedDict()
+        self.tried      = OrderedDict()
+        self.stats      = {}
+        self.firstSeen  = OrderedDict()
+        self.pings      = {}
+        # useSeeds     - False when the candidates were passed to run, the seeds are then never resolved
+        # lastResolved - time.monotonic() the seeds were last resolved, None if they have not been
+        self.useSeeds     = True
+        self.lastResolved = None
+        # Every message from every peer passes through handleMessage first
+        self.handler = self.connector.messageHandler
+        self.connector.messageHandler = self.handleMessage
+
+    async def connectRace(self,count):
+        '''
+        Description:
+            Connects to raceFactor*count candidates at once and keeps the first count to finish the handshake, the others are closed.
+        Inputs:
+            count - The number of peers wanted
+        Returns:
+            peers - List of the AsyncPeers kept, fewer than count if too few handshakes finished
+        '''
+        racing = [self.candidates.popitem(last=False)[0] for i in range(min(len(self.candidates),count*self.raceFactor))]
+        if not racing:
+            return []
+        start = time.monotonic()
+        for key in racing:
+            self.tried[key] = start
+            self.tried.move_to_end(key)
+        tasks = [asyncio.create_task(self.connectTimed(ip,port,start)) for ip,port in racing]
+        kept  = []
+        for finished in asyncio.as_completed(tasks):
+            peer = await finished
+            if peer is None:
+                continue
+            self.stats[(peer.peerIP,peer.peerPort)] = PeerStats(time.monotonic()-start)
+            # Ask the peer for more addresses, they refill the candidates
+            peer.sendMessage('getaddr',b'')
+            kept.append(peer)
+            if len(kept) == count:
+                # Enough peers, the handshakes still running are too slow and are closed when they finish
+                for task in tasks:
+                    if not task.done():
+                        task.add_done_callback(self.closeLate)
+                break
+        return kept
+
+    async def connectTimed(self,ip,port,start):
+        '''
+        Description:
+            Connects to one candidate and records the result in the address book if there is one.
+        Inputs:
+            ip    - The ip address of the candidate
+            port  - The port of the candidate
+            start - time.monotonic() when the race started
+        Returns:
+            peer - The AsyncPeer, None if the handshake did not finish
+        '''
+        peer = await self.connector.connectPeer(ip,port)
+        if self.addressBook is not None:
+            if peer is None:
+                self.addressBook.recordFailure(ip,port)
+            else:
+                self.addressBook.recordSuccess(ip,port,time.monotonic()-start)
+        return peer
+
+    @staticmethod
+    def closeLate(task):
+        # Done callback for a connection which lost the race
+        peer = task.result() if not task.cancelled() else None
+        if peer is not None:
+            peer.close()
+
+    def handleMessage(self,peer,command,payload):
+        '''
+        Description:
+            The message handler set on the connector. pong and inv messages are measured, then every message is passed to the original handler.
+        Inputs:
+            peer    - The AsyncPeer the message came from
+            command - String, the command name of the message
+            payload - memoryview of the message payload
+        '''
+        if command == 'pong':
+            self.recordPong(peer,payload)
+        elif command == 'inv':
+            self.recordInv(peer,payload)
+        elif command == 'addr' or command == 'addrv2':
+            try:
+                addresses = parseAddrV2Payload(payload)[0] if command == 'addrv2' else parseAddrPayload(payload)
+            except ValueError as e:
+                print(f'Warning: could not parse {command} message from {peer.peerIP}:{peer.peerPort}, {e}')
+            else:
+                self.addLearned(addresses)
+        self.handler(peer,command,payload)
+
+    def recordPong(self,peer,payload):
+        '''
+        Description:
+            Updates the RTT of a peer from a pong, it must echo the nonce of the last ping sent.
+        Inputs:
+            peer    - The AsyncPeer the pong came from
+            payload - memoryview of the 8 byte nonce
+        '''
+        key   = (peer.peerIP,peer.peerPort)
+        ping  = self.pings.get(key)
+        stats = self.stats.get(key)
+        if ping is None or stats is None or bytes(payload) != ping[0]:
+            return
+        del self.pings[key]
+        rtt = time.perf_counter() - ping[1]
+        stats.rtt = rtt if stats.rtt is None else stats.rtt + self.averaging*(rtt - stats.rtt)
+        stats.rttSamples += 1
+
+    def recordInv(self,peer,payload):
+        '''
+        Description:
+            Records when each tx and block in an inv was announced. The first peer to announce an item has a delay of 0, every later peer the time since.
+        Inputs:
+            peer    - The AsyncPeer the inv came from
+            payload - memoryview of the inv payload
+        '''
+        stats = self.stats.get((peer.peerIP,peer.peerPort))
+        if stats is None:
+            return
+        try:
+            count,position = readVarInt(payload,0)
+        except IndexError:
+            return
+        now       = time.monotonic()
+        firstSeen = self.firstSeen
+        averaging = self.averaging
+        for start in range(position,min(len(payload),position+36*count),36):
+            invHash = bytes(payload[start+4:start+36])
+            first = firstSeen.get(invHash)
+            if first is None:
+                firstSeen[invHash] = now
+                stats.firstCount += 1
+                delay = 0.0
+            else:
+                delay = now - first
+            stats.invDelay += averaging*(delay - stats.invDelay)
+            stats.invCount += 1
+        while len(firstSeen) > self.maxTracked:
+            firstSeen.popitem(last=False)
+
+    def sendPings(self):
+        '''
+        Description:
+            Sends a ping with a random nonce to every connected peer. A ping still unanswered is replaced.
+        '''
+        now = time.perf_counter()
+        for key,peer in list(self.connector.peers.items()):
+            nonce = os.urandom(8)
+            self.pings[key] = (nonce,now)
+            peer.sendMessage('ping',nonce)
+
+    def ranking(self):
+        '''
+        Description:
+            The connected peers from fastest to slowest.
+        Returns:
+            ranking - List of ((ip,port), score, PeerStats), lowest score first
+        '''
+        ranking = [(key,self.stats[key].score(self.minInvSamples),self.stats[key]) for key in self.connector.peers if key in self.stats]
+        ranking.sort(key=lambda entry: entry[1])
+        return ranking
+
+    async def rotate(self):
+        '''
+        Description:
+            Drops the slowest peer if it has been measured long enough and is slower than the median, then tops the connections back up to targetPeers.
+        Returns:
+            dropped - The (ip,port) of the peer dropped, None if none was
+        '''
+        dropped = None
+        ranking = self.ranking()
+        # Only drop a peer when there is a candidate to race in its place
+        await self.refill()
+        if self.candidates and len(ranking) >= 3:
+            key,score,stats = ranking[-1]
+            median = ranking[len(ranking)//2][1]
+            if stats.invCount >= self.minInvSamples and score > median:
+                dropped = key
+                # Not raced again for retryInterval seconds
+                self.tried[key] = time.monotonic()
+                self.tried.move_to_end(key)
+                peer = self.connector.peers[key]
+                peer.close()
+                # The peer leaves connector.peers once the connection is lost, wait for that so topUp sees the free slot
+                await asyncio.wait([peer.closed],timeout=5)
+                print(f'Dropped slowest peer {key[0]}:{key[1]}, score {score*1000:.1f} ms against a median of {median*1000:.1f} ms')
+        await self.topUp()
+        return dropped
+
+    def addCandidates(self,addresses):
+        '''
+        Description:
+            Adds addresses to the candidates, leaving out the peers already connected and the addresses raced in the last retryInterval seconds.
+        Inputs:
+            addresses - List of ip addresses or (ip,port) tuples
+        '''
+        retryAfter = time.monotonic() - self.retryInterval
+        for address in addresses:
+            address = address if isinstance(address,tuple) else (address,self.connector.peerPort)
+            if address not in self.connector.peers and self.tried.get(address,retryAfter) <= retryAfter:
+                self.candidates[address] = None
+
+    def addLearned(self,addresses):
+        '''
+        Description:
+            Takes the addresses a peer sent in an addr or addrv2 message. With an address book they are added to it and refill takes the best of it,
+            without one they are added straight to the candidates until there are maxCandidates.
+        Inputs:
+            addresses - List of (timestamp, services, 16 byte address, port) from parseAddrPayload or parseAddrV2Payload
+        '''
+        if self.addressBook is not None:
+            self.addressBook.addMany(addresses)
+            return
+        room = self.maxCandidates - len(self.candidates)
+        if room > 0:
+            self.addCandidates([(unpackIP(packed),port) for timestamp,services,packed,port in addresses
+                                if port and (self.allowPrivate or isRoutable(packed))][:room])
+
+    async def refill(self):
+        '''
+        Description:
+            Refills the candidates when fewer are left than one race needs. The best addresses in the address book which have not been raced lately come first,
+            then the seeds are resolved again if they have not been for seedInterval seconds.
+        '''
+        wanted = self.raceFactor*self.targetPeers
+        if len(self.candidates) >= wanted:
+            return
+        now = time.monotonic()
+        # Forget the addresses raced long enough ago to be tried again
+        while self.tried and next(iter(self.tried.values())) <= now - self.retryInterval:
+            self.tried.popitem(last=False)
+        if self.addressBook is not None:
+            exclude = set(self.connector.peers) | set(self.candidates) | set(self.tried)
+            self.addCandidates(self.addressBook.best(4*wanted,exclude))
+        if len(self.candidates) < wanted and self.useSeeds and (self.lastResolved is None or now - self.lastResolved >= self.seedInterval):
+            self.lastResolved = now
+            self.addCandidates(await resolveSeeds(self.seeds,self.connector.peerPort))
+
+    async def topUp(self):
+        '''
+        Description:
+            Races fresh candidates until targetPeers are connected or no more candidates can be found.
+        '''
+        # Forget the measurements of peers which have gone
+        for key in list(self.stats):
+            if key not in self.connector.peers:
+                del self.stats[key]
+                self.pings.pop(key,None)
+        while len(self.connector.peers) < self.targetPeers:
+            await self.refill()
+            if not self.candidates:
+                break
+            await self.connectRace(self.targetPeers - len(self.connector.peers))
+
+    def display(self):
+        '''
+        Description:
+            Prints the connected peers from fastest to slowest.
+        '''
+        print(f'{"peer":<48}{"score ms":>10}{"rtt ms":>10}{"inv delay ms":>14}{"invs":>8}{"first":>8}')
+        for (ip,port),score,stats in self.ranking():
+            rtt = f'{stats.rtt*1000:.1f}' if stats.rtt is not None else '-'
+            print(f'{ip+":"+str(port):<48}{score*1000:>10.1f}{rtt:>10}{stats.invDelay*1000:>14.1f}{stats.invCount:>8}{stats.firstCount:>8}')
+
+    async def run(self,addresses=None,duration=None,display=True):
+        '''
+        Description:
+            Resolves the seeds, or takes the best addresses from the address book, races the first connections and then keeps measuring and rotating the peers.
+            The connector handles the messages as usual, e.g. asyncio.run(selector.run())
+        Inputs:
+            addresses - List of ip addresses, or (ip,port) tuples, to use as candidates instead of resolving the seeds
+            duration  - Seconds to run for, None to run until cancelled
+            display   - Boolean, set true to print the ranking after each rotation
+        '''
+        if addresses is not None:
+            self.useSeeds = False
+        elif self.addressBook is not None and len(self.addressBook):
+            addresses = self.addressBook.best(4*self.raceFactor*self.targetPeers)
+            print(f'Using {len(addresses)} addresses from the address book, {len(self.addressBook)} known')
+        else:
+            self.lastResolved = time.monotonic()
+            addresses = await resolveSeeds(self.seeds,self.connector.peerPort)
+        self.addCandidates(addresses)
+        await self.topUp()
+        timeoutTask = asyncio.create_task(self.connector.checkRequests())
+        end = time.monotonic() + duration if duration is not None else float('inf')
+        nextRotate = time.monotonic() + self.rotateInterval
+        try:
+            while time.monotonic() < end:
+                self.sendPings()
+                await asyncio.sleep(max(0,min(self.pingInterval,end-time.monotonic())))
+                if time.monotonic() >= nextRotate:
+                    nextRotate += self.rotateInterval
+                    await self.rotate()
+                    if display:
+                        self.display()
+                elif len(self.connector.peers) < self.targetPeers:
+                    await self.topUp()
+        finally:
+            timeoutTask.cancel()
+
+async def selectFastestPeers(count=1,sampleTime=30,addresses=None,**selectorArgs):
+    '''
+    Description:
+        Connects to many peers, measures them for sampleTime seconds and returns the fastest. Used by main.py to pick the peer for the single connection.
+    Inputs:
+        count        - The number of addresses to return
+        sampleTime   - Seconds to measure the peers for
+        addresses    - List of (ip,port) candidates to use instead of resolving the seeds
+        selectorArgs - Passed on to PeerSelector, e.g. targetPeers
+    Returns:
+        addresses - List of (ip,port) of the fastest peers, fastest first
+    '''
+    connector = AsyncBitcoinConnector()
+    selector  = PeerSelector(connector,**selectorArgs)
+    try:
+        await selector.run(addresses,duration=sampleTime,display=False)
+        return [key for key,score,stats in selector.ranking()[:count]]
+    finally:
+        connector.close()
@@ -0,0 +1,695 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the classes BloomFilter, WatchList and ScriptWatcher and the functions which classify output scripts and encode and decode addresses
+#   The pk_script of an output is recognised by its length and a few fixed bytes, see https://en.bitcoin.it/wiki/Script and https://github.com/bitcoin/bips/blob/master/bip-0141.mediawiki
+#       P2PKH     - OP_DUP OP_HASH160 <20> OP_EQUALVERIFY OP_CHECKSIG       25 bytes, program is the public key hash
+#       P2SH      - OP_HASH160 <20> OP_EQUAL                                23 bytes, program is the script hash
+#       P2WPKH    - OP_0 <20>                                               22 bytes, program is the public key hash
+#       P2WSH     - OP_0 <32>                                               34 bytes, program is the SHA256 script hash
+#       P2TR      - OP_1 <32>                                               34 bytes, program is the taproot output key (BIP341)
+#       P2PK      - <33 or 65> OP_CHECKSIG                                  program is the public key
+#       MULTISIG  - OP_m <keys> OP_n OP_CHECKMULTISIG                       program is the whole script, see multisigKeys
+#       OP_RETURN - OP_RETURN <data>                                        program is everything after the OP_RETURN
+#   The program is a slice of the script, when the script is a memoryview of the payload nothing is copied.
+#   A WatchList holds the programs (hashes, keys) to look for, given as addresses or hex. A ScriptWatcher checks the outputs of every tx and block against it
+#   and calls back with the matching outputs. The lookup is a set of bytes, a few hundred nanoseconds per output.
+#   For watch-lists of many millions the set costs about 90 bytes per entry, in compact mode the entries are packed into sorted tables (the size of the program per entry, plus about 1 byte of Bloom filter)
+#   behind a Bloom filter so most outputs are rejected without a search. The programs are already hashes so the Bloom filter bits are taken straight from them.
+
+
+## Imports ##
+# time     - https://docs.python.org/3/library/time.html
+# math     - https://docs.python.org/3/library/math.html
+# hashlib  - https://docs.python.org/3/library/hashlib.html
+# bisect   - https://docs.python.org/3/library/bisect.html
+import time
+import math
+import hashlib
+from bisect import bisect_left
+
+# Script types returned by classifyScript
+P2PKH       = 'p2pkh'
+P2SH        = 'p2sh'
+P2WPKH      = 'p2wpkh'
+P2WSH       = 'p2wsh'
+P2TR        = 'p2tr'
+P2PK        = 'p2pk'
+MULTISIG    = 'multisig'
+OP_RETURN   = 'op_return'
+WITNESS     = 'witness_unknown'
+NONSTANDARD = 'nonstandard'
+
+# Opcodes used to recognise the scripts
+OP_0, OP_1, OP_16      = 0x00, 0x51, 0x60
+OP_DUP, OP_HASH160     = 0x76, 0xa9
+OP_EQUAL, OP_EQUALVERIFY = 0x87, 0x88
+OP_CHECKSIG, OP_CHECKMULTISIG = 0xac, 0xae
+OP_RETURN_CODE         = 0x6a
+
+# NETWORKS - The base58 version bytes and the bech32 human readable part of each network
+NETWORKS = {
+    'main'   :{'pubkeyhash':0x00,'scripthash':0x05,'hrp':'bc'},
+    'test'   :{'pubkeyhash':0x6f,'scripthash':0xc4,'hrp':'tb'},
+    'regtest':{'pubkeyhash':0x6f,'scripthash':0xc4,'hrp':'bcrt'},
+}
+BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+BASE58_INDEX    = {c:i for i,c in enumerate(BASE58_ALPHABET)}
+BECH32_ALPHABET = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+BECH32_INDEX    = {c:i for i,c in enumerate(BECH32_ALPHABET)}
+# BECH32_CONST, BECH32M_CONST - The checksum constants of BIP173 (witness version 0) and BIP350 (witness version 1 and up)
+BECH32_CONST  = 1
+BECH32M_CONST = 0x2bc830a3
+# HEX_LENGTHS - The lengths of a program written as hex, a hash160, a SHA256 hash or witness program, and a compressed or uncompressed public key
+HEX_LENGTHS = frozenset((40,64,66,130))
+
+def classifyScript(script):
+    '''
+    Description:
+        Works out the type of an output script and slices out its program (the hash, witness program or key) without copying.
+        The checks are ordered by how common the scripts are, most outputs are decided by their length and two bytes.
+    Inputs:
+        script - memoryview or byte string of the pk_script
+    Returns:
+        scriptType - One of the script type strings e.g. P2WPKH
+        program    - Slice of script holding the program, None for NONSTANDARD
+    '''
+    length = len(script)
+    if length == 22:
+        if script[0] == OP_0 and script[1] == 20:
+            return P2WPKH,script[2:22]
+    elif length == 34:
+        if script[1] == 32:
+            if script[0] == OP_1:
+                return P2TR,script[2:34]
+            if script[0] == OP_0:
+                return P2WSH,script[2:34]
+    elif length == 25:
+        if script[0] == OP_DUP and script[1] == OP_HASH160 and script[2] == 20 and script[23] == OP_EQUALVERIFY and script[24] == OP_CHECKSIG:
+            return P2PKH,script[3:23]
+    elif length == 23:
+        if script[0] == OP_HASH160 and script[1] == 20 and script[22] == OP_EQUAL:
+            return P2SH,script[2:22]
+    if length == 0:
+        return NONSTANDARD,None
+    first = script[0]
+    if first == OP_RETURN_CODE:
+        return OP_RETURN,script[1:]
+    # Other witness versions, OP_1 to OP_16 then a single push of 2 to 40 bytes (BIP141)
+    if (first == OP_0 or OP_1 <= first <= OP_16) and 4 <= length <= 42 and script[1] == length - 2:
+        return WITNESS,script[2:]
+    if (length == 35 or length == 67) and first == length - 2 and script[-1] == OP_CHECKSIG:
+        return P2PK,script[1:-1]
+    if script[-1] == OP_CHECKMULTISIG and multisigKeys(script) is not None:
+        return MULTISIG,script
+    return NONSTANDARD,None
+
+def multisigKeys(script):
+    '''
+    Description:
+        Reads the public keys of a bare multisig script, OP_m <key 1> ... <key n> OP_n OP_CHECKMULTISIG
+    Inputs:
+        script - memoryview or byte string of the pk_script
+    Returns:
+        required - m, the number of signatures required
+        keys     - List of slices of script, one per public key
+        None if the script is not a multisig script
+    '''
+    length = len(script)
+    if length < 37 or script[-1] != OP_CHECKMULTISIG or not OP_1 <= script[0] <= OP_16 or not OP_1 <= script[-2] <= OP_16:
+        return None
+    required,count = script[0] - 0x50,script[-2] - 0x50
+    keys   = []
+    offset = 1
+    while offset < length - 2:
+        size = script[offset]
+        if size != 33 and size != 65:
+            return None
+        keys.append(script[offset+1:offset+1+size])
+        offset += 1 + size
+    if offset != length - 2 or len(keys) != count or required > count:
+        return None
+    return required,keys
+
+def createScript(scriptType,program):
+    '''
+    Description:
+        Builds the output script for a program, the reverse of classifyScript for the address types.
+    Inputs:
+        scriptType - P2PKH, P2SH, P2WPKH, P2WSH, P2TR or P2PK
+        program    - Byte string of the program
+    Returns:
+        script - Byte string of the pk_script
+    Raises:
+        ValueError - If the type is not one of the above or the program is the wrong length for it
+    '''
+    program = bytes(program)
+    lengths = {P2PKH:(20,),P2SH:(20,),P2WPKH:(20,),P2WSH:(32,),P2TR:(32,),P2PK:(33,65)}
+    if scriptType not in lengths or len(program) not in lengths[scriptType]:
+        raise ValueError(f'can not create a {scriptType} script for a {len(program)} byte program')
+    if scriptType == P2PKH:
+        return bytes((OP_DUP,OP_HASH160,20)) + program + bytes((OP_EQUALVERIFY,OP_CHECKSIG))
+    if scriptType == P2SH:
+        return bytes((OP_HASH160,20)) + program + bytes((OP_EQUAL,))
+    if scriptType == P2PK:
+        return bytes((len(program),)) + program + bytes((OP_CHECKSIG,))
+    return bytes((OP_1 if scriptType == P2TR else OP_0,len(program))) + program
+
+def base58CheckEncode(version,data):
+    '''
+    Description:
+        Encodes a version byte and data as base58 with a 4 byte double SHA256 checksum, see https://en.bitcoin.it/wiki/Base58Check_encoding
+    Inputs:
+        version - The version byte e.g. 0x00 for a mainnet P2PKH address
+        data    - Byte string of the data
+    Returns:
+        encoded - String
+    '''
+    raw      = bytes((version,)) + bytes(data)
+    raw     += hashlib.sha256(hashlib.sha256(raw).digest()).digest()[:4]
+    value    = int.from_bytes(raw,'big')
+    encoded  = ''
+    while value:
+        value,digit = divmod(value,58)
+        encoded = BASE58_ALPHABET[digit] + encoded
+    # Each leading zero byte is a leading 1
+    return '1'*(len(raw) - len(raw.lstrip(b'\0'))) + encoded
+
+def base58CheckDecode(encoded):
+    '''
+    Description:
+        Decodes a base58check string, the reverse of base58CheckEncode.
+    Inputs:
+        encoded - String
+    Returns:
+        version - The version byte
+        data    - Byte string of the data
+    Raises:
+        ValueError - If the string has a character outside the alphabet or the checksum does not match
+    '''
+    value = 0
+    for c in encoded:
+        if c not in BASE58_INDEX:
+            raise ValueError(f'invalid base58 character {c!r}')
+        value = value*58 + BASE58_INDEX[c]
+    raw = value.to_bytes((value.bit_length() + 7)//8,'big')
+    raw = b'\0'*(len(encoded) - len(encoded.lstrip('1'))) + raw
+    if len(raw) < 5 or hashlib.sha256(hashlib.sha256(raw[:-4]).digest()).digest()[:4] != raw[-4:]:
+        raise ValueError('base58 checksum does not match')
+    return raw[0],raw[1:-4]
+
+def bech32Polymod(values):
+    '''
+    Description:
+        The BCH checksum of BIP173, see https://github.com/bitcoin/bips/blob/master/bip-0173.mediawiki
+    Inputs:
+        values - List of 5 bit integers
+    Returns:
+        checksum - Integer
+    '''
+    generator = (0x3b6a57b2,0x26508e6d,0x1ea119fa,0x3d4233dd,0x2a1462b3)
+    checksum = 1
+    for value in values:
+        top = checksum >> 25
+        checksum = (checksum & 0x1ffffff) << 5 ^ value
+        for i in range(5):
+            if (top >> i) & 1:
+                checksum ^= generator[i]
+    return checksum
+
+def bech32HrpExpand(hrp):
+    # The human readable part as it goes into the checksum, the high bits of each character, a zero, then the low bits
+    return [ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp]
+
+def convertBits(data,fromBits,toBits,pad=True):
+    '''
+    Description:
+        Regroups a sequence of integers of fromBits bits into integers of toBits bits, used to go between bytes and the 5 bit bech32 characters.
+    Inputs:
+        data     - Iterable of integers
+        fromBits - The size of each input integer in bits
+        toBits   - The size of each output integer in bits
+        pad      - Boolean, True to pad the last output with zeros, False to reject leftover bits
+    Returns:
+        values - List of integers, None if the leftover bits are not allowed
+    '''
+    accumulator,bits,values = 0,0,[]
+    maxValue = (1 << toBits) - 1
+    for value in data:
+        if value >> fromBits:
+            return None
+        accumulator = (accumulator << fromBits) | value
+        bits += fromBits
+        while bits >= toBits:
+            bits -= toBits
+            values.append((accumulator >> bits) & maxValue)
+    if pad:
+        if bits:
+            values.append((accumulator << (toBits - bits)) & maxValue)
+    elif bits >= fromBits or ((accumulator << (toBits - bits)) & maxValue):
+        return None
+    return values
+
+def segwitEncode(hrp,version,program):
+    '''
+    Description:
+        Encodes a witness program as a bech32 (version 0) or bech32m (version 1 and up) address, see BIP173 and BIP350.
+    Inputs:
+        hrp     - The human readable part e.g. 'bc'
+        version - The witness version 0-16
+        program - Byte string of the witness program
+    Returns:
+        address - String
+    '''
+    data     = [version] + convertBits(bytes(program),8,5)
+    constant = BECH32_CONST if version == 0 else BECH32M_CONST
+    polymod  = bech32Polymod(bech32HrpExpand(hrp) + data + [0]*6) ^ constant
+    checksum = [(polymod >> 5*(5 - i)) & 31 for i in range(6)]
+    return hrp + '1' + ''.join(BECH32_ALPHABET[d] for d in data + checksum)
+
+def segwitDecode(address):
+    '''
+    Description:
+        Decodes a bech32 or bech32m address, the reverse of segwitEncode.
+    Inputs:
+        address - String
+    Returns:
+        hrp     - The human readable part
+        version - The witness version
+        program - Byte string of the witness program
+    Raises:
+        ValueError - If the address is not a valid segwit address
+    '''
+    if address.lower() != address and address.upper() != address:
+        raise ValueError('bech32 address has mixed case')
+    address = address.lower()
+    separator = address.rfind('1')
+    if separator < 1 or separator + 7 > len(address) or len(address) > 90:
+        raise ValueError('bech32 address has no valid separator')
+    hrp = address[:separator]
+    try:
+        data = [BECH32_INDEX[c] for c in address[separator+1:]]
+    except KeyError as e:
+        raise ValueError(f'invalid bech32 character {e}') from None
+    if not data or data[0] > 16:
+        raise ValueError('invalid witness version')
+    version  = data[0]
+    constant = BECH32_CONST if version == 0 else BECH32M_CONST
+    if bech32Polymod(bech32HrpExpand(hrp) + data) != constant:
+        raise ValueError('bech32 checksum does not match')
+    program = convertBits(data[1:-6],5,8,pad=False)
+    if program is None or not 2 <= len(program) <= 40 or (version == 0 and len(program) not in (20,32)):
+        raise ValueError('invalid witness program')
+    return hrp,version,bytes(program)
+
+def encodeAddress(scriptType,program,network='main'):
+    '''
+    Description:
+        Encodes the program of an output as an address.
+    Inputs:
+        scriptType - The type from classifyScript
+        program    - The program from classifyScript
+        network    - 'main', 'test' or 'regtest'
+    Returns:
+        address - String, None for the types which have no address (P2PK, MULTISIG, OP_RETURN, NONSTANDARD)
+    '''
+    params = NETWORKS[network]
+    if scriptType == P2PKH:
+        return base58CheckEncode(params['pubkeyhash'],program)
+    if scriptType == P2SH:
+        return base58CheckEncode(params['scripthash'],program)
+    if scriptType == P2WPKH or scriptType == P2WSH:
+        return segwitEncode(params['hrp'],0,program)
+    if scriptType == P2TR:
+        return segwitEncode(params['hrp'],1,program)
+    return None
+
+def decodeAddress(address):
+    '''
+    Description:
+        Decodes an address of any network into its script type and program.
+    Inputs:
+        address - String, a base58 (P2PKH, P2SH) or bech32/bech32m (P2WPKH, P2WSH, P2TR) address
+    Returns:
+        scriptType - The script type
+        program    - Byte string of the program
+        network    - The network the address is for
+    Raises:
+        ValueError - If the address is not valid
+    '''
+    lower = address.lower()
+    for network,params in NETWORKS.items():
+        if lower.startswith(params['hrp'] + '1'):
+            hrp,version,program = segwitDecode(address)
+            if hrp != params['hrp']:
+                continue
+            if version == 0:
+                return (P2WPKH if len(program) == 20 else P2WSH),program,network
+            if version == 1 and len(program) == 32:
+                return P2TR,program,network
+            return WITNESS,program,network
+    version,data = base58CheckDecode(address)
+    if len(data) != 20:
+        raise ValueError(f'base58 address holds {len(data)} bytes, expected 20')
+    for network,params in NETWORKS.items():
+        if version == params['pubkeyhash']:
+            return P2PKH,data,network
+        if version == params['scripthash']:
+            return P2SH,data,network
+    raise ValueError(f'unknown base58 address version {version}')
+
+class BloomFilter:
+    def __init__(self,expected,falsePositiveRate=0.01):
+        '''
+        Description:
+            initiliaser method for the class. A Bloom filter for keys which are already hashes, e.g. the hash160, SHA256 or public keys of output scripts.
+            The bit positions are taken from the last 16 bytes of the key with double hashing, the key is not hashed again.
+            It is not the BIP37 filter, that one hashes each item with MurmurHash3 as items such as outpoints are not uniformly distributed.
+        Inputs:
+            expected          - The number of keys the filter is sized for
+            falsePositiveRate - The false positive rate at that number of keys
+        '''
+        expected = max(expected,1)
+        # Optimal size and number of bit positions, see https://en.wikipedia.org/wiki/Bloom_filter#Optimal_number_of_hash_functions
+        self.size   = max(64,int(-expected*math.log(falsePositiveRate)/math.log(2)**2))
+        self.hashes = max(1,round(self.size/expected*math.log(2)))
+        self.bits   = bytearray((self.size + 7)//8)
+        self.count  = 0
+
+    def positions(self,key):
+        '''
+        Description:
+            Works out the bit positions of a key.
+        Inputs:
+            key - Byte string or memoryview of at least 16 bytes
+        Returns:
+            positions - Generator of bit indexes
+        '''
+        value = int.from_bytes(key[-16:],'little')
+        first,second,size = value & 0xffffffffffffffff,(value >> 64) | 1,self.size
+        return ((first + i*second) % size for i in range(self.hashes))
+
+    def add(self,key):
+        bits = self.bits
+        for position in self.positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def addMany(self,keys):
+        '''
+        Description:
+            Adds many keys, the same as add with the loop written inline as it is run for every key of a watch-list.
+        Inputs:
+            keys - Iterable of byte strings
+        '''
+        bits,size,hashes = self.bits,self.size,self.hashes
+        count = 0
+        for key in keys:
+            value = int.from_bytes(key[-16:],'little')
+            position,step = (value & 0xffffffffffffffff) % size,((value >> 64) | 1) % size
+            for i in range(hashes):
+                bits[position >> 3] |= 1 << (position & 7)
+                position += step
+                if position >= size:
+                    position -= size
+            count += 1
+        self.count += count
+
+    def __contains__(self,key):
+        # The positions are stepped through inline, most keys are rejected on the first or second bit
+        bits,size = self.bits,self.size
+        value = int.from_bytes(key[-16:],'little')
+        position,step = (value & 0xffffffffffffffff) % size,((value >> 64) | 1) % size
+        for i in range(self.hashes):
+            if not bits[position >> 3] >> (position & 7) & 1:
+                return False
+            position += step
+            if position >= size:
+                position -= size
+        return True
+
+class SortedTable:
+    # __slots__ - One per program length, just a byte string and its record size
+    __slots__ = ('data','width')
+
+    def __init__(self,data,width):
+        '''
+        Description:
+            initiliaser method for the class, a sorted byte string of fixed size records which bisect can search as a sequence
+        Inputs:
+            data  - Byte string of the sorted records joined together
+            width - The size of each record in bytes
+        '''
+        self.data  = data
+        self.width = width
+
+    def __len__(self):
+        return len(self.data)//self.width
+
+    def __getitem__(self,i):
+        width = self.width
+        return self.data[i*width:(i+1)*width]
+
+    def __contains__(self,key):
+        i = bisect_left(self,key)
+        return i < len(self) and self[i] == key
+
+class WatchList:
+    def __init__(self,compact=False,falsePositiveRate=0.01):
+        '''
+        Description:
+            initiliaser method for the class, the programs (public key hashes, script hashes, witness programs and public keys) to watch for.
+            Programs are matched on their bytes alone, a P2PKH and a P2WPKH address of the same public key both match either output.
+        Inputs:
+            compact           - Boolean, False to keep the programs in a set, True to pack them into sorted tables behind a Bloom filter when compact is called.
+                                The set is the fastest lookup, the tables use about a quarter of the memory (22 bytes per hash160) for watch-lists of many millions
+            falsePositiveRate - The Bloom filter false positive rate in compact mode
+        '''
+        self.compactMode       = compact
+        self.falsePositiveRate = falsePositiveRate
+        # keys   - Set of program byte strings, in compact mode the programs added since compact was last called
+        # tables - Dictionary of program length -> SortedTable, compact mode only
+        # bloom  - BloomFilter over every program, compact mode only
+        # labels - Dictionary of program -> label for the programs added with a label
+        self.keys   = set()
+        self.tables = {}
+        self.bloom  = None
+        self.labels = {}
+
+    def add(self,key,label=None):
+        '''
+        Description:
+            Adds a program to watch for.
+        Inputs:
+            key   - An address string, or the program as a byte string or hex string (the hash160, SHA256 script hash, witness program or public key)
+            label - Optional label passed back with each match, e.g. the address or an account name
+        Returns:
+            program - Byte string of the program added
+        Raises:
+            ValueError - If the address or hex is not valid or the program is shorter than 16 bytes
+        '''
+        if isinstance(key,str):
+            # Hex is only tried for the lengths of a program so an address is never read as hex
+            program = None
+            if len(key) in HEX_LENGTHS:
+                try:
+                    program = bytes.fromhex(key)
+                except ValueError:
+                    pass
+            if program is None:
+                scriptType,program,network = decodeAddress(key)
+        else:
+            program = bytes(key)
+        if len(program) < 16:
+            raise ValueError(f'program of {len(program)} bytes is too short to watch')
+        if program not in self:
+            self.keys.add(program)
+            if self.bloom is not None:
+                self.bloom.add(program)
+        if label is not None:
+            self.labels[program] = label
+        return program
+
+    def addMany(self,keys):
+        '''
+        Description:
+            Adds many programs, then packs them if in compact mode.
+        Inputs:
+            keys - Iterable of keys or (key, label) tuples, see add
+        '''
+        for key in keys:
+            if isinstance(key,tuple):
+                self.add(*key)
+            else:
+                self.add(key)
+        if self.compactMode:
+            self.compact()
+
+    def addScript(self,script,label=None):
+        '''
+        Description:
+            Adds the program of an output script, e.g. taken from a wallet.
+        Inputs:
+            script - Byte string of the pk_script
+            label  - Optional label, see add
+        Raises:
+            ValueError - If the script has no program which can be watched
+        '''
+        scriptType,program = classifyScript(script)
+        if program is None or scriptType == OP_RETURN or scriptType == MULTISIG:
+            raise ValueError(f'can not watch a {scriptType} script')
+        return self.add(bytes(program),label)
+
+    def compact(self):
+        '''
+        Description:
+            Packs the programs in the set into the sorted tables and rebuilds the Bloom filter, compact mode only.
+            Called by addMany and load, programs added one at a time afterwards stay in the set until it is called again.
+        '''
+        if not self.compactMode:
+            return
+        byWidth = {}
+        for width,table in self.tables.items():
+            byWidth[width] = [table[i] for i in range(len(table))]
+        for program in self.keys:
+            byWidth.setdefault(len(program),[]).append(program)
+        self.keys   = set()
+        self.bloom  = BloomFilter(sum(len(programs) for programs in byWidth.values()),self.falsePositiveRate)
+        for programs in byWidth.values():
+            self.bloom.addMany(programs)
+        self.tables = {width:SortedTable(b''.join(sorted(programs)),width) for width,programs in byWidth.items()}
+
+    def __len__(self):
+        return len(self.keys) + sum(len(table) for table in self.tables.values())
+
+    def __contains__(self,program):
+        '''
+        Description:
+            Checks if a program is watched.
+        Inputs:
+            program - Byte string or memoryview of the program
+        Returns:
+            watched - Boolean
+        '''
+        if self.bloom is None:
+            return bytes(program) in self.keys
+        if program not in self.bloom:
+            return False
+        program = bytes(program)
+        if program in self.keys:
+            return True
+        table = self.tables.get(len(program))
+        return table is not None and program in table
+
+    @classmethod
+    def load(cls,path,compact=False,falsePositiveRate=0.01):
+        '''
+        Description:
+            Loads a watch-list from a text file with one address or hex program per line, optionally followed by a label after a space or comma.
+            Blank lines and lines starting with # are skipped.
+        Inputs:
+            path    - The path to the file
+            compact - Boolean, see the class initiliaser
+        Returns:
+            watchList - WatchList instance
+        Raises:
+            ValueError - If a line is not a valid address or program, the line number is in the message
+        '''
+        watchList = cls(compact=compact,falsePositiveRate=falsePositiveRate)
+        with open(path,'r') as file:
+            for number,line in enumerate(file,1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                parts = line.replace(',',' ').split(None,1)
+                try:
+                    watchList.add(parts[0],parts[1] if len(parts) > 1 else None)
+                except ValueError as e:
+                    raise ValueError(f'{path} line {number}: {e}') from None
+        watchList.compact()
+        return watchList
+
+class ScriptWatcher:
+    def __init__(self,watchList,callback=None,network='main'):
+        '''
+        Description:
+            initiliaser method for the class. Checks the outputs of transactions and blocks against a watch-list, set as the watcher of a connector
+            it is called for every parsed tx and block.
+        Inputs:
+            watchList - WatchList instance
+            callback  - Function called as callback(transaction, matches, block) when a transaction has matching outputs, block is None for a tx message.
+                        matches is a list of (output index, script type, program, label) tuples. The transaction is only valid during the call.
+                        None to print each match, see printMatches
+            network   - The network used to display the addresses of matches
+        '''
+        self.watchList = watchList
+        self.callback  = callback if callback is not None else self.printMatches
+        self.network   = network
+        # stats - Transactions and outputs checked, transactions which matched, and the total seconds spent checking
+        self.stats = {'transactions':0,'outputs':0,'matches':0,'seconds':0.0}
+
+    def checkTransaction(self,transaction,block=None):
+        '''
+        Description:
+            Classifies each output script of a transaction and looks up its program in the watch-list, calling the callback if any match.
+            The scripts are read straight from the output offsets of the transaction, no TxOut objects are created.
+        Inputs:
+            transaction - Transaction instance
+            block       - The Block the transaction is in, None for a tx message
+        Returns:
+            matches - List of (output index, script type, program, label) tuples, empty if none match
+        '''
+        start   = time.perf_counter()
+        watched = self.watchList
+        payload = transaction.payload
+        offsets = transaction.outputOffsets
+        matches = []
+        for i in range(0,len(offsets),3):
+            script = payload[offsets[i+1]:offsets[i+2]]
+            scriptType,program = classifyScript(script)
+            if program is None or scriptType == OP_RETURN:
+                continue
+            if scriptType == MULTISIG:
+                # A bare multisig output matches on any of its public keys
+                for key in multisigKeys(script)[1]:
+                    if key in watched:
+                        key = bytes(key)
+                        matches.append((i//3,scriptType,key,watched.labels.get(key)))
+            elif program in watched:
+                program = bytes(program)
+                matches.append((i//3,scriptType,program,watched.labels.get(program)))
+        stats = self.stats
+        stats['transactions'] += 1
+        stats['outputs']      += len(offsets)//3
+        if matches:
+            stats['matches'] += 1
+            self.callback(transaction,matches,block)
+        stats['seconds'] += time.perf_counter() - start
+        return matches
+
+    def checkBlock(self,block):
+        '''
+        Description:
+            Checks every transaction of a block, see checkTransaction.
+        Inputs:
+            block - Block instance
+        Returns:
+            matched - The number of transactions with matching outputs
+        '''
+        matched = 0
+        for transaction in block.transactions():
+            if self.checkTransaction(transaction,block):
+                matched += 1
+        return matched
+
+    def printMatches(self,transaction,matches,block):
+        '''
+        Description:
+            The default callback, prints a line for each matching output.
+        '''
+        where = f'in block {block.header.hash[::-1].hex()}' if block is not None else 'in tx message'
+        for index,scriptType,program,label in matches:
+            address = encodeAddress(scriptType,program,self.network) or program.hex()
+            print(f'Watch-list match {where}: {transaction.txid[::-1].hex()}:{index} {scriptType} {address} {transaction.output(index).value} Satoshis'
+                  + (f' ({label})' if label is not None else ''))
@@ -0,0 +1,107 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the SipHash-2-4 functions, see https://www.aumasson.jp/siphash/siphash.pdf
+#   SipHash is a keyed 64 bit hash. BIP152 uses it for the 6 byte short transaction IDs of compact blocks, keyed from the block header so they can not be attacked in advance.
+#   siphash is the general function for any length of data. siphash256 is the same hash specialised for a 32 byte input (a txid or wtxid),
+#   it reads the 4 words with one struct call and has the rounds written inline, saving a function call per round.
+
+
+## Imports ##
+# struct - https://docs.python.org/3/library/struct.html
+import struct
+
+# MASK - SipHash works on 64 bit words, Python integers are unbounded so every addition and shift is masked
+MASK = 0xffffffffffffffff
+# WORDS4 - A 32 byte hash read as 4 little endian 64 bit words
+WORDS4 = struct.Struct('<4Q')
+
+def sipRound(v0,v1,v2,v3):
+    '''
+    Description:
+        One SipRound, the add-rotate-xor mixing of the 4 state words.
+    Inputs:
+        v0,v1,v2,v3 - The state words
+    Returns:
+        v0,v1,v2,v3 - The mixed state words
+    '''
+    v0 = (v0 + v1) & MASK
+    v1 = ((v1 << 13) | (v1 >> 51)) & MASK
+    v1 ^= v0
+    v0 = ((v0 << 32) | (v0 >> 32)) & MASK
+    v2 = (v2 + v3) & MASK
+    v3 = ((v3 << 16) | (v3 >> 48)) & MASK
+    v3 ^= v2
+    v0 = (v0 + v3) & MASK
+    v3 = ((v3 << 21) | (v3 >> 43)) & MASK
+    v3 ^= v0
+    v2 = (v2 + v1) & MASK
+    v1 = ((v1 << 17) | (v1 >> 47)) & MASK
+    v1 ^= v2
+    v2 = ((v2 << 32) | (v2 >> 32)) & MASK
+    return v0,v1,v2,v3
+
+def siphash(k0,k1,data):
+    '''
+    Description:
+        SipHash-2-4 of data, 2 rounds per 8 byte word and 4 rounds to finish.
+    Inputs:
+        k0,k1 - The 128 bit key as two 64 bit integers
+        data  - Byte string to hash
+    Returns:
+        hash - The 64 bit hash as an integer
+    '''
+    v0 = k0 ^ 0x736f6d6570736575
+    v1 = k1 ^ 0x646f72616e646f6d
+    v2 = k0 ^ 0x6c7967656e657261
+    v3 = k1 ^ 0x7465646279746573
+    length = len(data)
+    end    = length - length % 8
+    for (m,) in struct.iter_unpack('<Q',data[:end]):
+        v3 ^= m
+        v0,v1,v2,v3 = sipRound(v0,v1,v2,v3)
+        v0,v1,v2,v3 = sipRound(v0,v1,v2,v3)
+        v0 ^= m
+    # The last word holds the remaining bytes with the length in the top byte
+    m = int.from_bytes(data[end:],'little') | ((length & 0xff) << 56)
+    v3 ^= m
+    v0,v1,v2,v3 = sipRound(v0,v1,v2,v3)
+    v0,v1,v2,v3 = sipRound(v0,v1,v2,v3)
+    v0 ^= m
+    v2 ^= 0xff
+    for i in range(4):
+        v0,v1,v2,v3 = sipRound(v0,v1,v2,v3)
+    return v0 ^ v1 ^ v2 ^ v3
+
+def siphash256(k0,k1,data):
+    '''
+    Description:
+        SipHash-2-4 of a 32 byte input, gives the same result as siphash but is faster as the length is fixed.
+        Used for the short IDs of every mempool transaction when a compact block arrives, so it is on the block latency path.
+    Inputs:
+        k0,k1 - The 128 bit key as two 64 bit integers
+        data  - The 32 byte hash to hash
+    Returns:
+        hash - The 64 bit hash as an integer
+    '''
+    v0 = k0 ^ 0x736f6d6570736575
+    v1 = k1 ^ 0x646f72616e646f6d
+    v2 = k0 ^ 0x6c7967656e657261
+    v3 = k1 ^ 0x7465646279746573
+    # The 4 data words followed by the length word, 32 in the top byte
+    for m in (*WORDS4.unpack(data),32 << 56):
+        v3 ^= m
+        for i in (0,1):
+            v0 = (v0 + v1) & MASK; v1 = ((v1 << 13) | (v1 >> 51)) & MASK; v1 ^= v0; v0 = ((v0 << 32) | (v0 >> 32)) & MASK
+            v2 = (v2 + v3) & MASK; v3 = ((v3 << 16) | (v3 >> 48)) & MASK; v3 ^= v2
+            v0 = (v0 + v3) & MASK; v3 = ((v3 << 21) | (v3 >> 43)) & MASK; v3 ^= v0
+            v2 = (v2 + v1) & MASK; v1 = ((v1 << 17) | (v1 >> 47)) & MASK; v1 ^= v2; v2 = ((v2 << 32) | (v2 >> 32)) & MASK
+        v0 ^= m
+    v2 ^= 0xff
+    for i in (0,1,2,3):
+        v0 = (v0 + v1) & MASK; v1 = ((v1 << 13) | (v1 >> 51)) & MASK; v1 ^= v0; v0 = ((v0 << 32) | (v0 >> 32)) & MASK
+        v2 = (v2 + v3) & MASK; v3 = ((v3 << 16) | (v3 >> 48)) & MASK; v3 ^= v2
+        v0 = (v0 + v3) & MASK; v3 = ((v3 << 21) | (v3 >> 43)) & MASK; v3 ^= v0
+        v2 = (v2 + v1) & MASK; v1 = ((v1 << 17) | (v1 >> 47)) & MASK; v1 ^= v2; v2 = ((v2 << 32) | (v2 >> 32)) & MASK
+    return v0 ^ v1 ^ v2 ^ v3
@@ -0,0 +1,434 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   This file holds the classes Transaction, TxIn and TxOut and the functions readVarInt, createVarInt, hashSegments and computeTxids
+#   A Transaction parses a tx payload (see https://en.bitcoin.it/wiki/Protocol_documentation#tx) in a single pass but does not copy anything out of it.
+#   Instead of a dictionary per input and output it stores the offsets of each input and output in two flat arrays and keeps a memoryview of the payload.
+#   TxIn and TxOut are small slotted objects which are only created when an input or output is asked for, their fields are decoded when accessed.
+#   SegWit transactions (BIP144) are parsed including the marker, flag and witness fields.
+#   The txid and wtxid are hashed straight from byte ranges of the payload, the transaction is never re-serialized to strip the witness.
+
+
+## Imports ##
+# struct  - https://docs.python.org/3/library/struct.html
+# array   - https://docs.python.org/3/library/array.html
+# hashlib - https://docs.python.org/3/library/hashlib.html
+import struct
+import hashlib
+from array import array
+
+# Precompiled structs for the fixed size little endian integers used in transactions
+UINT16 = struct.Struct('<H')
+UINT32 = struct.Struct('<I')
+UINT64 = struct.Struct('<Q')
+INT32  = struct.Struct('<i')
+INT64  = struct.Struct('<q')
+
+def readVarInt(data,offset):
+    '''
+    Description:
+        Reads a variable length integer see https://en.bitcoin.it/wiki/Protocol_documentation#Variable_length_integer
+        The first byte is the value if it is below 0xfd, otherwise 0xfd, 0xfe and 0xff mean the value is in the next 2, 4 or 8 bytes.
+    Inputs:
+        data   - Byte string or memoryview containing the varint
+        offset - Index of the first byte of the varint in data
+    Returns:
+        value  - The integer value
+        offset - Index of the first byte after the varint
+    '''
+    first = data[offset]
+    if first < 0xfd:
+        return first,offset+1
+    if first == 0xfd:
+        return UINT16.unpack_from(data,offset+1)[0],offset+3
+    if first == 0xfe:
+        return UINT32.unpack_from(data,offset+1)[0],offset+5
+    return UINT64.unpack_from(data,offset+1)[0],offset+9
+
+def createVarInt(value):
+    '''
+    Description:
+        Encodes an integer as a variable length integer, the reverse of readVarInt.
+    Inputs:
+        value - Integer between 0 and 2**64-1
+    Returns:
+        varInt - Byte string of 1, 3, 5 or 9 bytes
+    '''
+    if value < 0xfd:
+        return bytes((value,))
+    if value <= 0xffff:
+        return b'\xfd' + UINT16.pack(value)
+    if value <= 0xffffffff:
+        return b'\xfe' + UINT32.pack(value)
+    return b'\xff' + UINT64.pack(value)
+
+def hashSegments(data,segments):
+    '''
+    Description:
+        The batched hashing path used for txids and wtxids. Computes SHA256(SHA256(x)) for many transactions in one call.
+        Each transaction is given as 3 byte ranges of data which are hashed one after the other, this is how the witness is left out of a txid without re-serializing.
+        For a txid of a SegWit transaction the ranges are the version, the inputs and outputs, and the lock_time. Unused ranges have start == end.
+    Inputs:
+        data     - Byte string or memoryview the ranges index into, e.g. a block payload
+        segments - Flat sequence with 6 offsets per transaction (start1,end1,start2,end2,start3,end3), see Transaction.txidSegments
+    Returns:
+        hashes - List of 32 byte hashes in internal byte order, one per transaction
+    '''
+    # Local names avoid an attribute lookup per transaction
+    sha256 = hashlib.sha256
+    view   = data if isinstance(data,memoryview) else memoryview(data)
+    hashes = []
+    append = hashes.append
+    for i in range(0,len(segments),6):
+        start1,end1,start2,end2,start3,end3 = segments[i:i+6]
+        h = sha256(view[start1:end1])
+        if end2 > start2:
+            h.update(view[start2:end2])
+        if end3 > start3:
+            h.update(view[start3:end3])
+        append(sha256(h.digest()).digest())
+    return hashes
+
+def computeTxids(transactions,witness=False):
+    '''
+    Description:
+        Computes the txid (or wtxid) of many transactions through the batched path hashSegments.
+        Transactions which share a payload (e.g. every transaction in a block) are hashed together in one call.
+    Inputs:
+        transactions - List of Transaction instances
+        witness      - Boolean, if True the wtxid (hash including the witness) is computed instead of the txid
+    Returns:
+        hashes - List of 32 byte hashes in internal byte order, in the same order as transactions
+    '''
+    hashes   = [None]*len(transactions)
+    # Group the transactions by the payload they are parsed from
+    groups = {}
+    for i,transaction in enumerate(transactions):
+        groups.setdefault(id(transaction.payload),[]).append(i)
+    for indexes in groups.values():
+        segments = array('Q')
+        for i in indexes:
+            segments.extend(transactions[i].wtxidSegments() if witness else transactions[i].txidSegments())
+        for i,txHash in zip(indexes,hashSegments(transactions[indexes[0]].payload,segments)):
+            hashes[i] = txHash
+    return hashes
+
+class TxIn:
+    # __slots__ - No per object dictionary, an input is just a reference to the payload and three offsets
+    __slots__ = ('payload','start','scriptStart','scriptEnd','witnessStart')
+
+    def __init__(self,payload,start,scriptStart,scriptEnd,witnessStart=None):
+        '''
+        Description:
+            initiliaser method for the class, created by Transaction.input, the fields are decoded from the payload when accessed
+        Inputs:
+            payload      - memoryview of the payload containing the transaction
+            start        - Index of the previous_output field of this input in the payload
+            scriptStart  - Index of the first byte of the signature script
+            scriptEnd    - Index one past the last byte of the signature script, the 4 byte sequence follows it
+            witnessStart - Index of the witness item count for this input, None if the transaction has no witness
+        '''
+        self.payload      = payload
+        self.start        = start
+        self.scriptStart  = scriptStart
+        self.scriptEnd    = scriptEnd
+        self.witnessStart = witnessStart
+
+    @property
+    def previousOutput(self):
+        # previous_output - 36 bytes, the hash (32 bytes) and index (4 bytes) of the output being spent
+        return self.payload[self.start:self.start+36]
+
+    @property
+    def previousHash(self):
+        # The hash of the transaction holding the output being spent, internal byte order
+        return bytes(self.payload[self.start:self.start+32])
+
+    @property
+    def previousIndex(self):
+        # The index of the output being spent in the previous transaction
+        return UINT32.unpack_from(self.payload,self.start+32)[0]
+
+    @property
+    def scriptLength(self):
+        return self.scriptEnd - self.scriptStart
+
+    @property
+    def signatureScript(self):
+        # memoryview of the signature script, empty if there is none (e.g. for a SegWit input)
+        return self.payload[self.scriptStart:self.scriptEnd]
+
+    @property
+    def sequence(self):
+        return UINT32.unpack_from(self.payload,self.scriptEnd)[0]
+
+    @property
+    def witness(self):
+        # The witness stack of this input as a list of memoryviews, empty if there is no witness
+        if self.witnessStart is None:
+            return []
+        payload = self.payload
+        itemCount,position = readVarInt(payload,self.witnessStart)
+        items = []
+        for i in range(itemCount):
+            itemLength,position = readVarInt(payload,position)
+            items.append(payload[position:position+itemLength])
+            position += itemLength
+        return items
+
+class TxOut:
+    # __slots__ - No per object dictionary, an output is just a reference to the payload and three offsets
+    __slots__ = ('payload','start','scriptStart','scriptEnd')
+
+    def __init__(self,payload,start,scriptStart,scriptEnd):
+        '''
+        Description:
+            initiliaser method for the class, created by Transaction.output, the fields are decoded from the payload when accessed
+        Inputs:
+            payload     - memoryview of the payload containing the transaction
+            start       - Index of the 8 byte value of this output in the payload
+            scriptStart - Index of the first byte of the pk_script
+            scriptEnd   - Index one past the last byte of the pk_script
+        '''
+        self.payload     = payload
+        self.start       = start
+        self.scriptStart = scriptStart
+        self.scriptEnd   = scriptEnd
+
+    @property
+    def value(self):
+        # value - The value of the output in Satoshis
+        return INT64.unpack_from(self.payload,self.start)[0]
+
+    @property
+    def scriptLength(self):
+        return self.scriptEnd - self.scriptStart
+
+    @property
+    def pkScript(self):
+        # memoryview of the pk_script
+        return self.payload[self.scriptStart:self.scriptEnd]
+
+class Transaction:
+    # __slots__ - No per object dictionary
+    __slots__ = ('payload','start','end','inputsStart','witnessStart','inputOffsets','outputOffsets','witnessOffsets')
+
+    def __init__(self,payload,offset=0):
+        '''
+        Description:
+            Parses a transaction starting at offset in payload, see https://en.bitcoin.it/wiki/Protocol_documentation#tx
+            The transaction is made up of:
+                version      - Transaction data format version, 4 bytes
+                marker, flag - Only present in SegWit transactions, 0x00 0x01 (see BIP144)
+                tx_in count  - The number of transaction inputs, varint
+                tx_in        - The transaction inputs, previous_output (36 bytes) + script length (varint) + signature script + sequence (4 bytes)
+                tx_out count - The number of transaction outputs, varint
+                tx_out       - The transaction outputs, value (8 bytes) + pk_script length (varint) + pk_script
+                tx_witness   - Only present in SegWit transactions, a witness stack per input, item count (varint) + items (varint length + data)
+                lock_time    - The block number or time at which the transaction is unlocked, 4 bytes
+            Only the offsets of each input and output are stored, three per input/output in inputOffsets and outputOffsets, and one per input in witnessOffsets.
+            The payload is not copied so if it is a memoryview from the framer the transaction is only valid while the payload is.
+        Inputs:
+            payload - Byte string or memoryview containing the transaction
+            offset  - Index in payload where the transaction starts, used when the transaction is inside a block
+        Raises:
+            ValueError - If the payload is truncated or the counts do not fit in the payload
+        '''
+        if not isinstance(payload,memoryview):
+            payload = memoryview(payload)
+        self.payload = payload
+        self.start   = offset
+        payloadLength = len(payload)
+        try:
+            # Skip the 4 byte version
+            position = offset+4
+            # marker, flag - A SegWit transaction has the marker 0x00 where the tx_in count would be, followed by the flag 0x01
+            #   A non SegWit transaction can never have 0 inputs so a 0x00 here always means the marker
+            hasWitness = payload[position] == 0 and payload[position+1] != 0
+            if hasWitness:
+                if payload[position+1] != 1:
+                    raise ValueError(f'Unknown SegWit flag {payload[position+1]}')
+                position += 2
+            # inputsStart - Where the tx_in count starts, the txid hashes from here up to the witness
+            inputsStart = position
+            # tx_in - previous_output (36) + script length varint + script + sequence (4)
+            inputCount,position = readVarInt(payload,position)
+            # An input is at least 41 bytes, a count bigger than this could never fit and would only waste memory
+            if inputCount > (payloadLength-position)//41:
+                raise ValueError(f'tx_in count {inputCount} does not fit in the payload')
+            inputOffsets = array('Q')
+            for i in range(inputCount):
+                scriptLength,scriptStart = readVarInt(payload,position+36)
+                scriptEnd = scriptStart+scriptLength
+                inputOffsets.append(position)
+                inputOffsets.append(scriptStart)
+                inputOffsets.append(scriptEnd)
+                position = scriptEnd+4
+            # tx_out - value (8) + pk_script length varint + pk_script
+            outputCount,position = readVarInt(payload,position)
+            # An output is at least 9 bytes
+            if outputCount > (payloadLength-position)//9:
+                raise ValueError(f'tx_out count {outputCount} does not fit in the payload')
+            outputOffsets = array('Q')
+            for i in range(outputCount):
+                scriptLength,scriptStart = readVarInt(payload,position+8)
+                scriptEnd = scriptStart+scriptLength
+                outputOffsets.append(position)
+                outputOffsets.append(scriptStart)
+                outputOffsets.append(scriptEnd)
+                position = scriptEnd
+            # tx_witness - One witness stack per input, only the start of each is stored
+            witnessStart   = position
+            witnessOffsets = array('Q')
+            if hasWitness:
+                for i in range(inputCount):
+                    witnessOffsets.append(position)
+                    itemCount,position = readVarInt(payload,position)
+                    # An item is at least 1 byte (its length)
+                    if itemCount > payloadLength-position:
+                        raise ValueError(f'witness item count {itemCount} does not fit in the payload')
+                    for j in range(itemCount):
+                        itemLength,position = readVarInt(payload,position)
+                        position += itemLength
+        except (IndexError,struct.error):
+            raise ValueError('Transaction is truncated')
+        # lock_time - the final 4 bytes
+        self.end = position+4
+        if self.end > payloadLength:
+            raise ValueError('Transaction is truncated')
+        self.inputsStart    = inputsStart
+        self.witnessStart   = witnessStart
+        self.inputOffsets   = inputOffsets
+        self.outputOffsets  = outputOffsets
+        self.witnessOffsets = witnessOffsets
+
+    @property
+    def version(self):
+        return INT32.unpack_from(self.payload,self.start)[0]
+
+    @property
+    def lockTime(self):
+        return UINT32.unpack_from(self.payload,self.end-4)[0]
+
+    @property
+    def size(self):
+        # The size of the serialized transaction in bytes
+        return self.end - self.start
+
+    @property
+    def raw(self):
+        # memoryview of the serialized transaction
+        return self.payload[self.start:self.end]
+
+    @property
+    def hasWitness(self):
+        return len(self.witnessOffsets) > 0
+
+    @property
+    def strippedSize(self):
+        # The size without the marker, flag and witness, version (4) + inputs and outputs + lock_time (4)
+        return 8 + self.witnessStart - self.inputsStart
+
+    @property
+    def weight(self):
+        # BIP141 weight, non witness bytes count 4 times and witness bytes once
+        return 3*self.strippedSize + self.size
+
+    @property
+    def vsize(self):
+        # Virtual size in vbytes, weight / 4 rounded up
+        return (self.weight+3)//4
+
+    def txidSegments(self):
+        '''
+        Description:
+            The 3 byte ranges of the payload hashed for the txid, the witness is left out by skipping over it.
+        Returns:
+            segments - Tuple of 6 offsets (start1,end1,start2,end2,start3,end3) for hashSegments
+        '''
+        if not self.witnessOffsets:
+            # Without a witness the txid is the hash of the whole transaction
+            return (self.start,self.end,0,0,0,0)
+        # version + inputs and outputs + lock_time
+        return (self.start,self.start+4,self.inputsStart,self.witnessStart,self.end-4,self.end)
+
+    def wtxidSegments(self):
+        '''
+        Description:
+            The byte range of the payload hashed for the wtxid, this is the whole transaction including the witness.
+        Returns:
+            segments - Tuple of 6 offsets (start1,end1,start2,end2,start3,end3) for hashSegments
+        '''
+        return (self.start,self.end,0,0,0,0)
+
+    @property
+    def txid(self):
+        # Hash of the transaction without the witness, internal byte order (reverse it for the usual hex display)
+        return hashSegments(self.payload,self.txidSegments())[0]
+
+    @property
+    def wtxid(self):
+        # Hash of the transaction including the witness, the same as the txid if there is no witness
+        return hashSegments(self.payload,self.wtxidSegments())[0]
+
+    @property
+    def inputCount(self):
+        return len(self.inputOffsets)//3
+
+    @property
+    def outputCount(self):
+        return len(self.outputOffsets)//3
+
+    def input(self,i):
+        '''
+        Description:
+            Creates the TxIn for input i
+        Inputs:
+            i - The index of the input
+        Returns:
+            txIn - TxIn instance
+        '''
+        offsets = self.inputOffsets
+        witnessStart = self.witnessOffsets[i] if self.witnessOffsets else None
+        return TxIn(self.payload,offsets[3*i],offsets[3*i+1],offsets[3*i+2],witnessStart)
+
+    def output(self,i):
+        '''
+        Description:
+            Creates the TxOut for output i
+        Inputs:
+            i - The index of the output
+        Returns:
+            txOut - TxOut instance
+        '''
+        offsets = self.outputOffsets
+        return TxOut(self.payload,offsets[3*i],offsets[3*i+1],offsets[3*i+2])
+
+    def inputs(self):
+        '''
+        Description:
+            Generator which yields a TxIn for every input
+        '''
+        for i in range(self.inputCount):
+            yield self.input(i)
+
+    def outputs(self):
+        '''
+        Description:
+            Generator which yields a TxOut for every output
+        '''
+        for i in range(self.outputCount):
+            yield self.output(i)
+
+    def totalOutputValue(self):
+        '''
+        Description:
+            Adds up the value of every output without creating any TxOut objects
+        Returns:
+            total - The total value of the outputs in Satoshis
+        '''
+        unpack  = INT64.unpack_from
+        payload = self.payload
+        offsets = self.outputOffsets
+        return sum(unpack(payload,offsets[i])[0] for i in range(0,len(offsets),3))
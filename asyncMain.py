@@ -0,0 +1,51 @@
+### House Keeping ###
+# Name           - Warren Kavanagh 
+# Description    - Script which connects to many nodes in the bitcoin network at once from a single process and listens out for inv, tx and block messages from all of them 
+
+## Imports ##
+# asyncio               - https://docs.python.org/3/library/asyncio.html
+# AsyncBitcoinConnector - Class developed for this project which connects to many peers on one asyncio event loop, see Lib/AsyncBitcoinConnector.py
+# PeerSelector          - Class developed for this project which keeps the connections rotated towards the fastest peers, see Lib/PeerSelector.py
+# AddressBook           - Class developed for this project which keeps the addresses peers send us and how each connection went, see Lib/AddressBook.py
+# Metrics               - Classes developed for this project which count messages, time the parsing and serve the figures over HTTP, see Lib/Metrics.py
+import os
+import asyncio
+from Lib.AsyncBitcoinConnector import AsyncBitcoinConnector
+from Lib.PeerSelector import PeerSelector
+from Lib.AddressBook import AddressBook
+from Lib.Metrics import ConnectorMetrics,MetricsServer
+
+if __name__ == '__main__':
+    # ips - List of the ip addresses of the nodes to connect to, when None a DNS lookup of seed.bitcoin.sipa.be is performed and every address returned is used
+    ips = None
+    # connector - Instance of the AsyncBitcoinConnector class, every peer it connects to shares the one event loop started by asyncio.run
+    #   With hundreds of peers printing every message is too much for the terminal so displaying is off by default
+    connector = AsyncBitcoinConnector(displayInv=False,displayTx=False,displayBlock=True)
+    # metricsPort - Set to a port (e.g. 9100) to serve the metrics of every peer at http://127.0.0.1:metricsPort/metrics, see Lib/Metrics.py
+    metricsPort = None
+    if metricsPort:
+        metrics = ConnectorMetrics()
+        metrics.attach(connector)
+        MetricsServer(metrics,port=metricsPort).start()
+    # selectPeers - When True only targetPeers are kept, chosen from every DNS seed by racing handshakes, and the slowest is swapped for a new peer every minute
+    #   Peers are measured on ping round trip time and how far behind the first announcement they announce each tx and block
+    selectPeers = False
+    targetPeers = 8
+    # addressBookPath - Set to a file (e.g. 'addresses.dat') and with selectPeers the addresses learnt from peers are saved there on exit, the next run connects to the best of them without resolving the DNS seeds
+    addressBookPath = None
+    addressBook = None
+    if selectPeers and addressBookPath:
+        addressBook = AddressBook.load(addressBookPath) if os.path.exists(addressBookPath) else AddressBook()
+    # Run until every peer disconnects or ctrl+c is entered on the keyboard 
+    try:
+        if selectPeers:
+            selector = PeerSelector(connector,targetPeers=targetPeers,addressBook=addressBook)
+            asyncio.run(selector.run(ips))
+        else:
+            asyncio.run(connector.run(ips))
+    # This exception is just here so that a stack trace is not printed when you press ctrl+c to stop loop 
+    except KeyboardInterrupt:
+        print("Program exited")
+    finally:
+        if addressBook is not None:
+            addressBook.save(addressBookPath)
@@ -0,0 +1,228 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+# Description    - Script which benchmarks the message parsing and creating functions of BitcoinConnector over a corpus of real shaped messages
+#                  For each function it reports messages per second, MB per second, the peak memory used by one call, the memory held by its result
+#                  and the number of allocations made by one call which are still alive when it returns
+#                  The results can be saved as a baseline and later runs compared against it, so a parser change is judged on numbers
+#                  Usage: python benchmark.py [--save baseline.json] [--baseline baseline.json] [--capture captureDirectory]
+
+## Imports ##
+# gc               - https://docs.python.org/3/library/gc.html
+# os               - https://docs.python.org/3/library/os.html
+# sys              - https://docs.python.org/3/library/sys.html
+# json             - https://docs.python.org/3/library/json.html
+# time             - https://docs.python.org/3/library/time.html
+# struct           - https://docs.python.org/3/library/struct.html
+# argparse         - https://docs.python.org/3/library/argparse.html
+# tracemalloc      - https://docs.python.org/3/library/tracemalloc.html
+# BitcoinConnector - Class developed for this project, the functions being benchmarked
+# Transaction      - createVarInt is used to build the inv payloads
+# MockPeer         - The functions which create synthetic transactions and blocks, see Lib/MockPeer.py
+# CaptureLog       - CaptureReader is used to benchmark over recorded traffic instead of the synthetic corpus, see Lib/CaptureLog.py
+import gc
+import os
+import sys
+import json
+import time
+import struct
+import argparse
+import tracemalloc
+from Lib.BitcoinConnector import BitcoinConnector
+from Lib.Transaction import createVarInt
+from Lib.MockPeer import createTransaction,createBlock
+from Lib.CaptureLog import CaptureReader
+
+def createInv(count):
+    '''
+    Description:
+        Creates an inv payload announcing count random transactions.
+    Inputs:
+        count - The number of inventory vectors, the protocol limit is 50,000
+    Returns:
+        payload - Byte string of the inv payload
+    '''
+    return createVarInt(count) + b''.join(struct.pack('<I',1) + os.urandom(32) for i in range(count))
+
+def createBlockOfSize(size,witnessShare=0.5):
+    '''
+    Description:
+        Creates a block of roughly size bytes filled with small transactions, witnessShare of them SegWit.
+    Inputs:
+        size         - The rough size in bytes of the block
+        witnessShare - The fraction of the transactions which are SegWit
+    Returns:
+        block - Byte string of the block payload
+    '''
+    transactions = []
+    total = 0
+    while total < size:
+        tx = createTransaction(250,inputs=1+len(transactions)%3,witness=(len(transactions)%100) < witnessShare*100)
+        transactions.append(tx)
+        total += len(tx)
+    return createBlock(bytes(32),transactions,height=1)
+
+def createCorpus():
+    '''
+    Description:
+        Creates the synthetic corpus of real shaped messages.
+    Returns:
+        corpus - Dictionary of case name -> (command, list of payloads)
+    '''
+    return {
+        'inv 1 entry':          ('inv',[createInv(1) for i in range(100)]),
+        'inv 50k entries':      ('inv',[createInv(50000)]),
+        'tx small':             ('tx',[createTransaction(250) for i in range(200)]),
+        'tx small segwit':      ('tx',[createTransaction(250,witness=True) for i in range(200)]),
+        'tx large 100KB':       ('tx',[createTransaction(100000) for i in range(5)]),
+        'tx consolidation 500': ('tx',[createTransaction(80000,inputs=500,witness=True) for i in range(5)]),
+        'block 1MB':            ('block',[createBlockOfSize(1000000)]),
+        'block 4MB':            ('block',[createBlockOfSize(4000000)]),
+    }
+
+def corpusFromCapture(directory,limit=1000):
+    '''
+    Description:
+        Builds a corpus from recorded traffic, the first limit inv, tx and block messages.
+    Inputs:
+        directory - Capture directory written by CaptureLog
+        limit     - The maximum number of messages of each command to use
+    Returns:
+        corpus - Dictionary of case name -> (command, list of payloads)
+    '''
+    reader = CaptureReader(directory)
+    corpus = {}
+    for timestamp,command,peer,payload in reader.messages(commands={'inv','tx','block'}):
+        payloads = corpus.setdefault(f'{command} captured',(command,[]))[1]
+        if len(payloads) < limit:
+            payloads.append(bytes(payload))
+    return corpus
+
+def measure(function,messages,minTime):
+    '''
+    Description:
+        Times a function over a list of messages and measures the memory used by one call on the largest message.
+            The allocations are counted from a tracemalloc snapshot before and after the call, so they are the memory blocks the call allocated which are still
+            alive when it returns (held by the result or cached). Blocks allocated and freed inside the call can not be seen by tracemalloc and are not counted.
+    Inputs:
+        function - Function called as function(message)
+        messages - List of messages, cycled through until minTime has passed
+        minTime  - Minimum seconds to run each of the 3 timing rounds for
+    Returns:
+        result - Dictionary of the measurements
+    '''
+    totalBytes = sum(len(message) for message in messages)
+    # Best of 3 rounds, each round runs the whole list as many times as fit in minTime
+    best = None
+    for i in range(3):
+        rounds = 0
+        gc.disable()
+        start = time.perf_counter()
+        while True:
+            for message in messages:
+                function(message)
+            rounds += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= minTime:
+                break
+        gc.enable()
+        perMessage = elapsed/(rounds*len(messages))
+        best = perMessage if best is None else min(best,perMessage)
+    # Memory - peak during one call on the largest message and the memory still held by what it returned
+    largest = max(messages,key=len)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    result = function(largest)
+    current,peak = tracemalloc.get_traced_memory()
+    # The snapshots themselves are allocated while tracing, leave out the tracemalloc module
+    ignore = (tracemalloc.Filter(False,tracemalloc.__file__),)
+    difference  = tracemalloc.take_snapshot().filter_traces(ignore).compare_to(snapshot.filter_traces(ignore),'lineno')
+    allocations = sum(stat.count_diff for stat in difference if stat.count_diff > 0)
+    tracemalloc.stop()
+    del result
+    return {
+        'messagesPerSecond':  1/best,
+        'megabytesPerSecond': totalBytes/len(messages)/best/1e6,
+        'averageBytes':       totalBytes//len(messages),
+        'peakKB':             (peak-before)/1024,
+        'retainedKB':         (current-before)/1024,
+        'allocations':        allocations,
+    }
+
+def runBenchmarks(corpus,minTime):
+    '''
+    Description:
+        Runs every benchmark over the corpus.
+    Inputs:
+        corpus  - Dictionary of case name -> (command, list of payloads)
+        minTime - Minimum seconds for each timing round
+    Returns:
+        results - Dictionary of "function case" -> measurements
+    '''
+    # No socket, no display and no inventory cache so every inv is parsed in full every time
+    connector = BitcoinConnector(ip='127.0.0.1',connect=False)
+    connector.inventoryCache = None
+    parsers = {
+        'inv':   ('parseInvMsg',  lambda msg: connector.parseInvMsg(msg,display=False)),
+        'tx':    ('parseTXMsg',   lambda msg: connector.parseTXMsg(msg,display=False)),
+        'block': ('parseBlockMsg',lambda msg: connector.parseBlockMsg(msg,display=False)),
+    }
+    results = {}
+    for case,(command,payloads) in corpus.items():
+        # The parse functions take the whole message including the header
+        messages = [connector.createMessage(command,payload) for payload in payloads]
+        name,function = parsers[command]
+        results[f'{name} {case}'] = measure(function,messages,minTime)
+        results[f'createMessage {case}'] = measure(lambda payload: connector.createMessage(command,payload),payloads,minTime)
+        print(f'{name} {case} done',file=sys.stderr)
+    return results
+
+def compare(results,baseline,threshold):
+    '''
+    Description:
+        Prints the results, with the change in messages per second against the baseline if one is passed.
+    Inputs:
+        results   - Dictionary from runBenchmarks
+        baseline  - Dictionary from a saved run, or None
+        threshold - Fractional slow down, e.g. 0.1, counted as a regression
+    Returns:
+        regressions - List of the names which are slower than the baseline by more than threshold
+    '''
+    regressions = []
+    print(f'{"benchmark":<44}{"msg/s":>12}{"MB/s":>10}{"peak KB":>11}{"held KB":>11}{"allocs":>9}{"vs base":>10}')
+    for name,result in results.items():
+        change = ''
+        if baseline and name in baseline:
+            ratio  = result['messagesPerSecond']/baseline[name]['messagesPerSecond'] - 1
+            change = f'{ratio*100:+.1f}%'
+            if ratio < -threshold:
+                regressions.append(name)
+                change += ' !'
+        print(f'{name:<44}{result["messagesPerSecond"]:>12.1f}{result["megabytesPerSecond"]:>10.1f}{result["peakKB"]:>11.1f}{result["retainedKB"]:>11.1f}{result.get("allocations",0):>9}{change:>10}')
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the BitcoinConnector message functions')
+    parser.add_argument('--save',help='Write the results to this JSON file to use as a baseline')
+    parser.add_argument('--baseline',help='Compare the results against this saved JSON file')
+    parser.add_argument('--threshold',type=float,default=0.1,help='Slow down against the baseline counted as a regression, default 0.1 (10 percent)')
+    parser.add_argument('--capture',help='Use the messages recorded in this capture directory instead of the synthetic corpus')
+    parser.add_argument('--min-time',type=float,default=0.2,help='Minimum seconds for each timing round')
+    args = parser.parse_args()
+
+    corpus = corpusFromCapture(args.capture) if args.capture else createCorpus()
+    results = runBenchmarks(corpus,args.min_time)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+    regressions = compare(results,baseline,args.threshold)
+    if args.save:
+        with open(args.save,'w') as saveFile:
+            json.dump(results,saveFile,indent=2)
+    # Exit code 1 when something is slower than the baseline so it can be used in a script
+    if regressions:
+        print(f'{len(regressions)} benchmarks slower than the baseline by more than {args.threshold*100:.0f}%')
+        sys.exit(1)
@@ -4,16 +4,109 @@
 
 ## Imports ##
 # BitcoinConnector - Class developed for this project which provides funtionality for conntecting to bitcoin network and parsing messages 
+# CaptureLog       - Class developed for this project which records every message received so it can be replayed with replay.py
+# DecodePipeline   - Class developed for this project which decodes tx and block messages in worker processes, connectorHooks lists the options it can not feed, see Lib/DecodePipeline.py
+# Mempool          - Class developed for this project which stores unconfirmed transactions, compact blocks are rebuilt from it, see Lib/Mempool.py
+# PeerSelector     - selectFastestPeers measures many peers and returns the fastest, see Lib/PeerSelector.py
+# AddressBook      - Class developed for this project which keeps the addresses peers send us and how each connection went, see Lib/AddressBook.py
+# Metrics          - Classes developed for this project which count messages, time the parsing and serve the figures over HTTP, see Lib/Metrics.py
+# OutputSink       - Classes developed for this project which write the displayed messages as text, JSON Lines or binary records from a background thread, see Lib/OutputSink.py
+# ScriptClassifier - Classes developed for this project which classify output scripts and match them against a watch-list of addresses, see Lib/ScriptClassifier.py
+# BlockFilter      - Classes developed for this project which build BIP158 block filters and keep them in an on-disk index, see Lib/BlockFilter.py
+# ColumnarExport   - Classes developed for this project which collect parsed transactions and blocks into column files for analysis, see Lib/ColumnarExport.py
+# Handshake        - NEGOTIATION_COMMANDS are the feature messages the peer may send after the handshake, see Lib/Handshake.py
+# GetDataScheduler - Class developed for this project which caps the getdata requests in flight and sends timed out requests again, see Lib/GetDataScheduler.py
+import os
+import asyncio
 from Lib.BitcoinConnector import BitcoinConnector
+from Lib.CaptureLog import CaptureLog
+from Lib.DecodePipeline import DecodePipeline,displayDecoded,connectorHooks
+from Lib.Mempool import Mempool
+from Lib.PeerSelector import selectFastestPeers
+from Lib.AddressBook import AddressBook
+from Lib.Metrics import ConnectorMetrics,MetricsServer
+from Lib.OutputSink import OutputSink,HumanFormatter,JsonLinesFormatter,BinaryFormatter
+from Lib.ScriptClassifier import WatchList,ScriptWatcher
+from Lib.BlockFilter import FilterIndex
+from Lib.ColumnarExport import ColumnarExporter
+from Lib.Handshake import NEGOTIATION_COMMANDS
+from Lib.GetDataScheduler import GetDataScheduler
 
 if __name__ == '__main__':
     # ip - this is the ip address of the node which is to be connected to, it is set here as I found this IP to be quite quick at sending messages
     #      The value of ip can be changed to None if you want to script to perform a DNS lookup for seed.bitcoin.sipa.be to get a bitcoin node IP if this ip is offline 
     ip = '1.116.110.123'
+    # selectPeer - When True the peer is picked automatically instead of using ip, every DNS seed is resolved (IPv4 and IPv6), handshakes are raced
+    #   and the peers are measured for selectSeconds on ping round trip time and how early they announce new transactions, the fastest is used
+    selectPeer    = False
+    selectSeconds = 20
+    port = 8333
+    # addressBookPath - Set to a file (e.g. 'addresses.dat') to save the addresses learnt from addr messages there on exit along with how each connection went
+    #   When the file exists and ip is None the best saved address is connected to and the DNS lookup is skipped
+    addressBookPath = None
+    addressBook = None
+    if addressBookPath:
+        addressBook = AddressBook.load(addressBookPath) if os.path.exists(addressBookPath) else AddressBook()
+        print(f'Address book has {len(addressBook)} addresses')
+    if selectPeer:
+        fastest = asyncio.run(selectFastestPeers(1,sampleTime=selectSeconds,addressBook=addressBook))
+        if fastest:
+            ip,port = fastest[0]
+            print(f'Selected fastest peer {ip}:{port}')
     # connector - This is an instance of the BitcoinConnector class developed for this project, see the file Lib/BitcoinConnector.py for more information on this
-    connector = BitcoinConnector(ip=ip)
+    connector = BitcoinConnector(ip=ip,peerPort=port,addressBook=addressBook)
+    # maxInFlight    - The most tx and block requests sent and not yet answered, the rest of a large inv burst waits its turn instead of going in one getdata
+    # requestTimeout - Seconds before a request which has not been answered is sent again, it is dropped if the second request is not answered either
+    #   Set maxInFlight to None to request everything announced straight away without timeouts, see Lib/GetDataScheduler.py
+    maxInFlight    = 5000
+    requestTimeout = 60
+    if maxInFlight:
+        connector.scheduler = GetDataScheduler(maxInFlightPerPeer=maxInFlight,timeout=requestTimeout,maxRetries=1,inventoryCache=connector.inventoryCache)
+    # captureDirectory - Set to a directory to record every message received there, the capture can be replayed later with replay.py
+    captureDirectory = None
+    if captureDirectory:
+        connector.captureLog = CaptureLog(captureDirectory)
+    # metricsPort - Set to a port (e.g. 9100) to serve message counts, parse time and getdata round trip histograms and queue depths at http://127.0.0.1:metricsPort/metrics
+    #   in the Prometheus text format
+    metricsPort = None
+    if metricsPort:
+        metrics = ConnectorMetrics()
+        metrics.attach(connector)
+        MetricsServer(metrics,port=metricsPort).start()
+    # watchListPath - Set to a file of addresses (or hex script hashes and public keys) one per line to be alerted when a transaction or block pays to one of them
+    #   The output scripts of every parsed tx and block are classified and looked up in the watch-list, each match is printed, see Lib/ScriptClassifier.py
+    watchListPath = None
+    if watchListPath:
+        watchList = WatchList.load(watchListPath)
+        connector.watcher = ScriptWatcher(watchList)
+        print(f'Watching {len(watchList)} addresses')
+    # filterDirectory - Set to a directory to build the BIP158 filter of every block received and keep it there, a few KB per block
+    #   Scripts can then be checked against every block seen with FilterIndex(filterDirectory).scan(scripts) without keeping the blocks
+    filterDirectory = None
+    if filterDirectory:
+        connector.filterIndex = FilterIndex(filterDirectory)
+    # exportDirectory - Set to a directory to collect every transaction and block parsed into column files of exportRows transactions each
+    #   Read them back with ColumnarReader(exportDirectory), e.g. .summary() for the total value moved and the size distribution
+    exportDirectory = None
+    exportRows      = 1000000
+    if exportDirectory:
+        connector.exporter = ColumnarExporter(exportDirectory,rowsPerChunk=exportRows)
     # Call the connectToPeer function, this performs the sending of the initial version message, recieveing the version and verack response and then sending a verack response 
-    connector.connectToPeer()
+    # handshakeTimeout - Seconds the handshake may take before giving up on the peer, the version of the peer and the time the handshake took are printed
+    # feeRate          - Set to satoshis per 1000 virtual bytes (e.g. 1000) to send a feefilter so transactions paying less are not announced, None for every transaction
+    handshakeTimeout = 10
+    feeRate          = None
+    if connector.connectToPeer(timeout=handshakeTimeout,feeRate=feeRate) is None:
+        raise SystemExit(f'Could not complete the handshake with peer {connector.peerIP}:{connector.peerPort}')
+    # Ask the peer for the addresses of other nodes, the replies are added to the address book
+    if addressBook is not None:
+        connector.sendMessage(connector.createMessage('getaddr',connector.createGetAddrCMD()),'getaddr message')
+    # compactBlocks - When True new blocks are received as BIP152 compact blocks, a few KB of short IDs which are rebuilt from the transactions already received
+    #   The transactions are kept in a mempool so they can be found, the peer is asked to push new blocks straight away (high bandwidth mode)
+    compactBlocks = True
+    if compactBlocks:
+        connector.mempool = Mempool()
+        connector.sendMessage(connector.createMessage('sendcmpct',connector.createSendCmpctCMD(announce=True)),'sendcmpct message')
 
     # displayInv   - When True will display inv messages to terminal, set False it will not 
     # displayTx    - When True will display tx messages to the terminal, set False it will not 
@@ -21,33 +114,107 @@ if __name__ == '__main__':
     displayInv   = True
     displayTx    = True
     displayBlock = True
+    # outputFormat - How the displayed messages are written, 'human' for the text below, 'jsonl' for one JSON object per line or 'binary' for compact records (read back with readBinaryRecords)
+    # outputPath   - File the output is appended to, None for the terminal
+    #   The output is written in batches from a background thread so a slow terminal or disk does not hold up reading the socket
+    outputFormat = 'human'
+    outputPath   = None
+    formatters = {'human':HumanFormatter,'jsonl':JsonLinesFormatter,'binary':BinaryFormatter}
+    connector.output = OutputSink(formatters[outputFormat](),path=outputPath)
+
+    # pipelineWorkers - Set above 0 to decode tx and block messages in that many worker processes so a large block does not hold up reading the socket
+    #   In this mode a one line summary of each tx and block is displayed instead of the full message
+    #   The workers only send back a summary so the mempool (compactBlocks), watch-list, filter index, export and header chain would get nothing, they must be off
+    pipelineWorkers = 0
+    pipeline = None
+    if pipelineWorkers:
+        hooks = connectorHooks(connector)
+        if hooks:
+            raise SystemExit(f'pipelineWorkers can not be used with {", ".join(hooks)} set, they are fed by parsing each tx and block in this process. '
+                             'Set compactBlocks to False and watchListPath, filterDirectory and exportDirectory to None to use the pipeline')
+        pipeline = DecodePipeline(workers=pipelineWorkers)
+        pipeline.start()
+
+    # Consumers subscribe to the commands they want, a message is parsed once for all of its subscribers and a command with no subscriber is not parsed at all
+    # The handlers are called as handler(connector, command, result), result is what the parse function for the command returns, see parseMessage in Lib/BitcoinConnector.py
+    # Inv message type - These message will include updates on the network including tx and block hashes which can be used to get tx and block messages. See https://en.bitcoin.it/wiki/Protocol_documentation#inv
+    #   The parse returns the MSG_TX and MSG_BLOCK vectors, vectors for hashes which have already been requested are dropped by the connector inventory cache (or scheduler)
+    def requestInventory(connector,command,inventoryVecs):
+        # Now send getdata messages for the inventory vectors for transactions and blocks to gather more information on them, through the scheduler if it is set
+        # each getdata prints "getdata message sent <time>" to console when its sent
+        connector.requestInventory(inventoryVecs)
+    # cmpctblock and blocktxn message types - A compact block and the transactions missing from it
+    #   If transactions are missing the parse returns the getblocktxn request to send, once complete the block is parsed like a block message
+    def sendRequest(connector,command,result):
+        block,request = result
+        if request is not None:
+            connector.sendMessage(connector.createMessage(*request),f'{request[0]} message')
+    # ignore - Handler for the commands where the parse does the work, e.g. adding a tx to the mempool or an address to the address book
+    def ignore(connector,command,result):
+        pass
+    connector.subscribe('inv',requestInventory)
+    # transaction and block message types - See https://en.bitcoin.it/wiki/Protocol_documentation#tx and https://en.bitcoin.it/wiki/Protocol_documentation#block
+    #   With the pipeline the payloads are replaced by the decoded result from the workers so they are subscribed to unparsed
+    if pipeline is None:
+        connector.subscribe('tx',ignore)
+        connector.subscribe('block',ignore)
+    else:
+        def showDecoded(connector,command,result):
+            if command in connector.dispatcher.displayCommands:
+                displayDecoded(command,result)
+        connector.subscribe('tx',showDecoded,parse=False)
+        connector.subscribe('block',showDecoded,parse=False)
+    if compactBlocks:
+        # sendcmpct message type - The peer supports compact blocks, from now on blocks are requested from it as cmpctblock. See https://github.com/bitcoin/bips/blob/master/bip-0152.mediawiki
+        connector.subscribe('sendcmpct',ignore)
+        connector.subscribe('cmpctblock',sendRequest)
+        connector.subscribe('blocktxn',sendRequest)
+    if addressBook is not None:
+        # addr and addrv2 message types - The addresses of other nodes, kept in the address book for the next run. See https://en.bitcoin.it/wiki/Protocol_documentation#addr
+        connector.subscribe('addr',ignore)
+        connector.subscribe('addrv2',ignore)
+    # The parse functions display the commands in displayCommands
+    connector.dispatcher.displayCommands = {command for command,display in (('inv',displayInv),('addr',displayInv),('addrv2',displayInv),('tx',displayTx),('block',displayBlock),
+                                                                              ('sendcmpct',displayBlock),('cmpctblock',displayBlock),('blocktxn',displayBlock)) if display}
 
     # This will enter a loop forever which can only be escaped when ctrl+c is entered on the keyboard
     # the exception will be caught and will print "program exited" to the terminal 
     try:
-        # Loop forever 
-        while True:
-            # Recover the message from the node, msg will be a byte string containing a bitcoin message 
-            # The node will be sending messages as the connection has already been established using the connectToPeer function called earlier
-            msg = connector.socket.recv(2048)
-            # Inv message type - These message will include updates on the network including tx and block hashes which can be used to get tx and block messages. See https://en.bitcoin.it/wiki/Protocol_documentation#inv
-            if msg[0:7] == b'\xf9\xbe\xb4\xd9inv':
-                # Parse the inv messages and extract out the inventory vectors of type MSG_TX and MSG_BLOCK
-                inventoryVecs = connector.parseInvMsg(msg,display=displayInv)
-                # Now create a getdata message using the inventory vectors for transactions and blocks to gather more information on them 
-                # The payload for getdata message is built using the function createGetDataCMD
-                # The message is built using the function createMessage, this adds the headers
-                getDataMSG = connector.createMessage('getdata',connector.createGetDataCMD(inventoryVecs))
-                # Now send the getdata message, the optional second input is a string which will print "getdata message sent <time>" to console when its sent
-                connector.sendMessage(getDataMSG,'getdata message')
-            # transaction message type - This type of message contains information on transactions. See https://en.bitcoin.it/wiki/Protocol_documentation#tx
-            elif msg[0:6] == b'\xf9\xbe\xb4\xd9tx':
-                # Parse the transaction message, set the display True or False to display the parsed message  
-                connector.parseTXMsg(msg,display=displayTx)
-            # block message type - This type of message is related to a new block being mined and contains information on it. See https://en.bitcoin.it/wiki/Protocol_documentation#block 
-            elif msg[0:9] == b'\xf9\xbe\xb4\xd9block':
-                # Parse the block message, set the display True or False to display the parsed message  
-                connector.parseBlockMsg(msg,display=displayBlock)
+        # Loop forever reading complete messages from the node and passing each to its subscribers, ping is answered with pong
+        # readFrames reads the socket into a reusable buffer and yields each complete message as the command name and its payload
+        # A message split across reads is held until it is complete and a read containing several messages yields all of them so nothing is lost
+        # The node will be sending messages as the connection has already been established using the connectToPeer function called earlier
+        if pipeline is None:
+            connector.dispatchFrames()
+        else:
+            # tx and block payloads are replaced by the decoded result from the workers, in the order they were received
+            for command,payload in pipeline.decodeFrames(connector.readFrames()):
+                if command == 'ping':
+                    connector.sendMessage(connector.createMessage('pong',bytes(payload)))
+                elif command in NEGOTIATION_COMMANDS:
+                    connector.receiveFeature(command,payload)
+                connector.dispatcher.dispatch(connector,command,payload)
+                if connector.scheduler is not None:
+                    # parseTXPayload and parseBlockPayload are not run, mark the requests received from the decoded results, a block with a bad Merkle root is requested again
+                    if command == 'tx' and payload is not None and 'error' not in payload:
+                        connector.scheduler.received(connector,payload['txid'])
+                    elif command == 'block' and payload is not None and payload.get('merkleValid'):
+                        connector.scheduler.received(connector,payload['hash'])
+                    connector.updateRequests(command,payload)
     # This exception is just here so that a stack trace is not printed when you press ctrl+c to stop loop 
     except KeyboardInterrupt:
         print("Program exited")
+    finally:
+        # Make sure everything captured reaches the disk
+        if connector.captureLog is not None:
+            connector.captureLog.close()
+        if connector.filterIndex is not None:
+            connector.filterIndex.close()
+        # The last chunk is only part full, write it
+        if connector.exporter is not None:
+            connector.exporter.close()
+        if pipeline is not None:
+            pipeline.close()
+        if addressBook is not None:
+            addressBook.save(addressBookPath)
+        connector.output.close()
@@ -0,0 +1,41 @@
+### House Keeping ###
+# Name           - Warren Kavanagh 
+# Description    - Script which replays the messages recorded by main.py (or AsyncBitcoinConnector) through the parsing functions, without connecting to a node 
+
+## Imports ##
+# sys              - https://docs.python.org/3/library/sys.html
+# BitcoinConnector - Class developed for this project, used here only for parsing messages 
+# CaptureLog       - CaptureReader is the class developed for this project which memory maps a capture directory, see Lib/CaptureLog.py
+import sys
+from Lib.BitcoinConnector import BitcoinConnector
+from Lib.CaptureLog import CaptureReader
+
+if __name__ == '__main__':
+    # captureDirectory - The directory the capture was written to, can be passed as the first argument
+    captureDirectory = sys.argv[1] if len(sys.argv) > 1 else 'capture'
+    # connector - Created with connect=False as nothing is sent, only the parse functions are used
+    #   The inventory cache is turned off so every inv is parsed in full as it was when captured
+    connector = BitcoinConnector(ip='0.0.0.0',connect=False)
+    connector.inventoryCache = None
+    reader = CaptureReader(captureDirectory)
+    print(f'Replaying {len(reader)} messages from {captureDirectory}')
+
+    # displayInv   - When True will display inv messages to terminal, set False it will not 
+    # displayTx    - When True will display tx messages to the terminal, set False it will not 
+    # displayBlock - When True will display block messages to the terminal, set False it will not 
+    displayInv   = False
+    displayTx    = False
+    displayBlock = True
+
+    try:
+        # messages can also be limited to a time range with start/end or to some commands e.g. commands={'block'}
+        for timestamp,command,peer,payload in reader.messages():
+            if command == 'inv':
+                connector.parseInvPayload(payload,display=displayInv)
+            elif command == 'tx':
+                connector.parseTXPayload(payload,display=displayTx)
+            elif command == 'block':
+                connector.parseBlockPayload(payload,display=displayBlock)
+    # This exception is just here so that a stack trace is not printed when you press ctrl+c to stop loop 
+    except KeyboardInterrupt:
+        print("Program exited")
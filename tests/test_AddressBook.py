@@ -0,0 +1,234 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   Tests for Lib/AddressBook.py, parsing addr and addrv2 messages, the sampled eviction once the book is full, saving and loading the records,
+#   and BitcoinConnector falling back on the next best addresses and then the DNS lookup when the best address does not connect.
+#   Run from the top directory with: python -m unittest discover -s tests   (or python -m pytest tests)
+
+
+## Imports ##
+# os               - https://docs.python.org/3/library/os.html
+# time             - https://docs.python.org/3/library/time.html
+# socket           - https://docs.python.org/3/library/socket.html
+# struct           - https://docs.python.org/3/library/struct.html
+# tempfile         - https://docs.python.org/3/library/tempfile.html
+# unittest         - https://docs.python.org/3/library/unittest.html
+# mock             - https://docs.python.org/3/library/unittest.mock.html
+# AddressBook      - The class and functions being tested, see Lib/AddressBook.py
+# CaptureLog       - packIP gives the 16 byte form of the addresses, see Lib/CaptureLog.py
+# Transaction      - createVarInt creates the addrv2 counts, see Lib/Transaction.py
+# BitcoinConnector - Connects to the addresses in the book and parses the addr and addrv2 messages into it, see Lib/BitcoinConnector.py
+# Metrics          - ConnectorMetrics records the parse time of each command, see Lib/Metrics.py
+# MockPeer         - The peer at the one address which accepts connections, see Lib/MockPeer.py
+import os
+import time
+import socket
+import struct
+import tempfile
+import unittest
+from unittest import mock
+from Lib.AddressBook import AddressBook,AddressEntry,RECORD,MAX_ADDRESSES,createAddrPayload,parseAddrPayload,parseAddrV2Payload
+from Lib.CaptureLog import packIP
+from Lib.Transaction import createVarInt
+from Lib.BitcoinConnector import BitcoinConnector
+from Lib.Metrics import ConnectorMetrics
+from Lib.MockPeer import MockPeer
+
+def addrV2Entry(network,address,port,timestamp=1700000000,services=1033):
+    # One address of an addrv2 payload, see BIP155
+    return struct.pack('<I',timestamp) + createVarInt(services) + bytes([network]) + createVarInt(len(address)) + address + port.to_bytes(2,'big')
+
+def closedPort():
+    # A local port nothing listens on, so a connection to it is refused straight away
+    sock = socket.socket()
+    sock.bind(('127.0.0.1',0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class ParseTest(unittest.TestCase):
+    def testAddrRoundTrip(self):
+        addresses = [(1700000000,1,'8.8.8.8',8333),(1700000001,9,'2001:4860::8888',18333)]
+        parsed = parseAddrPayload(createAddrPayload(addresses))
+        self.assertEqual(parsed,[(timestamp,services,packIP(ip),port) for timestamp,services,ip,port in addresses])
+        self.assertEqual(parseAddrPayload(memoryview(b'\x00')),[])
+
+    def testAddrBad(self):
+        payload = createAddrPayload([(1700000000,1,'8.8.8.8',8333)]*2)
+        with self.assertRaises(ValueError):
+            parseAddrPayload(payload[:-1])
+        with self.assertRaises(ValueError):
+            parseAddrPayload(b'')
+        with self.assertRaisesRegex(ValueError,'limit'):
+            parseAddrPayload(createVarInt(MAX_ADDRESSES+1))
+        with self.assertRaises(ValueError):
+            createAddrPayload([(1700000000,1,'8.8.8.8',8333)]*(MAX_ADDRESSES+1))
+
+    def testAddrV2SkipsTorAndI2P(self):
+        payload = (createVarInt(5) + addrV2Entry(1,bytes([8,8,4,4]),8333) + addrV2Entry(4,os.urandom(32),9050) + addrV2Entry(2,packIP('2001:db8::1'),8334)
+                   + addrV2Entry(5,os.urandom(32),0) + addrV2Entry(6,bytes([0xfc])+os.urandom(15),8333,services=0xfd00))
+        addresses,skipped = parseAddrV2Payload(memoryview(payload))
+        self.assertEqual(addresses,[(1700000000,1033,packIP('8.8.4.4'),8333),(1700000000,1033,packIP('2001:db8::1'),8334)])
+        # Tor v3, I2P and CJDNS
+        self.assertEqual(skipped,3)
+        # An unknown network with a sensible length is skipped too
+        addresses,skipped = parseAddrV2Payload(createVarInt(1) + addrV2Entry(9,os.urandom(20),8333))
+        self.assertEqual((addresses,skipped),([],1))
+
+    def testAddrV2Bad(self):
+        with self.assertRaisesRegex(ValueError,'not valid'):
+            parseAddrV2Payload(createVarInt(1) + addrV2Entry(1,bytes(5),8333))
+        payload = createVarInt(2) + addrV2Entry(1,bytes([8,8,4,4]),8333) + addrV2Entry(2,packIP('2001:db8::1'),8334)
+        for length in (0,len(payload)-1,len(payload)-17,3):
+            with self.assertRaisesRegex(ValueError,'truncated'):
+                parseAddrV2Payload(payload[:length])
+        with self.assertRaisesRegex(ValueError,'limit'):
+            parseAddrV2Payload(createVarInt(MAX_ADDRESSES+1))
+
+class BookTest(unittest.TestCase):
+    def testAdd(self):
+        book = AddressBook()
+        now = int(time.time())
+        addresses,skipped = parseAddrV2Payload(createVarInt(3) + addrV2Entry(1,bytes([8,8,4,4]),8333,timestamp=now-60) + addrV2Entry(1,bytes([10,0,0,1]),8333)
+                                               + addrV2Entry(1,bytes([1,1,1,1]),0))
+        self.assertEqual(book.addMany(addresses),1)
+        self.assertEqual(book.counters['rejected'],2)
+        # Announced again, only the newest time is kept
+        self.assertFalse(book.add('8.8.4.4',8333,timestamp=now-3600))
+        self.assertEqual(book.entries[(packIP('8.8.4.4'),8333)].lastSeen,now-60)
+        # A time in the future is not believed
+        book.add('8.8.8.8',8333,timestamp=now+86400)
+        self.assertLess(book.entries[(packIP('8.8.8.8'),8333)].lastSeen,now)
+        self.assertEqual(book.stats()['ipv4'],2)
+
+    def testBest(self):
+        book = AddressBook()
+        for i in range(1,6):
+            book.add(f'8.8.8.{i}',8333)
+        book.recordSuccess('8.8.8.3',8333,0.5)
+        book.recordSuccess('8.8.8.4',8333,0.05)
+        book.recordFailure('8.8.8.1',8333)
+        best = book.best(5)
+        self.assertEqual(best[0:2],[('8.8.8.4',8333),('8.8.8.3',8333)])
+        self.assertEqual(best[-1],('8.8.8.1',8333))
+        self.assertEqual(book.best(2,exclude=[('8.8.8.4',8333)]),[('8.8.8.3',8333),best[2]])
+
+    def testEvictionKeepsWorkingPeers(self):
+        book = AddressBook(maxEntries=50)
+        for i in range(1,11):
+            book.add(f'8.8.8.{i}',8333)
+            book.recordSuccess(f'8.8.8.{i}',8333,0.1)
+        # A flood of addresses nobody has connected to fills the book many times over
+        for i in range(1000):
+            book.add(f'9.9.{i//250}.{i%250+1}',8333)
+        self.assertEqual(len(book),50)
+        self.assertEqual(book.counters['evicted'],960)
+        self.assertEqual(len(book.keys),50)
+        self.assertEqual({key: index for index,key in enumerate(book.keys)},book.keyIndex)
+        # A working peer is only evicted when all eight sampled entries are working peers, which is rare
+        kept = sum(1 for i in range(1,11) if (packIP(f'8.8.8.{i}'),8333) in book.entries)
+        self.assertGreaterEqual(kept,9)
+
+    def testEvictsWorstOfSample(self):
+        book = AddressBook(maxEntries=4,evictionSample=4)
+        for i in range(1,5):
+            book.add(f'8.8.8.{i}',8333)
+        book.recordFailure('8.8.8.2',8333)
+        book.add('8.8.8.5',8333)
+        self.assertNotIn((packIP('8.8.8.2'),8333),book.entries)
+        self.assertEqual(len(book),4)
+
+class SaveLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name,'addresses.dat')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def testRoundTrip(self):
+        self.assertEqual(RECORD.size,48)
+        book = AddressBook()
+        book.add('8.8.8.8',8333,services=1033,timestamp=1700000000)
+        book.add('2001:4860::8888',18333,services=9,timestamp=1700000001)
+        book.recordSuccess('8.8.8.8',8333,0.25)
+        book.recordFailure('2001:4860::8888',18333)
+        book.save(self.path)
+        self.assertEqual(os.path.getsize(self.path),12 + 48*2)
+        loaded = AddressBook.load(self.path)
+        self.assertEqual(list(loaded.entries),list(book.entries))
+        for key,entry in book.entries.items():
+            self.assertEqual([getattr(loaded.entries[key],name) for name in AddressEntry.__slots__],[getattr(entry,name) for name in AddressEntry.__slots__])
+        self.assertEqual(loaded.best(2),book.best(2))
+        self.assertEqual(len(AddressBook.load(self.path,maxEntries=1)),1)
+
+    def testBadFile(self):
+        AddressBook().save(self.path)
+        self.assertEqual(len(AddressBook.load(self.path)),0)
+        with open(self.path,'ab') as bookFile:
+            bookFile.write(bytes(10))
+        with self.assertRaisesRegex(ValueError,'truncated'):
+            AddressBook.load(self.path)
+        with open(self.path,'wb') as bookFile:
+            bookFile.write(b'not a book')
+        with self.assertRaises(ValueError):
+            AddressBook.load(self.path)
+
+class ConnectorParseTest(unittest.TestCase):
+    def testParseTimedByCommand(self):
+        connector = BitcoinConnector(ip='127.0.0.1',connect=False,addressBook=AddressBook())
+        metrics = ConnectorMetrics()
+        metrics.attach(connector)
+        addr   = createAddrPayload([(int(time.time()),1,'8.8.8.8',8333)])
+        addrV2 = createVarInt(2) + addrV2Entry(1,bytes([8,8,4,4]),8333,timestamp=int(time.time())) + addrV2Entry(4,os.urandom(32),9050)
+        self.assertEqual(len(connector.parseMessage('addr',memoryview(addr),display=False)),1)
+        for i in range(2):
+            self.assertEqual(len(connector.parseMessage('addrv2',memoryview(addrV2),display=False)),1)
+        self.assertIsNone(connector.parseAddrV2Payload(addrV2[:-1],display=False))
+        # Each message is timed once, under its own command
+        counts = {labels: entry[2] for labels,entry in metrics.parseSeconds.values.items()}
+        self.assertEqual(counts,{('addr',):1,('addrv2',):3})
+        self.assertEqual(len(connector.addressBook),2)
+        self.assertEqual(connector.addressBook.counters['skippedNetworks'],2)
+
+class ConnectFallbackTest(unittest.TestCase):
+    def setUp(self):
+        self.mockPeer = MockPeer(txRate=0,handshakeGap=0)
+        self.host,self.port = self.mockPeer.start()
+
+    def tearDown(self):
+        self.mockPeer.stop()
+
+    def testNextBestAddressTried(self):
+        book = AddressBook(allowPrivate=True)
+        refused = [closedPort(),closedPort()]
+        # The refusing addresses have worked before so they rank above the mock peer
+        for port in refused:
+            book.recordSuccess('127.0.0.1',port,0.01)
+        book.add(self.host,self.port)
+        with mock.patch.object(BitcoinConnector,'getIPAddress',side_effect=AssertionError('DNS lookup done')):
+            connector = BitcoinConnector(ip=None,addressBook=book)
+        try:
+            self.assertEqual((connector.peerIP,connector.peerPort),(self.host,self.port))
+            self.assertIsNotNone(connector.connectToPeer(timeout=5))
+        finally:
+            connector.socket.close()
+        for port in refused:
+            self.assertEqual(book.entries[(packIP('127.0.0.1'),port)].failures,1)
+        self.assertEqual(book.entries[(packIP(self.host),self.port)].successes,1)
+
+    def testDNSLookupWhenNoneConnect(self):
+        book = AddressBook(allowPrivate=True)
+        book.add('127.0.0.1',closedPort())
+        with mock.patch.object(BitcoinConnector,'getIPAddress',return_value=self.host) as lookup:
+            connector = BitcoinConnector(ip=None,peerPort=self.port,addressBook=book)
+        try:
+            lookup.assert_called_once()
+            self.assertEqual((connector.peerIP,connector.peerPort),(self.host,self.port))
+            self.assertIsNotNone(connector.connectToPeer(timeout=5))
+        finally:
+            connector.socket.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   Tests for Lib/BlockFilter.py, building and matching BIP158 basic filters and keeping them in a FilterIndex.
+#   The filter and filter header of the testnet genesis block are checked against the test vector of BIP158.
+#   Run from the top directory with: python -m unittest discover -s tests   (or python -m pytest tests)
+
+
+## Imports ##
+# os          - https://docs.python.org/3/library/os.html
+# struct      - https://docs.python.org/3/library/struct.html
+# tempfile    - https://docs.python.org/3/library/tempfile.html
+# unittest    - https://docs.python.org/3/library/unittest.html
+# BlockFilter - The functions and classes being tested, see Lib/BlockFilter.py
+# Block       - Parses the blocks the filters are built from, see Lib/Block.py
+# MockPeer    - Creates the blocks of the chain kept in the FilterIndex, see Lib/MockPeer.py
+import os
+import struct
+import tempfile
+import unittest
+from Lib.BlockFilter import BlockFilter,FilterIndex,RECORD,encodeFilter,decodeFilter,hashedItems,filterItems
+from Lib.Block import Block
+from Lib.MockPeer import createTransaction,createBlock
+
+# GENESIS_COINBASE - The coinbase of the genesis block, the same on mainnet and testnet
+GENESIS_COINBASE = bytes.fromhex(
+    '01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff4d04ffff001d0104455468652054696d65732030332f4a616e2f32303039'
+    '204368616e63656c6c6f72206f6e206272696e6b206f66207365636f6e64206261696c6f757420666f722062616e6b73ffffffff0100f2052a01000000434104678afdb0fe5548'
+    '271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac00000000')
+GENESIS_MERKLE_ROOT = bytes.fromhex('4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b')[::-1]
+# TESTNET_GENESIS - The testnet genesis block, time 1296688602 and nonce 414098458
+TESTNET_GENESIS = struct.pack('<i32s32sIII',1,bytes(32),GENESIS_MERKLE_ROOT,1296688602,0x1d00ffff,414098458) + b'\x01' + GENESIS_COINBASE
+# The expected values from the BIP158 test vectors, the hashes in display byte order
+TESTNET_GENESIS_HASH   = '000000000933ea01ad0ee984209779baaec3ced90fa3f408719526f8d77f4943'
+TESTNET_GENESIS_FILTER = '019dfca8'
+TESTNET_GENESIS_HEADER = '21584579b7eb08997773e5aeff3a7f932700042d0ed2a6129012b7d7ae81b750'
+
+class BlockFilterTest(unittest.TestCase):
+    def testTestnetGenesisVector(self):
+        block = Block(TESTNET_GENESIS)
+        self.assertEqual(block.header.hash[::-1].hex(),TESTNET_GENESIS_HASH)
+        blockFilter,missing = BlockFilter.fromBlock(block)
+        # The coinbase spends nothing so no scripts are missing
+        self.assertEqual(missing,0)
+        self.assertEqual(blockFilter.data.hex(),TESTNET_GENESIS_FILTER)
+        self.assertEqual(blockFilter.header()[::-1].hex(),TESTNET_GENESIS_HEADER)
+        script = GENESIS_COINBASE[-71:-4]
+        self.assertEqual(blockFilter.match([script,b'\x51']),{script})
+
+    def testEncodeDecodeRoundTrip(self):
+        blockHash = bytes(range(32))
+        items = {os.urandom(25) for i in range(500)}
+        data  = encodeFilter(blockHash,items)
+        self.assertEqual(list(decodeFilter(data)),sorted(hashedItems(blockHash,items,len(items))))
+        self.assertEqual(len(BlockFilter(blockHash,data)),500)
+
+    def testMatch(self):
+        blockHash = bytes(range(32))
+        items = {os.urandom(25) for i in range(1000)}
+        blockFilter = BlockFilter(blockHash,encodeFilter(blockHash,items))
+        self.assertEqual(blockFilter.match(items),items)
+        # A script not in the block matches with a probability of 1/784931
+        self.assertLessEqual(len(blockFilter.match(os.urandom(25) for i in range(1000))),1)
+
+    def testEmptyFilter(self):
+        blockFilter = BlockFilter(bytes(32),encodeFilter(bytes(32),set()))
+        self.assertEqual(blockFilter.data,b'\x00')
+        self.assertEqual(blockFilter.match([b'\x51']),set())
+
+    def testTruncatedFilter(self):
+        data = encodeFilter(bytes(32),{os.urandom(25) for i in range(20)})
+        with self.assertRaises(ValueError):
+            list(decodeFilter(data[:-5]))
+
+    def testFilterItems(self):
+        block = Block(createBlock(bytes(32),[createTransaction(250),createTransaction(250)],1))
+        transactions = list(block.transactions())
+        outputs = {bytes(transaction.output(i).pkScript) for transaction in transactions for i in range(transaction.outputCount)}
+        items,missing = filterItems(block)
+        self.assertEqual(items,outputs)
+        self.assertEqual(missing,2)
+        # With a lookup the scripts of the spent outputs are added, the coinbase is not looked up
+        lookups = []
+        def prevoutScript(previousHash,previousIndex):
+            lookups.append(previousHash)
+            return b'\x00\x14' + previousHash[:20] if len(lookups) == 1 else None
+        items,missing = filterItems(block,prevoutScript)
+        self.assertEqual(len(lookups),2)
+        self.assertEqual(items,outputs | {b'\x00\x14' + lookups[0][:20]})
+        self.assertEqual(missing,1)
+
+    def testOpReturnLeftOut(self):
+        opReturn = (struct.pack('<i',2) + b'\x01' + bytes(36) + b'\x00' + b'\xff\xff\xff\xff'
+                    + b'\x02' + bytes(8) + b'\x03\x6a\x01\x00' + bytes(8) + b'\x00' + b'\x00\x00\x00\x00')
+        block = Block(createBlock(bytes(32),[opReturn],1))
+        items,missing = filterItems(block)
+        self.assertFalse(any(item[0] == 0x6a for item in items))
+        self.assertNotIn(b'',items)
+
+class FilterIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+        # A chain of three blocks on top of the testnet genesis block
+        self.blocks = [Block(TESTNET_GENESIS)]
+        for height in range(1,4):
+            self.blocks.append(Block(createBlock(self.blocks[-1].header.hash,[createTransaction(250) for i in range(5)],height)))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def testHeadersChain(self):
+        index = FilterIndex(self.path)
+        headers = [index.addBlock(block) for block in self.blocks]
+        index.close()
+        self.assertEqual(headers[0][::-1].hex(),TESTNET_GENESIS_HEADER)
+        previous = headers[0]
+        for block,header in zip(self.blocks[1:],headers[1:]):
+            self.assertEqual(header,BlockFilter.fromBlock(block)[0].header(previous))
+            previous = header
+
+    def testReopen(self):
+        index = FilterIndex(self.path)
+        for block in self.blocks:
+            index.addBlock(block)
+        # Adding a block again does not write it twice
+        index.addBlock(self.blocks[1])
+        self.assertEqual(index.stats['filters'],4)
+        index.close()
+        index = FilterIndex(self.path)
+        try:
+            self.assertEqual(len(index),4)
+            for block in self.blocks:
+                self.assertIn(block.header.hash,index)
+                self.assertEqual(index.getFilter(block.header.hash).data,BlockFilter.fromBlock(block)[0].data)
+            self.assertIsNone(index.getFilter(bytes(32)))
+        finally:
+            index.close()
+
+    def testTornRecordDropped(self):
+        index = FilterIndex(self.path)
+        for block in self.blocks:
+            index.addBlock(block)
+        index.close()
+        # A crash part way through writing the last record
+        idxPath = os.path.join(self.path,'filters.idx')
+        os.truncate(idxPath,os.path.getsize(idxPath) - RECORD.size//2)
+        index = FilterIndex(self.path)
+        try:
+            self.assertEqual(len(index),3)
+            self.assertNotIn(self.blocks[-1].header.hash,index)
+        finally:
+            index.close()
+
+    def testScan(self):
+        index = FilterIndex(self.path)
+        try:
+            for block in self.blocks:
+                index.addBlock(block)
+            transaction = list(self.blocks[2].transactions())[3]
+            script = bytes(transaction.output(0).pkScript)
+            results = dict(index.scan([script,b'\x00\x14' + bytes(20)]))
+            self.assertEqual(results,{self.blocks[2].header.hash:{script}})
+        finally:
+            index.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   Tests for Lib/CaptureLog.py, writing segments, reopening a capture which was torn part way through a write, and the time range and command scans of CaptureReader.
+#   Run from the top directory with: python -m unittest discover -s tests   (or python -m pytest tests)
+
+
+## Imports ##
+# os         - https://docs.python.org/3/library/os.html
+# mmap       - https://docs.python.org/3/library/mmap.html
+# tempfile   - https://docs.python.org/3/library/tempfile.html
+# unittest   - https://docs.python.org/3/library/unittest.html
+# mock       - https://docs.python.org/3/library/unittest.mock.html
+# CaptureLog - The classes and functions being tested, see Lib/CaptureLog.py
+import os
+import mmap
+import tempfile
+import unittest
+from unittest import mock
+from Lib.CaptureLog import CaptureLog,CaptureReader,RECORD,packIP,unpackIP,segmentNumbers
+
+# COMMANDS - The command of each message written by writeCapture, in turn
+COMMANDS = ('inv','tx','tx','block','ping')
+
+def writeCapture(directory,count,segmentBytes=1<<30,start=1000.0):
+    # Writes count messages a second apart, message i has a payload of i+1 bytes of i and comes from 10.0.0.(i%4)
+    capture = CaptureLog(directory,segmentBytes=segmentBytes)
+    for i in range(count):
+        capture.append(COMMANDS[i%len(COMMANDS)],bytes([i%256])*(i+1),peer=(f'10.0.0.{i%4}',8333),timestamp=start+i)
+    capture.close()
+
+class TrackedMmap(mmap.mmap):
+    # maps - Every map opened while patched in, to check none are left open
+    maps = []
+
+    def __new__(cls,*args,**kwargs):
+        memoryMap = super().__new__(cls,*args,**kwargs)
+        cls.maps.append(memoryMap)
+        return memoryMap
+
+class CaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def testIPRoundTrip(self):
+        for ip in ('10.0.0.1','2001:db8::1','::1'):
+            self.assertEqual(unpackIP(packIP(ip)),ip)
+        self.assertEqual(packIP(None),bytes(16))
+        self.assertEqual(packIP('not an ip'),bytes(16))
+
+    def testWriteAndReplay(self):
+        writeCapture(self.path,20)
+        reader = CaptureReader(self.path)
+        try:
+            self.assertEqual(len(reader),20)
+            for i,(timestamp,command,peer,payload) in enumerate(reader.messages()):
+                self.assertEqual((timestamp,command,peer),(1000.0+i,COMMANDS[i%len(COMMANDS)],(f'10.0.0.{i%4}',8333)))
+                self.assertEqual(bytes(payload),bytes([i])*(i+1))
+            timestamp,command,peer,payload = reader.record(19)
+            self.assertEqual((timestamp,command,bytes(payload)),(1019.0,'ping',bytes([19])*20))
+            payload.release()
+            with self.assertRaises(IndexError):
+                reader.record(20)
+        finally:
+            reader.close()
+
+    def testSegments(self):
+        # Every 50 bytes a new segment is started, the records run on across them
+        writeCapture(self.path,30,segmentBytes=50)
+        numbers = segmentNumbers(self.path)
+        self.assertGreater(len(numbers),3)
+        reader = CaptureReader(self.path)
+        try:
+            self.assertEqual(len(reader.segments),len(numbers))
+            self.assertEqual([timestamp for timestamp,command,peer,payload in reader.messages()],[1000.0+i for i in range(30)])
+            for i in range(30):
+                (data,index,records),local = reader.locate(i)
+                self.assertLess(local,records)
+                self.assertEqual(reader.timestamp(i),1000.0+i)
+        finally:
+            reader.close()
+        # Opening the capture again starts a new segment after the others
+        capture = CaptureLog(self.path,segmentBytes=50)
+        capture.append('tx',b'\x01',timestamp=2000.0)
+        capture.close()
+        self.assertEqual(segmentNumbers(self.path),numbers+[numbers[-1]+1])
+        reader = CaptureReader(self.path)
+        try:
+            self.assertEqual(len(reader),31)
+            self.assertEqual(reader.record(30)[0:2],(2000.0,'tx'))
+        finally:
+            reader.close()
+
+    def testTornSegment(self):
+        writeCapture(self.path,10)
+        base = os.path.join(self.path,'capture-000000')
+        # Half of a record is written after the last one, and the last payload only partly reached the data file
+        with open(base+'.idx','ab') as idxFile:
+            idxFile.write(bytes(RECORD.size//2))
+        with open(base+'.dat','r+b') as dataFile:
+            dataFile.truncate(os.path.getsize(base+'.dat')-3)
+        reader = CaptureReader(self.path)
+        try:
+            self.assertEqual(len(reader),9)
+            self.assertEqual(bytes(reader.record(8)[3]),bytes([8])*9)
+        finally:
+            reader.close()
+
+    def testTornSegmentWithNoWholeRecordClosed(self):
+        # Only part of the payload got to disk before the capture stopped, its record points past it
+        capture = CaptureLog(self.path)
+        capture.append('block',bytes(100),timestamp=1000.0)
+        capture.close()
+        base = os.path.join(self.path,'capture-000000')
+        with open(base+'.dat','r+b') as dataFile:
+            dataFile.truncate(40)
+        writeCapture(self.path,2,start=2000.0)
+        TrackedMmap.maps = []
+        with mock.patch('mmap.mmap',TrackedMmap):
+            reader = CaptureReader(self.path)
+        try:
+            self.assertEqual(len(reader),2)
+            self.assertEqual(len(TrackedMmap.maps),4)
+            inUse = {id(index) for data,index,records in reader.segments} | {id(data.obj) for data,index,records in reader.segments}
+            self.assertTrue(all(memoryMap.closed for memoryMap in TrackedMmap.maps if id(memoryMap) not in inUse))
+        finally:
+            reader.close()
+        self.assertTrue(all(memoryMap.closed for memoryMap in TrackedMmap.maps))
+
+    def testFindTime(self):
+        writeCapture(self.path,50,segmentBytes=200)
+        reader = CaptureReader(self.path)
+        try:
+            self.assertEqual(reader.findTime(0),0)
+            self.assertEqual(reader.findTime(1000.0),0)
+            self.assertEqual(reader.findTime(1020.0),20)
+            self.assertEqual(reader.findTime(1020.5),21)
+            self.assertEqual(reader.findTime(5000),50)
+            timestamps = [timestamp for timestamp,command,peer,payload in reader.messages(start=1010.0,end=1040.0)]
+            self.assertEqual(timestamps,[1000.0+i for i in range(10,40)])
+            self.assertEqual(list(reader.messages(start=1040.0,end=1010.0)),[])
+        finally:
+            reader.close()
+
+    def testCommandScan(self):
+        writeCapture(self.path,50,segmentBytes=200)
+        reader = CaptureReader(self.path)
+        try:
+            blocks = [(timestamp,command) for timestamp,command,peer,payload in reader.messages(commands={'block'})]
+            self.assertEqual(blocks,[(1000.0+i,'block') for i in range(3,50,5)])
+            both = [command for timestamp,command,peer,payload in reader.messages(start=1010.0,end=1020.0,commands={'tx','ping'})]
+            self.assertEqual(both,['tx','tx','ping','tx','tx','ping'])
+            self.assertEqual(list(reader.messages(commands={'headers'})),[])
+        finally:
+            reader.close()
+
+    def testEmptyCapture(self):
+        CaptureLog(self.path).close()
+        reader = CaptureReader(self.path)
+        self.assertEqual(len(reader),0)
+        self.assertEqual(list(reader.messages()),[])
+        self.assertEqual(reader.findTime(1000.0),0)
+        reader.close()
+
+if __name__ == '__main__':
+    unittest.main()
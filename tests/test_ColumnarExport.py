@@ -0,0 +1,151 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   Tests for Lib/ColumnarExport.py, writing transactions and blocks to chunk files and reading the columns back.
+#   The reader is tested with memoryviews, and with NumPy arrays as well when NumPy is installed.
+#   Run from the top directory with: python -m unittest discover -s tests   (or python -m pytest tests)
+
+
+## Imports ##
+# os               - https://docs.python.org/3/library/os.html
+# struct           - https://docs.python.org/3/library/struct.html
+# tempfile         - https://docs.python.org/3/library/tempfile.html
+# unittest         - https://docs.python.org/3/library/unittest.html
+# ColumnarExport   - The classes and functions being tested, see Lib/ColumnarExport.py
+# ScriptClassifier - The script types expected in the scriptType column, see Lib/ScriptClassifier.py
+# Transaction      - Parses the transactions exported, see Lib/Transaction.py
+# Block            - Parses the blocks exported, see Lib/Block.py
+# MockPeer         - Creates the transactions and blocks, see Lib/MockPeer.py
+import os
+import struct
+import tempfile
+import unittest
+from Lib.ColumnarExport import ColumnarExporter,ColumnarReader,SCRIPT_TYPES,readChunk,numpy
+from Lib.ScriptClassifier import P2WPKH,OP_RETURN,classifyScript
+from Lib.Transaction import Transaction
+from Lib.Block import Block
+from Lib.MockPeer import createTransaction,createBlock
+
+def column(chunk,name):
+    # A column as a list, or as bytes for the byte string columns, whether the reader gave NumPy arrays or memoryviews
+    data = chunk[name]
+    if name.endswith(('hash','txid','prevBlock','prevHash')):
+        return bytes(data)
+    return data.tolist()
+
+class ColumnarExportTest(unittest.TestCase):
+    useNumpy = False
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+        # A block of mixed transactions, then two tx messages, one with an OP_RETURN output
+        self.block = Block(createBlock(bytes(32),[createTransaction(400,inputs=2,witness=i % 2 == 0) for i in range(6)],1,timestamp=1700000000))
+        opReturn = (struct.pack('<i',2) + b'\x01' + bytes(36) + b'\x00' + b'\xff\xff\xff\xff'
+                    + b'\x02' + struct.pack('<q',5000) + b'\x16\x00\x14' + bytes(range(20)) + bytes(8) + b'\x03\x6a\x01\x00' + b'\x00\x00\x00\x00')
+        self.messages = [Transaction(createTransaction(300,witness=True)),Transaction(opReturn)]
+        self.transactions = list(self.block.transactions()) + self.messages
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def export(self,rowsPerChunk=1000000):
+        exporter = ColumnarExporter(self.path,rowsPerChunk=rowsPerChunk)
+        exporter.addBlock(self.block,received=1.5)
+        for transaction in self.messages:
+            exporter.addTransaction(transaction,received=2.5)
+        exporter.close()
+        return exporter
+
+    def reader(self):
+        return ColumnarReader(self.path,useNumpy=self.useNumpy)
+
+    def testRoundTrip(self):
+        self.export()
+        chunks = list(self.reader().chunks())
+        self.assertEqual(len(chunks),1)
+        chunk = chunks[0]
+        transactions = self.transactions
+        # block table
+        self.assertEqual(column(chunk,'block.hash'),self.block.header.hash)
+        self.assertEqual(column(chunk,'block.timestamp'),[1700000000])
+        self.assertEqual(column(chunk,'block.txCount'),[7])
+        self.assertEqual(column(chunk,'block.firstTx'),[0])
+        self.assertEqual(column(chunk,'block.received'),[1.5])
+        # tx table, the tx messages have no block
+        self.assertEqual(column(chunk,'tx.txid'),b''.join(transaction.txid for transaction in transactions))
+        self.assertEqual(column(chunk,'tx.size'),[transaction.size for transaction in transactions])
+        self.assertEqual(column(chunk,'tx.vsize'),[transaction.vsize for transaction in transactions])
+        self.assertEqual(column(chunk,'tx.block'),[0]*7 + [-1,-1])
+        self.assertEqual(column(chunk,'tx.received'),[1.5]*7 + [2.5,2.5])
+        # input table
+        inputs = [txIn for transaction in transactions for txIn in transaction.inputs()]
+        self.assertEqual(column(chunk,'input.prevHash'),b''.join(bytes(txIn.previousHash) for txIn in inputs))
+        self.assertEqual(column(chunk,'input.prevIndex'),[txIn.previousIndex for txIn in inputs])
+        self.assertEqual(column(chunk,'input.tx'),[row for row,transaction in enumerate(transactions) for txIn in transaction.inputs()])
+        # output table, each script is found in the blob from its offset and length
+        outputs = [transaction.output(i) for transaction in transactions for i in range(transaction.outputCount)]
+        self.assertEqual(column(chunk,'output.value'),[txOut.value for txOut in outputs])
+        blob = bytes(chunk['scripts'])
+        scripts = [blob[offset:offset+length] for offset,length in zip(column(chunk,'output.scriptOffset'),column(chunk,'output.scriptLength'))]
+        self.assertEqual(scripts,[bytes(txOut.pkScript) for txOut in outputs])
+        self.assertEqual([SCRIPT_TYPES[code] for code in column(chunk,'output.scriptType')],[classifyScript(script)[0] for script in scripts])
+        self.assertEqual([SCRIPT_TYPES[code] for code in column(chunk,'output.scriptType')][-2:],[P2WPKH,OP_RETURN])
+        # The first input and output of each transaction
+        firstOutputs = column(chunk,'tx.firstOutput')
+        self.assertEqual([firstOutputs[i+1] - firstOutputs[i] for i in range(len(transactions)-1)],[transaction.outputCount for transaction in transactions[:-1]])
+        self.assertEqual(column(chunk,'tx.firstInput')[-1],len(inputs) - 1)
+
+    def testChunks(self):
+        exporter = self.export(rowsPerChunk=3)
+        # The block of 7 transactions is not split, the two tx messages fill the next chunk up to the end
+        self.assertEqual(exporter.stats,{'blocks':1,'transactions':9,'inputs':sum(t.inputCount for t in self.transactions),
+                                         'outputs':sum(t.outputCount for t in self.transactions),'chunks':2})
+        reader = self.reader()
+        self.assertEqual([len(chunk['tx.version']) for chunk in reader.chunks()],[7,2])
+        # The row references start again in each chunk
+        self.assertEqual(list(reader.chunks())[1]['input.tx'].tolist(),[0,1])
+        self.assertEqual(bytes(reader.column('tx.txid')),b''.join(transaction.txid for transaction in self.transactions))
+        # A new exporter carries on after the chunks already written
+        exporter = ColumnarExporter(self.path)
+        exporter.addTransaction(self.messages[0])
+        self.assertTrue(exporter.flush().endswith('chunk-000002.col'))
+
+    def testSummary(self):
+        self.export()
+        summary = self.reader().summary()
+        outputs = [transaction.output(i) for transaction in self.transactions for i in range(transaction.outputCount)]
+        self.assertEqual((summary['blocks'],summary['transactions'],summary['inputs'],summary['outputs']),
+                         (1,9,sum(t.inputCount for t in self.transactions),len(outputs)))
+        self.assertEqual(summary['totalValue'],sum(txOut.value for txOut in outputs))
+        byType = {}
+        for txOut in outputs:
+            scriptType = classifyScript(txOut.pkScript)[0]
+            byType[scriptType] = byType.get(scriptType,0) + txOut.value
+        self.assertEqual(summary['valueByScriptType'],{scriptType:value for scriptType,value in byType.items() if value})
+        sizes = [transaction.size for transaction in self.transactions]
+        self.assertEqual(sum(summary['sizeDistribution'].values()),9)
+        for start,count in summary['sizeDistribution'].items():
+            self.assertEqual(count,sum(1 for size in sizes if start <= size < 2*start))
+        self.assertIn(summary['sizePercentiles'][50],sizes)
+
+    def testEmptyDirectory(self):
+        exporter = ColumnarExporter(self.path)
+        self.assertIsNone(exporter.flush())
+        self.assertEqual(self.reader().summary()['transactions'],0)
+        self.assertEqual(len(self.reader().column('output.value')),0)
+
+    def testNotAChunk(self):
+        path = os.path.join(self.path,'chunk-000000.col')
+        with open(path,'wb') as chunkFile:
+            chunkFile.write(bytes(64))
+        with self.assertRaises(ValueError):
+            readChunk(path)
+
+@unittest.skipIf(numpy is None,'NumPy is not installed')
+class ColumnarExportNumpyTest(ColumnarExportTest):
+    useNumpy = True
+
+if __name__ == '__main__':
+    unittest.main()
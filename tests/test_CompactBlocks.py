@@ -0,0 +1,182 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   Tests for Lib/CompactBlocks.py, rebuilding compact blocks from the mempool of a BitcoinConnector, and the witness getdata requests they rely on.
+#   Run from the top directory with: python -m unittest discover -s tests   (or python -m pytest tests)
+
+
+## Imports ##
+# time             - https://docs.python.org/3/library/time.html
+# struct           - https://docs.python.org/3/library/struct.html
+# unittest         - https://docs.python.org/3/library/unittest.html
+# BitcoinConnector - The connector whose mempool the blocks are rebuilt from, see Lib/BitcoinConnector.py
+# Mempool          - Holds the transactions the compact blocks are rebuilt from, see Lib/Mempool.py
+# CompactBlocks    - The class and functions being tested, see Lib/CompactBlocks.py
+# GetDataScheduler - Creates the getdata payloads of Lib/AsyncBitcoinConnector.py, see Lib/GetDataScheduler.py
+# MockPeer         - Creates the transactions and blocks, and serves them over a local socket, see Lib/MockPeer.py
+# Transaction      - Used to work out the txids, see Lib/Transaction.py
+# Block            - Used to work out the block hashes, see Lib/Block.py
+import time
+import struct
+import unittest
+from Lib.BitcoinConnector import BitcoinConnector
+from Lib.Mempool import Mempool
+from Lib.CompactBlocks import CompactBlock,ShortIDCollision,MSG_CMPCT_BLOCK,createCmpctBlockPayload,createBlockTxnPayload
+from Lib.GetDataScheduler import GetDataScheduler
+from Lib.MockPeer import MockPeer,createTransaction,createBlock,stripWitness,stripBlockWitness
+from Lib.Transaction import Transaction,readVarInt
+from Lib.Block import Block
+
+# MSG_WITNESS_TX/MSG_WITNESS_BLOCK - The inventory types which ask for the witness serialization
+MSG_WITNESS_TX    = 0x40000001
+MSG_WITNESS_BLOCK = 0x40000002
+
+def inventoryTypes(payload):
+    # The type of each vector in a getdata payload
+    count,position = readVarInt(payload,0)
+    return [struct.unpack_from('<I',payload,position+36*i)[0] for i in range(count)]
+
+class RebuildTest(unittest.TestCase):
+    def setUp(self):
+        self.connector = BitcoinConnector(ip='127.0.0.1',connect=False)
+        self.connector.mempool = Mempool()
+        # Mostly SegWit transactions, like mainnet
+        self.transactions = [createTransaction(250,witness=i % 5 != 0) for i in range(50)]
+        self.block = createBlock(bytes(32),self.transactions,1)
+
+    def testSegWitTransactionsAreFound(self):
+        for transaction in self.transactions:
+            self.connector.parseTXPayload(transaction,display=False)
+        block,request = self.connector.parseCmpctBlockPayload(createCmpctBlockPayload(self.block),display=False)
+        self.assertIsNone(request)
+        self.assertEqual(block.header.hash,Block(self.block).header.hash)
+        # Every transaction was in the mempool so they are all removed with the block
+        self.assertEqual(len(self.connector.mempool),0)
+
+    def testTransactionsWithoutWitnessAreMissed(self):
+        # What a peer sends for MSG_TX, the mempool then holds wtxid == txid and the short IDs of the SegWit transactions do not match
+        for transaction in self.transactions:
+            self.connector.parseTXPayload(stripWitness(Transaction(transaction)),display=False)
+        block,request = self.connector.parseCmpctBlockPayload(createCmpctBlockPayload(self.block),display=False)
+        self.assertIsNone(block)
+        self.assertEqual(request[0],'getblocktxn')
+        missing = [i for i,transaction in enumerate(self.transactions,1) if Transaction(transaction).hasWitness]
+        self.assertEqual(self.connector.partialBlocks[Block(self.block).header.hash].missing(),missing)
+
+    def testBlockTxnCompletesTheBlock(self):
+        for transaction in self.transactions[:25]:
+            self.connector.parseTXPayload(transaction,display=False)
+        block,request = self.connector.parseCmpctBlockPayload(createCmpctBlockPayload(self.block),display=False)
+        self.assertEqual(request[0],'getblocktxn')
+        compactBlock = self.connector.partialBlocks[Block(self.block).header.hash]
+        self.assertEqual(compactBlock.missing(),list(range(26,51)))
+        blockTxn = createBlockTxnPayload(compactBlock.hash,self.transactions[25:])
+        block,request = self.connector.parseBlockTxnPayload(blockTxn,display=False)
+        self.assertIsNone(request)
+        self.assertEqual(block.header.hash,compactBlock.hash)
+
+    def testShortIDCollisionRequestsFullBlock(self):
+        # The same transaction twice gives the same short ID twice, the block can not be rebuilt so it is downloaded whole
+        transaction = self.transactions[1]
+        block = createBlock(bytes(32),[transaction,transaction],1)
+        blockHash = Block(block).header.hash
+        with self.assertRaises(ShortIDCollision) as raised:
+            CompactBlock(createCmpctBlockPayload(block))
+        self.assertEqual(raised.exception.blockHash,blockHash)
+        block,request = self.connector.parseCmpctBlockPayload(createCmpctBlockPayload(block),display=False)
+        self.assertIsNone(block)
+        self.assertEqual(request,self.connector.createFullBlockRequest(blockHash))
+        self.assertNotIn(blockHash,self.connector.partialBlocks)
+
+class WitnessRequestTest(unittest.TestCase):
+    def setUp(self):
+        self.connector = BitcoinConnector(ip='127.0.0.1',connect=False)
+        self.txHash    = bytes(range(32))
+        self.blockHash = bytes(range(32,64))
+        self.vecs      = struct.pack('<I',1) + self.txHash + struct.pack('<I',2) + self.blockHash
+
+    def testGetDataAsksForWitness(self):
+        self.assertEqual(inventoryTypes(self.connector.createGetDataCMD(self.vecs)),[MSG_WITNESS_TX,MSG_WITNESS_BLOCK])
+
+    def testGetDataAsksForCompactBlocksOnceAgreed(self):
+        self.connector.compactBlockVersion = 2
+        self.assertEqual(inventoryTypes(self.connector.createGetDataCMD(self.vecs)),[MSG_WITNESS_TX,MSG_CMPCT_BLOCK])
+
+    def testFullBlockFallbackAsksForWitness(self):
+        command,payload = self.connector.createFullBlockRequest(self.blockHash)
+        self.assertEqual(command,'getdata')
+        self.assertEqual(inventoryTypes(payload),[MSG_WITNESS_BLOCK])
+        self.assertEqual(payload[-32:],self.blockHash)
+
+    def testSchedulerAsksForWitness(self):
+        scheduler = GetDataScheduler(inventoryCache=None)
+        vecs = [self.vecs[0:36],self.vecs[36:72],struct.pack('<I',3) + self.txHash]
+        payload, = scheduler.createGetDataPayloads(vecs)
+        self.assertEqual(inventoryTypes(payload),[MSG_WITNESS_TX,MSG_WITNESS_BLOCK,3])
+        self.assertEqual(payload[5:37],self.txHash)
+
+class MockPeerWitnessTest(unittest.TestCase):
+    def testStrippedBlockKeepsTheTxids(self):
+        block = createBlock(bytes(32),[createTransaction(300,witness=True),createTransaction(300)],1)
+        stripped = stripBlockWitness(block)
+        self.assertLess(len(stripped),len(block))
+        self.assertEqual([transaction.txid for transaction in Block(stripped).transactions()],[transaction.txid for transaction in Block(block).transactions()])
+        self.assertFalse(any(transaction.hasWitness for transaction in Block(stripped).transactions()))
+
+    def testReconstructionFromStreamedSegWitTransactions(self):
+        # The mock peer streams mostly SegWit transactions and pushes a compact block of them every half second
+        mockPeer = MockPeer(txRate=400,invBatch=20,blockInterval=0.5,blockSize=20000,handshakeGap=0,witnessShare=0.8)
+        host,port = mockPeer.start()
+        try:
+            connector = BitcoinConnector(ip=host,peerPort=port)
+            self.assertIsNotNone(connector.connectToPeer(timeout=5))
+            connector.mempool = Mempool()
+            connector.sendMessage(connector.createMessage('sendcmpct',connector.createSendCmpctCMD(announce=True)))
+            rates,blocks = self.receiveBlocks(connector,3)
+            connector.socket.close()
+        finally:
+            mockPeer.stop()
+        self.assertEqual(len(blocks),3)
+        # A few transactions announced just before a block may not have arrived yet, without the witness only the 20% legacy ones would be found
+        self.assertGreater(sum(rates)/len(rates),0.9)
+
+    def receiveBlocks(self,connector,count):
+        # Handles the messages like main.py until count blocks are complete, returns the share of each compact block found in the mempool
+        rates  = []
+        blocks = []
+        frames = connector.readFrames(deadline=time.monotonic()+20)
+        try:
+            for command,payload in frames:
+                request = None
+                if command == 'ping':
+                    request = ('pong',bytes(payload))
+                elif command == 'inv':
+                    inventoryVecs = connector.parseInvPayload(payload,display=False)
+                    if inventoryVecs:
+                        request = ('getdata',connector.createGetDataCMD(inventoryVecs))
+                elif command == 'tx':
+                    connector.parseTXPayload(payload,display=False)
+                elif command == 'sendcmpct':
+                    connector.parseSendCmpctPayload(payload,display=False)
+                elif command == 'cmpctblock':
+                    compactBlock = CompactBlock(payload)
+                    found = compactBlock.fill((entry.wtxid,entry.raw) for entry in connector.mempool.entries.values())
+                    rates.append(found/len(compactBlock.shortIDs))
+                    block,request = connector.parseCmpctBlockPayload(payload,display=False)
+                elif command == 'blocktxn':
+                    block,request = connector.parseBlockTxnPayload(payload,display=False)
+                if command in ('cmpctblock','blocktxn') and block is not None:
+                    blocks.append(block.header.hash)
+                    if len(blocks) == count:
+                        break
+                if request is not None:
+                    connector.sendMessage(connector.createMessage(*request))
+        except TimeoutError:
+            pass
+        finally:
+            frames.close()
+        return rates,blocks
+
+if __name__ == '__main__':
+    unittest.main()
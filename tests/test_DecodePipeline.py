@@ -0,0 +1,171 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   Tests for Lib/DecodePipeline.py, the shared memory ring allocator and the decoding in worker processes.
+#   Run from the top directory with: python -m unittest discover -s tests   (or python -m pytest tests)
+
+
+## Imports ##
+# os             - https://docs.python.org/3/library/os.html
+# time           - https://docs.python.org/3/library/time.html
+# unittest       - https://docs.python.org/3/library/unittest.html
+# multiprocessing - parent_process tells a worker from the test process, https://docs.python.org/3/library/multiprocessing.html
+# DecodePipeline - The class being tested, see Lib/DecodePipeline.py
+# BitcoinConnector - An unconnected connector whose hooks connectorHooks checks, see Lib/BitcoinConnector.py
+# Mempool        - Set on the connector as compactBlocks does in main.py
+# MockPeer       - createTransaction creates the transactions decoded by the workers, see Lib/MockPeer.py
+# Transaction    - Used to work out the expected txids
+import os
+import time
+import unittest
+import multiprocessing
+from Lib.DecodePipeline import DecodePipeline,connectorHooks,decodeMessage
+from Lib.BitcoinConnector import BitcoinConnector
+from Lib.Mempool import Mempool
+from Lib.MockPeer import createTransaction
+from Lib.Transaction import Transaction
+
+# POISON - A payload which kills the worker decoding it
+POISON = b'poison'
+
+def dieOnPoison(command,payload):
+    # A decoder which exits the worker process on POISON, in the test process it decodes as usual
+    if bytes(payload) == POISON and multiprocessing.parent_process() is not None:
+        os._exit(3)
+    return decodeMessage(command,payload)
+
+class RingAllocatorTest(unittest.TestCase):
+    def setUp(self):
+        # No workers or shared memory are needed to test where payloads are placed
+        self.pipeline = DecodePipeline(workers=1,ringBytes=100)
+
+    def assertNoOverlap(self):
+        # Every region in flight must have its own bytes of the ring
+        used = set()
+        for sequence,start,end,done in self.pipeline.regions:
+            if done:
+                continue
+            span = set(range(start,end))
+            self.assertFalse(used & span,f'region {sequence} [{start},{end}) overlaps another region in flight')
+            used |= span
+
+    def testWrapFillsRing(self):
+        pipeline = self.pipeline
+        self.assertEqual(pipeline.reserve(0,60),0)
+        self.assertEqual(pipeline.reserve(1,40),60)
+        # A is decoded, B is still with a worker
+        pipeline.release(0)
+        # 60 bytes do not fit after B so they wrap to the start, the ring is now full with head == tail
+        self.assertEqual(pipeline.reserve(2,60),0)
+        self.assertEqual(pipeline.head,60)
+        self.assertEqual(pipeline.regions[0][1],60)
+        self.assertIsNone(pipeline.reserve(3,10))
+        self.assertIsNone(pipeline.reserve(3,1))
+        self.assertNoOverlap()
+        # Once B is decoded the space after the wrapped region is free again
+        pipeline.release(1)
+        self.assertEqual(pipeline.reserve(3,10),60)
+        self.assertNoOverlap()
+
+    def testWrappedFreeSpaceBetweenHeadAndTail(self):
+        pipeline = self.pipeline
+        pipeline.reserve(0,50)
+        pipeline.reserve(1,30)
+        pipeline.release(0)
+        # Wraps to the start, leaving [20,50) free between head and tail
+        self.assertEqual(pipeline.reserve(2,30),0)
+        self.assertEqual(pipeline.reserve(3,20),30)
+        self.assertIsNone(pipeline.reserve(4,1))
+        self.assertNoOverlap()
+
+    def testOutOfOrderRelease(self):
+        pipeline = self.pipeline
+        pipeline.reserve(0,40)
+        pipeline.reserve(1,40)
+        # A later message finishing first frees nothing, space is only freed from the oldest end
+        pipeline.release(1)
+        self.assertIsNone(pipeline.reserve(2,30))
+        pipeline.release(0)
+        self.assertEqual(len(pipeline.regions),0)
+        self.assertEqual(pipeline.reserve(2,100),0)
+
+    def testEmptyPayloadTakesNoSpace(self):
+        pipeline = self.pipeline
+        pipeline.reserve(0,60)
+        pipeline.reserve(1,40)
+        pipeline.release(0)
+        pipeline.reserve(2,60)
+        # A zero length payload between wrapped regions must not make the ring look unwrapped
+        self.assertEqual(pipeline.reserve(3,0),0)
+        pipeline.release(3)
+        self.assertIsNone(pipeline.reserve(4,10))
+        self.assertNoOverlap()
+
+class DecodeFramesTest(unittest.TestCase):
+    def testResultsInOrderThroughSmallRing(self):
+        # A ring which only holds a few transactions at once so it wraps many times while the workers decode
+        transactions = [createTransaction(200+i*7,witness=i%2 == 0) for i in range(200)]
+        pipeline = DecodePipeline(workers=2,ringBytes=2000)
+        pipeline.start()
+        try:
+            results = list(pipeline.decodeFrames(('tx',memoryview(transaction)) for transaction in transactions))
+        finally:
+            pipeline.close()
+        self.assertEqual([result['txid'] for command,result in results],[Transaction(transaction).txid for transaction in transactions])
+
+    def testPassedThroughMessagesKeepTheirPlace(self):
+        # inv and ping messages between the transactions must come out where they went in, behind the decodes still in progress
+        transactions = [createTransaction(300+i) for i in range(50)]
+        frames = []
+        for i,transaction in enumerate(transactions):
+            frames.append(('tx',memoryview(transaction)))
+            if i % 5 == 0:
+                frames.append(('ping',memoryview(i.to_bytes(8,'little'))))
+        pipeline = DecodePipeline(workers=2,ringBytes=1<<16)
+        pipeline.start()
+        try:
+            results = list(pipeline.decodeFrames(iter(frames)))
+        finally:
+            pipeline.close()
+        expected = [(command,Transaction(payload).txid if command == 'tx' else bytes(payload)) for command,payload in frames]
+        self.assertEqual([(command,result['txid'] if command == 'tx' else bytes(result)) for command,result in results],expected)
+
+class WorkerDiedTest(unittest.TestCase):
+    def decodeWithPoison(self,workers):
+        transactions = [createTransaction(250+i) for i in range(40)]
+        frames = [('tx',memoryview(transaction)) for transaction in transactions]
+        frames.insert(10,('tx',memoryview(POISON)))
+        # A small ring so the reader also has to wait for space after the worker dies
+        pipeline = DecodePipeline(workers=workers,ringBytes=3000,decoder=dieOnPoison,pollInterval=0.05)
+        pipeline.start()
+        start = time.monotonic()
+        try:
+            results = list(pipeline.decodeFrames(iter(frames)))
+        finally:
+            pipeline.close()
+        self.assertLess(time.monotonic() - start,10)
+        self.assertTrue(pipeline.failed)
+        self.assertEqual(pipeline.pending(),0)
+        # Every message is handed back in order, the poison one decoded in this process as a parse error
+        self.assertEqual(len(results),41)
+        self.assertIn('error',results[10][1])
+        del results[10]
+        self.assertEqual([result['txid'] for command,result in results],[Transaction(transaction).txid for transaction in transactions])
+
+    def testOnlyWorkerDies(self):
+        self.decodeWithPoison(workers=1)
+
+    def testOneOfManyWorkersDies(self):
+        self.decodeWithPoison(workers=3)
+
+class ConnectorHooksTest(unittest.TestCase):
+    def testHooksFedByParsingAreReported(self):
+        connector = BitcoinConnector(ip='127.0.0.1',connect=False)
+        self.assertEqual(connectorHooks(connector),[])
+        # compactBlocks sets the mempool, which the workers would leave empty
+        connector.mempool = Mempool()
+        self.assertEqual(connectorHooks(connector),['mempool'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   Tests for Lib/GetDataScheduler.py, the getdata counts and splitting, the in-flight cap, timeouts and notfound, and its use by a single BitcoinConnector.
+#   Run from the top directory with: python -m unittest discover -s tests   (or python -m pytest tests)
+
+
+## Imports ##
+# struct           - https://docs.python.org/3/library/struct.html
+# unittest         - https://docs.python.org/3/library/unittest.html
+# GetDataScheduler - The class being tested, see Lib/GetDataScheduler.py
+# InventoryCache   - Shared by the scheduler and the connector, see Lib/InventoryCache.py
+# BitcoinConnector - Sends the scheduled getdata messages for its single peer, see Lib/BitcoinConnector.py
+# CompactBlocks    - MSG_CMPCT_BLOCK is the type blocks are requested as once compact blocks are agreed, see Lib/CompactBlocks.py
+# Transaction      - readVarInt reads the getdata counts, see Lib/Transaction.py
+# MockPeer         - createTransaction creates the transactions sent back, see Lib/MockPeer.py
+import struct
+import unittest
+from Lib.GetDataScheduler import GetDataScheduler
+from Lib.InventoryCache import InventoryCache
+from Lib.BitcoinConnector import BitcoinConnector
+from Lib.CompactBlocks import MSG_CMPCT_BLOCK
+from Lib.Transaction import Transaction,readVarInt
+from Lib.MockPeer import createTransaction
+
+# MSG_WITNESS_TX/MSG_WITNESS_BLOCK - The inventory types which ask for the witness serialization
+MSG_WITNESS_TX    = 0x40000001
+MSG_WITNESS_BLOCK = 0x40000002
+
+def txVec(i):
+    # A MSG_TX inventory vector with a hash made from i
+    return struct.pack('<I',1) + i.to_bytes(32,'little')
+
+def blockVec(i):
+    return struct.pack('<I',2) + i.to_bytes(32,'little')
+
+def getDataVectors(payload):
+    # The (type, hash) of each vector in a getdata payload, the count must match the vectors
+    count,position = readVarInt(payload,0)
+    assert len(payload) == position + 36*count
+    return [(struct.unpack_from('<I',payload,position+36*i)[0],bytes(payload[position+36*i+4:position+36*i+36])) for i in range(count)]
+
+class PayloadTest(unittest.TestCase):
+    def testCountIsVarInt(self):
+        scheduler = GetDataScheduler()
+        payload, = scheduler.createGetDataPayloads([txVec(i) for i in range(252)])
+        self.assertEqual(payload[0:1],b'\xfc')
+        # Over 252 the count takes 0xfd and 2 bytes
+        payload, = scheduler.createGetDataPayloads([txVec(i) for i in range(300)])
+        self.assertEqual(payload[0:3],b'\xfd\x2c\x01')
+        self.assertEqual(len(getDataVectors(payload)),300)
+
+    def testConnectorCountIsVarInt(self):
+        connector = BitcoinConnector(ip='127.0.0.1',connect=False)
+        payload = connector.createGetDataCMD(b''.join(txVec(i) for i in range(1000)))
+        self.assertEqual(payload[0:3],b'\xfd\xe8\x03')
+        self.assertEqual([invType for invType,invHash in getDataVectors(payload)],[MSG_WITNESS_TX]*1000)
+
+    def testSplitAt50000(self):
+        scheduler = GetDataScheduler(maxInFlightPerPeer=100000)
+        scheduler.announce('peer',[txVec(i) for i in range(60000)])
+        payloads = scheduler.schedule(now=0)['peer']
+        self.assertEqual([len(getDataVectors(payload)) for payload in payloads],[50000,10000])
+        self.assertEqual([invHash for payload in payloads for invType,invHash in getDataVectors(payload)],[i.to_bytes(32,'little') for i in range(60000)])
+
+class ScheduleTest(unittest.TestCase):
+    def testInFlightCap(self):
+        scheduler = GetDataScheduler(maxInFlightPerPeer=10)
+        scheduler.announce('peer',[txVec(i) for i in range(25)])
+        self.assertEqual(len(getDataVectors(scheduler.schedule(now=0)['peer'][0])),10)
+        # Nothing more until something arrives
+        self.assertEqual(scheduler.schedule(now=0),{})
+        for i in range(4):
+            self.assertTrue(scheduler.received('peer',i.to_bytes(32,'little')))
+        self.assertEqual(len(getDataVectors(scheduler.schedule(now=0)['peer'][0])),4)
+        self.assertEqual(scheduler.inFlightCount('peer'),10)
+        self.assertEqual(len(scheduler.pending),11)
+
+    def testBlocksFirst(self):
+        scheduler = GetDataScheduler()
+        scheduler.announce('peer',[txVec(1),txVec(2),blockVec(3)])
+        vectors = getDataVectors(scheduler.schedule(now=0)['peer'][0])
+        self.assertEqual(vectors[0],(MSG_WITNESS_BLOCK,(3).to_bytes(32,'little')))
+
+    def testAnnouncedOnce(self):
+        scheduler = GetDataScheduler(inventoryCache=InventoryCache())
+        scheduler.announce('a',[txVec(1)])
+        scheduler.announce('b',[txVec(1)])
+        requests = scheduler.schedule(now=0)
+        self.assertEqual(list(requests),['a'])
+        self.assertTrue(scheduler.received('a',(1).to_bytes(32,'little')))
+        # Already fetched, announcing it again does not request it
+        scheduler.announce('b',[txVec(1)])
+        self.assertEqual(scheduler.schedule(now=0),{})
+
+class RetryTest(unittest.TestCase):
+    def testTimeoutGoesToOtherAnnouncer(self):
+        scheduler = GetDataScheduler(timeout=10)
+        scheduler.announce('a',[txVec(1)])
+        scheduler.announce('b',[txVec(1)])
+        self.assertEqual(list(scheduler.schedule(now=0)),['a'])
+        self.assertEqual(scheduler.checkTimeouts(now=5),0)
+        self.assertEqual(scheduler.checkTimeouts(now=10),1)
+        self.assertEqual(list(scheduler.schedule(now=10)),['b'])
+        self.assertEqual((scheduler.stats['timedOut'],scheduler.stats['retried'],scheduler.stats['dropped']),(1,1,0))
+
+    def testTimeoutWithSingleAnnouncerIsCounted(self):
+        cache = InventoryCache()
+        scheduler = GetDataScheduler(timeout=10,inventoryCache=cache)
+        scheduler.announce('a',[txVec(1),txVec(2)])
+        scheduler.schedule(now=0)
+        self.assertEqual(scheduler.checkTimeouts(now=10),2)
+        self.assertEqual(scheduler.stats['dropped'],2)
+        self.assertEqual(scheduler.inFlightCount(),0)
+        # Forgotten, so it is requested if it is announced again
+        scheduler.announce('a',[txVec(1)])
+        self.assertEqual(len(scheduler.schedule(now=20)['a']),1)
+
+    def testTimeoutRetriesSamePeer(self):
+        # A single connection asks its one peer again before giving up
+        scheduler = GetDataScheduler(timeout=10,maxRetries=1)
+        scheduler.announce('a',[txVec(1)])
+        scheduler.schedule(now=0)
+        scheduler.checkTimeouts(now=10)
+        self.assertEqual(getDataVectors(scheduler.schedule(now=10)['a'][0]),[(MSG_WITNESS_TX,(1).to_bytes(32,'little'))])
+        self.assertEqual(scheduler.stats['retried'],1)
+        scheduler.checkTimeouts(now=20)
+        self.assertEqual(scheduler.schedule(now=20),{})
+        self.assertEqual(scheduler.stats['dropped'],1)
+        self.assertEqual(scheduler.retries,{})
+
+    def testNotFound(self):
+        scheduler = GetDataScheduler(maxRetries=1)
+        scheduler.announce('a',[txVec(1),txVec(2)])
+        scheduler.announce('b',[txVec(1)])
+        scheduler.schedule(now=0)
+        # A notfound from a peer it was not requested from is ignored
+        scheduler.notFound('b',[txVec(1)])
+        self.assertEqual(scheduler.stats['notFound'],0)
+        scheduler.notFound('a',[txVec(1),txVec(2)])
+        self.assertEqual(scheduler.stats['notFound'],2)
+        # 1 goes to b, 2 had nobody else and the peer said it does not have it so it is not asked again
+        self.assertEqual(list(scheduler.schedule(now=1)),['b'])
+        self.assertEqual(scheduler.stats['dropped'],1)
+
+    def testDisconnectedPeer(self):
+        scheduler = GetDataScheduler()
+        scheduler.announce('a',[txVec(1),txVec(2)])
+        scheduler.announce('b',[txVec(1)])
+        scheduler.schedule(now=0)
+        scheduler.peerDisconnected('a')
+        self.assertEqual(list(scheduler.schedule(now=0)),['b'])
+        self.assertEqual(scheduler.stats['dropped'],1)
+
+class FakeSocket:
+    def __init__(self):
+        self.sent = []
+
+    def send(self,message):
+        self.sent.append(bytes(message))
+        return len(message)
+
+class ConnectorSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.connector = BitcoinConnector(ip='127.0.0.1',connect=False)
+        self.connector.socket = FakeSocket()
+        self.connector.scheduler = GetDataScheduler(maxInFlightPerPeer=3,timeout=10,maxRetries=1,inventoryCache=self.connector.inventoryCache)
+
+    def getDatas(self):
+        # The vectors of each getdata sent since the last call
+        sent = self.connector.socket.sent
+        self.connector.socket.sent = []
+        return [getDataVectors(message[24:]) for message in sent if message[4:16].rstrip(b'\x00') == b'getdata']
+
+    def testInvBurstIsCapped(self):
+        connector = self.connector
+        transactions = [createTransaction(200+i) for i in range(5)]
+        inv = bytes([5]) + b''.join(struct.pack('<I',1) + Transaction(transaction).txid for transaction in transactions)
+        connector.requestInventory(connector.parseInvPayload(inv,display=False))
+        self.assertEqual([len(vectors) for vectors in self.getDatas()],[3])
+        # An answer frees a slot, the next request goes once the message has been dispatched
+        connector.parseTXPayload(transactions[0],display=False)
+        connector.updateRequests('tx',memoryview(transactions[0]))
+        self.assertEqual(self.getDatas(),[[(MSG_WITNESS_TX,Transaction(transactions[3]).txid)]])
+        # Announced again, already requested
+        connector.requestInventory(connector.parseInvPayload(inv,display=False))
+        self.assertEqual(self.getDatas(),[])
+
+    def testTimeoutsCheckedAfterMessages(self):
+        connector = self.connector
+        connector.requestInventory(txVec(1))
+        self.getDatas()
+        # Requested long enough ago to have timed out
+        connector.scheduler.inFlight[(1).to_bytes(32,'little')] = (connector,-100.0,txVec(1))
+        connector.updateRequests('inv',memoryview(b'\x00'))
+        self.assertEqual(self.getDatas(),[[(MSG_WITNESS_TX,(1).to_bytes(32,'little'))]])
+        self.assertEqual(connector.scheduler.stats['timedOut'],1)
+
+    def testNotFoundFromDispatch(self):
+        connector = self.connector
+        connector.requestInventory(txVec(1))
+        self.getDatas()
+        connector.updateRequests('notfound',memoryview(b'\x01' + txVec(1)))
+        self.assertEqual(connector.scheduler.stats['notFound'],1)
+        self.assertEqual(connector.scheduler.inFlightCount(),0)
+
+    def testCompactBlocksRequested(self):
+        connector = self.connector
+        connector.parseSendCmpctPayload(connector.createSendCmpctCMD(),display=False)
+        connector.requestInventory(blockVec(7))
+        self.assertEqual(self.getDatas(),[[(MSG_CMPCT_BLOCK,(7).to_bytes(32,'little'))]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   Tests for Lib/Handshake.py, parsing the version of the peer and negotiating the feature messages.
+#   The connectors are run with their default protocol version against a MockPeer with its defaults, so sendaddrv2 must be negotiated without passing anything.
+#   Run from the top directory with: python -m unittest discover -s tests   (or python -m pytest tests)
+
+
+## Imports ##
+# time                  - https://docs.python.org/3/library/time.html
+# asyncio               - https://docs.python.org/3/library/asyncio.html
+# unittest              - https://docs.python.org/3/library/unittest.html
+# Handshake             - The class and functions being tested, see Lib/Handshake.py
+# BitcoinConnector      - Runs the handshake over a socket, see Lib/BitcoinConnector.py
+# AsyncBitcoinConnector - Runs the handshake over an asyncio transport, see Lib/AsyncBitcoinConnector.py
+# MockPeer              - The local peer the handshakes are run against, see Lib/MockPeer.py
+import time
+import asyncio
+import unittest
+from Lib.Handshake import Handshake,PeerVersion,createVersionPayload,createFeeFilterPayload,FEATURE_VERSIONS,NEGOTIATION_COMMANDS,USER_AGENT
+from Lib.BitcoinConnector import BitcoinConnector
+from Lib.AsyncBitcoinConnector import AsyncBitcoinConnector
+from Lib.MockPeer import MockPeer
+
+def peerVersion(version,nonce=b'\x01'*8):
+    # The version payload of a peer
+    return createVersionPayload(version,'127.0.0.1',8333,startHeight=800000,services=9,userAgent=b'/Satoshi:25.0.0/',nonce=nonce)
+
+class PeerVersionTest(unittest.TestCase):
+    def testRoundTrip(self):
+        peer = PeerVersion(createVersionPayload(70016,'::1',18444,startHeight=123,relay=False,services=1,nonce=b'\x02'*8))
+        self.assertEqual((peer.version,peer.services,peer.startHeight,peer.relay,peer.nonce),(70016,1,123,False,b'\x02'*8))
+        self.assertEqual(peer.userAgent,USER_AGENT.decode())
+        self.assertEqual(peer.addrRecv[:2],('::1',18444))
+
+    def testRelayDefaultsToTrue(self):
+        # The relay flag was added in 70001, a version without it relays
+        self.assertTrue(PeerVersion(peerVersion(70016)[:-1]).relay)
+
+    def testTruncated(self):
+        with self.assertRaises(ValueError):
+            PeerVersion(peerVersion(70016)[:50])
+
+class HandshakeTest(unittest.TestCase):
+    def handshake(self,protocolVersion=70016,**options):
+        handshake = Handshake(createVersionPayload(protocolVersion,'127.0.0.1',8333,nonce=b'\x00'*8),protocolVersion,**options)
+        self.assertEqual(handshake.start()[0][0],'version')
+        return handshake
+
+    def testFeaturesBeforeVerack(self):
+        handshake = self.handshake(wtxidRelay=True)
+        replies = handshake.receive('version',peerVersion(70016))
+        self.assertEqual([command for command,payload in replies],['wtxidrelay','sendaddrv2','verack'])
+        for command in ('wtxidrelay','sendaddrv2','verack'):
+            handshake.receive(command,b'')
+        self.assertTrue(handshake.complete)
+        self.assertTrue(handshake.negotiated('sendaddrv2'))
+        self.assertTrue(handshake.negotiated('wtxidrelay'))
+
+    def testOldPeerGetsNoFeatures(self):
+        handshake = self.handshake(wtxidRelay=True)
+        replies = handshake.receive('version',peerVersion(70015))
+        self.assertEqual(replies,[('verack',b'')])
+        self.assertEqual(handshake.commonVersion,70015)
+        handshake.receive('verack',b'')
+        self.assertFalse(handshake.negotiated('sendaddrv2'))
+
+    def testOldDefaultNegotiatesNothing(self):
+        # What the connectors used to default to, sendaddrv2 needs 70016 on both sides
+        self.assertLess(70015,FEATURE_VERSIONS['sendaddrv2'])
+        handshake = self.handshake(protocolVersion=70015)
+        self.assertEqual(handshake.receive('version',peerVersion(70016)),[('verack',b'')])
+
+    def testFeatureAfterVerackIgnored(self):
+        handshake = self.handshake()
+        handshake.receive('version',peerVersion(70016))
+        handshake.receive('verack',b'')
+        handshake.receive('sendaddrv2',b'')
+        self.assertFalse(handshake.negotiated('sendaddrv2'))
+
+    def testFeaturesAfterHandshake(self):
+        handshake = self.handshake(sendHeaders=True,feeRate=1000)
+        handshake.receive('version',peerVersion(70016))
+        replies = handshake.receive('verack',b'')
+        self.assertEqual(replies,[('sendheaders',b''),('feefilter',createFeeFilterPayload(1000))])
+        handshake.receive('feefilter',createFeeFilterPayload(2500))
+        self.assertEqual(handshake.features['feefilter'],2500)
+
+    def testBadVersions(self):
+        with self.assertRaisesRegex(ValueError,'too old'):
+            self.handshake().receive('version',peerVersion(31799))
+        with self.assertRaisesRegex(ValueError,'ourselves'):
+            self.handshake().receive('version',peerVersion(70016,nonce=b'\x00'*8))
+        handshake = self.handshake()
+        handshake.receive('version',peerVersion(70016))
+        with self.assertRaisesRegex(ValueError,'second version'):
+            handshake.receive('version',peerVersion(70016))
+
+class MockPeerHandshakeTest(unittest.TestCase):
+    def setUp(self):
+        # No transactions or blocks, only the handshake
+        self.mockPeer = MockPeer(txRate=0,handshakeGap=0)
+        self.host,self.port = self.mockPeer.start()
+
+    def tearDown(self):
+        self.mockPeer.stop()
+
+    def waitForFeature(self,feature):
+        # The MockPeer reads our messages on its own thread
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            if self.mockPeer.connections and feature in self.mockPeer.connections[0].features:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def testConnectorNegotiatesSendAddrV2(self):
+        connector = BitcoinConnector(ip=self.host,peerPort=self.port)
+        try:
+            handshake = connector.connectToPeer(timeout=5,feeRate=1000)
+            self.assertIsNotNone(handshake)
+            self.assertEqual(handshake.commonVersion,70016)
+            self.assertIn('sendaddrv2',handshake.sent)
+            self.assertTrue(handshake.negotiated('sendaddrv2'))
+            self.assertTrue(self.waitForFeature('sendaddrv2'))
+            self.assertTrue(self.waitForFeature('feefilter'))
+            self.assertEqual(self.mockPeer.connections[0].features['feefilter'],1000)
+            # sendheaders and feefilter from the peer follow its verack
+            frames = connector.readFrames(deadline=time.monotonic()+5)
+            try:
+                for command,payload in frames:
+                    if command in NEGOTIATION_COMMANDS:
+                        connector.receiveFeature(command,payload)
+                    if 'feefilter' in handshake.features:
+                        break
+            finally:
+                frames.close()
+            self.assertTrue(handshake.negotiated('sendheaders'))
+            self.assertEqual(handshake.features['feefilter'],self.mockPeer.feeRate)
+        finally:
+            connector.socket.close()
+
+    def testAsyncConnectorNegotiatesSendAddrV2(self):
+        async def connect():
+            manager = AsyncBitcoinConnector(handshakeTimeout=5)
+            peer = await manager.connectPeer(self.host,self.port)
+            try:
+                return peer.connector.handshake if peer is not None else None
+            finally:
+                manager.close()
+        handshake = asyncio.run(connect())
+        self.assertIsNotNone(handshake)
+        self.assertIn('sendaddrv2',handshake.sent)
+        self.assertTrue(handshake.negotiated('sendaddrv2'))
+        self.assertTrue(self.waitForFeature('sendaddrv2'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,224 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   Tests for Lib/HeaderChain.py, the compact bits conversions, the retarget every 2016 blocks, switching to a fork with more work, parsing headers messages and saving the chain.
+#   The headers are mined against an easy proof of work limit so a whole retarget period is built in well under a second.
+#   Run from the top directory with: python -m unittest discover -s tests   (or python -m pytest tests)
+
+
+## Imports ##
+# os          - https://docs.python.org/3/library/os.html
+# struct      - https://docs.python.org/3/library/struct.html
+# tempfile    - https://docs.python.org/3/library/tempfile.html
+# unittest    - https://docs.python.org/3/library/unittest.html
+# HeaderChain - The class and functions being tested, see Lib/HeaderChain.py
+# Transaction - createVarInt creates the headers counts, see Lib/Transaction.py
+import os
+import struct
+import tempfile
+import unittest
+from Lib.HeaderChain import HeaderChain,bitsToTarget,targetToBits,RETARGET_INTERVAL,TARGET_TIMESPAN,MAX_HEADERS,GENESIS_HEADER,POW_LIMIT_BITS
+from Lib.Transaction import createVarInt
+
+# EASY_BITS - The regtest proof of work limit, about every second nonce meets it
+EASY_BITS = 0x207fffff
+# START - The timestamp of the genesis header of the test chains
+START = 1296688602
+
+def mine(prevBlock,timestamp,bits,version=1):
+    # An 80 byte header building on prevBlock whose hash meets the target of bits
+    target = bitsToTarget(bits)
+    nonce  = 0
+    while True:
+        header = struct.pack('<i32s32sIII',version,prevBlock,bytes(32),timestamp,bits,nonce)
+        if int.from_bytes(HeaderChain.hashHeader(header),'little') <= target:
+            return header
+        nonce += 1
+
+def extend(prevHeader,count,spacing=600,bits=None,version=1):
+    # count headers each spacing seconds after the last, with the bits of prevHeader unless given
+    headers = []
+    previous = prevHeader
+    for i in range(count):
+        previous = mine(HeaderChain.hashHeader(previous),struct.unpack_from('<I',previous,68)[0]+spacing,bits or struct.unpack_from('<I',previous,72)[0],version)
+        headers.append(previous)
+    return headers
+
+def headersPayload(headers):
+    # A headers message payload, each header is followed by a txn_count of 0
+    return createVarInt(len(headers)) + b''.join(header + b'\x00' for header in headers)
+
+class BitsTest(unittest.TestCase):
+    def testRoundTrip(self):
+        for bits in (POW_LIMIT_BITS,EASY_BITS,0x1b0404cb,0x170e0408,0x03123456,0x02123400,0x01120000):
+            self.assertEqual(targetToBits(bitsToTarget(bits)),bits)
+        self.assertEqual(bitsToTarget(POW_LIMIT_BITS),0xffff << 208)
+        self.assertEqual(bitsToTarget(0x1b0404cb),0x0404cb << 192)
+        self.assertEqual(bitsToTarget(0x01120000),0x12)
+
+    def testSignBit(self):
+        # A mantissa with its top bit set would be negative, so the target is written a byte longer
+        self.assertEqual(targetToBits(0x80),0x02008000)
+        self.assertEqual(bitsToTarget(0x02008000),0x80)
+        self.assertEqual(targetToBits(0xffff << 208),POW_LIMIT_BITS)
+        self.assertEqual(targetToBits(0x800000 << 200),0x1d008000)
+        self.assertEqual(bitsToTarget(0x1d008000),0x800000 << 200)
+        # bits with the sign bit set are invalid
+        self.assertEqual(bitsToTarget(0x1d800000),0)
+        self.assertEqual(bitsToTarget(0x01800000),0)
+
+    def testLowBitsLost(self):
+        target = (0x123456 << 200) + 0xffff
+        self.assertEqual(bitsToTarget(targetToBits(target)),0x123456 << 200)
+
+class RetargetTest(unittest.TestCase):
+    def retarget(self,spacing,startBits):
+        # The bits expected at height 2016 after blocks spacing seconds apart
+        genesis = mine(bytes(32),START,startBits)
+        chain   = HeaderChain(genesis,powLimitBits=EASY_BITS)
+        added,error = chain.addHeaders(extend(genesis,RETARGET_INTERVAL-1,spacing))
+        self.assertEqual((added,error),(RETARGET_INTERVAL-1,None))
+        return chain,chain.expectedBits(chain.best)
+
+    def testFastBlocksClampedToQuarter(self):
+        # 2015 minutes is far less than a quarter of two weeks, the target only gets 4 times harder
+        startBits = targetToBits(bitsToTarget(EASY_BITS) >> 4)
+        chain,bits = self.retarget(60,startBits)
+        self.assertEqual(bits,targetToBits(bitsToTarget(startBits)//4))
+        self.assertNotEqual(bits,targetToBits(bitsToTarget(startBits)*60*(RETARGET_INTERVAL-1)//TARGET_TIMESPAN))
+        tipHeader = chain.getByHeight(RETARGET_INTERVAL-1).raw
+        # The header at 2016 must use the new bits, the old ones are refused
+        added,error = chain.addHeaders(extend(bytes(tipHeader),1,60,bits=startBits))
+        self.assertEqual(added,0)
+        self.assertIn('expected',error)
+        self.assertEqual(chain.addHeaders(extend(bytes(tipHeader),1,60,bits=bits)),(1,None))
+        self.assertEqual(chain.height,RETARGET_INTERVAL)
+        # No retarget until the next 2016
+        self.assertEqual(chain.expectedBits(chain.best),bits)
+
+    def testSlowBlocksClampedToFourTimes(self):
+        startBits = targetToBits(bitsToTarget(EASY_BITS) >> 4)
+        chain,bits = self.retarget(6000,startBits)
+        self.assertEqual(bits,targetToBits(bitsToTarget(startBits)*4))
+
+    def testNeverEasierThanLimit(self):
+        chain,bits = self.retarget(6000,EASY_BITS)
+        self.assertEqual(bits,EASY_BITS)
+
+    def testWithoutRetargeting(self):
+        genesis = mine(bytes(32),START,EASY_BITS)
+        chain   = HeaderChain(genesis,powLimitBits=EASY_BITS,retargeting=False)
+        chain.addHeaders(extend(genesis,RETARGET_INTERVAL-1,1))
+        self.assertEqual(chain.expectedBits(chain.best),EASY_BITS)
+
+class ForkTest(unittest.TestCase):
+    def setUp(self):
+        self.genesis = mine(bytes(32),START,EASY_BITS)
+        self.chain   = HeaderChain(self.genesis,powLimitBits=EASY_BITS,retargeting=False)
+        self.first   = extend(self.genesis,3)
+        # A different version so the fork headers differ from the first chain
+        self.fork    = extend(self.first[0],3,version=2)
+
+    def testForkOvertakes(self):
+        chain = self.chain
+        self.assertEqual(chain.addHeaders(self.first),(3,None))
+        tip = chain.tipHash
+        # Two fork headers only equal the work of the best chain, the first one seen stays best
+        self.assertEqual(chain.addHeaders(self.fork[:2]),(2,None))
+        self.assertEqual(chain.tipHash,tip)
+        self.assertEqual(chain.forks(),[(HeaderChain.hashHeader(self.fork[1]),3,2)])
+        chain.addHeaders(self.fork[2:])
+        self.assertEqual(chain.tipHash,HeaderChain.hashHeader(self.fork[2]))
+        self.assertEqual(chain.height,4)
+        self.assertEqual([bytes(chain.getByHeight(height).raw) for height in range(5)],[self.genesis,self.first[0]] + self.fork)
+        self.assertEqual(chain.forks(),[(tip,3,2)])
+        # The old best chain is still indexed, just not on mainChain
+        header,height = chain.getByHash(tip)
+        self.assertEqual(height,3)
+        self.assertEqual(chain.locator()[-1],HeaderChain.hashHeader(self.genesis))
+
+    def testHeaderNotConnecting(self):
+        added,error = self.chain.addHeaders(self.first[1:])
+        self.assertEqual(added,0)
+        self.assertIn('does not connect',error)
+
+    def testBadProofOfWork(self):
+        # A header whose hash is above the target, the valid headers before it are kept
+        headers = list(self.first)
+        nonce = 0
+        while True:
+            bad = headers[1][:76] + struct.pack('<I',nonce)
+            if int.from_bytes(HeaderChain.hashHeader(bad),'little') > bitsToTarget(EASY_BITS):
+                break
+            nonce += 1
+        added,error = self.chain.addHeaders([headers[0],bad])
+        self.assertEqual(added,1)
+        self.assertIn('proof of work',error)
+
+class ParseHeadersTest(unittest.TestCase):
+    def setUp(self):
+        self.chain   = HeaderChain(mine(bytes(32),START,EASY_BITS),powLimitBits=EASY_BITS,retargeting=False)
+        self.headers = extend(self.chain.getByHeight(0).raw.tobytes(),3)
+
+    def testParse(self):
+        self.assertEqual(self.chain.parseHeaders(headersPayload(self.headers)),self.headers)
+        self.assertEqual(self.chain.parseHeaders(memoryview(headersPayload(self.headers))),self.headers)
+        self.assertEqual(self.chain.parseHeaders(b'\x00'),[])
+
+    def testTruncated(self):
+        payload = headersPayload(self.headers)
+        for length in (0,len(payload)-1,len(payload)-2,len(payload)-81,5):
+            with self.assertRaises(ValueError):
+                self.chain.parseHeaders(payload[:length])
+
+    def testOverLimit(self):
+        # The count is checked before anything else is read
+        self.assertEqual(len(self.chain.parseHeaders(headersPayload([self.headers[0]]*MAX_HEADERS))),MAX_HEADERS)
+        with self.assertRaisesRegex(ValueError,'limit'):
+            self.chain.parseHeaders(createVarInt(MAX_HEADERS+1))
+
+class SaveLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name,'headers.dat')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def testRoundTrip(self):
+        genesis = mine(bytes(32),START,EASY_BITS)
+        chain   = HeaderChain(genesis,powLimitBits=EASY_BITS,retargeting=False)
+        first   = extend(genesis,5)
+        chain.addHeaders(first)
+        chain.addHeaders(extend(first[1],2,version=2))
+        chain.save(self.path)
+        loaded = HeaderChain.load(self.path,powLimitBits=EASY_BITS,retargeting=False)
+        for name in ('raw','hashList','hashes','parents','heights','chainWork','best','mainChain','tips'):
+            self.assertEqual(getattr(loaded,name),getattr(chain,name),name)
+        self.assertEqual(loaded.forks(),chain.forks())
+        self.assertFalse(os.path.exists(self.path+'.tmp'))
+        # The loaded chain carries on from where it was
+        self.assertEqual(loaded.addHeaders(extend(first[-1],1)),(1,None))
+        self.assertEqual(loaded.height,6)
+
+    def testMainnetGenesisOnly(self):
+        chain = HeaderChain()
+        chain.save(self.path)
+        loaded = HeaderChain.load(self.path)
+        self.assertEqual(loaded.tipHash[::-1].hex(),'000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f')
+        self.assertEqual(bytes(loaded.raw),GENESIS_HEADER)
+
+    def testBadFile(self):
+        with open(self.path,'wb') as chainFile:
+            chainFile.write(b'not a chain')
+        with self.assertRaises(ValueError):
+            HeaderChain.load(self.path)
+        HeaderChain().save(self.path)
+        with open(self.path,'r+b') as chainFile:
+            chainFile.truncate(os.path.getsize(self.path)-1)
+        with self.assertRaisesRegex(ValueError,'truncated'):
+            HeaderChain.load(self.path)
+
+if __name__ == '__main__':
+    unittest.main()
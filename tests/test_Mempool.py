@@ -0,0 +1,164 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   Tests for Lib/Mempool.py, working out fees from parent transactions, eviction under the memory budget, removing the transactions of a block and the fee-rate queries.
+#   The transactions are built by spend below so the value of each output and so the fee is known.
+#   Run from the top directory with: python -m unittest discover -s tests   (or python -m pytest tests)
+
+
+## Imports ##
+# os          - https://docs.python.org/3/library/os.html
+# struct      - https://docs.python.org/3/library/struct.html
+# unittest    - https://docs.python.org/3/library/unittest.html
+# Mempool     - The class being tested, see Lib/Mempool.py
+# Transaction - Parses the transactions added, see Lib/Transaction.py
+# Block       - Parses the block whose transactions are removed, see Lib/Block.py
+# MockPeer    - createBlock puts the transactions in a block, see Lib/MockPeer.py
+import os
+import struct
+import unittest
+from Lib.Mempool import Mempool
+from Lib.Transaction import Transaction,createVarInt
+from Lib.Block import Block
+from Lib.MockPeer import createBlock
+
+def spend(outpoints,values):
+    # A legacy transaction spending each (previous hash, index) in outpoints with an output for each value
+    parts = [struct.pack('<i',2),createVarInt(len(outpoints))]
+    for previousHash,previousIndex in outpoints:
+        parts.append(previousHash + struct.pack('<I',previousIndex) + b'\x00' + b'\xff\xff\xff\xff')
+    parts.append(createVarInt(len(values)))
+    for value in values:
+        parts.append(struct.pack('<q',value) + b'\x16\x00\x14' + os.urandom(20))
+    parts.append(b'\x00\x00\x00\x00')
+    return Transaction(b''.join(parts))
+
+def outside():
+    # An outpoint of a confirmed transaction, not in the mempool
+    return (os.urandom(32),0)
+
+class FeeTest(unittest.TestCase):
+    def testFeeFromParent(self):
+        mempool = Mempool()
+        parent = spend([outside()],[50000,20000])
+        self.assertTrue(mempool.add(parent,fee=1000))
+        child = spend([(parent.txid,0),(parent.txid,1)],[69000])
+        mempool.add(child)
+        self.assertEqual(mempool.entries[child.txid].fee,1000)
+        self.assertEqual(len(mempool.feeIndex),2)
+        self.assertFalse(mempool.add(parent))
+
+    def testFeeFromLookup(self):
+        previous = outside()
+        mempool = Mempool(prevoutLookup=lambda previousHash,previousIndex: 30000 if (previousHash,previousIndex) == previous else None)
+        transaction = spend([previous],[29500])
+        mempool.add(transaction)
+        self.assertEqual(mempool.entries[transaction.txid].fee,500)
+        unknown = spend([outside()],[1000])
+        mempool.add(unknown)
+        self.assertIsNone(mempool.entries[unknown.txid].fee)
+        self.assertIn(unknown.txid,mempool.unknownFee)
+
+    def testChildBeforeParent(self):
+        # The child is announced first, its fee is worked out once the parent arrives
+        mempool = Mempool()
+        parent = spend([outside()],[50000,20000])
+        child = spend([(parent.txid,1)],[19000])
+        mempool.add(child)
+        self.assertIn(child.txid,mempool.unknownFee)
+        mempool.add(parent,fee=700)
+        self.assertNotIn(child.txid,mempool.unknownFee)
+        self.assertEqual(mempool.entries[child.txid].fee,1000)
+        self.assertEqual(mempool.topN(1),[(1000/child.vsize,child.txid)])
+
+    def testChildWaitingOnTwoParents(self):
+        mempool = Mempool()
+        first  = spend([outside()],[10000])
+        second = spend([outside()],[10000])
+        child  = spend([(first.txid,0),(second.txid,0)],[19000])
+        mempool.add(child)
+        mempool.add(first,fee=100)
+        self.assertIn(child.txid,mempool.unknownFee)
+        mempool.add(second,fee=100)
+        self.assertEqual(mempool.entries[child.txid].fee,1000)
+        self.assertEqual(len(mempool.unknownFee),0)
+
+class EvictionTest(unittest.TestCase):
+    def testUnknownFeeEvictedFirst(self):
+        transactions = [spend([outside()],[1000]) for i in range(4)]
+        usage = sum(len(transaction.raw) + Mempool.ENTRY_BYTES + Mempool.INPUT_BYTES for transaction in transactions)
+        mempool = Mempool(maxBytes=usage-1)
+        mempool.add(transactions[0],fee=100)
+        mempool.add(transactions[1])
+        mempool.add(transactions[2],fee=5000)
+        self.assertTrue(mempool.add(transactions[3],fee=50))
+        self.assertNotIn(transactions[1].txid,mempool)
+        self.assertEqual(len(mempool),3)
+        self.assertLessEqual(mempool.usage,mempool.maxBytes)
+
+    def testLowestFeeRateEvictedWithDescendants(self):
+        parent  = spend([outside()],[10000])
+        child   = spend([(parent.txid,0)],[9000])
+        richer  = spend([outside()],[10000])
+        usage = sum(len(transaction.raw) + Mempool.ENTRY_BYTES + Mempool.INPUT_BYTES for transaction in (parent,child,richer))
+        mempool = Mempool(maxBytes=usage-1)
+        mempool.add(parent,fee=10)
+        # The child pays a high fee but can not confirm without the parent
+        mempool.add(child)
+        self.assertTrue(mempool.add(richer,fee=5000))
+        self.assertEqual(list(mempool.entries),[richer.txid])
+        self.assertEqual(mempool.spenders,{bytes(richer.input(0).previousOutput):richer.txid})
+        self.assertEqual(mempool.usage,len(richer.raw) + Mempool.ENTRY_BYTES + Mempool.INPUT_BYTES)
+
+    def testNewTransactionEvictedStraightAway(self):
+        first = spend([outside()],[1000])
+        mempool = Mempool(maxBytes=len(first.raw) + Mempool.ENTRY_BYTES + Mempool.INPUT_BYTES)
+        mempool.add(first,fee=5000)
+        self.assertFalse(mempool.add(spend([outside()],[1000]),fee=1))
+        self.assertEqual(list(mempool.entries),[first.txid])
+
+class BlockTest(unittest.TestCase):
+    def testRemoveForBlock(self):
+        mempool = Mempool()
+        shared = outside()
+        confirmed = spend([shared],[1000])
+        conflict  = spend([shared],[900])
+        conflictChild = spend([(conflict.txid,0)],[800])
+        unrelated = spend([outside()],[1000])
+        mempool.add(conflict,fee=100)
+        mempool.add(conflictChild)
+        mempool.add(unrelated,fee=100)
+        other = spend([outside()],[1000])
+        mempool.add(other,fee=100)
+        block = Block(createBlock(bytes(32),[bytes(confirmed.raw),bytes(other.raw)],height=1))
+        # other was in the mempool, the conflict and its child double spend confirmed
+        self.assertEqual(mempool.removeForBlock(block),(1,2))
+        self.assertEqual(list(mempool.entries),[unrelated.txid])
+        self.assertEqual(len(mempool.spenders),1)
+
+class QueryTest(unittest.TestCase):
+    def setUp(self):
+        self.mempool = Mempool()
+        self.transactions = [spend([outside()],[1000]) for i in range(11)]
+        for i,transaction in enumerate(self.transactions):
+            self.mempool.add(transaction,fee=(i+1)*transaction.vsize)
+        self.mempool.add(spend([outside()],[1000]))
+
+    def testTopN(self):
+        top = self.mempool.topN(3)
+        self.assertEqual([txid for feeRate,txid in top],[transaction.txid for transaction in self.transactions[:-4:-1]])
+        self.assertEqual([feeRate for feeRate,txid in top],[11,10,9])
+        self.assertEqual(self.mempool.topN(0),[])
+        self.assertEqual(len(self.mempool.topN(100)),11)
+
+    def testPercentiles(self):
+        self.assertEqual(self.mempool.feeRatePercentile(0),1)
+        self.assertEqual(self.mempool.feeRatePercentile(50),6)
+        self.assertEqual(self.mempool.feeRatePercentile(90),10)
+        self.assertEqual(self.mempool.feeRatePercentile(100),11)
+        self.assertEqual(self.mempool.feeRatePercentile(150),11)
+        self.assertIsNone(Mempool().feeRatePercentile(50))
+
+if __name__ == '__main__':
+    unittest.main()
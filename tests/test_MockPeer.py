@@ -0,0 +1,88 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   Tests for Lib/MockPeer.py, the stream of transactions and blocks shared by every connection and the stats counted from each connection thread.
+#   Run from the top directory with: python -m unittest discover -s tests   (or python -m pytest tests)
+
+
+## Imports ##
+# time             - https://docs.python.org/3/library/time.html
+# unittest         - https://docs.python.org/3/library/unittest.html
+# MockPeer         - The class being tested, see Lib/MockPeer.py
+# BitcoinConnector - The clients connected to the MockPeer, see Lib/BitcoinConnector.py
+# Block            - Works out the hash of the pushed blocks, see Lib/Block.py
+# Transaction      - Works out the txid of the pushed transactions, see Lib/Transaction.py
+import time
+import unittest
+from Lib.MockPeer import MockPeer
+from Lib.BitcoinConnector import BitcoinConnector
+from Lib.Block import Block
+from Lib.Transaction import Transaction
+
+def receive(connector,transactions,blocks):
+    # The txids and block hashes pushed to a connector until it has the number of each asked for
+    txids   = []
+    hashes  = []
+    frames  = connector.readFrames(deadline=time.monotonic()+10)
+    try:
+        for command,payload in frames:
+            if command == 'tx':
+                txids.append(Transaction(bytes(payload)).txid)
+            elif command == 'block':
+                hashes.append(Block(bytes(payload)).header.hash)
+            if len(txids) >= transactions and len(hashes) >= blocks:
+                break
+    finally:
+        frames.close()
+    return txids,hashes
+
+class SharedStreamTest(unittest.TestCase):
+    def setUp(self):
+        # The items are pushed so no getdata is needed
+        self.mockPeer = MockPeer(txRate=200,invBatch=10,blockInterval=0.2,blockSize=2000,announce=False,handshakeGap=0)
+        self.host,self.port = self.mockPeer.start()
+        self.connectors = []
+
+    def tearDown(self):
+        for connector in self.connectors:
+            connector.socket.close()
+        self.mockPeer.stop()
+
+    def connect(self):
+        connector = BitcoinConnector(ip=self.host,peerPort=self.port)
+        self.assertIsNotNone(connector.connectToPeer(timeout=5))
+        self.connectors.append(connector)
+        return connector
+
+    def testConnectionsGetTheSameStream(self):
+        start  = time.monotonic()
+        first  = self.connect()
+        second = self.connect()
+        firstTxids,firstBlocks   = receive(first,100,3)
+        secondTxids,secondBlocks = receive(second,100,3)
+        # Whichever finished its handshake later joins part way through, from then on the streams match
+        shared = [txid for txid in firstTxids if txid in set(secondTxids)]
+        self.assertGreaterEqual(len(shared),50)
+        self.assertEqual(shared,[txid for txid in secondTxids if txid in set(firstTxids)])
+        self.assertTrue(set(firstBlocks) & set(secondBlocks))
+        # One chain with a block each interval, not a block per connection each interval
+        self.assertEqual(len(self.mockPeer.headers),self.mockPeer.height+1)
+        self.assertLessEqual(self.mockPeer.height,(time.monotonic()-start)/self.mockPeer.blockInterval + 1)
+
+    def testStatsCountEveryConnection(self):
+        connectors = [self.connect() for i in range(3)]
+        for connector in connectors:
+            receive(connector,20,0)
+        stats = self.mockPeer.stats
+        self.assertEqual(stats['connections'],3)
+        self.assertGreaterEqual(stats['txSent'],60)
+        self.assertGreater(stats['bytesSent'],0)
+
+    def testNothingStreamedBeforeHandshake(self):
+        time.sleep(0.3)
+        self.assertEqual(len(self.mockPeer.items),0)
+        self.assertEqual(self.mockPeer.height,0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   Tests for Lib/PeerSelector.py, rotating the slowest peer out and refilling the candidates once the first ones are used up.
+#   The peers are held by FakeConnector below, which connects to any address at once, so no sockets or DNS lookups are needed.
+#   Run from the top directory with: python -m unittest discover -s tests   (or python -m pytest tests)
+
+
+## Imports ##
+# time         - https://docs.python.org/3/library/time.html
+# asyncio      - https://docs.python.org/3/library/asyncio.html
+# unittest     - https://docs.python.org/3/library/unittest.html
+# mock         - https://docs.python.org/3/library/unittest.mock.html
+# PeerSelector - The class being tested, see Lib/PeerSelector.py
+# AddressBook  - The address book the candidates are refilled from, see Lib/AddressBook.py
+import time
+import asyncio
+import unittest
+from unittest import mock
+from Lib.PeerSelector import PeerSelector
+from Lib.AddressBook import AddressBook,createAddrPayload
+
+class FakePeer:
+    def __init__(self,connector,ip,port):
+        # Like an AsyncPeer, it leaves connector.peers when closed
+        self.connector = connector
+        self.peerIP    = ip
+        self.peerPort  = port
+        self.closed    = asyncio.get_running_loop().create_future()
+        self.sent      = []
+
+    def sendMessage(self,command,payload):
+        self.sent.append(command)
+
+    def close(self):
+        if not self.closed.done():
+            self.closed.set_result(None)
+            del self.connector.peers[(self.peerIP,self.peerPort)]
+
+class FakeConnector:
+    def __init__(self):
+        self.peerPort = 8333
+        self.peers    = {}
+        self.messageHandler = lambda peer,command,payload: None
+        # connected - Every (ip,port) connected to, in order
+        self.connected = []
+
+    async def connectPeer(self,ip,port=None):
+        peer = FakePeer(self,ip,port)
+        self.peers[(ip,port)] = peer
+        self.connected.append((ip,port))
+        return peer
+
+def addresses(start,count):
+    return [(f'10.0.0.{i}',8333) for i in range(start,start+count)]
+
+class RotateTest(unittest.TestCase):
+    def setUp(self):
+        self.connector = FakeConnector()
+
+    def selector(self,**selectorArgs):
+        return PeerSelector(self.connector,seeds=(),targetPeers=3,raceFactor=1,minInvSamples=1,**selectorArgs)
+
+    def measure(self,selector,slow):
+        # Every peer has announced enough items, slow announces them a second after the rest
+        for key,stats in selector.stats.items():
+            stats.invCount = 5
+            stats.invDelay = 1.0 if key == slow else 0.01
+            stats.rtt      = 0.01
+
+    async def rotateSlowest(self,selector,rounds):
+        # Makes the newest peer the slowest each round and rotates, returns the peers dropped
+        dropped = []
+        for i in range(rounds):
+            slow = self.connector.connected[-1]
+            self.measure(selector,slow)
+            self.assertEqual(await selector.rotate(),slow)
+            self.assertNotIn(slow,self.connector.peers)
+            self.assertEqual(len(self.connector.peers),3)
+            dropped.append(slow)
+        return dropped
+
+    def testRefilledFromAddrMessages(self):
+        async def run():
+            selector = self.selector(allowPrivate=True)
+            selector.addCandidates(addresses(1,3))
+            await selector.topUp()
+            self.assertEqual(len(selector.candidates),0)
+            # Each peer was asked for addresses, one answers with more than the first candidates
+            self.assertTrue(all('getaddr' in peer.sent for peer in self.connector.peers.values()))
+            peer = next(iter(self.connector.peers.values()))
+            payload = createAddrPayload([(int(time.time()),1,ip,port) for ip,port in addresses(4,5) + [('8.8.8.8',0)]])
+            selector.handleMessage(peer,'addr',memoryview(payload))
+            dropped = await self.rotateSlowest(selector,4)
+            # A dropped peer is not raced again
+            self.assertFalse(set(dropped) & set(selector.candidates))
+            self.assertEqual(self.connector.connected,addresses(1,7))
+        asyncio.run(run())
+
+    def testPrivateAddrLeftOut(self):
+        selector = self.selector()
+        payload = createAddrPayload([(int(time.time()),1,ip,port) for ip,port in addresses(1,2) + [('8.8.8.8',8333)]])
+        selector.handleMessage(None,'addr',memoryview(payload))
+        self.assertEqual(list(selector.candidates),[('8.8.8.8',8333)])
+
+    def testRefilledFromAddressBook(self):
+        async def run():
+            addressBook = AddressBook(allowPrivate=True)
+            for ip,port in addresses(1,10):
+                addressBook.add(ip,port)
+            selector = self.selector(addressBook=addressBook)
+            selector.addCandidates(addressBook.best(3))
+            await selector.topUp()
+            dropped = await self.rotateSlowest(selector,5)
+            # The best addresses not raced yet were used, nothing was connected twice
+            self.assertEqual(len(set(self.connector.connected)),8)
+            self.assertFalse(set(dropped) & set(self.connector.peers))
+        asyncio.run(run())
+
+    def testNoCandidatesNoDrop(self):
+        async def run():
+            selector = self.selector()
+            selector.addCandidates(addresses(1,3))
+            await selector.topUp()
+            self.measure(selector,self.connector.connected[-1])
+            self.assertIsNone(await selector.rotate())
+            self.assertEqual(len(self.connector.peers),3)
+        asyncio.run(run())
+
+class SeedTest(unittest.TestCase):
+    def testSeedsResolvedAgainAfterInterval(self):
+        calls = []
+        async def resolveSeeds(seeds,port):
+            calls.append(seeds)
+            return addresses(10*len(calls),3)
+        async def run():
+            selector = PeerSelector(FakeConnector(),seeds=('seed.example',),targetPeers=3,raceFactor=1,seedInterval=100)
+            await selector.topUp()
+            self.assertEqual(len(calls),1)
+            # The candidates are used up but the seeds were resolved too recently
+            selector.connector.peers.popitem()[1].closed.set_result(None)
+            await selector.topUp()
+            self.assertEqual(len(calls),1)
+            self.assertEqual(len(selector.connector.peers),2)
+            selector.lastResolved -= 100
+            await selector.topUp()
+            self.assertEqual(len(calls),2)
+            self.assertEqual(len(selector.connector.peers),3)
+        with mock.patch('Lib.PeerSelector.resolveSeeds',resolveSeeds):
+            asyncio.run(run())
+
+    def testAddressesPassedToRunSkipSeeds(self):
+        async def run():
+            selector = PeerSelector(FakeConnector(),targetPeers=3,raceFactor=1)
+            await selector.run(addresses(1,2),duration=0,display=False)
+            self.assertEqual(len(selector.connector.peers),2)
+            self.assertIsNone(selector.lastResolved)
+        with mock.patch('Lib.PeerSelector.resolveSeeds',side_effect=AssertionError('seeds resolved')):
+            with mock.patch.object(FakeConnector,'checkRequests',create=True,new=lambda self: asyncio.sleep(0)):
+                asyncio.run(run())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+### House Keeping ###
+# Name           - Warren Kavanagh
+
+## Description ##
+#   Tests for Lib/ScriptClassifier.py, classifying output scripts, the base58 and bech32/bech32m address codecs and matching outputs against a watch-list.
+#   The addresses are the test vectors of BIP173 and BIP350 and the address of the genesis block coinbase.
+#   Run from the top directory with: python -m unittest discover -s tests   (or python -m pytest tests)
+
+
+## Imports ##
+# os               - https://docs.python.org/3/library/os.html
+# struct           - https://docs.python.org/3/library/struct.html
+# tempfile         - https://docs.python.org/3/library/tempfile.html
+# unittest         - https://docs.python.org/3/library/unittest.html
+# ScriptClassifier - The functions and classes being tested, see Lib/ScriptClassifier.py
+# Transaction      - Parses the transactions checked by the ScriptWatcher, see Lib/Transaction.py
+import os
+import struct
+import tempfile
+import unittest
+from Lib.ScriptClassifier import (P2PKH,P2SH,P2WPKH,P2WSH,P2TR,P2PK,MULTISIG,OP_RETURN,WITNESS,NONSTANDARD,classifyScript,multisigKeys,createScript,
+                                  base58CheckEncode,base58CheckDecode,encodeAddress,decodeAddress,WatchList,ScriptWatcher)
+from Lib.Transaction import Transaction,createVarInt
+
+# ADDRESSES - (address, script type, program hex, network)
+ADDRESSES = [
+    ('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa',P2PKH,'62e907b15cbf27d5425399ebf6f0fb50ebb88f18','main'),
+    ('bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4',P2WPKH,'751e76e8199196d454941c45d1b3a323f1433bd6','main'),
+    ('tb1qw508d6qejxtdg4y5r3zarvary0c5xw7kxpjzsx',P2WPKH,'751e76e8199196d454941c45d1b3a323f1433bd6','test'),
+    ('bc1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3qccfmv3',P2WSH,'1863143c14c5166804bd19203356da136c985678cd4d27a1b8c6329604903262','main'),
+    ('bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqzk5jj0',P2TR,'79be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798','main'),
+]
+# KEY - A compressed public key, the generator point
+KEY = bytes.fromhex('0279be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798')
+
+def createTransactionWithScripts(scripts):
+    # A one input transaction with an output of 1000 Satoshis for each script
+    outputs = b''.join(struct.pack('<q',1000) + createVarInt(len(script)) + script for script in scripts)
+    return (struct.pack('<i',2) + b'\x01' + bytes(36) + b'\x00' + b'\xff\xff\xff\xff'
+            + createVarInt(len(scripts)) + outputs + b'\x00\x00\x00\x00')
+
+class ClassifyScriptTest(unittest.TestCase):
+    def testAddressTypes(self):
+        for scriptType in (P2PKH,P2SH,P2WPKH,P2WSH,P2TR,P2PK):
+            program = bytes(range(33 if scriptType == P2PK else 32 if scriptType in (P2WSH,P2TR) else 20))
+            script  = createScript(scriptType,program)
+            self.assertEqual(classifyScript(script),(scriptType,program),scriptType)
+
+    def testProgramIsNotCopied(self):
+        script = memoryview(createScript(P2WPKH,bytes(20)))
+        scriptType,program = classifyScript(script)
+        self.assertIsInstance(program,memoryview)
+        self.assertIs(program.obj,script.obj)
+
+    def testOtherScripts(self):
+        self.assertEqual(classifyScript(b'\x6a\x04abcd'),(OP_RETURN,b'\x04abcd'))
+        self.assertEqual(classifyScript(b'\x52\x02\xab\xcd'),(WITNESS,b'\xab\xcd'))
+        self.assertEqual(classifyScript(b''),(NONSTANDARD,None))
+        self.assertEqual(classifyScript(b'\x51\x87'),(NONSTANDARD,None))
+        # A 34 byte script which is not a witness program
+        self.assertEqual(classifyScript(b'\x00\x21' + bytes(32)),(NONSTANDARD,None))
+
+    def testMultisig(self):
+        otherKey = b'\x03' + bytes(range(32))
+        script = b'\x51\x21' + KEY + b'\x21' + otherKey + b'\x52\xae'
+        self.assertEqual(classifyScript(script),(MULTISIG,script))
+        required,keys = multisigKeys(script)
+        self.assertEqual((required,[bytes(key) for key in keys]),(1,[KEY,otherKey]))
+        # 2 of 1 is not valid
+        self.assertIsNone(multisigKeys(b'\x52\x21' + KEY + b'\x51\xae'))
+
+    def testCreateScriptRejectsWrongLength(self):
+        with self.assertRaises(ValueError):
+            createScript(P2WPKH,bytes(32))
+        with self.assertRaises(ValueError):
+            createScript(OP_RETURN,bytes(20))
+
+class AddressTest(unittest.TestCase):
+    def testEncode(self):
+        for address,scriptType,program,network in ADDRESSES:
+            self.assertEqual(encodeAddress(scriptType,bytes.fromhex(program),network),address)
+
+    def testDecode(self):
+        for address,scriptType,program,network in ADDRESSES:
+            self.assertEqual(decodeAddress(address),(scriptType,bytes.fromhex(program),network))
+        # bech32 addresses may be all upper case
+        self.assertEqual(decodeAddress(ADDRESSES[1][0].upper())[1],bytes.fromhex(ADDRESSES[1][2]))
+
+    def testNoAddress(self):
+        self.assertIsNone(encodeAddress(P2PK,KEY))
+        self.assertIsNone(encodeAddress(OP_RETURN,b'data'))
+
+    def testBadAddresses(self):
+        bad = [
+            # A character changed so the checksums do not match
+            '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNb',
+            'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t5',
+            # Mixed case
+            'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7KV8F3T4',
+            # 0 is not in the base58 alphabet, b is not in the bech32 alphabet
+            '0A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa',
+            'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3tb',
+            # A version 1 program with the version 0 (bech32) checksum, BIP350 requires bech32m
+            'bc1pw508d6qejxtdg4y5r3zarvary0c5xw7kw508d6qejxtdg4y5r3zarvary0c5xw7k7grplx',
+        ]
+        for address in bad:
+            with self.assertRaises(ValueError,msg=address):
+                decodeAddress(address)
+
+    def testBase58LeadingZeros(self):
+        encoded = base58CheckEncode(0,bytes(3) + b'\x01')
+        self.assertTrue(encoded.startswith('1111'))
+        self.assertEqual(base58CheckDecode(encoded),(0,bytes(3) + b'\x01'))
+
+class WatchListTest(unittest.TestCase):
+    def testAddressAndHexKeys(self):
+        for compact in (False,True):
+            watchList = WatchList(compact=compact)
+            watchList.addMany([(ADDRESSES[0][0],'genesis'),ADDRESSES[3][2],KEY])
+            self.assertEqual(len(watchList),3)
+            self.assertIn(bytes.fromhex(ADDRESSES[0][2]),watchList)
+            self.assertIn(memoryview(bytes.fromhex(ADDRESSES[3][2])),watchList)
+            self.assertIn(KEY,watchList)
+            self.assertNotIn(bytes(20),watchList)
+            self.assertEqual(watchList.labels[bytes.fromhex(ADDRESSES[0][2])],'genesis')
+
+    def testCompactKeepsLaterAdds(self):
+        watchList = WatchList(compact=True)
+        watchList.addMany([bytes([i])*20 for i in range(1,100)])
+        # Added after compact, it stays in the set until compact is called again
+        watchList.add(bytes(20))
+        self.assertIn(bytes(20),watchList)
+        watchList.compact()
+        self.assertIn(bytes(20),watchList)
+        self.assertEqual(len(watchList),100)
+
+    def testLoad(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory,'watch.txt')
+            with open(path,'w') as file:
+                file.write(f'# comment\n\n{ADDRESSES[1][0]} savings\n{ADDRESSES[4][0]},taproot\n')
+            watchList = WatchList.load(path)
+            self.assertEqual(watchList.labels,{bytes.fromhex(ADDRESSES[1][2]):'savings',bytes.fromhex(ADDRESSES[4][2]):'taproot'})
+            with open(path,'a') as file:
+                file.write('notanaddress\n')
+            with self.assertRaisesRegex(ValueError,'line 5'):
+                WatchList.load(path)
+
+    def testShortProgramRejected(self):
+        with self.assertRaises(ValueError):
+            WatchList().add(bytes(8))
+
+class ScriptWatcherTest(unittest.TestCase):
+    def testMatchingOutputs(self):
+        otherKey = b'\x03' + bytes(range(32))
+        scripts = [
+            createScript(P2WPKH,bytes.fromhex(ADDRESSES[1][2])),
+            createScript(P2PKH,bytes(range(20))),
+            b'\x6a\x14' + bytes.fromhex(ADDRESSES[1][2]),
+            b'\x51\x21' + otherKey + b'\x21' + KEY + b'\x52\xae',
+            createScript(P2TR,bytes.fromhex(ADDRESSES[4][2])),
+        ]
+        watchList = WatchList()
+        watchList.add(ADDRESSES[1][0],'savings')
+        watchList.add(KEY)
+        calls = []
+        watcher = ScriptWatcher(watchList,callback=lambda transaction,matches,block: calls.append(matches))
+        transaction = Transaction(createTransactionWithScripts(scripts))
+        expected = [(0,P2WPKH,bytes.fromhex(ADDRESSES[1][2]),'savings'),(3,MULTISIG,KEY,None)]
+        self.assertEqual(watcher.checkTransaction(transaction),expected)
+        # The OP_RETURN holding the same bytes is not a payment to the address
+        self.assertEqual(calls,[expected])
+        self.assertEqual((watcher.stats['transactions'],watcher.stats['outputs'],watcher.stats['matches']),(1,5,1))
+
+    def testNoMatchNoCallback(self):
+        calls = []
+        watcher = ScriptWatcher(WatchList(),callback=lambda *args: calls.append(args))
+        self.assertEqual(watcher.checkTransaction(Transaction(createTransactionWithScripts([createScript(P2SH,bytes(20))]))),[])
+        self.assertEqual(calls,[])
+
+if __name__ == '__main__':
+    unittest.main()